@@ -1,10 +1,15 @@
 from __future__ import annotations
 
-import json
-from dataclasses import dataclass
-from typing import Iterable, List, Mapping
+import asyncio
+import threading
+import weakref
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Mapping, Optional
 
-import requests
+from backend import aio_http
+from backend.async_bridge import iterate_in_executor
+from backend.http_pool import PoolConfig, PooledHTTP, PoolStats, abort_response
+from backend.sse import ChatStreamDecoder, json_dumps, json_loads
 
 
 Message = Mapping[str, str]
@@ -14,17 +19,191 @@ class AIClientError(RuntimeError):
     pass
 
 
+class GenerationCancelled(AIClientError):
+    """The caller cancelled the request (`CancelToken.cancel`); the stream stopped early on purpose."""
+
+    def __init__(self, reason: str = "cancelled"):
+        super().__init__(reason)
+
+
+class CancelToken:
+    """Thread-safe one-shot cancellation flag for one turn.
+
+    WS 处理方在用户点停止、断开连接或发来新消息时 `cancel()`；provider 在每个分片之间检查 `cancelled`，
+    并用 `add_callback` 注册“立即中断阻塞读”的动作（同步流关闭上游 socket），回调在 cancel 的线程里执行。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._reason: Optional[str] = None
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._reason is not None
+
+    @property
+    def reason(self) -> Optional[str]:
+        return self._reason
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """Cancel once and run the callbacks; False if it was already cancelled."""
+        with self._lock:
+            if self._reason is not None:
+                return False
+            self._reason = reason or "cancelled"
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn()
+        return True
+
+    def add_callback(self, fn: Callable[[], None]) -> Callable[[], None]:
+        """Run `fn` on cancel (right away if already cancelled); returns a function that unregisters it."""
+        with self._lock:
+            if self._reason is None:
+                self._callbacks.append(fn)
+                return lambda: self._discard(fn)
+        fn()
+        return lambda: None
+
+    def _discard(self, fn: Callable[[], None]) -> None:
+        with self._lock:
+            try:
+                self._callbacks.remove(fn)
+            except ValueError:
+                pass
+
+    def raise_if_cancelled(self) -> None:
+        if self._reason is not None:
+            raise GenerationCancelled(self._reason)
+
+
+@dataclass(frozen=True)
+class Usage:
+    """Token accounting the provider reported for one request."""
+
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # 命中上游 prompt 缓存的前缀 token 数；None = 上游没有返回这个字段
+    cached_tokens: Optional[int] = None
+
+    @property
+    def hit_ratio(self) -> Optional[float]:
+        if self.cached_tokens is None or self.prompt_tokens <= 0:
+            return None
+        return self.cached_tokens / self.prompt_tokens
+
+
+def _int_field(data: Mapping[str, Any], key: str) -> Optional[int]:
+    value = data.get(key)
+    return int(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def parse_usage(data: Any) -> Optional[Usage]:
+    """`usage` object of an OpenAI-compatible response -> Usage (None if absent / malformed).
+
+    缓存命中的字段各家不同：DeepSeek 是 `prompt_cache_hit_tokens`（另有 `prompt_cache_miss_tokens`），
+    OpenAI 兼容实现是 `prompt_tokens_details.cached_tokens`。
+    """
+    if not isinstance(data, Mapping):
+        return None
+    prompt = _int_field(data, "prompt_tokens")
+    completion = _int_field(data, "completion_tokens")
+    cached = _int_field(data, "prompt_cache_hit_tokens")
+    if cached is None:
+        details = data.get("prompt_tokens_details")
+        if isinstance(details, Mapping):
+            cached = _int_field(details, "cached_tokens")
+    if prompt is None:
+        miss = _int_field(data, "prompt_cache_miss_tokens")
+        if cached is not None and miss is not None:
+            prompt = cached + miss
+    if prompt is None and completion is None:
+        return None
+    return Usage(prompt_tokens=prompt or 0, completion_tokens=completion or 0, cached_tokens=cached)
+
+
+@dataclass
+class RequestOptions:
+    """Per-request knobs understood by wrapper clients; providers ignore what they don't use."""
+
+    session_id: str = ""
+    # 跳过回复缓存（既不读也不写）
+    bypass_cache: bool = False
+    # 取消这一轮：流式 provider 停止读取并关闭上游连接，抛出 GenerationCancelled
+    cancel: Optional[CancelToken] = None
+    # 上游返回 usage 时回调（请求结束后、在 provider 所在的线程 / 事件循环里调用）；命中回复缓存时不会调用
+    on_usage: Optional[Callable[[Usage], None]] = None
+
+
+def cancel_token(options: Optional[RequestOptions]) -> Optional[CancelToken]:
+    return options.cancel if options is not None else None
+
+
+async def aclose_stream(stream: AsyncIterator[str]) -> None:
+    """Close an async chunk stream right away (async generators are otherwise closed lazily)."""
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+# 滚动摘要的长度上限（字）；模型版本写进指令里，占位版本直接截断
+SUMMARY_MAX_CHARS = 800
+
+_SUMMARY_INSTRUCTION = (
+    "你是对话摘要助手。把“已有摘要”和“新增对话”合并成一份新的摘要，供后续对话作为上下文使用。"
+    "保留用户的身份信息、偏好、已经做出的决定、仍未解决的问题和关键事实，不要编造，不要评论，"
+    f"只输出摘要正文，不超过 {SUMMARY_MAX_CHARS} 字。"
+)
+
+
+def _transcript(messages: List[Message]) -> List[str]:
+    return [f"{'用户' if m.get('role') == 'user' else 'AI'}：{m.get('content', '')}" for m in messages]
+
+
 class BaseAIClient:
-    def generate(self, messages: List[Message]) -> str:
+    def generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
         raise NotImplementedError
 
-    def stream_generate(self, messages: List[Message]) -> Iterable[str]:
+    def stream_generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> Iterable[str]:
         raise NotImplementedError
 
+    async def agenerate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        # 默认实现：同步 generate 丢到事件循环的默认线程池；原生异步的 client 应覆盖
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.generate, list(messages), options)
+
+    def astream_generate(
+        self, messages: List[Message], options: Optional[RequestOptions] = None
+    ) -> AsyncIterator[str]:
+        # 默认实现：在线程池里驱动同步 stream_generate；原生异步的 client 应覆盖
+        return iterate_in_executor(lambda: self.stream_generate(messages, options))
+
+    def summarize(self, previous: str, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        """Fold `messages` into the rolling summary `previous` and return the new summary."""
+        parts = []
+        if previous:
+            parts.append("已有摘要：\n" + previous)
+        parts.append("新增对话：\n" + "\n".join(_transcript(messages)))
+        prompt = [
+            {"role": "system", "content": _SUMMARY_INSTRUCTION},
+            {"role": "user", "content": "\n\n".join(parts)},
+        ]
+        return self.generate(prompt, options)
+
+    def warm_up(self) -> None:
+        """Optionally open upstream connections before the first turn."""
+
+    async def awarm_up(self) -> None:
+        """Async counterpart of `warm_up` for the current event loop."""
+
+    def pool_stats(self) -> Dict[str, int]:
+        return {}
+
 
 @dataclass
 class PlaceholderClient(BaseAIClient):
-    def generate(self, messages: List[Message]) -> str:
+    def generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
         last_user = ""
         for msg in reversed(messages):
             if msg.get("role") == "user":
@@ -39,12 +218,36 @@ class PlaceholderClient(BaseAIClient):
             "要让 AI 真正回答：请在 `.env` 里设置 `AI_PROVIDER=deepseek` 并填入 `DEEPSEEK_API_KEY`，然后重启后端。"
         )
 
-    def stream_generate(self, messages: List[Message]) -> Iterable[str]:
+    def stream_generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> Iterable[str]:
         text = self.generate(messages)
+        token = cancel_token(options)
         # 简单按字符流式输出，前端能立刻看到“流式效果”
         for ch in text:
+            if token is not None:
+                token.raise_if_cancelled()
             yield ch
 
+    async def agenerate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        return self.generate(messages)
+
+    async def astream_generate(
+        self, messages: List[Message], options: Optional[RequestOptions] = None
+    ) -> AsyncIterator[str]:
+        token = cancel_token(options)
+        for ch in self.generate(messages):
+            if token is not None:
+                token.raise_if_cancelled()
+            yield ch
+
+    def summarize(self, previous: str, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        # 确定性的抽取式摘要（每条消息压成一行），便于在没有模型的环境里测试压缩流程
+        lines = previous.splitlines() if previous else []
+        for line in _transcript(messages):
+            line = " ".join(line.split())
+            lines.append(line if len(line) <= 60 else line[:60] + "…")
+        text = "\n".join(lines)
+        return text if len(text) <= SUMMARY_MAX_CHARS else "…" + text[-(SUMMARY_MAX_CHARS - 1) :]
+
 
 @dataclass
 class DeepseekClient(BaseAIClient):
@@ -53,25 +256,101 @@ class DeepseekClient(BaseAIClient):
     model: str
     temperature: float = 0.7
     timeout_seconds: int = 30
+    pool_config: PoolConfig = field(default_factory=PoolConfig)
+    # 流式请求带上 stream_options.include_usage，让上游在最后一个事件里返回 usage（含缓存命中数）
+    stream_usage: bool = True
 
-    def generate(self, messages: List[Message]) -> str:
-        if not self.api_key:
-            raise AIClientError("missing_api_key")
+    # 长连接池：同步侧是线程安全的 requests.Session（Flask 线程与 WS 线程共用），
+    # asyncio 侧按事件循环各建一个池；两边共用同一组计数器
+    _stats: PoolStats = field(init=False, repr=False)
+    _http: PooledHTTP = field(init=False, repr=False)
+    _async_pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aio_http.AsyncConnectionPool]" = field(
+        init=False, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        self._stats = PoolStats()
+        self._http = PooledHTTP(self.pool_config, self._stats)
+        self._async_pools = weakref.WeakKeyDictionary()
+
+    def _async_pool(self) -> aio_http.AsyncConnectionPool:
+        loop = asyncio.get_running_loop()
+        pool = self._async_pools.get(loop)
+        if pool is None:
+            pool = aio_http.AsyncConnectionPool(
+                maxsize_per_host=self.pool_config.pool_maxsize,
+                idle_seconds=self.pool_config.idle_seconds,
+                block=self.pool_config.pool_block,
+                stats=self._stats,
+            )
+            self._async_pools[loop] = pool
+        return pool
+
+    def warm_up(self) -> None:
+        # 不预热连接时也要调用：会建好 requests.Session（requests 是在这里才导入的）
+        self._http.warm_up(self._url(), timeout=self.timeout_seconds)
+        if self._url().startswith("https:"):
+            # 在事件循环之外先建好 asyncio 侧共用的 SSLContext
+            aio_http.default_ssl_context()
+
+    async def awarm_up(self) -> None:
+        if self.pool_config.warmup_connections > 0:
+            await self._async_pool().warm_up(
+                self._url(), self.pool_config.warmup_connections, connect_timeout=self.timeout_seconds
+            )
+
+    def pool_stats(self) -> Dict[str, int]:
+        return self._stats.snapshot()
 
-        url = self.base_url.rstrip("/") + "/chat/completions"
-        headers = {
+    def _url(self) -> str:
+        return self.base_url.rstrip("/") + "/chat/completions"
+
+    def _headers(self) -> dict:
+        return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
         }
+
+    def _body(self, messages: List[Message], *, stream: bool) -> bytes:
         payload = {
             "model": self.model,
             "messages": list(messages),
             "temperature": self.temperature,
-            "stream": False,
+            "stream": stream,
         }
+        if stream and self.stream_usage:
+            payload["stream_options"] = {"include_usage": True}
+        return json_dumps(payload)
+
+    @staticmethod
+    def _report_usage(data: Any, options: Optional[RequestOptions]) -> None:
+        if options is None or options.on_usage is None:
+            return
+        usage = parse_usage(data)
+        if usage is not None:
+            options.on_usage(usage)
+
+    @staticmethod
+    def _reply_from_json(data: object) -> str:
+        try:
+            return (data["choices"][0]["message"]["content"] or "").strip()  # type: ignore[index]
+        except Exception as e:
+            raise AIClientError("bad_response_shape") from e
+
+    def generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        # 同步通道才用 requests：延迟到第一次请求（或 warm_up）时导入，见 backend/http_pool.py
+        import requests
+
+        if not self.api_key:
+            raise AIClientError("missing_api_key")
 
         try:
-            resp = requests.post(url, headers=headers, data=json.dumps(payload), timeout=self.timeout_seconds)
+            resp = self._http.post(
+                self._url(),
+                headers=self._headers(),
+                data=self._body(messages, stream=False),
+                timeout=self.timeout_seconds,
+            )
         except requests.RequestException as e:
             raise AIClientError("network_error") from e
 
@@ -79,36 +358,28 @@ class DeepseekClient(BaseAIClient):
             raise AIClientError(f"http_{resp.status_code}")
 
         try:
-            data = resp.json()
+            data = json_loads(resp.content)
         except ValueError as e:
             raise AIClientError("invalid_json") from e
 
-        try:
-            return (data["choices"][0]["message"]["content"] or "").strip()
-        except Exception as e:
-            raise AIClientError("bad_response_shape") from e
+        reply = self._reply_from_json(data)
+        self._report_usage(data.get("usage") if isinstance(data, dict) else None, options)
+        return reply
+
+    def stream_generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> Iterable[str]:
+        import requests
 
-    def stream_generate(self, messages: List[Message]) -> Iterable[str]:
         if not self.api_key:
             raise AIClientError("missing_api_key")
-
-        url = self.base_url.rstrip("/") + "/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "model": self.model,
-            "messages": list(messages),
-            "temperature": self.temperature,
-            "stream": True,
-        }
+        token = cancel_token(options)
+        if token is not None:
+            token.raise_if_cancelled()
 
         try:
-            resp = requests.post(
-                url,
-                headers=headers,
-                data=json.dumps(payload),
+            resp = self._http.post(
+                self._url(),
+                headers=self._headers(),
+                data=self._body(messages, stream=True),
                 timeout=self.timeout_seconds,
                 stream=True,
             )
@@ -116,39 +387,119 @@ class DeepseekClient(BaseAIClient):
             raise AIClientError("network_error") from e
 
         if resp.status_code >= 400:
+            resp.close()
             raise AIClientError(f"http_{resp.status_code}")
 
-        # OpenAI compatible: Server-Sent Events
-        for line in resp.iter_lines(decode_unicode=True):
-            if not line:
-                continue
-            if isinstance(line, bytes):
-                try:
-                    line = line.decode("utf-8", errors="ignore")
-                except Exception:
-                    continue
+        # OpenAI compatible: Server-Sent Events。直接按字节增量解析：不依赖响应头里的 charset，
+        # 被分块切断的 UTF-8 字符也会等到完整后再解码
+        decoder = ChatStreamDecoder()
+        # 取消时从别的线程关掉 socket：本线程可能正阻塞在读上（上游还没吐下一个字）
+        unregister = token.add_callback(lambda: abort_response(resp)) if token is not None else None
+        try:
+            chunks = resp.iter_content(chunk_size=None)
+            for data in chunks:
+                if token is not None:
+                    token.raise_if_cancelled()
+                contents, done = decoder.feed(data)
+                yield from contents
+                if done:
+                    # 把 [DONE] 之后的剩余 body 读完，连接才能回到池里复用
+                    for _ in chunks:
+                        pass
+                    break
+            else:
+                if token is not None:
+                    # socket 被关掉后 iter_content 可能只是提前结束
+                    token.raise_if_cancelled()
+                contents, done = decoder.flush()
+                yield from contents
+                if not done:
+                    # body 在 [DONE] 之前就结束了（上游或中间代理断流）：回复不完整，不能当作成功
+                    raise AIClientError("stream_incomplete")
+            self._report_usage(decoder.usage, options)
+        except (requests.RequestException, OSError) as e:
+            if token is not None:
+                token.raise_if_cancelled()
+            raise AIClientError("network_error") from e
+        finally:
+            if unregister is not None:
+                unregister()
+            # 读到一半关闭：urllib3 会丢弃这条连接而不是放回池里
+            resp.close()
 
-            line = line.strip()
-            if not line.startswith("data:"):
-                continue
+    async def _arequest(self, messages: List[Message], *, stream: bool) -> aio_http.AsyncHTTPResponse:
+        try:
+            resp = await aio_http.request(
+                "POST",
+                self._url(),
+                headers=self._headers(),
+                body=self._body(messages, stream=stream),
+                connect_timeout=self.timeout_seconds,
+                read_timeout=self.timeout_seconds,
+                pool=self._async_pool(),
+            )
+        except (OSError, asyncio.TimeoutError, aio_http.AsyncHTTPError) as e:
+            raise AIClientError("network_error") from e
 
-            data_part = line[len("data:") :].strip()
-            if data_part == "[DONE]":
-                break
+        if resp.status >= 400:
+            await resp.aclose()
+            raise AIClientError(f"http_{resp.status}")
+        return resp
 
-            try:
-                data = json.loads(data_part)
-            except ValueError:
-                continue
+    async def agenerate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        if not self.api_key:
+            raise AIClientError("missing_api_key")
 
-            try:
-                choice0 = data.get("choices", [{}])[0]
-                delta = choice0.get("delta", {}) or {}
-                content = delta.get("content")
-                if content:
-                    yield str(content)
-            except Exception:
-                continue
+        resp = await self._arequest(messages, stream=False)
+        try:
+            raw = await resp.read()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, aio_http.AsyncHTTPError) as e:
+            raise AIClientError("network_error") from e
+        finally:
+            await resp.aclose()
+
+        try:
+            data = json_loads(raw)
+        except ValueError as e:
+            raise AIClientError("invalid_json") from e
+
+        reply = self._reply_from_json(data)
+        self._report_usage(data.get("usage") if isinstance(data, dict) else None, options)
+        return reply
+
+    async def astream_generate(
+        self, messages: List[Message], options: Optional[RequestOptions] = None
+    ) -> AsyncIterator[str]:
+        if not self.api_key:
+            raise AIClientError("missing_api_key")
+
+        token = cancel_token(options)
+        if token is not None:
+            token.raise_if_cancelled()
+        resp = await self._arequest(messages, stream=True)
+        decoder = ChatStreamDecoder()
+        try:
+            async for data in resp.iter_chunks():
+                if token is not None:
+                    # 阻塞中的读由调用方 task.cancel() 打断；这里在分片之间检查
+                    token.raise_if_cancelled()
+                if decoder.done:
+                    # [DONE] 之后继续把 body 读完，连接才能回到池里复用
+                    continue
+                contents, _done = decoder.feed(data)
+                for content in contents:
+                    yield content
+            contents, done = decoder.flush()
+            for content in contents:
+                yield content
+            if not done:
+                # body 在 [DONE] 之前就结束了（上游或中间代理断流）：回复不完整，不能当作成功
+                raise AIClientError("stream_incomplete")
+            self._report_usage(decoder.usage, options)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, aio_http.AsyncHTTPError) as e:
+            raise AIClientError("network_error") from e
+        finally:
+            await resp.aclose()
 
 
 def build_client(
@@ -159,6 +510,8 @@ def build_client(
     model: str,
     temperature: float,
     timeout_seconds: int,
+    pool_config: Optional[PoolConfig] = None,
+    stream_usage: bool = True,
 ) -> BaseAIClient:
     provider = (provider or "placeholder").strip().lower()
     if provider in {"deepseek", "deepseek_api"}:
@@ -168,5 +521,7 @@ def build_client(
             model=model,
             temperature=temperature,
             timeout_seconds=timeout_seconds,
+            pool_config=pool_config or PoolConfig(),
+            stream_usage=stream_usage,
         )
     return PlaceholderClient()
@@ -0,0 +1,371 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import ssl
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Mapping, Optional, Tuple
+from urllib.parse import urlsplit
+
+from backend.http_pool import PoolStats
+from backend.metrics import UPSTREAM_CONNECT_SECONDS
+
+
+_PoolKey = Tuple[str, str, int]
+
+
+class AsyncHTTPError(Exception):
+    """Protocol-level failure (malformed status line, bad chunk framing, ...)."""
+
+
+@functools.lru_cache(maxsize=None)
+def default_ssl_context() -> ssl.SSLContext:
+    """Client SSLContext shared by every https request that is not given one.
+
+    创建 SSLContext 要加载系统 CA 证书（几十毫秒，同步执行），在事件循环里每个请求建一次会卡住所有连接；
+    进程内只建一次。
+    """
+    return ssl.create_default_context()
+
+
+def _split_url(url: str) -> Tuple[str, str, int, str]:
+    parts = urlsplit(url)
+    scheme = (parts.scheme or "http").lower()
+    if scheme not in {"http", "https"}:
+        raise AsyncHTTPError(f"unsupported_scheme:{scheme}")
+    host = parts.hostname or ""
+    if not host:
+        raise AsyncHTTPError("missing_host")
+    port = parts.port or (443 if scheme == "https" else 80)
+    target = parts.path or "/"
+    if parts.query:
+        target += "?" + parts.query
+    return scheme, host, port, target
+
+
+async def _open(
+    host: str, port: int, ssl_context: Optional[ssl.SSLContext], connect_timeout: Optional[float]
+) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    t0 = time.perf_counter()
+    opening = asyncio.open_connection(host, port, ssl=ssl_context, server_hostname=host if ssl_context else None)
+    if connect_timeout is not None:
+        reader, writer = await asyncio.wait_for(opening, timeout=connect_timeout)
+    else:
+        reader, writer = await opening
+    UPSTREAM_CONNECT_SECONDS.observe(time.perf_counter() - t0, "async")
+    return reader, writer
+
+
+class AsyncConnectionPool:
+    """Keep-alive connections for one event loop, with a per-host limit and idle expiry."""
+
+    def __init__(
+        self,
+        *,
+        maxsize_per_host: int = 16,
+        idle_seconds: float = 60.0,
+        block: bool = False,
+        stats: Optional[PoolStats] = None,
+        ssl_context: Optional[ssl.SSLContext] = None,
+    ):
+        self.maxsize_per_host = max(1, int(maxsize_per_host))
+        # https 连接（新建、预热）共用的 SSLContext；不给时用进程级默认的那一个
+        self.ssl_context = ssl_context
+        self.idle_seconds = float(idle_seconds)
+        self.block = bool(block)
+        self.stats = stats or PoolStats()
+        self._idle: Dict[_PoolKey, List[Tuple[asyncio.StreamReader, asyncio.StreamWriter, float]]] = {}
+        self._active: Dict[_PoolKey, int] = {}
+        self._waiters: Dict[_PoolKey, Deque["asyncio.Future[None]"]] = {}
+
+    def _pop_idle(self, key: _PoolKey) -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+        idle = self._idle.get(key) or []
+        now = time.monotonic()
+        while idle:
+            reader, writer, since = idle.pop()
+            expired = self.idle_seconds > 0 and now - since > self.idle_seconds
+            if expired or reader.at_eof() or writer.is_closing():
+                if expired:
+                    self.stats.incr("expired_connections")
+                writer.close()
+                continue
+            return reader, writer
+        return None
+
+    async def acquire(
+        self,
+        key: _PoolKey,
+        *,
+        ssl_context: Optional[ssl.SSLContext],
+        connect_timeout: Optional[float],
+        fresh: bool = False,
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        """Return (reader, writer, reused); `fresh=True` skips idle connections."""
+        self.stats.incr("requests")
+        if not fresh:
+            conn = self._pop_idle(key)
+            if conn is not None:
+                self._active[key] = self._active.get(key, 0) + 1
+                self.stats.incr("reused_connections")
+                return conn[0], conn[1], True
+
+        if self._active.get(key, 0) >= self.maxsize_per_host:
+            self.stats.incr("saturated")
+            if self.block:
+                while self._active.get(key, 0) >= self.maxsize_per_host:
+                    fut = asyncio.get_running_loop().create_future()
+                    self._waiters.setdefault(key, deque()).append(fut)
+                    await fut
+                    conn = self._pop_idle(key)
+                    if conn is not None and not fresh:
+                        self._active[key] = self._active.get(key, 0) + 1
+                        self.stats.incr("reused_connections")
+                        return conn[0], conn[1], True
+
+        _scheme, host, port = key
+        self._active[key] = self._active.get(key, 0) + 1
+        try:
+            reader, writer = await _open(host, port, ssl_context, connect_timeout)
+        except BaseException:
+            self._release_slot(key)
+            raise
+        self.stats.incr("new_connections")
+        return reader, writer, False
+
+    def release(self, key: _PoolKey, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, reusable: bool) -> None:
+        idle = self._idle.setdefault(key, [])
+        if reusable and not writer.is_closing() and len(idle) < self.maxsize_per_host:
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        self._release_slot(key)
+
+    def _release_slot(self, key: _PoolKey) -> None:
+        self._active[key] = max(0, self._active.get(key, 0) - 1)
+        waiters = self._waiters.get(key)
+        while waiters:
+            fut = waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                break
+
+    async def warm_up(self, url: str, n: int, *, connect_timeout: Optional[float] = None) -> int:
+        scheme, host, port, _target = _split_url(url)
+        key = (scheme, host, port)
+        ctx = (self.ssl_context or default_ssl_context()) if scheme == "https" else None
+        opened = 0
+        for _ in range(min(max(0, int(n)), self.maxsize_per_host)):
+            try:
+                reader, writer, _reused = await self.acquire(
+                    key, ssl_context=ctx, connect_timeout=connect_timeout, fresh=True
+                )
+            except (OSError, asyncio.TimeoutError):
+                break
+            self.release(key, reader, writer, True)
+            opened += 1
+        # 预热不计入业务请求数
+        self.stats.incr("requests", -opened)
+        self.stats.incr("new_connections", -opened)
+        return opened
+
+    def close(self) -> None:
+        for idle in self._idle.values():
+            for _reader, writer, _since in idle:
+                writer.close()
+        self._idle.clear()
+
+
+class AsyncHTTPResponse:
+    """A response whose body is read lazily from the socket."""
+
+    def __init__(
+        self,
+        *,
+        status: int,
+        headers: Dict[str, str],
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        read_timeout: Optional[float],
+        pool: Optional[AsyncConnectionPool] = None,
+        pool_key: Optional[_PoolKey] = None,
+    ):
+        self.status = status
+        self.headers = headers
+        self._reader = reader
+        self._writer = writer
+        self._read_timeout = read_timeout
+        self._closed = False
+        self._pool = pool
+        self._pool_key = pool_key
+        # 只有把 body 完整读完、且服务端没要求关闭时，连接才能放回池子复用
+        self._complete = False
+
+    async def _read(self, coro):
+        if self._read_timeout is None:
+            return await coro
+        return await asyncio.wait_for(coro, timeout=self._read_timeout)
+
+    async def iter_chunks(self, chunk_size: int = 16384) -> AsyncIterator[bytes]:
+        """Yield raw body bytes as they arrive (chunked / content-length / until EOF)."""
+        te = self.headers.get("transfer-encoding", "").lower()
+        if "chunked" in te:
+            while True:
+                size_line = await self._read(self._reader.readline())
+                if not size_line:
+                    raise AsyncHTTPError("truncated_chunked_body")
+                try:
+                    size = int(size_line.split(b";", 1)[0].strip(), 16)
+                except ValueError as e:
+                    raise AsyncHTTPError("bad_chunk_size") from e
+                if size == 0:
+                    # trailers
+                    while True:
+                        line = await self._read(self._reader.readline())
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                    self._complete = True
+                    return
+                data = await self._read(self._reader.readexactly(size))
+                await self._read(self._reader.readline())
+                yield data
+            return
+
+        length = self.headers.get("content-length")
+        if length is not None:
+            try:
+                remaining = int(length)
+            except ValueError as e:
+                raise AsyncHTTPError("bad_content_length") from e
+            while remaining > 0:
+                data = await self._read(self._reader.read(min(chunk_size, remaining)))
+                if not data:
+                    raise AsyncHTTPError("truncated_body")
+                remaining -= len(data)
+                yield data
+            self._complete = True
+            return
+
+        while True:
+            data = await self._read(self._reader.read(chunk_size))
+            if not data:
+                return
+            yield data
+
+    async def read(self) -> bytes:
+        parts = []
+        async for data in self.iter_chunks():
+            parts.append(data)
+        return b"".join(parts)
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._pool is not None and self._pool_key is not None:
+            reusable = self._complete and self.headers.get("connection", "").lower() != "close"
+            self._pool.release(self._pool_key, self._reader, self._writer, reusable)
+            return
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def request(
+    method: str,
+    url: str,
+    *,
+    headers: Optional[Mapping[str, str]] = None,
+    body: bytes = b"",
+    connect_timeout: Optional[float] = None,
+    read_timeout: Optional[float] = None,
+    ssl_context: Optional[ssl.SSLContext] = None,
+    pool: Optional[AsyncConnectionPool] = None,
+) -> AsyncHTTPResponse:
+    """Send one HTTP/1.1 request and return once the status line and headers are in.
+
+    With `pool`, the connection is kept alive and returned to the pool by `aclose()`.
+    """
+    scheme, host, port, target = _split_url(url)
+    key: _PoolKey = (scheme, host, port)
+
+    ctx: Optional[ssl.SSLContext] = None
+    if scheme == "https":
+        ctx = ssl_context or (pool.ssl_context if pool is not None else None) or default_ssl_context()
+
+    host_header = host if port in (80, 443) else f"{host}:{port}"
+    lines = [f"{method.upper()} {target} HTTP/1.1", f"Host: {host_header}"]
+    sent = {"host"}
+    for k, v in (headers or {}).items():
+        lines.append(f"{k}: {v}")
+        sent.add(k.lower())
+    if "content-length" not in sent:
+        lines.append(f"Content-Length: {len(body)}")
+    if "connection" not in sent:
+        lines.append("Connection: keep-alive" if pool is not None else "Connection: close")
+    head = ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+    async def read_head(reader: asyncio.StreamReader) -> Tuple[int, Dict[str, str]]:
+        status_line = await reader.readline()
+        parts = status_line.decode("latin-1").split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise AsyncHTTPError("bad_status_line")
+        try:
+            status = int(parts[1])
+        except ValueError as e:
+            raise AsyncHTTPError("bad_status_line") from e
+        resp_headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            resp_headers[name.strip().lower()] = value.strip()
+        return status, resp_headers
+
+    fresh = False
+    while True:
+        if pool is not None:
+            reader, writer, reused = await pool.acquire(
+                key, ssl_context=ctx, connect_timeout=connect_timeout, fresh=fresh
+            )
+        else:
+            reader, writer = await _open(host, port, ctx, connect_timeout)
+            reused = False
+
+        try:
+            writer.write(head + body)
+            await writer.drain()
+            if read_timeout is not None:
+                status, resp_headers = await asyncio.wait_for(read_head(reader), timeout=read_timeout)
+            else:
+                status, resp_headers = await read_head(reader)
+        except (OSError, AsyncHTTPError) as e:
+            if pool is not None:
+                pool.release(key, reader, writer, False)
+            else:
+                writer.close()
+            # 复用的长连接可能已被对端悄悄关闭：换一条新连接重试一次
+            if reused and not fresh:
+                fresh = True
+                continue
+            raise e
+        except BaseException:
+            if pool is not None:
+                pool.release(key, reader, writer, False)
+            else:
+                writer.close()
+            raise
+        break
+
+    return AsyncHTTPResponse(
+        status=status,
+        headers=resp_headers,
+        reader=reader,
+        writer=writer,
+        read_timeout=read_timeout,
+        pool=pool,
+        pool_key=key if pool is not None else None,
+    )
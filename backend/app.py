@@ -1,22 +1,16 @@
 from __future__ import annotations
 
+import dataclasses
 import json
+import os
+import queue
+import re
 import sys
+import threading
 from pathlib import Path
-from typing import Any
+from typing import Any, Dict, Optional
 
-from flask import Flask, jsonify, request, send_from_directory
-
-try:
-    from flask_sock import Sock
-except ModuleNotFoundError:  # pragma: no cover
-    Sock = None
-
-try:
-    from dotenv import load_dotenv
-except ModuleNotFoundError:  # pragma: no cover
-    def load_dotenv(*_args, **_kwargs):
-        return False
+from flask import Blueprint, Flask, Response, current_app, jsonify, request, send_from_directory, stream_with_context
 
 CURRENT_DIR = Path(__file__).resolve().parent
 PROJECT_ROOT = CURRENT_DIR.parent
@@ -25,45 +19,36 @@ if str(PROJECT_ROOT) not in sys.path:
 BASE_DIR = Path(__file__).resolve().parent.parent
 FRONTEND_DIR = BASE_DIR / "frontend"
 
-# Prefer `.env`; fallback to `.env.example` to reduce beginner friction.
-if callable(load_dotenv):
-    loaded = load_dotenv(BASE_DIR / ".env")
-    if not loaded:
-        load_dotenv(BASE_DIR / ".env.example")
-
-from backend.ai_client import build_client
-from backend.chat_service import ChatService
-from backend.config import Settings
-from backend.storage_sqlite import SQLiteStore
-from backend.ws_async_server import start_ws_server_in_thread
-
-settings = Settings()
-
-store = SQLiteStore(settings.db_path)
-
-ai_client = build_client(
-    settings.ai_provider,
-    base_url=settings.ai_base_url,
-    api_key=settings.deepseek_api_key,
-    model=settings.ai_model,
-    temperature=settings.ai_temperature,
-    timeout_seconds=settings.ai_timeout_seconds,
+from backend.config import Settings, load_env
+from backend.metrics import CONTENT_TYPE, GENERATIONS_IN_FLIGHT, REGISTRY, WS_CONNECTIONS
+from backend.replay import ReplayStream
+from backend.retention import iter_with_archive, merge_archived_page
+from backend.scheduler import SchedulerRejected
+from backend.search import SearchError
+from backend.services import Services, build_services
+from backend.streaming import (
+    STREAM_STATS,
+    ActiveTurn,
+    DeltaCoalescer,
+    assistant_message_frame,
+    assistant_start_frame,
+    delta_frame_encoder,
+    error_frame,
+    iter_coalesced,
 )
 
-chat_service = ChatService(
-    ai_client=ai_client,
-    store=store,
-    default_system_prompt=settings.system_prompt,
-    max_history_messages=settings.max_history_messages,
-)
+bp = Blueprint("aichat", __name__)
 
-app = Flask(
-    __name__,
-    static_folder=str(FRONTEND_DIR),
-    static_url_path="",
-)
 
-sock = Sock(app) if Sock is not None else None
+# /api/session 单页上限：前端向上滚动时按页加载更早的消息
+_SESSION_PAGE_MAX = 500
+# /api/search 每页上限与可翻到的最大偏移（按相关度排序只能用 OFFSET，限制深翻页的代价）
+_SEARCH_PAGE_MAX = 50
+_SEARCH_MAX_OFFSET = 1000
+
+
+def _safe_filename(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)[:80] or "session"
 
 
 def _normalize_session_id(maybe_session_id: Any) -> str:
@@ -72,32 +57,126 @@ def _normalize_session_id(maybe_session_id: Any) -> str:
     return ""
 
 
-@app.get("/")
+def _services() -> Services:
+    return current_app.extensions["aichat"]
+
+
+@bp.get("/")
 def index():
     return send_from_directory(str(FRONTEND_DIR), "index.html")
 
 
-@app.post("/api/chat")
+@bp.post("/api/chat")
 def api_chat():
     payload = request.get_json(silent=True) or {}
     message = payload.get("message", "")
     session_id = _normalize_session_id(payload.get("session_id"))
     system_prompt = payload.get("system_prompt")
+    no_cache = bool(payload.get("no_cache", False))
 
     if system_prompt is not None:
         system_prompt = str(system_prompt)
 
-    result = chat_service.handle_user_message(session_id=session_id, content=str(message), system_prompt=system_prompt)
+    try:
+        with GENERATIONS_IN_FLIGHT.track("http"):
+            result = _services().chat_service.handle_user_message(
+                session_id=session_id,
+                content=str(message),
+                system_prompt=system_prompt,
+                bypass_cache=no_cache,
+                client_id=request.remote_addr or "",
+            )
+    except SchedulerRejected as e:
+        # 这一轮没有落任何记录，客户端按 Retry-After 原样重发即可
+        resp = jsonify({"error": e.reason, "retry_after": e.retry_after, "session_id": session_id})
+        resp.headers["Retry-After"] = str(e.retry_after)
+        return resp, 429
     return jsonify({"session_id": result.session_id, "reply": result.reply})
 
 
-@app.get("/api/config")
+def _sse_event(frame: str) -> str:
+    # 帧与 WS 上的完全相同（单行 JSON），每帧一个 SSE data 事件
+    return "data: " + frame + "\n\n"
+
+
+@bp.post("/api/chat/stream")
+def api_chat_stream():
+    """Streamed `/api/chat` over Server-Sent Events, for clients that cannot open a WebSocket.
+
+    事件与 WS 流式回复相同：`assistant_start`、若干 `assistant_delta`、最后一个 `assistant_message`；
+    调度器拒绝时是带 retry_after 的 `error`。客户端断开（WSGI 服务器写失败后关闭本响应）按 disconnect
+    取消上游，已生成的部分按截断落库。没有 message_id / 续传：断开就是取消。
+    """
+    payload = request.get_json(silent=True) or {}
+    services = _services()
+    chat_service, settings = services.chat_service, services.settings
+    session_id = _normalize_session_id(payload.get("session_id")) or chat_service.new_session_id()
+    system_prompt = payload.get("system_prompt")
+    if system_prompt is not None:
+        system_prompt = str(system_prompt)
+
+    turn = ActiveTurn()
+    coalescer = DeltaCoalescer(window_ms=settings.ws_delta_window_ms, max_bytes=settings.ws_delta_max_bytes)
+    frames = iter_coalesced(
+        chat_service.stream_user_message(
+            session_id=session_id,
+            content=str(payload.get("message", "")),
+            system_prompt=system_prompt,
+            bypass_cache=bool(payload.get("no_cache", False)),
+            cancel=turn.token,
+            client_id=request.remote_addr or "",
+        ),
+        coalescer,
+        services.stream_pumps,
+    )
+    encode = delta_frame_encoder(session_id)
+
+    def events():
+        rejected: Optional[SchedulerRejected] = None
+        GENERATIONS_IN_FLIGHT.inc("http_sse")
+        try:
+            # 先发一帧：响应头和代理缓冲立即刷出，客户端也能马上显示“停止”
+            yield _sse_event(assistant_start_frame(session_id, ""))
+            for frame in frames:
+                yield _sse_event(encode(frame))
+        except SchedulerRejected as e:
+            rejected = e
+        except GeneratorExit:
+            turn.cancel("disconnect")
+            raise
+        finally:
+            frames.close()
+            coalescer.finish()
+            GENERATIONS_IN_FLIGHT.dec("http_sse")
+            truncated = turn.finish()
+            if rejected is None:
+                chat_service.finish_streamed_reply(session_id, coalescer.text(), turn.token)
+        if rejected is not None:
+            yield _sse_event(error_frame(session_id, rejected.reason, retry_after=rejected.retry_after))
+            return
+        yield _sse_event(assistant_message_frame(session_id, coalescer.text(), truncated=truncated))
+
+    resp = Response(events(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    # nginx 默认缓冲上游响应，会把逐字输出攒成一整块
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+@bp.get("/api/config")
 def api_config():
-    return jsonify({"ws_port": settings.ws_port, "ws_path": "/ws"})
+    settings = _services().settings
+    cfg = {"ws_port": settings.ws_port, "ws_path": "/ws"}
+    # 反向代理 / 多进程部署时给前端一个固定地址，不再由浏览器按 hostname:ws_port 拼
+    if settings.ws_public_url:
+        cfg["ws_url"] = settings.ws_public_url
+    return jsonify(cfg)
 
 
-@app.get("/api/health")
+@bp.get("/api/health")
 def api_health():
+    svc = _services()
+    settings = svc.settings
     return jsonify(
         {
             "ai_provider": settings.ai_provider,
@@ -106,115 +185,416 @@ def api_health():
             "deepseek_api_key_present": bool(settings.deepseek_api_key),
             "ws_port": settings.ws_port,
             "db_path": settings.db_path,
+            "worker": svc.worker_info,
+            "upstream_pool": svc.ai_client.pool_stats(),
+            "router": (
+                {"totals": svc.router.stats(), "endpoints": svc.router.endpoint_stats()}
+                if svc.router is not None
+                else None
+            ),
+            "context": svc.chat_service.context_stats(),
+            "prompt_cache": svc.prompt_cache.stats(),
+            "streaming": STREAM_STATS.snapshot(),
+            "stream_pumps": svc.stream_pumps.stats(),
+            "context_cache": svc.context_cache.stats() if svc.context_cache is not None else None,
+            "reply_cache": svc.reply_cache.stats() if svc.reply_cache is not None else None,
+            "scheduler": svc.scheduler.stats() if svc.scheduler is not None else None,
+            "replay": svc.replay.stats() if svc.replay is not None else None,
+            "single_flight": svc.single_flight.stats() if svc.single_flight is not None else None,
+            "summary": svc.compactor.stats() if svc.compactor is not None else None,
+            "retention": svc.retention.stats() if svc.retention is not None else None,
         }
     )
 
 
-@app.get("/api/session")
+@bp.get("/api/ready")
+def api_ready():
+    # 就绪探针：本 worker 预热完成前返回 503（负载均衡先别把流量导过来）；存活探针仍是 /api/health
+    info = _services().readiness()
+    return jsonify(info), (200 if info["ready"] else 503)
+
+
+@bp.get("/api/metrics")
+def api_metrics():
+    # 组件指标跟着本 app 的 Services 走，不注册进全局 REGISTRY：同一进程多次 create_app()（测试、
+    # 热重载）不会出现重复的 # TYPE 族，也不会让旧的 Services 一直被引用着
+    return Response(REGISTRY.render([_services().collect_stats]), mimetype=None, content_type=CONTENT_TYPE)
+
+
+@bp.get("/api/session")
 def api_session():
     session_id = _normalize_session_id(request.args.get("session_id"))
     if not session_id:
         return jsonify({"error": "missing_session_id"}), 400
-    data = store.export_session(session_id, settings.max_history_messages)
+    svc = _services()
+    store, settings = svc.store, svc.settings
+
+    # ?limit=&before=<message id>：按 id 向前翻页；不带 before 时返回最新一页
+    try:
+        limit = int(request.args.get("limit") or settings.max_history_messages)
+        before_raw = request.args.get("before")
+        before = int(before_raw) if before_raw not in (None, "") else None
+    except ValueError:
+        return jsonify({"error": "invalid_cursor"}), 400
+    limit = min(max(1, limit), _SESSION_PAGE_MAX)
+
+    data = store.get_messages_page(session_id, limit=limit, before=before)
+    # 热表翻到头后接着读归档（过期会话被搬走后历史仍可回看）
+    data = merge_archived_page(data, svc.archive, session_id, limit=limit, before=before)
+    data["session_id"] = session_id
     # 若 session 没设置过 prompt，返回默认 prompt 便于前端展示
-    if not data.get("system_prompt"):
-        data["system_prompt"] = settings.system_prompt
+    data["system_prompt"] = store.get_system_prompt(session_id) or settings.system_prompt
+    return jsonify(data)
+
+
+@bp.get("/api/session/stats")
+def api_session_stats():
+    session_id = _normalize_session_id(request.args.get("session_id"))
+    if not session_id:
+        return jsonify({"error": "missing_session_id"}), 400
+    svc = _services()
+    # 内存里按进程统计：多进程部署时只看得到本 worker 处理过的轮次
+    stats = svc.prompt_cache.session_stats(session_id)
+    if stats is None:
+        return jsonify({"error": "no_stats", "session_id": session_id}), 404
+    stats["session_id"] = session_id
+    stats["worker"] = svc.worker_info
+    return jsonify(stats)
+
+
+@bp.get("/api/search")
+def api_search():
+    query = (request.args.get("q") or "").strip()
+    session_id = _normalize_session_id(request.args.get("session_id"))
+    svc = _services()
+    if not session_id and not svc.settings.search_allow_global:
+        return jsonify({"error": "missing_session_id"}), 400
+    try:
+        limit = min(max(1, int(request.args.get("limit") or 20)), _SEARCH_PAGE_MAX)
+        offset = max(0, int(request.args.get("offset") or 0))
+    except ValueError:
+        return jsonify({"error": "invalid_cursor"}), 400
+    if offset > _SEARCH_MAX_OFFSET:
+        return jsonify({"error": "offset_too_large"}), 400
+
+    try:
+        data = svc.message_search.search(query, session_id=session_id or None, limit=limit, offset=offset)
+    except SearchError as e:
+        return jsonify({"error": str(e)}), 503 if str(e) == "search_unavailable" else 400
+    data["query"] = query
+    data["scope"] = "session" if session_id else "global"
     return jsonify(data)
 
 
-if sock is not None:
+@bp.get("/api/session/export")
+def api_session_export():
+    session_id = _normalize_session_id(request.args.get("session_id"))
+    if not session_id:
+        return jsonify({"error": "missing_session_id"}), 400
+    svc = _services()
+    store = svc.store
+
+    def lines():
+        head = {"type": "session", "session_id": session_id, "system_prompt": store.get_system_prompt(session_id)}
+        yield json.dumps(head, ensure_ascii=False) + "\n"
+        for m in iter_with_archive(store, svc.archive, session_id):
+            m["type"] = "message"
+            yield json.dumps(m, ensure_ascii=False) + "\n"
+
+    return Response(
+        stream_with_context(lines()),
+        mimetype="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="session-{_safe_filename(session_id)}.ndjson"'},
+    )
 
-    @sock.route("/ws")
-    def ws_chat(ws):
-        session_id = chat_service.new_session_id()
-        ws.send(json.dumps({"type": "session", "session_id": session_id}, ensure_ascii=False))
 
-        while True:
-            raw = ws.receive()
-            if raw is None:
-                break
+_WS_CLOSED = object()
 
+
+def _ws_reader(ws, inbox: "queue.Queue[object]", current: Dict[str, Any]) -> None:
+    """Read frames for `_ws_chat` so a cancel / new message / disconnect is seen while a reply streams.
+
+    `current["turn"]` 是进行中的回复（本连接发起的 ActiveTurn，或正在续传的 ReplayStream），
+    `current["lease"]` 是本连接持有的续传 lease：有它时断开只释放 lease，回复在宽限期内继续生成。
+    """
+    # flask-sock 的依赖，只有 /ws 路由注册了才会走到这里，所以不在模块顶层导入（省 import 时间）
+    from simple_websocket import ConnectionClosed
+
+    # simple_websocket 的 receive/send 可以分属两个线程；只有 handler 线程发送
+    while True:
+        try:
+            raw = ws.receive()
+        except ConnectionClosed:
+            raw = None
+        if raw is None:
+            current["closed"] = True
+            lease, turn = current.get("lease"), current.get("turn")
+            if lease is not None:
+                lease.release()
+            elif turn is not None:
+                turn.cancel("disconnect")
+            wake = current.get("wake")
+            if wake is not None:
+                wake()
+            inbox.put(_WS_CLOSED)
+            return
+        turn = current.get("turn")
+        if turn is not None:
             try:
-                data = json.loads(raw)
-            except json.JSONDecodeError:
-                ws.send(
-                    json.dumps(
-                        {"type": "error", "message": "invalid_json", "session_id": session_id},
-                        ensure_ascii=False,
-                    )
-                )
+                msg_type = json.loads(raw).get("type")
+            except (json.JSONDecodeError, AttributeError):
+                msg_type = None
+            if msg_type == "cancel":
+                turn.cancel("cancel")
                 continue
-
-            msg_type = data.get("type")
-            if msg_type != "user_message":
+            if msg_type in ("user_message", "resume"):
+                # 上一条还在生成时又来了新消息：上一条就此截断，新消息排队等它落库
+                turn.cancel("superseded")
+        inbox.put(raw)
+
+
+def _ws_forward_replay(ws, stream: ReplayStream, last_seq: int, current: Dict[str, Any]) -> None:
+    """Resume: send what the client missed after `last_seq`, then the live tail and the final message."""
+    from simple_websocket import ConnectionClosed
+
+    wake = threading.Event()
+    lease = stream.attach()
+    current.update(turn=stream, lease=lease, wake=wake.set)
+    unsubscribe = stream.subscribe(wake.set)
+    encode = delta_frame_encoder(stream.session_id, stream.message_id)
+    cursor = last_seq
+    try:
+        while not current.get("closed"):
+            wake.clear()
+            # 错过的多帧合并成一帧补发，seq 取其中最后一帧的序号
+            text, seq, done = stream.read(cursor)
+            if text:
+                ws.send(encode(text, seq))
+                cursor = seq
+            if done:
                 ws.send(
-                    json.dumps(
-                        {
-                            "type": "error",
-                            "message": "unknown_type",
-                            "session_id": session_id,
-                        },
-                        ensure_ascii=False,
+                    assistant_message_frame(
+                        stream.session_id, stream.text(), truncated=stream.truncated, message_id=stream.message_id
                     )
                 )
+                break
+            # 超时只是兜底：读线程发现断开时会直接唤醒
+            wake.wait(1.0)
+    except ConnectionClosed:
+        pass
+    finally:
+        unsubscribe()
+        lease.release()
+        current.update(turn=None, lease=None, wake=None)
+
+
+def _ws_chat(ws, services: Services, client_id: str = "") -> None:
+    from simple_websocket import ConnectionClosed
+
+    chat_service, settings, replay = services.chat_service, services.settings, services.replay
+    session_id = chat_service.new_session_id()
+    ws.send(json.dumps({"type": "session", "session_id": session_id}, ensure_ascii=False))
+
+    inbox: "queue.Queue[object]" = queue.Queue()
+    current: Dict[str, Any] = {"turn": None, "lease": None, "wake": None, "closed": False}
+    threading.Thread(target=_ws_reader, args=(ws, inbox, current), name="ws-reader", daemon=True).start()
+
+    while True:
+        raw = inbox.get()
+        if raw is _WS_CLOSED:
+            break
+
+        try:
+            data = json.loads(raw)  # type: ignore[arg-type]
+        except json.JSONDecodeError:
+            ws.send(error_frame(session_id, "invalid_json"))
+            continue
+
+        msg_type = data.get("type")
+        if msg_type == "cancel":
+            # 没有进行中的回复时忽略（用户点停止与回复结束可能同时发生）
+            continue
+        if msg_type == "resume":
+            message_id = str(data.get("message_id") or "")
+            target = replay.get(message_id) if replay is not None else None
+            if target is None:
+                ws.send(error_frame(session_id, "resume_unavailable", message_id=message_id))
                 continue
-
-            content = str(data.get("content", ""))
-            session_id = _normalize_session_id(data.get("session_id")) or session_id
-            system_prompt = data.get("system_prompt")
-            if system_prompt is not None:
-                system_prompt = str(system_prompt)
-
-            stream = bool(data.get("stream", True))
-
-            if stream:
-                full = ""
-                for chunk in chat_service.stream_user_message(
+            try:
+                last_seq = int(data.get("last_seq") or 0)
+            except (TypeError, ValueError):
+                last_seq = 0
+            session_id = target.session_id
+            _ws_forward_replay(ws, target, last_seq, current)
+            continue
+        if msg_type != "user_message":
+            ws.send(error_frame(session_id, "unknown_type"))
+            continue
+
+        content = str(data.get("content", ""))
+        session_id = _normalize_session_id(data.get("session_id")) or session_id
+        system_prompt = data.get("system_prompt")
+        if system_prompt is not None:
+            system_prompt = str(system_prompt)
+        if replay is not None:
+            # 同一会话在断开的连接上还没生成完的回复（没有来续传）同样就此截断
+            replay.cancel_session(session_id, "superseded")
+
+        stream = bool(data.get("stream", True))
+        no_cache = bool(data.get("no_cache", False))
+
+        if stream:
+            turn = ActiveTurn()
+            replay_stream = replay.start(session_id, turn.cancel) if replay is not None else None
+            lease = replay_stream.attach() if replay_stream is not None else None
+            message_id = replay_stream.message_id if replay_stream is not None else ""
+            current.update(turn=turn, lease=lease)
+            coalescer = DeltaCoalescer(
+                window_ms=settings.ws_delta_window_ms,
+                max_bytes=settings.ws_delta_max_bytes,
+            )
+            encode = delta_frame_encoder(session_id, message_id)
+            frames = iter_coalesced(
+                chat_service.stream_user_message(
                     session_id=session_id,
                     content=content,
                     system_prompt=system_prompt,
-                ):
-                    full += chunk
-                    ws.send(
-                        json.dumps(
-                            {
-                                "type": "assistant_delta",
-                                "content": chunk,
-                                "session_id": session_id,
-                            },
-                            ensure_ascii=False,
-                        )
-                    )
-
-                # 记录最终 assistant 消息
-                store.append_message(session_id, "assistant", full)
-                ws.send(
-                    json.dumps(
-                        {
-                            "type": "assistant_message",
-                            "content": full,
-                            "session_id": session_id,
-                        },
-                        ensure_ascii=False,
-                    )
-                )
+                    bypass_cache=no_cache,
+                    cancel=turn.token,
+                    client_id=client_id,
+                ),
+                coalescer,
+                services.stream_pumps,
+            )
+            # 连接断开后（有续传缓冲时）继续生成，只是不再发送
+            sending = True
+            GENERATIONS_IN_FLIGHT.inc("flask_ws")
+            rejected: Optional[SchedulerRejected] = None
+            try:
+                if replay_stream is not None:
+                    ws.send(assistant_start_frame(session_id, message_id))
+                for frame in frames:
+                    if turn.token.cancelled:
+                        break
+                    seq = replay_stream.append(frame) if replay_stream is not None else 0
+                    if not sending:
+                        continue
+                    try:
+                        ws.send(encode(frame, seq))
+                    except ConnectionClosed:
+                        if lease is None:
+                            raise
+                        sending = False
+                        lease.release()
+            except SchedulerRejected as e:
+                rejected = e
+            except ConnectionClosed:
+                turn.cancel("disconnect")
+            finally:
+                # 提前关闭时上游连接已由 cancel token 断开，读线程随之退出
+                frames.close()
+                coalescer.finish()
+                GENERATIONS_IN_FLIGHT.dec("flask_ws")
+            truncated = turn.finish()
+            current.update(turn=None, lease=None)
+            if rejected is not None:
+                # 还没落用户消息、也没有任何输出：只回一个带 retry_after 的错误帧
+                if replay_stream is not None and replay is not None:
+                    replay.discard(replay_stream)
+                    replay_stream.finish(False)
+                    lease.release()  # type: ignore[union-attr]
+                if sending:
+                    ws.send(error_frame(session_id, rejected.reason, retry_after=rejected.retry_after))
                 continue
-
-            result = chat_service.handle_user_message(session_id=session_id, content=content, system_prompt=system_prompt)
-            session_id = result.session_id
-            ws.send(
-                json.dumps(
-                    {
-                        "type": "assistant_message",
-                        "content": result.reply,
-                        "session_id": result.session_id,
-                    },
-                    ensure_ascii=False,
+            full = coalescer.text()
+
+            # 记录最终 assistant 消息（经 ChatService 落库，顺带更新上下文缓存；被取消的标记为截断）
+            chat_service.finish_streamed_reply(session_id, full, turn.token)
+            if replay_stream is not None:
+                # 落库之后才结束续传流：续传方收到最终消息时它已经在历史里了
+                replay_stream.finish(truncated)
+                lease.release()  # type: ignore[union-attr]
+            if sending and turn.token.reason != "disconnect":
+                try:
+                    ws.send(assistant_message_frame(session_id, full, truncated=truncated, message_id=message_id))
+                except ConnectionClosed:
+                    pass
+            continue
+
+        try:
+            with GENERATIONS_IN_FLIGHT.track("flask_ws"):
+                result = chat_service.handle_user_message(
+                    session_id=session_id,
+                    content=content,
+                    system_prompt=system_prompt,
+                    bypass_cache=no_cache,
+                    client_id=client_id,
                 )
-            )
+        except SchedulerRejected as e:
+            ws.send(error_frame(session_id, e.reason, retry_after=e.retry_after))
+            continue
+        session_id = result.session_id
+        ws.send(assistant_message_frame(result.session_id, result.reply))
+
+
+def create_app(settings: Optional[Settings] = None, services: Optional[Services] = None) -> Flask:
+    """Build the Flask app and (unless given) this process's `Services`, then start warming up in the background.
+
+    每个 worker 进程调用一次；WSGI 服务器可直接用 `backend.app:create_app()`（多进程时保持
+    CONTEXT_CACHE_ENABLED 关闭：上下文缓存只在单进程里是新鲜的）。
+    返回时已经可以接请求，预热（上游连接等）完成后 `/api/ready` 才变成 200。
+    """
+    if services is None:
+        services = build_services(settings)
+    app = Flask(
+        __name__,
+        static_folder=str(FRONTEND_DIR),
+        static_url_path="",
+    )
+    app.extensions["aichat"] = services
+    app.register_blueprint(bp)
+
+    try:
+        from flask_sock import Sock
+    except ModuleNotFoundError:  # pragma: no cover
+        Sock = None
+    if Sock is not None:
+        sock = Sock(app)
+
+        @sock.route("/ws")
+        def ws_chat(ws):
+            with WS_CONNECTIONS.track("flask"):
+                _ws_chat(ws, services, request.remote_addr or "")
+
+    services.start_warm_up()
+    return app
+
+
+_default_app: Optional[Flask] = None
+
+
+def __getattr__(name: str) -> Any:
+    # 兼容 `from backend.app import app`：第一次访问时才创建（import 本模块不再有副作用）
+    global _default_app
+    if name == "app":
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
+    raise AttributeError(name)
 
 
 if __name__ == "__main__":
-    # 在同一进程启动一个 asyncio WebSocket server（更稳定，尤其是 Windows）
-    start_ws_server_in_thread(chat_service, settings)
-    app.run(host=settings.host, port=settings.port, debug=True, use_reloader=False)
+    # 开发模式：单进程，在同一进程启动一个 asyncio WebSocket server（更稳定，尤其是 Windows）；
+    # 多核部署见 python -m backend.serve
+    from backend.ws_async_server import start_ws_server_in_thread
+
+    load_env()
+    settings = Settings()
+    if os.getenv("CONTEXT_CACHE_ENABLED") is None:
+        # 单进程：所有写入都经过这里，上下文缓存不会过期
+        settings = dataclasses.replace(settings, context_cache_enabled=True)
+    services = build_services(settings)
+    start_ws_server_in_thread(services.chat_service, services.settings, replay=services.replay)
+    create_app(services=services).run(
+        host=services.settings.host, port=services.settings.port, debug=True, use_reloader=False
+    )
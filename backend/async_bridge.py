@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from concurrent.futures import Executor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import AsyncIterator, Callable, Iterable, Iterator, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+_END = object()
+
+# 生产者线程与事件循环之间的队列长度（背压）；asyncio WS server 启动时按 WS_STREAM_QUEUE_SIZE 设置
+_default_maxsize = 64
+
+
+class _Raised:
+    __slots__ = ("exc",)
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def set_default_queue_size(maxsize: int) -> None:
+    """Queue length used by `iterate_in_executor` when the caller does not pass one."""
+    global _default_maxsize
+    _default_maxsize = max(1, int(maxsize))
+
+
+async def iterate_in_executor(
+    make_iterable: Callable[[], Iterable[T]],
+    *,
+    executor: Optional[Executor] = None,
+    maxsize: Optional[int] = None,
+) -> AsyncIterator[T]:
+    """Drive a blocking iterator on `executor` and yield its items on the event loop.
+
+    生产者线程通过有界 asyncio.Queue 把数据交回事件循环：队列满时线程阻塞（背压），
+    消费端提前退出（如 WS 断开）时会通知生产者停止并关闭底层迭代器。
+    """
+    loop = asyncio.get_running_loop()
+    queue: "asyncio.Queue[object]" = asyncio.Queue(
+        maxsize=max(1, int(_default_maxsize if maxsize is None else maxsize))
+    )
+    stop = threading.Event()
+
+    def put(item: object) -> None:
+        fut = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                fut.result(timeout=0.5)
+                return
+            except FutureTimeoutError:
+                # 消费端已经走了：不要让线程永远卡在满队列上
+                if stop.is_set():
+                    fut.cancel()
+                    return
+
+    def produce() -> None:
+        it: Optional[Iterator[T]] = None
+        try:
+            # 构造迭代器本身也可能抛错（参数校验、连接失败等），同样要交给事件循环，否则消费端会一直等下去
+            it = iter(make_iterable())
+            for item in it:
+                if stop.is_set():
+                    break
+                put(item)
+                if stop.is_set():
+                    break
+        except BaseException as e:  # noqa: BLE001 - 原样转交给事件循环侧
+            if not stop.is_set():
+                put(_Raised(e))
+            return
+        finally:
+            close = getattr(it, "close", None)
+            if callable(close):
+                close()
+        if not stop.is_set():
+            put(_END)
+
+    task = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                break
+            if isinstance(item, _Raised):
+                raise item.exc
+            yield item  # type: ignore[misc]
+    finally:
+        stop.set()
+        # 清空队列，让可能阻塞在 put 上的生产者线程尽快看到 stop
+        while not queue.empty():
+            queue.get_nowait()
+        if task.done():
+            task.exception()
+        else:
+            task.add_done_callback(lambda f: f.cancelled() or f.exception())
@@ -1,13 +1,27 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import functools
+import logging
+import threading
+import time
 from dataclasses import dataclass
-from typing import Dict, Iterable, List, Optional
+from typing import AsyncIterator, ContextManager, Dict, Iterable, List, Optional, Tuple
 
-from backend.ai_client import AIClientError, BaseAIClient
-from backend.storage_sqlite import SQLiteStore
+from backend.ai_client import AIClientError, BaseAIClient, CancelToken, GenerationCancelled, RequestOptions, Usage
+from backend.compaction import ConversationCompactor
+from backend.context_cache import SessionContextCache
+from backend.metrics import BUILD_MESSAGES_SECONDS, GENERATIONS_CANCELLED, timed
+from backend.prompt_cache import PromptCacheTracker
+from backend.scheduler import GenerationScheduler
+from backend.storage_sqlite import SQLiteStore, StoredMessage, StoredSummary
+from backend.tokens import message_tokens, prompt_tokens
 from backend.utils import new_session_id
 
 
+logger = logging.getLogger(__name__)
+
 Message = Dict[str, str]
 
 
@@ -17,6 +31,22 @@ class ChatResult:
     reply: str
 
 
+@dataclass
+class ContextReport:
+    """What `_build_messages` picked for one turn."""
+
+    session_id: str
+    messages: int
+    history_tokens: int
+    system_tokens: int
+    dropped: int
+    summary_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.history_tokens + self.system_tokens + self.summary_tokens
+
+
 class ChatService:
     def __init__(
         self,
@@ -25,57 +55,357 @@ class ChatService:
         store: SQLiteStore,
         default_system_prompt: str,
         max_history_messages: int = 20,
+        context_cache: Optional[SessionContextCache] = None,
+        context_token_budget: int = 0,
+        history_scan_limit: int = 200,
+        compactor: Optional[ConversationCompactor] = None,
+        scheduler: Optional[GenerationScheduler] = None,
+        context_block_messages: int = 0,
+        prompt_cache: Optional[PromptCacheTracker] = None,
     ):
         self._ai_client = ai_client
         self._store = store
         self._default_system_prompt = (default_system_prompt or "").strip()
         self._max_history_messages = max(2, int(max_history_messages))
+        # 所有写入都经由 ChatService，缓存才能与 SQLite 保持一致（不要绕过它直接写 store）
+        self._context_cache = context_cache
+        # >0 时按 token 预算挑历史（最多回看 history_scan_limit 条），否则按条数 max_history_messages
+        self._context_token_budget = max(0, int(context_token_budget))
+        self._history_scan_limit = max(2, int(history_scan_limit))
+        self._context_lock = threading.Lock()
+        self._context_totals = {"turns": 0, "tokens": 0, "max_tokens": 0, "trimmed_turns": 0, "summarized_turns": 0}
+        # 开启滚动摘要时：每轮结束通知后台压缩，构建 prompt 时用摘要代替已折叠的旧消息
+        self._compactor = compactor
+        # 准入控制：每轮先拿到生成名额再落用户消息，被拒绝（SchedulerRejected）的请求不留任何记录，客户端可原样重试
+        self._scheduler = scheduler
+        # >0 时窗口的起点只落在“会话内第 k*block 条消息之后”：窗口按整块丢弃旧消息，两次丢弃之间
+        # 每轮的 prompt 都是上一轮的前缀 + 新消息，上游的前缀缓存才能命中；0 = 逐条滑动
+        self._context_block_messages = max(0, int(context_block_messages))
+        self._prompt_cache = prompt_cache
+
+    @property
+    def ai_client(self) -> BaseAIClient:
+        return self._ai_client
 
     def new_session_id(self) -> str:
         return new_session_id()
 
+    @property
+    def context_cache(self) -> Optional[SessionContextCache]:
+        return self._context_cache
+
     def set_system_prompt(self, session_id: str, system_prompt: str) -> None:
         self._store.set_system_prompt(session_id, system_prompt)
+        if self._context_cache is not None:
+            self._context_cache.set_prompt(session_id, system_prompt)
 
-    def append_assistant_message(self, session_id: str, content: str) -> None:
-        self._store.append_message(session_id, "assistant", content)
+    def _append(self, session_id: str, role: str, content: str, *, truncated: bool = False) -> None:
+        tokens = message_tokens(content)
+        self._store.append_message(session_id, role, content, tokens, truncated=truncated)
+        if self._context_cache is not None:
+            self._context_cache.append(session_id, role, content, tokens)
 
-    def get_effective_system_prompt(self, session_id: str) -> str:
-        stored = self._store.get_system_prompt(session_id)
+    def append_assistant_message(self, session_id: str, content: str, *, truncated: bool = False) -> None:
+        self._append(session_id, "assistant", content, truncated=truncated)
+        if self._compactor is not None:
+            self._compactor.notify(session_id)
+
+    def finish_streamed_reply(self, session_id: str, content: str, cancel: Optional[CancelToken] = None) -> bool:
+        """Persist a streamed reply; a cancelled one is stored as truncated. Returns whether it was truncated.
+
+        取消时一个字都还没生成就不落库（空的 assistant 消息对上游没有意义）。
+        """
+        truncated = cancel is not None and cancel.cancelled
+        if truncated:
+            GENERATIONS_CANCELLED.inc(cancel.reason or "cancelled")  # type: ignore[union-attr]
+            if not content:
+                return True
+        self.append_assistant_message(session_id, content, truncated=truncated)
+        return truncated
+
+    @property
+    def compactor(self) -> Optional[ConversationCompactor]:
+        return self._compactor
+
+    @property
+    def prompt_cache(self) -> Optional[PromptCacheTracker]:
+        return self._prompt_cache
+
+    @property
+    def scheduler(self) -> Optional[GenerationScheduler]:
+        return self._scheduler
+
+    def _admit(self, session_id: str, client_id: str, cancel: Optional[CancelToken] = None) -> ContextManager[object]:
+        if self._scheduler is None:
+            return contextlib.nullcontext()
+        return self._scheduler.acquire(session_id, client_id, cancel)
+
+    async def _aadmit(
+        self, session_id: str, client_id: str, cancel: Optional[CancelToken] = None
+    ) -> ContextManager[object]:
+        if self._scheduler is None:
+            return contextlib.nullcontext()
+        return await self._scheduler.aacquire(session_id, client_id, cancel)
+
+    def context_stats(self) -> Dict[str, float]:
+        with self._context_lock:
+            totals = dict(self._context_totals)
+        totals["avg_tokens"] = totals["tokens"] / totals["turns"] if totals["turns"] else 0.0
+        totals["token_budget"] = self._context_token_budget
+        totals["block_messages"] = self._context_block_messages
+        return totals
+
+    def _effective_prompt(self, stored: Optional[str]) -> str:
         if stored is None:
             return self._default_system_prompt
         stored = (stored or "").strip()
         return stored if stored else self._default_system_prompt
 
+    def get_effective_system_prompt(self, session_id: str) -> str:
+        cache = self._context_cache
+        if cache is not None:
+            found, stored = cache.get_prompt(session_id)
+            if found:
+                return self._effective_prompt(stored)
+        return self._effective_prompt(self._store.get_system_prompt(session_id))
+
+    def _load_context(
+        self, session_id: str
+    ) -> Tuple[Optional[str], Optional[StoredSummary], List[StoredMessage]]:
+        """Return (stored_prompt, summary, recent history), served from the context cache when warm."""
+        limit = self._history_scan_limit if self._context_token_budget else self._max_history_messages
+        want_summary = self._compactor is not None
+        # 会话内序号只有分块对齐用得上，不开时省掉那次 COUNT
+        with_seq = self._context_block_messages > 0
+        cache = self._context_cache
+        if cache is None:
+            summary = self._store.get_summary(session_id) if want_summary else None
+            return (
+                self._store.get_system_prompt(session_id),
+                summary,
+                self._store.get_recent_messages(session_id, limit, with_seq=with_seq),
+            )
+
+        found, stored = cache.get_prompt(session_id)
+        summary_found, summary = cache.get_summary(session_id) if want_summary else (True, None)
+        history = cache.get_window(session_id, limit)
+        if found and summary_found and history is not None:
+            return stored, summary, history
+
+        token = cache.begin_fill(session_id)
+        try:
+            if not found:
+                stored = self._store.get_system_prompt(session_id)
+            if not summary_found:
+                summary = self._store.get_summary(session_id)
+            if history is None:
+                history = self._store.get_recent_messages(session_id, limit, with_seq=with_seq)
+        except BaseException:
+            cache.end_fill(session_id, token)
+            raise
+        cache.end_fill(
+            session_id,
+            token,
+            window=history,
+            capacity=limit,
+            prompt=stored,
+            prompt_loaded=True,
+            summary=summary,
+            summary_loaded=want_summary,
+        )
+        return stored, summary, history
+
+    def _select_history(
+        self, system_prompt: str, history: List[StoredMessage], reserved: int = 0
+    ) -> Tuple[List[StoredMessage], int, int]:
+        """Pick the newest messages that fit the token budget -> (window, history_tokens, system_tokens).
+
+        `reserved` 是预算里已经被摘要占掉的 token 数。
+        """
+        system_tokens = prompt_tokens(system_prompt) if system_prompt else 0
+        budget = self._context_token_budget
+        # 分块对齐需要会话内序号；拿不到（为 0）时退回逐条滑动
+        block = self._context_block_messages if history and history[0].seq > 0 else 0
+        if not budget:
+            if block:
+                history = self._align_count(history, block)
+            return history, sum(m.token_count for m in history), system_tokens
+
+        # 先为 system prompt（和摘要）预留，再从最新一条往回累加缓存好的 token 数；最新一条（本轮用户消息）总是保留
+        remaining = budget - system_tokens - reserved
+        if block:
+            aligned = self._align_budget(history, block, remaining)
+            if aligned is not None:
+                return aligned[0], aligned[1], system_tokens
+        used = 0
+        start = len(history)
+        while start > 0:
+            cost = history[start - 1].token_count
+            if used + cost > remaining and start < len(history):
+                break
+            used += cost
+            start -= 1
+        return history[start:], used, system_tokens
+
+    def _align_count(self, history: List[StoredMessage], block: int) -> List[StoredMessage]:
+        """Count mode: keep the messages after the last block boundary that leaves <= max_history_messages.
+
+        例：上限 20、块 8，会话第 21~28 条消息时窗口都从第 9 条开始，第 29 条时一次性跳到第 17 条开始。
+        """
+        # 块不超过上限的一半，窗口最少也有上限一半的消息
+        block = max(1, min(block, self._max_history_messages // 2))
+        excess = max(0, history[-1].seq - self._max_history_messages)
+        cut = -(-excess // block) * block
+        return [m for m in history if m.seq > cut]
+
+    @staticmethod
+    def _align_budget(
+        history: List[StoredMessage], block: int, remaining: int
+    ) -> Optional[Tuple[List[StoredMessage], int]]:
+        """Token mode: the longest window that starts on a block boundary and fits; None if none fits."""
+        best: Optional[Tuple[int, int]] = None
+        used = 0
+        for i in range(len(history) - 1, -1, -1):
+            used += history[i].token_count
+            if used > remaining:
+                break
+            if (history[i].seq - 1) % block == 0:
+                best = (i, used)
+        if best is None:
+            return None
+        return history[best[0] :], best[1]
+
+    def _record_context(self, report: ContextReport) -> None:
+        with self._context_lock:
+            t = self._context_totals
+            t["turns"] += 1
+            t["tokens"] += report.total_tokens
+            t["max_tokens"] = max(t["max_tokens"], report.total_tokens)
+            if report.dropped:
+                t["trimmed_turns"] += 1
+            if report.summary_tokens:
+                t["summarized_turns"] += 1
+        logger.debug(
+            "context session=%s messages=%d dropped=%d tokens=%d (system=%d summary=%d history=%d) budget=%d",
+            report.session_id,
+            report.messages,
+            report.dropped,
+            report.total_tokens,
+            report.system_tokens,
+            report.summary_tokens,
+            report.history_tokens,
+            self._context_token_budget,
+        )
+
+    @timed(BUILD_MESSAGES_SECONDS)
     def _build_messages(self, session_id: str) -> List[Message]:
-        history = self._store.get_recent_messages(session_id, self._max_history_messages)
+        stored_prompt, summary, history = self._load_context(session_id)
         messages: List[Message] = []
-        system_prompt = self.get_effective_system_prompt(session_id)
+        system_prompt = self._effective_prompt(stored_prompt)
+        summary_tokens = 0
+        if summary is not None:
+            # 已折叠进摘要的消息不再逐条发送；id 为 0 的是尚未落库的新消息，一定不在摘要里
+            covered = summary.covered_until
+            history = [m for m in history if not 0 < m.id <= covered]
+            summary_tokens = summary.token_count
+        window, history_tokens, system_tokens = self._select_history(system_prompt, history, summary_tokens)
+        self._record_context(
+            ContextReport(
+                session_id=session_id,
+                messages=len(window),
+                history_tokens=history_tokens,
+                system_tokens=system_tokens,
+                dropped=len(history) - len(window),
+                summary_tokens=summary_tokens,
+            )
+        )
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
-        for m in history:
+        if summary is not None:
+            messages.append({"role": "system", "content": "此前对话的摘要（更早的消息已折叠）：\n" + summary.content})
+        for m in window:
             messages.append({"role": m.role, "content": m.content})
+        if self._prompt_cache is not None:
+            tokens = [system_tokens] if system_prompt else []
+            if summary is not None:
+                tokens.append(summary_tokens)
+            tokens.extend(m.token_count for m in window)
+            self._prompt_cache.observe_prompt(session_id, messages, tokens)
         return messages
 
-    def handle_user_message(self, *, session_id: str, content: str, system_prompt: Optional[str] = None) -> ChatResult:
-        content = (content or "").strip()
+    def _request_options(
+        self, session_id: str, bypass_cache: bool, cancel: Optional[CancelToken] = None
+    ) -> Tuple[RequestOptions, List[Usage]]:
+        """Options for this turn's upstream call, plus the list the provider's usage report lands in."""
+        reported: List[Usage] = []
+        options = RequestOptions(
+            session_id=session_id,
+            bypass_cache=bypass_cache,
+            cancel=cancel,
+            on_usage=reported.append if self._prompt_cache is not None else None,
+        )
+        return options, reported
+
+    def _record_turn(self, session_id: str, reported: List[Usage], ttft: Optional[float]) -> None:
+        if self._prompt_cache is None or (not reported and ttft is None):
+            return
+        usage = reported[-1] if reported else None
+        self._prompt_cache.record_turn(session_id, usage, ttft)
+        if usage is not None:
+            logger.debug(
+                "prompt_cache session=%s prompt=%d cached=%s ttft=%s",
+                session_id,
+                usage.prompt_tokens,
+                usage.cached_tokens,
+                f"{ttft:.3f}" if ttft is not None else "-",
+            )
+
+    def _prepare_turn(self, session_id: str, content: str, system_prompt: Optional[str]) -> Tuple[str, List[Message]]:
+        """Persist the user message and build the prompt for this turn (blocking)."""
         if not session_id:
             session_id = self.new_session_id()
 
-        self._store.get_or_create_session(session_id)
-        if system_prompt is not None:
-            self._store.set_system_prompt(session_id, system_prompt)
+        # 设置 prompt + 落用户消息（含创建/touch session）合并为一个事务；缓存在提交成功后再更新
+        tokens = message_tokens(content)
+        with self._store.atomic():
+            if system_prompt is not None:
+                self._store.set_system_prompt(session_id, system_prompt)
+            self._store.append_message(session_id, "user", content, tokens)
+        cache = self._context_cache
+        if cache is not None:
+            if system_prompt is not None:
+                cache.set_prompt(session_id, system_prompt)
+            cache.append(session_id, "user", content, tokens)
+        return session_id, self._build_messages(session_id)
 
-        self._store.append_message(session_id, "user", content)
-        messages = self._build_messages(session_id)
+    @staticmethod
+    def _fallback_reply(content: str, reason: Optional[str] = None) -> str:
+        head = f"（AI 服务暂不可用：{reason}）" if reason is not None else "（AI 服务暂不可用）"
+        return head + ("你说：" + content if content else "")
 
-        try:
-            reply = self._ai_client.generate(messages)
-        except AIClientError as e:
-            reason = str(e) or "unknown"
-            reply = f"（AI 服务暂不可用：{reason}）" + ("你说：" + content if content else "")
+    def handle_user_message(
+        self,
+        *,
+        session_id: str,
+        content: str,
+        system_prompt: Optional[str] = None,
+        bypass_cache: bool = False,
+        client_id: str = "",
+    ) -> ChatResult:
+        """Run one non-streamed turn; raises `SchedulerRejected` when the scheduler refuses it."""
+        content = (content or "").strip()
+        session_id = session_id or self.new_session_id()
+        with self._admit(session_id, client_id):
+            session_id, messages = self._prepare_turn(session_id, content, system_prompt)
+            options, reported = self._request_options(session_id, bypass_cache)
+
+            try:
+                reply = self._ai_client.generate(messages, options)
+            except AIClientError as e:
+                reply = self._fallback_reply(content, str(e) or "unknown")
+            self._record_turn(session_id, reported, None)
 
-        self._store.append_message(session_id, "assistant", reply)
+        self.append_assistant_message(session_id, reply)
         return ChatResult(session_id=session_id, reply=reply)
 
     def stream_user_message(
@@ -84,30 +414,114 @@ class ChatService:
         session_id: str,
         content: str,
         system_prompt: Optional[str] = None,
+        bypass_cache: bool = False,
+        cancel: Optional[CancelToken] = None,
+        client_id: str = "",
     ) -> Iterable[str]:
-        """Yield assistant reply chunks; caller can accumulate to final reply."""
+        """Yield assistant reply chunks; caller can accumulate to final reply.
+
+        `cancel` 被触发后流直接结束（不给兜底回复），调用方用 `finish_streamed_reply` 落截断的部分；
+        调度器拒绝时在第一次迭代抛出 `SchedulerRejected`。生成名额一直占到流结束或被关闭。
+        """
         content = (content or "").strip()
-        if not session_id:
-            session_id = self.new_session_id()
+        session_id = session_id or self.new_session_id()
+        try:
+            slot = self._admit(session_id, client_id, cancel)
+        except GenerationCancelled:
+            return
+        with slot:
+            session_id, messages = self._prepare_turn(session_id, content, system_prompt)
+            options, reported = self._request_options(session_id, bypass_cache, cancel)
+            started, ttft = time.monotonic(), None
 
-        self._store.get_or_create_session(session_id)
-        if system_prompt is not None:
-            self._store.set_system_prompt(session_id, system_prompt)
+            try:
+                for chunk in self._ai_client.stream_generate(messages, options):
+                    if chunk:
+                        if ttft is None:
+                            ttft = time.monotonic() - started
+                        yield str(chunk)
+            except GenerationCancelled:
+                return
+            except AIClientError as e:
+                yield self._fallback_reply(content, str(e) or "unknown")
+            except Exception:
+                # 流式失败时给一个可见的兜底
+                yield self._fallback_reply(content)
+            finally:
+                self._record_turn(session_id, reported, ttft)
 
-        self._store.append_message(session_id, "user", content)
-        messages = self._build_messages(session_id)
+    # ---- asyncio 版本：provider 调用原生 await，SQLite 操作走事件循环的默认线程池 ----
 
+    @staticmethod
+    async def _run_blocking(fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+    async def aappend_assistant_message(self, session_id: str, content: str) -> None:
+        await self._run_blocking(self.append_assistant_message, session_id, content)
+
+    async def afinish_streamed_reply(
+        self, session_id: str, content: str, cancel: Optional[CancelToken] = None
+    ) -> bool:
+        return await self._run_blocking(self.finish_streamed_reply, session_id, content, cancel)
+
+    async def ahandle_user_message(
+        self,
+        *,
+        session_id: str,
+        content: str,
+        system_prompt: Optional[str] = None,
+        bypass_cache: bool = False,
+        client_id: str = "",
+    ) -> ChatResult:
+        content = (content or "").strip()
+        session_id = session_id or self.new_session_id()
+        with await self._aadmit(session_id, client_id):
+            session_id, messages = await self._run_blocking(self._prepare_turn, session_id, content, system_prompt)
+            options, reported = self._request_options(session_id, bypass_cache)
+
+            try:
+                reply = await self._ai_client.agenerate(messages, options)
+            except AIClientError as e:
+                reply = self._fallback_reply(content, str(e) or "unknown")
+            self._record_turn(session_id, reported, None)
+
+        await self._run_blocking(self.append_assistant_message, session_id, reply)
+        return ChatResult(session_id=session_id, reply=reply)
+
+    async def astream_user_message(
+        self,
+        *,
+        session_id: str,
+        content: str,
+        system_prompt: Optional[str] = None,
+        bypass_cache: bool = False,
+        cancel: Optional[CancelToken] = None,
+        client_id: str = "",
+    ) -> AsyncIterator[str]:
+        """Async counterpart of `stream_user_message`; caller persists the final reply."""
+        content = (content or "").strip()
+        session_id = session_id or self.new_session_id()
         try:
-            for chunk in self._ai_client.stream_generate(messages):
-                if chunk:
-                    yield str(chunk)
-        except AIClientError as e:
-            reason = str(e) or "unknown"
-            fallback = f"（AI 服务暂不可用：{reason}）" + ("你说：" + content if content else "")
-            for ch in fallback:
-                yield ch
-        except Exception:
-            # 流式失败时给一个可见的兜底
-            fallback = "（AI 服务暂不可用）" + ("你说：" + content if content else "")
-            for ch in fallback:
-                yield ch
+            slot = await self._aadmit(session_id, client_id, cancel)
+        except GenerationCancelled:
+            return
+        with slot:
+            session_id, messages = await self._run_blocking(self._prepare_turn, session_id, content, system_prompt)
+            options, reported = self._request_options(session_id, bypass_cache, cancel)
+            started, ttft = time.monotonic(), None
+
+            try:
+                async for chunk in self._ai_client.astream_generate(messages, options):
+                    if chunk:
+                        if ttft is None:
+                            ttft = time.monotonic() - started
+                        yield str(chunk)
+            except GenerationCancelled:
+                return
+            except AIClientError as e:
+                yield self._fallback_reply(content, str(e) or "unknown")
+            except Exception:
+                yield self._fallback_reply(content)
+            finally:
+                self._record_turn(session_id, reported, ttft)
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+from typing import Callable, Dict, Optional, Set
+
+from backend.ai_client import AIClientError, BaseAIClient, RequestOptions
+from backend.storage_sqlite import SQLiteStore, StoredSummary
+from backend.tokens import message_tokens
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ConversationCompactor:
+    """Fold old messages of long sessions into a stored rolling summary, off the user-facing turn.
+
+    每轮结束时 `notify(session_id)` 只是把会话放进队列（同一会话排队期间去重）；后台线程检查
+    “未被摘要覆盖的消息数”，超过 trigger_messages 时把最老的那部分（只留最近 keep_recent 条）
+    交给 summarizer 合并进已有摘要，每次最多折叠 batch_messages 条。summarizer 是任意
+    `BaseAIClient`：真实模型走 `summarize` 的默认实现，`PlaceholderClient` 给出确定性的摘要。
+    """
+
+    def __init__(
+        self,
+        store: SQLiteStore,
+        summarizer: BaseAIClient,
+        *,
+        trigger_messages: int = 20,
+        keep_recent: int = 8,
+        batch_messages: int = 100,
+        on_compacted: Optional[Callable[[str], None]] = None,
+        start: bool = True,
+    ):
+        self._store = store
+        self._summarizer = summarizer
+        self._trigger = max(2, int(trigger_messages))
+        # 至少折叠一条：keep_recent 必须小于触发阈值
+        self._keep_recent = min(max(0, int(keep_recent)), self._trigger - 1)
+        self._batch = max(1, int(batch_messages))
+        # 摘要更新后回调（用来让上下文缓存里的旧窗口失效）
+        self._on_compacted = on_compacted
+
+        self._queue: "queue.Queue[object]" = queue.Queue()
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stats = {"notified": 0, "checked": 0, "compactions": 0, "folded_messages": 0, "failures": 0}
+        self._closed = False
+        self._worker: Optional[threading.Thread] = None
+        if start:
+            self._worker = threading.Thread(target=self._run, name="summary-compactor", daemon=True)
+            self._worker.start()
+
+    @property
+    def trigger_messages(self) -> int:
+        return self._trigger
+
+    def notify(self, session_id: str) -> None:
+        """Schedule a threshold check for `session_id` (non-blocking)."""
+        if not session_id or self._closed:
+            return
+        with self._lock:
+            self._stats["notified"] += 1
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        self._queue.put(session_id)
+
+    def compact(self, session_id: str) -> bool:
+        """Run compaction for one session now (blocking); True if its summary moved forward."""
+        # write-behind 模式下排队的消息还没有 id，先等它们落库
+        self._store.flush()
+        summary = self._store.get_summary(session_id)
+        covered = summary.covered_until if summary is not None else 0
+        previous = summary.content if summary is not None else ""
+        pending = self._store.count_messages_after(session_id, covered)
+        self._bump("checked")
+        if pending <= self._trigger:
+            return False
+
+        changed = False
+        options = RequestOptions(session_id=session_id, bypass_cache=True)
+        while pending > self._keep_recent:
+            fold = self._store.get_messages_after(session_id, covered, min(pending - self._keep_recent, self._batch))
+            if not fold:
+                break
+            text = self._summarizer.summarize(
+                previous, [{"role": m.role, "content": m.content} for m in fold], options
+            ).strip()
+            if not text:
+                break
+            new = StoredSummary(content=text, covered_until=fold[-1].id, token_count=message_tokens(text))
+            if not self._store.save_summary(session_id, new, expected_covered_until=covered):
+                # 另一个进程刚更新过这段摘要：放弃本次，下一轮再检查
+                break
+            previous, covered = text, new.covered_until
+            pending -= len(fold)
+            changed = True
+            with self._lock:
+                self._stats["compactions"] += 1
+                self._stats["folded_messages"] += len(fold)
+
+        if changed and self._on_compacted is not None:
+            self._on_compacted(session_id)
+        return changed
+
+    def _bump(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            session_id = str(item)
+            with self._lock:
+                self._pending.discard(session_id)
+            try:
+                self.compact(session_id)
+            except AIClientError as e:
+                # 上游失败：摘要保持原样，下一轮结束时会再次尝试
+                self._bump("failures")
+                logger.warning("summary compaction failed for session=%s: %s", session_id, e)
+            except Exception:
+                self._bump("failures")
+                logger.exception("summary compaction crashed for session=%s", session_id)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            out = dict(self._stats)
+            out["queued"] = len(self._pending)
+        out["trigger_messages"] = self._trigger
+        out["keep_recent"] = self._keep_recent
+        return out
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._worker is not None:
+            self._queue.put(_STOP)
+            self._worker.join(timeout)
@@ -2,6 +2,30 @@ from __future__ import annotations
 
 from dataclasses import dataclass, field
 import os
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+_env_loaded = False
+
+
+def load_env() -> None:
+    """Load `.env` (or `.env.example` when there is none) into `os.environ`; only the first call does anything.
+
+    由入口（create_app / python -m backend.app / serve / manage）在构造 `Settings` 之前调用，import 本包不再读文件。
+    已存在的环境变量不会被覆盖。
+    """
+    global _env_loaded
+    if _env_loaded:
+        return
+    _env_loaded = True
+    try:
+        from dotenv import load_dotenv
+    except ModuleNotFoundError:  # pragma: no cover
+        return
+    # Prefer `.env`; fallback to `.env.example` to reduce beginner friction.
+    if not load_dotenv(PROJECT_ROOT / ".env"):
+        load_dotenv(PROJECT_ROOT / ".env.example")
 
 
 def _get_int(name: str, default: int) -> int:
@@ -14,6 +38,13 @@ def _get_int(name: str, default: int) -> int:
         return default
 
 
+def _get_bool(name: str, default: bool) -> bool:
+    raw = os.getenv(name)
+    if raw is None or not raw.strip():
+        return default
+    return raw.strip().lower() in {"1", "true", "yes", "on"}
+
+
 def _get_float(name: str, default: float) -> float:
     raw = os.getenv(name)
     if raw is None or not raw.strip():
@@ -30,11 +61,31 @@ class Settings:
     host: str = field(default_factory=lambda: os.getenv("HOST", "127.0.0.1"))
     port: int = field(default_factory=lambda: _get_int("PORT", 5000))
     ws_port: int = field(default_factory=lambda: _get_int("WS_PORT", 8765))
+    # /api/config 返回给前端的完整 WS 地址（如 wss://chat.example.com/ws，经反向代理时使用）；留空则由前端按 hostname:WS_PORT 拼
+    ws_public_url: str = field(default_factory=lambda: os.getenv("WS_PUBLIC_URL", "").strip())
+
+    # python -m backend.serve（多进程部署）：HTTP / WS 进程数（0 = CPU 核数）与每个 HTTP 进程的线程数
+    http_workers: int = field(default_factory=lambda: _get_int("HTTP_WORKERS", 0))
+    ws_workers: int = field(default_factory=lambda: _get_int("WS_WORKERS", 0))
+    http_threads: int = field(default_factory=lambda: _get_int("HTTP_THREADS", 16))
 
     db_path: str = field(
         default_factory=lambda: os.getenv("DB_PATH", os.path.join("backend", "data", "chat.db")).strip()
     )
 
+    # SQLite 长连接调优（每线程一条连接，WAL）
+    sqlite_synchronous: str = field(default_factory=lambda: os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").strip())
+    sqlite_cache_size_kb: int = field(default_factory=lambda: _get_int("SQLITE_CACHE_SIZE_KB", 16384))
+    sqlite_mmap_size: int = field(default_factory=lambda: _get_int("SQLITE_MMAP_SIZE", 64 * 1024 * 1024))
+    sqlite_busy_timeout_ms: int = field(default_factory=lambda: _get_int("SQLITE_BUSY_TIMEOUT_MS", 5000))
+    # 新建库的 auto_vacuum 模式；INCREMENTAL 时保留期任务会分步把空闲页还给文件系统
+    sqlite_auto_vacuum: str = field(default_factory=lambda: os.getenv("SQLITE_AUTO_VACUUM", "INCREMENTAL").strip())
+
+    # 写入模式：sync=直接写（默认）；group/async=后台批量提交（write-behind），见 backend/write_behind.py
+    db_write_mode: str = field(default_factory=lambda: os.getenv("DB_WRITE_MODE", "sync").strip().lower())
+    db_write_batch_size: int = field(default_factory=lambda: _get_int("DB_WRITE_BATCH_SIZE", 256))
+    db_write_flush_ms: int = field(default_factory=lambda: _get_int("DB_WRITE_FLUSH_MS", 10))
+
     ai_provider: str = field(default_factory=lambda: os.getenv("AI_PROVIDER", "placeholder").strip().lower())
 
     ai_base_url: str = field(default_factory=lambda: os.getenv("AI_BASE_URL", "https://api.deepseek.com").strip())
@@ -42,8 +93,31 @@ class Settings:
     ai_temperature: float = field(default_factory=lambda: _get_float("AI_TEMPERATURE", 0.7))
     ai_timeout_seconds: int = field(default_factory=lambda: _get_int("AI_TIMEOUT_SECONDS", 30))
 
+    # 上游长连接池：host 数、每个 host 的连接上限、用满时是否排队、空闲回收秒数、启动预热连接数
+    ai_pool_connections: int = field(default_factory=lambda: _get_int("AI_POOL_CONNECTIONS", 4))
+    ai_pool_maxsize: int = field(default_factory=lambda: _get_int("AI_POOL_MAXSIZE", 16))
+    ai_pool_block: bool = field(default_factory=lambda: _get_bool("AI_POOL_BLOCK", False))
+    ai_pool_idle_seconds: float = field(default_factory=lambda: _get_float("AI_POOL_IDLE_SECONDS", 60.0))
+    ai_pool_warmup: int = field(default_factory=lambda: _get_int("AI_POOL_WARMUP", 0))
+    # 流式请求带 stream_options.include_usage，拿到上游的 usage（含前缀缓存命中数）；不支持该参数的上游请关掉
+    ai_stream_usage: bool = field(default_factory=lambda: _get_bool("AI_STREAM_USAGE", True))
+
     deepseek_api_key: str = field(default_factory=lambda: os.getenv("DEEPSEEK_API_KEY", "").strip())
 
+    # 备用端点（OpenAI 兼容），逗号分隔，每项 base_url[|model[|存放 API key 的环境变量名]]，model / key 缺省同主端点；
+    # 非空时主端点（AI_BASE_URL）与它们一起交给路由：熔断连续失败的端点，首字迟迟不到时向下一个端点对冲
+    ai_fallback_endpoints: str = field(default_factory=lambda: os.getenv("AI_FALLBACK_ENDPOINTS", "").strip())
+    router_hedge_enabled: bool = field(default_factory=lambda: _get_bool("ROUTER_HEDGE_ENABLED", True))
+    # 对冲延迟 = 该端点近期 TTFT 的第 N 百分位，限制在 [MIN, MAX] 毫秒内；样本不足时用 DEFAULT
+    router_hedge_percentile: float = field(default_factory=lambda: _get_float("ROUTER_HEDGE_PERCENTILE", 95.0))
+    router_hedge_min_ms: int = field(default_factory=lambda: _get_int("ROUTER_HEDGE_MIN_MS", 300))
+    router_hedge_max_ms: int = field(default_factory=lambda: _get_int("ROUTER_HEDGE_MAX_MS", 5000))
+    router_hedge_default_ms: int = field(default_factory=lambda: _get_int("ROUTER_HEDGE_DEFAULT_MS", 2000))
+    router_circuit_failures: int = field(default_factory=lambda: _get_int("ROUTER_CIRCUIT_FAILURES", 5))
+    router_circuit_open_seconds: float = field(
+        default_factory=lambda: _get_float("ROUTER_CIRCUIT_OPEN_SECONDS", 30.0)
+    )
+
     system_prompt: str = field(
         default_factory=lambda: os.getenv(
             "SYSTEM_PROMPT",
@@ -52,3 +126,91 @@ class Settings:
     )
 
     max_history_messages: int = field(default_factory=lambda: _get_int("MAX_HISTORY_MESSAGES", 20))
+    # >0 时改为按 token 预算挑选历史（system prompt 先预留），最多回看 CONTEXT_HISTORY_SCAN 条
+    context_token_budget: int = field(default_factory=lambda: _get_int("CONTEXT_TOKEN_BUDGET", 0))
+    context_history_scan: int = field(default_factory=lambda: _get_int("CONTEXT_HISTORY_SCAN", 200))
+    # 历史窗口按 N 条一块整块前移（prompt 前缀在两次前移之间保持不变，利于上游 prompt 缓存）；0（默认）= 逐条滑动
+    context_block_messages: int = field(default_factory=lambda: _get_int("CONTEXT_BLOCK_MESSAGES", 0))
+    # 按会话统计 prompt 稳定前缀 / 上游缓存命中率 / TTFT（/api/session/stats），最多跟踪这么多会话
+    prompt_cache_stats_sessions: int = field(default_factory=lambda: _get_int("PROMPT_CACHE_STATS_SESSIONS", 10000))
+
+    # asyncio WS server：阻塞的 provider/SQLite 调用放到有界线程池里跑（同时作为事件循环默认 executor），
+    # 非原生异步 provider 的流式分片经有界队列回到事件循环
+    ws_executor_workers: int = field(default_factory=lambda: _get_int("WS_EXECUTOR_WORKERS", 32))
+    ws_stream_queue_size: int = field(default_factory=lambda: _get_int("WS_STREAM_QUEUE_SIZE", 64))
+    # assistant_delta 合并：首个分片立即发，之后每个时间窗或攒够字节数发一帧（两个 WS 通道共用）
+    ws_delta_window_ms: int = field(default_factory=lambda: _get_int("WS_DELTA_WINDOW_MS", 20))
+    ws_delta_max_bytes: int = field(default_factory=lambda: _get_int("WS_DELTA_MAX_BYTES", 2048))
+    # 同步通道（Flask /ws、/api/chat/stream）读上游分片的线程上限；用满后新流在请求线程上直接读（不再按时间窗补发停顿前的尾巴）
+    stream_pump_threads: int = field(default_factory=lambda: _get_int("STREAM_PUMP_THREADS", 64))
+    # 断线续传：流式回复的 delta 按序号留在内存回放缓冲里，重连后发 resume 接着收，不重新调用上游；
+    # WS_RESUME_GRACE_SECONDS > 0 时连接断开后回复继续生成这么多秒，等客户端接手再取消；代价是断开的连接
+    # 仍在消耗上游 token。默认 0：断开立即取消（同 disconnect），已生成的部分仍可续传。多个 WS worker 时
+    # 重连多半落到别的进程，serve 会把宽限期强制为 0
+    ws_resume_enabled: bool = field(default_factory=lambda: _get_bool("WS_RESUME_ENABLED", True))
+    ws_resume_grace_seconds: float = field(default_factory=lambda: _get_float("WS_RESUME_GRACE_SECONDS", 0.0))
+    # 回放缓冲的淘汰：结束超过 TTL 秒的回复丢弃；总字节数 / 回复数超限时丢最旧的
+    replay_buffer_ttl_seconds: float = field(default_factory=lambda: _get_float("REPLAY_BUFFER_TTL_SECONDS", 120.0))
+    replay_buffer_max_bytes: int = field(default_factory=lambda: _get_int("REPLAY_BUFFER_MAX_BYTES", 32 * 1024 * 1024))
+    replay_buffer_max_streams: int = field(default_factory=lambda: _get_int("REPLAY_BUFFER_MAX_STREAMS", 10000))
+
+    # 会话上下文 LRU 缓存：热会话构建 prompt 时不再查库。缓存在进程内、不感知别的进程写库，
+    # 只有同一会话的请求总落在同一个进程时才安全，所以默认关闭；python -m backend.app（单进程）会打开
+    context_cache_enabled: bool = field(default_factory=lambda: _get_bool("CONTEXT_CACHE_ENABLED", False))
+    context_cache_max_sessions: int = field(default_factory=lambda: _get_int("CONTEXT_CACHE_MAX_SESSIONS", 10000))
+    context_cache_max_bytes: int = field(default_factory=lambda: _get_int("CONTEXT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+    # 合并完全相同的并发上游请求（同一份上下文同时到达时只调用一次上游，订阅者共享同一条流）
+    single_flight_enabled: bool = field(default_factory=lambda: _get_bool("SINGLE_FLIGHT_ENABLED", True))
+    # 同步流的上游驱动线程上限；用完时发起者在自己的线程上驱动（它离开时其余订阅者收到错误）
+    single_flight_max_threads: int = field(default_factory=lambda: _get_int("SINGLE_FLIGHT_MAX_THREADS", 32))
+
+    # 生成调度（准入控制，按进程计）：全局并发上限 + 有界等待队列（按会话轮转出队），
+    # 每会话 / 每客户端（IP）令牌桶，*_PER_MINUTE 为 0（默认）表示不限；队列满、等待超时或超速时拒绝并给出 retry_after
+    scheduler_enabled: bool = field(default_factory=lambda: _get_bool("SCHEDULER_ENABLED", True))
+    scheduler_max_concurrent: int = field(default_factory=lambda: _get_int("SCHEDULER_MAX_CONCURRENT", 32))
+    scheduler_max_queue: int = field(default_factory=lambda: _get_int("SCHEDULER_MAX_QUEUE", 128))
+    scheduler_max_wait_seconds: float = field(default_factory=lambda: _get_float("SCHEDULER_MAX_WAIT_SECONDS", 30.0))
+    scheduler_session_per_minute: float = field(
+        default_factory=lambda: _get_float("SCHEDULER_SESSION_PER_MINUTE", 0.0)
+    )
+    scheduler_session_burst: int = field(default_factory=lambda: _get_int("SCHEDULER_SESSION_BURST", 5))
+    scheduler_client_per_minute: float = field(default_factory=lambda: _get_float("SCHEDULER_CLIENT_PER_MINUTE", 0.0))
+    scheduler_client_burst: int = field(default_factory=lambda: _get_int("SCHEDULER_CLIENT_BURST", 20))
+
+    # 回复缓存：相同（归一化后的）消息列表 + 模型 + 温度直接回放缓存结果；REPLY_CACHE_DB_PATH 非空时启用 SQLite 二级缓存
+    reply_cache_enabled: bool = field(default_factory=lambda: _get_bool("REPLY_CACHE_ENABLED", False))
+    reply_cache_ttl_seconds: float = field(default_factory=lambda: _get_float("REPLY_CACHE_TTL_SECONDS", 3600.0))
+    reply_cache_max_entries: int = field(default_factory=lambda: _get_int("REPLY_CACHE_MAX_ENTRIES", 1024))
+    reply_cache_max_bytes: int = field(default_factory=lambda: _get_int("REPLY_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+    reply_cache_db_path: str = field(default_factory=lambda: os.getenv("REPLY_CACHE_DB_PATH", "").strip())
+    reply_cache_sqlite_max_entries: int = field(
+        default_factory=lambda: _get_int("REPLY_CACHE_SQLITE_MAX_ENTRIES", 100000)
+    )
+
+    # 滚动摘要：会话里未被摘要覆盖的消息超过阈值（0 = MAX_HISTORY_MESSAGES）时，后台把较早的消息折叠进摘要，
+    # 只保留最近 SUMMARY_KEEP_RECENT 条原文；SUMMARY_MODEL 非空时摘要改用这个（通常更便宜的）模型
+    summary_enabled: bool = field(default_factory=lambda: _get_bool("SUMMARY_ENABLED", False))
+    summary_trigger_messages: int = field(default_factory=lambda: _get_int("SUMMARY_TRIGGER_MESSAGES", 0))
+    summary_keep_recent: int = field(default_factory=lambda: _get_int("SUMMARY_KEEP_RECENT", 8))
+    summary_batch_messages: int = field(default_factory=lambda: _get_int("SUMMARY_BATCH_MESSAGES", 100))
+    summary_model: str = field(default_factory=lambda: os.getenv("SUMMARY_MODEL", "").strip())
+
+    # 保留期：updated_at 早于 RETENTION_TTL_DAYS 天的会话被压缩搬进 ARCHIVE_DB_PATH（/api/session 仍可读到），
+    # 之后分步 incremental_vacuum；RETENTION_ENABLED=false 时只能手动执行 python -m backend.manage retention
+    archive_db_path: str = field(
+        default_factory=lambda: os.getenv("ARCHIVE_DB_PATH", os.path.join("backend", "data", "archive.db")).strip()
+    )
+    retention_enabled: bool = field(default_factory=lambda: _get_bool("RETENTION_ENABLED", False))
+    retention_ttl_days: float = field(default_factory=lambda: _get_float("RETENTION_TTL_DAYS", 180.0))
+    retention_interval_minutes: float = field(default_factory=lambda: _get_float("RETENTION_INTERVAL_MINUTES", 60.0))
+    retention_batch_sessions: int = field(default_factory=lambda: _get_int("RETENTION_BATCH_SESSIONS", 50))
+    retention_batch_messages: int = field(default_factory=lambda: _get_int("RETENTION_BATCH_MESSAGES", 5000))
+    retention_pause_ms: int = field(default_factory=lambda: _get_int("RETENTION_PAUSE_MS", 100))
+    vacuum_pages_per_step: int = field(default_factory=lambda: _get_int("VACUUM_PAGES_PER_STEP", 512))
+
+    # 全文搜索：messages_fts（FTS5）的分词器，trigram 适合中文子串检索。默认留空：不建索引、/api/search 不可用，
+    # 每次写消息也不多一份索引开销；开启后执行一次 python -m backend.manage fts-backfill 把已有消息补进索引
+    search_tokenizer: str = field(default_factory=lambda: os.getenv("SEARCH_TOKENIZER", "").strip())
+    # 允许不带 session_id 的全库搜索（会返回所有会话的消息：只适合单用户部署）
+    search_allow_global: bool = field(default_factory=lambda: _get_bool("SEARCH_ALLOW_GLOBAL", False))
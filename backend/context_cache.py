@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from backend.storage_sqlite import StoredMessage, StoredSummary
+
+
+# 每条缓存消息/每个会话的固定开销估算（dict/deque/对象头），只用于内存上限的近似计费
+_MESSAGE_OVERHEAD = 120
+_ENTRY_OVERHEAD = 400
+
+
+def _message_cost(m: StoredMessage) -> int:
+    return _MESSAGE_OVERHEAD + len(m.role) + len(m.content.encode("utf-8"))
+
+
+class _Entry:
+    __slots__ = ("prompt", "prompt_loaded", "summary", "summary_loaded", "window", "capacity", "cost")
+
+    def __init__(self) -> None:
+        self.prompt: Optional[str] = None
+        self.prompt_loaded = False
+        self.summary: Optional[StoredSummary] = None
+        self.summary_loaded = False
+        self.window: Optional[Deque[StoredMessage]] = None
+        self.capacity = 0
+        self.cost = _ENTRY_OVERHEAD
+
+
+class SessionContextCache:
+    """Bounded LRU of per-session context windows and stored system prompts.
+
+    窗口保存“最近 capacity 条消息”，追加消息时增量更新；读路径填充缓存时用 fill 代号
+    防止“读库期间又有新消息写入”导致缓存旧窗口。
+    """
+
+    def __init__(self, *, max_sessions: int = 10000, max_bytes: int = 64 * 1024 * 1024):
+        self._max_sessions = max(1, int(max_sessions))
+        self._max_bytes = max(0, int(max_bytes))
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # session_id -> [写入代号, 正在填充的读者数]
+        self._fills: Dict[str, List[int]] = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    # ---- 读 ----
+
+    def get_window(self, session_id: str, limit: int) -> Optional[List[StoredMessage]]:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry.window is None or entry.capacity < limit:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self._hits += 1
+            window = list(entry.window)
+        return window[-limit:] if limit < len(window) else window
+
+    def get_prompt(self, session_id: str) -> Tuple[bool, Optional[str]]:
+        """Return (found, stored_prompt); stored_prompt may legitimately be None."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or not entry.prompt_loaded:
+                self._misses += 1
+                return False, None
+            self._entries.move_to_end(session_id)
+            self._hits += 1
+            return True, entry.prompt
+
+    def get_summary(self, session_id: str) -> Tuple[bool, Optional[StoredSummary]]:
+        """Return (found, summary); not counted in hits/misses (only read when compaction is on)."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or not entry.summary_loaded:
+                return False, None
+            return True, entry.summary
+
+    # ---- 填充 ----
+
+    def begin_fill(self, session_id: str) -> int:
+        with self._lock:
+            rec = self._fills.setdefault(session_id, [0, 0])
+            rec[1] += 1
+            return rec[0]
+
+    def end_fill(
+        self,
+        session_id: str,
+        token: int,
+        *,
+        window: Optional[List[StoredMessage]] = None,
+        capacity: int = 0,
+        prompt: Optional[str] = None,
+        prompt_loaded: bool = False,
+        summary: Optional[StoredSummary] = None,
+        summary_loaded: bool = False,
+    ) -> None:
+        with self._lock:
+            rec = self._fills.get(session_id)
+            if rec is None:
+                return
+            rec[1] -= 1
+            fresh = rec[0] == token
+            if rec[1] <= 0:
+                del self._fills[session_id]
+            if not fresh:
+                return
+            entry = self._entry(session_id)
+            if window is not None:
+                self._set_window(entry, window, capacity)
+            if prompt_loaded:
+                entry.prompt = prompt
+                entry.prompt_loaded = True
+            if summary_loaded:
+                cost = len(summary.content.encode("utf-8")) if summary is not None else 0
+                old = len(entry.summary.content.encode("utf-8")) if entry.summary is not None else 0
+                entry.summary = summary
+                entry.summary_loaded = True
+                entry.cost += cost - old
+                self._bytes += cost - old
+            self._evict()
+
+    # ---- 增量更新（在对应的 store 写入成功之后调用）----
+
+    def append(self, session_id: str, role: str, content: str, token_count: int = 0) -> None:
+        with self._lock:
+            rec = self._fills.get(session_id)
+            if rec is not None:
+                rec[0] += 1
+            entry = self._entries.get(session_id)
+            if entry is None or entry.window is None:
+                return
+            # 窗口是从库里整段读来的，序号接着最后一条编；窗口为空说明会话本来就没有消息
+            last = entry.window[-1].seq if entry.window else 0
+            seq = last + 1 if last or not entry.window else 0
+            m = StoredMessage(role=role, content=content, token_count=token_count, seq=seq)
+            entry.window.append(m)
+            cost = _message_cost(m)
+            while len(entry.window) > entry.capacity:
+                cost -= _message_cost(entry.window.popleft())
+            entry.cost += cost
+            self._bytes += cost
+            self._entries.move_to_end(session_id)
+            self._evict()
+
+    def set_prompt(self, session_id: str, prompt: Optional[str]) -> None:
+        with self._lock:
+            rec = self._fills.get(session_id)
+            if rec is not None:
+                rec[0] += 1
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            entry.prompt = prompt
+            entry.prompt_loaded = True
+
+    def invalidate(self, session_id: str) -> None:
+        with self._lock:
+            rec = self._fills.get(session_id)
+            if rec is not None:
+                rec[0] += 1
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self._bytes -= entry.cost
+
+    def clear(self) -> None:
+        with self._lock:
+            for rec in self._fills.values():
+                rec[0] += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    # ---- 内部 ----
+
+    def _entry(self, session_id: str) -> _Entry:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            entry = _Entry()
+            self._entries[session_id] = entry
+            self._bytes += entry.cost
+        else:
+            self._entries.move_to_end(session_id)
+        return entry
+
+    def _set_window(self, entry: _Entry, window: List[StoredMessage], capacity: int) -> None:
+        old = sum(_message_cost(m) for m in entry.window) if entry.window is not None else 0
+        new = sum(_message_cost(m) for m in window)
+        entry.window = deque(window)
+        entry.capacity = max(int(capacity), len(window))
+        entry.cost += new - old
+        self._bytes += new - old
+
+    def _evict(self) -> None:
+        while self._entries and (
+            len(self._entries) > self._max_sessions or (self._max_bytes and self._bytes > self._max_bytes)
+        ):
+            _sid, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.cost
+            self._evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "sessions": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": (self._hits / lookups) if lookups else 0.0,
+                "evictions": self._evictions,
+            }
@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import functools
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Optional
+
+from backend.metrics import UPSTREAM_CONNECT_SECONDS
+
+if TYPE_CHECKING:  # pragma: no cover
+    import requests
+
+
+class PoolStats:
+    """Thread-safe counters shared by the sync and asyncio upstream pools."""
+
+    FIELDS = ("requests", "new_connections", "reused_connections", "expired_connections", "saturated")
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {name: 0 for name in self.FIELDS}
+
+    def incr(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+
+@dataclass
+class PoolConfig:
+    # pool_connections：缓存多少个 host 的连接池；pool_maxsize：每个 host 最多保留多少条长连接
+    pool_connections: int = 4
+    pool_maxsize: int = 16
+    # 连接池用满时：True=排队等待空闲连接，False=临时新建一条（用完即关）
+    pool_block: bool = False
+    idle_seconds: float = 60.0
+    warmup_connections: int = 0
+
+
+def abort_response(resp: requests.Response) -> None:
+    """Unblock a thread reading a streamed `resp` from any other thread by shutting its socket down.
+
+    只 shutdown，不 close：读线程随后从 recv 返回（报错或 EOF），由它自己在 finally 里 `resp.close()`，
+    这条读了一半的连接会被丢弃而不是放回池里。
+    """
+    conn = getattr(getattr(resp, "raw", None), "_connection", None)
+    sock = getattr(conn, "sock", None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        # 已经关闭 / 对端先断开
+        pass
+
+
+class _CountingPoolMixin:
+    """Record reuse / saturation and drop connections that idled past `idle_seconds`."""
+
+    aichat_stats: Optional[PoolStats] = None
+    aichat_idle_seconds: float = 0.0
+
+    def _get_conn(self, timeout=None):  # type: ignore[no-untyped-def]
+        stats = self.aichat_stats
+        pool = getattr(self, "pool", None)
+        if stats is not None and pool is not None and pool.empty():
+            stats.incr("saturated")
+
+        conn = super()._get_conn(timeout)  # type: ignore[misc]
+
+        idle_since = getattr(conn, "_aichat_idle_since", None)
+        if (
+            getattr(conn, "sock", None) is not None
+            and idle_since is not None
+            and self.aichat_idle_seconds > 0
+            and time.monotonic() - idle_since > self.aichat_idle_seconds
+        ):
+            # 服务端/中间设备大多会回收空闲连接，超龄连接直接重建比踩到半开连接更划算
+            conn.close()
+            if stats is not None:
+                stats.incr("expired_connections")
+
+        if stats is not None:
+            stats.incr("requests")
+            stats.incr("reused_connections" if getattr(conn, "sock", None) is not None else "new_connections")
+        return conn
+
+    def _put_conn(self, conn) -> None:  # type: ignore[no-untyped-def]
+        if conn is not None:
+            conn._aichat_idle_since = time.monotonic()
+        super()._put_conn(conn)  # type: ignore[misc]
+
+
+class _TimedConnectMixin:
+    def connect(self) -> None:
+        t0 = time.perf_counter()
+        super().connect()  # type: ignore[misc]
+        UPSTREAM_CONNECT_SECONDS.observe(time.perf_counter() - t0, "sync")
+
+
+@functools.lru_cache(maxsize=None)
+def _adapter_class() -> type:
+    """The pooled `HTTPAdapter` subclass, built on first use.
+
+    requests / urllib3 在这里才导入（约占进程 import 时间的四分之一）：只用 asyncio 通道、
+    或者 worker 还在预热时，import 本模块不必付这笔开销。
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class _TimedHTTPConnection(_TimedConnectMixin, HTTPConnection):
+        pass
+
+    class _TimedHTTPSConnection(_TimedConnectMixin, HTTPSConnection):
+        pass
+
+    class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+        ConnectionCls = _TimedHTTPConnection
+
+    class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+        ConnectionCls = _TimedHTTPSConnection
+
+    class _PooledAdapter(HTTPAdapter):
+        def __init__(self, config: PoolConfig, stats: PoolStats):
+            self._aichat_config = config
+            self._aichat_stats = stats
+            super().__init__(
+                pool_connections=max(1, int(config.pool_connections)),
+                pool_maxsize=max(1, int(config.pool_maxsize)),
+                pool_block=bool(config.pool_block),
+            )
+
+        def init_poolmanager(self, *args, **kwargs):  # type: ignore[no-untyped-def]
+            super().init_poolmanager(*args, **kwargs)
+            config, stats = self._aichat_config, self._aichat_stats
+
+            def make(base):  # type: ignore[no-untyped-def]
+                return type(
+                    base.__name__,
+                    (base,),
+                    {"aichat_stats": stats, "aichat_idle_seconds": float(config.idle_seconds)},
+                )
+
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": make(_CountingHTTPConnectionPool),
+                "https": make(_CountingHTTPSConnectionPool),
+            }
+
+    return _PooledAdapter
+
+
+class PooledHTTP:
+    """A keep-alive `requests.Session` shared by Flask worker threads and the WS thread."""
+
+    def __init__(self, config: Optional[PoolConfig] = None, stats: Optional[PoolStats] = None):
+        self.config = config or PoolConfig()
+        self.stats = stats or PoolStats()
+        self._session: Optional[requests.Session] = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        session = self._session
+        if session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+
+                    s = requests.Session()
+                    adapter = _adapter_class()(self.config, self.stats)
+                    s.mount("http://", adapter)
+                    s.mount("https://", adapter)
+                    self._session = s
+                session = self._session
+        return session
+
+    def post(self, url: str, **kwargs) -> requests.Response:  # type: ignore[no-untyped-def]
+        return self.session.post(url, **kwargs)
+
+    def warm_up(self, url: str, n: Optional[int] = None, timeout: float = 5.0) -> int:
+        """Open up to `n` connections to `url`'s host ahead of the first turn; return how many succeeded.
+
+        `n` 为 0 时也会建好 Session（连同 requests 的导入），首个请求不再付这笔开销。
+        """
+        n = self.config.warmup_connections if n is None else n
+        n = min(max(0, int(n)), max(1, int(self.config.pool_maxsize)))
+        session = self.session
+        if n <= 0:
+            return 0
+
+        pool = self._pool_for(session, url)
+        conns = []
+        opened = 0
+        try:
+            for _ in range(n):
+                # 绕过计数层：预热不算作业务请求
+                conn = super(_CountingPoolMixin, pool)._get_conn(timeout=timeout)
+                conns.append(conn)
+                if getattr(conn, "sock", None) is None:
+                    conn.timeout = timeout
+                    try:
+                        conn.connect()
+                        opened += 1
+                    except Exception:
+                        # 预热失败不影响启动，首个请求会按正常路径建连并报错
+                        conn.close()
+                        break
+        finally:
+            for conn in conns:
+                pool._put_conn(conn)
+        return opened
+
+    @staticmethod
+    def _pool_for(session, url: str):  # type: ignore[no-untyped-def]
+        """The urllib3 pool `session.post(url)` will draw from."""
+        adapter = session.get_adapter(url)
+        if hasattr(adapter, "get_connection_with_tls_context"):
+            # requests >= 2.32 按 TLS 参数（verify / cert）给连接池分键，
+            # 直接 connection_from_url 拿到的是另一个池，预热的连接业务请求用不上
+            from requests import Request
+
+            # verify / cert 同 Session.request 一样合并环境变量（REQUESTS_CA_BUNDLE 等）
+            env = session.merge_environment_settings(url, {}, None, None, None)
+            request = Request("POST", url).prepare()
+            return adapter.get_connection_with_tls_context(
+                request, env["verify"], proxies=env["proxies"], cert=env["cert"]
+            )
+        return adapter.get_connection(url)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
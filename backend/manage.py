@@ -0,0 +1,128 @@
+"""Maintenance commands for chat.db (run while the server is up or down).
+
+    python -m backend.manage stats
+    python -m backend.manage retention --dry-run
+    python -m backend.manage retention [--ttl-days 90] [--max-batches N]
+    python -m backend.manage vacuum [--max-pages N]
+    python -m backend.manage vacuum --enable      # 老库一次性切换到 auto_vacuum=INCREMENTAL（完整 VACUUM，需停服）
+    python -m backend.manage fts-backfill [--batch 2000] [--pause-ms 50]
+    python -m backend.manage fts-backfill --rebuild   # 一个事务重建整个索引（需停服）
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Iterable, Optional
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from backend.config import Settings, load_env  # noqa: E402
+from backend.retention import ArchiveStore, RetentionManager  # noqa: E402
+from backend.search import MessageSearch  # noqa: E402
+from backend.storage_sqlite import SQLiteStore, SQLiteTuning  # noqa: E402
+
+
+def _open(settings: Settings):  # type: ignore[no-untyped-def]
+    store = SQLiteStore(
+        settings.db_path,
+        tuning=SQLiteTuning(
+            synchronous=settings.sqlite_synchronous,
+            busy_timeout_ms=settings.sqlite_busy_timeout_ms,
+            auto_vacuum=settings.sqlite_auto_vacuum,
+        ),
+        # 必须与服务端一致：分词器不同（或为空）会重建 / 删除索引
+        fts_tokenizer=settings.search_tokenizer,
+    )
+    archive = ArchiveStore(settings.archive_db_path) if settings.archive_db_path else None
+    return store, archive
+
+
+def _manager(
+    settings: Settings, store: SQLiteStore, archive: Optional[ArchiveStore], ttl_days: Optional[float] = None
+) -> RetentionManager:
+    return RetentionManager(
+        store,
+        archive,
+        ttl_days=settings.retention_ttl_days if ttl_days is None else ttl_days,
+        batch_sessions=settings.retention_batch_sessions,
+        batch_messages=settings.retention_batch_messages,
+        pause_ms=settings.retention_pause_ms,
+        vacuum_pages=settings.vacuum_pages_per_step,
+    )
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m backend.manage",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("stats", help="database / archive size and free pages")
+
+    p_ret = sub.add_parser("retention", help="archive sessions idle for longer than the TTL")
+    p_ret.add_argument("--ttl-days", type=float, default=None, help="override RETENTION_TTL_DAYS")
+    p_ret.add_argument("--max-batches", type=int, default=None)
+    p_ret.add_argument("--dry-run", action="store_true", help="only count expired sessions")
+    p_ret.add_argument("--no-vacuum", action="store_true", help="skip incremental vacuum afterwards")
+
+    p_vac = sub.add_parser("vacuum", help="paced incremental vacuum")
+    p_vac.add_argument("--max-pages", type=int, default=None)
+    p_vac.add_argument("--enable", action="store_true", help="switch an existing db to auto_vacuum=INCREMENTAL")
+
+    p_fts = sub.add_parser("fts-backfill", help="index messages written before search was enabled")
+    p_fts.add_argument("--batch", type=int, default=2000, help="message ids per write transaction")
+    p_fts.add_argument("--pause-ms", type=int, default=50)
+    p_fts.add_argument("--max-batches", type=int, default=None)
+    p_fts.add_argument("--rebuild", action="store_true", help="re-index everything in one transaction")
+
+    args = parser.parse_args(argv)
+    load_env()
+    settings = Settings()
+    if args.command == "retention" and not settings.archive_db_path:
+        parser.error("ARCHIVE_DB_PATH is empty: archiving needs somewhere to put old sessions")
+    store, archive = _open(settings)
+    try:
+        if args.command == "stats":
+            out = {
+                "db_path": settings.db_path,
+                "db": store.space_stats(),
+                "archive": archive.stats() if archive is not None else None,
+            }
+        elif args.command == "retention":
+            manager = _manager(settings, store, archive, args.ttl_days)
+            if args.dry_run:
+                out = {"ttl_days": manager.ttl_days, "expired_sessions": manager.expired_count()}
+            else:
+                out = {"archive": manager.archive_expired(max_batches=args.max_batches)}
+                if not args.no_vacuum:
+                    out["vacuum"] = manager.vacuum()
+        elif args.command == "fts-backfill":
+            search = MessageSearch(store)
+            if not search.available:
+                parser.error("full-text search is unavailable (SEARCH_TOKENIZER empty or unsupported by this SQLite)")
+            if args.rebuild:
+                search.rebuild()
+                p = search.progress()
+                out = {"rebuilt": True, "indexed_until": p.indexed_until, "target": p.target}
+            else:
+                out = search.backfill(batch_size=args.batch, pause_ms=args.pause_ms, max_batches=args.max_batches)
+        else:
+            if args.enable:
+                store.enable_incremental_vacuum()
+            out = _manager(settings, store, archive).vacuum(max_pages=args.max_pages)
+            out["db"] = store.space_stats()
+    finally:
+        store.close()
+    print(json.dumps(out, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
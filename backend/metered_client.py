@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+from backend.ai_client import AIClientError, BaseAIClient, GenerationCancelled, Message, RequestOptions, aclose_stream
+from backend.metrics import (
+    AI_CLIENT_ERRORS,
+    GENERATION_SECONDS,
+    UPSTREAM_TOKENS_PER_SECOND,
+    UPSTREAM_TTFT_SECONDS,
+)
+from backend.tokens import estimate_tokens
+
+
+class _StreamTimer:
+    __slots__ = ("t0", "first", "parts")
+
+    def __init__(self) -> None:
+        self.t0 = time.perf_counter()
+        self.first: Optional[float] = None
+        self.parts: List[str] = []
+
+    def chunk(self, chunk: str) -> None:
+        if self.first is None:
+            self.first = time.perf_counter()
+            UPSTREAM_TTFT_SECONDS.observe(self.first - self.t0)
+        self.parts.append(chunk)
+
+    def done(self) -> None:
+        end = time.perf_counter()
+        GENERATION_SECONDS.observe(end - self.t0, "stream")
+        if self.first is not None and end > self.first:
+            tokens = estimate_tokens("".join(self.parts))
+            UPSTREAM_TOKENS_PER_SECOND.observe(tokens / (end - self.first))
+
+
+def _count_error(e: AIClientError) -> None:
+    # 调用方主动取消不是上游故障（取消次数见 aichat_generations_cancelled_total）
+    if isinstance(e, GenerationCancelled):
+        return
+    AI_CLIENT_ERRORS.inc(str(e) or "unknown")
+
+
+class MeteredAIClient(BaseAIClient):
+    """Record TTFT / tokens-per-sec / total time / error reasons for the provider it wraps.
+
+    包在最内层（真正的 provider 外面），single-flight 与回复缓存在它外面，所以这里的数字就是上游调用本身。
+    被中途关闭的流只计 TTFT，不计总耗时与吐字速度。
+    """
+
+    def __init__(self, inner: BaseAIClient):
+        self.inner = inner
+
+    @property
+    def model(self) -> str:
+        return str(getattr(self.inner, "model", ""))
+
+    @property
+    def temperature(self) -> float:
+        return float(getattr(self.inner, "temperature", 0.0) or 0.0)
+
+    def generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        t0 = time.perf_counter()
+        try:
+            reply = self.inner.generate(messages, options)
+        except AIClientError as e:
+            _count_error(e)
+            raise
+        GENERATION_SECONDS.observe(time.perf_counter() - t0, "generate")
+        return reply
+
+    def stream_generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> Iterable[str]:
+        timer = _StreamTimer()
+        try:
+            for chunk in self.inner.stream_generate(messages, options):
+                timer.chunk(chunk)
+                yield chunk
+        except AIClientError as e:
+            _count_error(e)
+            raise
+        timer.done()
+
+    async def agenerate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        t0 = time.perf_counter()
+        try:
+            reply = await self.inner.agenerate(messages, options)
+        except AIClientError as e:
+            _count_error(e)
+            raise
+        GENERATION_SECONDS.observe(time.perf_counter() - t0, "generate")
+        return reply
+
+    async def astream_generate(
+        self, messages: List[Message], options: Optional[RequestOptions] = None
+    ) -> AsyncIterator[str]:
+        timer = _StreamTimer()
+        stream = self.inner.astream_generate(messages, options)
+        try:
+            async for chunk in stream:
+                timer.chunk(chunk)
+                yield chunk
+        except AIClientError as e:
+            _count_error(e)
+            raise
+        finally:
+            await aclose_stream(stream)
+        timer.done()
+
+    def summarize(self, previous: str, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        t0 = time.perf_counter()
+        try:
+            summary = self.inner.summarize(previous, messages, options)
+        except AIClientError as e:
+            _count_error(e)
+            raise
+        GENERATION_SECONDS.observe(time.perf_counter() - t0, "summarize")
+        return summary
+
+    def warm_up(self) -> None:
+        self.inner.warm_up()
+
+    async def awarm_up(self) -> None:
+        await self.inner.awarm_up()
+
+    def pool_stats(self) -> Dict[str, int]:
+        return self.inner.pool_stats()
@@ -0,0 +1,328 @@
+from __future__ import annotations
+
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple, TypeVar
+
+
+# 延迟类直方图的默认分桶（秒）：覆盖 SQLite 的亚毫秒级到上游生成的几十秒
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+RATE_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 35.0, 50.0, 75.0, 100.0, 150.0, 250.0, 500.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _check(self, values: LabelValues) -> None:
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {values}")
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            value = self._values.get(labels)
+            if value is None:
+                self._check(labels)
+                value = 0.0
+            self._values[labels] = value + amount
+
+    def value(self, *labels: str) -> float:
+        with self._lock:
+            return self._values.get(labels, 0.0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            value = self._values.get(labels)
+            if value is None:
+                self._check(labels)
+                value = 0.0
+            self._values[labels] = value + amount
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str) -> None:
+        self._check(labels)
+        with self._lock:
+            self._values[labels] = float(value)
+
+    @contextmanager
+    def track(self, *labels: str) -> Iterator[None]:
+        """+1 for the duration of the block."""
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+    def value(self, *labels: str) -> float:
+        with self._lock:
+            return self._values.get(labels, 0.0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram; `observe` is a bisect plus two adds under a lock."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        # labels -> [每个桶的（非累计）计数..., +Inf 桶]、sum
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(labels)
+            if counts is None:
+                self._check(labels)
+                counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+                self._sums[labels] = 0.0
+            counts[i] += 1
+            self._sums[labels] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def count(self, *labels: str) -> int:
+        with self._lock:
+            return sum(self._counts.get(labels, ()))
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            snapshot = [(k, list(v), self._sums[k]) for k, v in sorted(self._counts.items())]
+        lines: List[str] = []
+        for labels, counts, total in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="' + _num(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_num(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], List[str]]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: "_M") -> "_M":
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect: Callable[[], List[str]]) -> None:
+        """Register a callable that renders extra exposition lines at scrape time."""
+        with self._lock:
+            self._collectors.append(collect)
+
+    def render(self, collectors: Sequence[Callable[[], List[str]]] = ()) -> str:
+        """Exposition text: registered metrics and collectors, then the per-scrape `collectors`."""
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = self._collectors + list(collectors)
+        lines: List[str] = []
+        for m in metrics:
+            lines.extend(m.render())
+        for collect in collectors:
+            try:
+                lines.extend(collect())
+            except Exception:
+                # 采集失败不能让整个 /api/metrics 报错
+                continue
+        return "\n".join(lines) + "\n"
+
+
+_M = TypeVar("_M", bound=_Metric)
+
+REGISTRY = Registry()
+
+
+def gauge_lines(name: str, help_text: str, values: Dict[str, float], label: str = "") -> List[str]:
+    """Render a dict of numbers as one gauge (optionally labelled by key) for `add_collector`."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for key, value in sorted(values.items()):
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        lines.append(f"{name}{_labels((label,), (key,)) if label else ''} {_num(value)}")
+    return lines
+
+
+# ---- 热路径指标 ----
+
+UPSTREAM_CONNECT_SECONDS = REGISTRY.register(
+    Histogram("aichat_upstream_connect_seconds", "TCP/TLS connect time to the AI provider.", ("transport",))
+)
+UPSTREAM_TTFT_SECONDS = REGISTRY.register(
+    Histogram("aichat_upstream_ttft_seconds", "Time from request to first streamed chunk.")
+)
+UPSTREAM_TOKENS_PER_SECOND = REGISTRY.register(
+    Histogram(
+        "aichat_upstream_tokens_per_second",
+        "Estimated output tokens/sec after the first chunk.",
+        buckets=RATE_BUCKETS,
+    )
+)
+GENERATION_SECONDS = REGISTRY.register(
+    Histogram("aichat_generation_seconds", "Total provider call time.", ("mode",))
+)
+AI_CLIENT_ERRORS = REGISTRY.register(
+    Counter("aichat_ai_client_errors_total", "AIClientError raised by the provider, by reason.", ("reason",))
+)
+SQLITE_OP_SECONDS = REGISTRY.register(
+    Histogram("aichat_sqlite_op_seconds", "SQLiteStore operation latency.", ("op",))
+)
+BUILD_MESSAGES_SECONDS = REGISTRY.register(
+    Histogram("aichat_build_messages_seconds", "ChatService._build_messages time.")
+)
+WS_CONNECTIONS = REGISTRY.register(
+    Gauge("aichat_ws_connections", "Open WebSocket connections.", ("server",))
+)
+GENERATIONS_IN_FLIGHT = REGISTRY.register(
+    Gauge("aichat_generations_in_flight", "Replies currently being generated.", ("server",))
+)
+GENERATIONS_CANCELLED = REGISTRY.register(
+    Counter(
+        "aichat_generations_cancelled_total",
+        "Streamed replies stopped before completion (cancel / disconnect / superseded).",
+        ("reason",),
+    )
+)
+ROUTER_ATTEMPTS = REGISTRY.register(
+    Counter(
+        "aichat_router_attempts_total",
+        "Upstream attempts per routed endpoint (ok / error / closed early: hedge lost or caller stopped).",
+        ("endpoint", "outcome"),
+    )
+)
+ROUTER_HEDGES = REGISTRY.register(
+    Counter("aichat_router_hedges_total", "Hedged streams by which attempt answered first.", ("winner",))
+)
+SCHEDULER_WAIT_SECONDS = REGISTRY.register(
+    Histogram("aichat_scheduler_wait_seconds", "Time a turn waited for a generation slot.")
+)
+SCHEDULER_REJECTED = REGISTRY.register(
+    Counter(
+        "aichat_scheduler_rejected_total",
+        "Turns refused by the generation scheduler (queue_full / queue_timeout / *_rate_limited).",
+        ("reason",),
+    )
+)
+PROMPT_TOKENS = REGISTRY.register(
+    Counter(
+        "aichat_prompt_tokens_total",
+        "Prompt tokens reported by the provider, split by whether its prefix cache served them.",
+        ("cache",),
+    )
+)
+PROMPT_CACHE_TTFT_SECONDS = REGISTRY.register(
+    Histogram(
+        "aichat_prompt_cache_ttft_seconds",
+        "Time to first chunk of a streamed turn by provider prefix-cache outcome (hit / partial / miss / unknown).",
+        ("cache",),
+    )
+)
+
+
+_F = TypeVar("_F", bound=Callable[..., object])
+
+
+def timed(histogram: Histogram, *labels: str) -> Callable[[_F], _F]:
+    """Decorator: observe the wrapped call's duration (also when it raises)."""
+
+    def decorate(fn: _F) -> _F:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):  # type: ignore[no-untyped-def]
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - t0, *labels)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorate
+
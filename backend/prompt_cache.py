@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from backend.ai_client import Usage
+from backend.metrics import PROMPT_CACHE_TTFT_SECONDS, PROMPT_TOKENS
+
+
+def _fingerprint(messages: Sequence[Mapping[str, str]]) -> Tuple[int, ...]:
+    # 进程内比较前后两轮的 prompt，用内置 hash 就够了（不跨进程、不落盘）
+    return tuple(hash((m.get("role", ""), m.get("content", ""))) for m in messages)
+
+
+def cache_outcome(usage: Optional[Usage]) -> str:
+    """hit / partial / miss / unknown, by the share of prompt tokens the provider served from its cache."""
+    ratio = usage.hit_ratio if usage is not None else None
+    if ratio is None:
+        return "unknown"
+    if ratio >= 0.8:
+        return "hit"
+    return "partial" if ratio > 0 else "miss"
+
+
+class _SessionStats:
+    __slots__ = (
+        "fingerprint",
+        "tokens",
+        "prefix_tokens",
+        "prompt_estimate",
+        "turns",
+        "reported_turns",
+        "prompt_tokens",
+        "cached_tokens",
+        "completion_tokens",
+        "prefix_total",
+        "ttft_total",
+        "ttft_turns",
+        "last_hit_ratio",
+        "last_ttft",
+    )
+
+    def __init__(self) -> None:
+        self.fingerprint: Tuple[int, ...] = ()
+        self.tokens: List[int] = []
+        self.prefix_tokens = 0
+        self.prompt_estimate = 0
+        self.turns = 0
+        self.reported_turns = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.prefix_total = 0
+        self.ttft_total = 0.0
+        self.ttft_turns = 0
+        self.last_hit_ratio: Optional[float] = None
+        self.last_ttft: Optional[float] = None
+
+
+class PromptCacheTracker:
+    """Per-session view of how well prompts line up with the provider's prefix cache.
+
+    每轮记两件事：
+    - `observe_prompt`：本轮 prompt 与上一轮 prompt 的公共前缀（按消息对齐）有多少 token —— 这是我们这边
+      “理论上可被上游缓存”的部分，窗口滑动时它会掉到只剩 system prompt；
+    - `record_turn`：上游实际报告的 usage（缓存命中 token 数）和首 token 延迟。
+
+    只统计本进程、只在内存里，按会话 LRU 限量；多进程部署时每个 worker 各看各的。
+    """
+
+    def __init__(self, *, max_sessions: int = 10000):
+        self._max_sessions = max(1, int(max_sessions))
+        self._sessions: "OrderedDict[str, _SessionStats]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._totals = {
+            "turns": 0,
+            "reported_turns": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "estimated_prompt_tokens": 0,
+            "stable_prefix_tokens": 0,
+            "evictions": 0,
+        }
+
+    def _entry(self, session_id: str) -> _SessionStats:
+        # 调用方持锁
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            entry = self._sessions[session_id] = _SessionStats()
+            while len(self._sessions) > self._max_sessions:
+                self._sessions.popitem(last=False)
+                self._totals["evictions"] += 1
+        else:
+            self._sessions.move_to_end(session_id)
+        return entry
+
+    def observe_prompt(self, session_id: str, messages: Sequence[Mapping[str, str]], tokens: Sequence[int]) -> int:
+        """Remember this turn's prompt; returns the tokens of its prefix shared with the previous turn's prompt."""
+        fingerprint = _fingerprint(messages)
+        with self._lock:
+            entry = self._entry(session_id)
+            prefix = 0
+            for i, (old, new) in enumerate(zip(entry.fingerprint, fingerprint)):
+                if old != new:
+                    break
+                prefix += tokens[i]
+            entry.fingerprint = fingerprint
+            entry.tokens = list(tokens)
+            entry.prefix_tokens = prefix
+            entry.prompt_estimate = sum(tokens)
+            entry.prefix_total += prefix
+            entry.turns += 1
+            t = self._totals
+            t["turns"] += 1
+            t["estimated_prompt_tokens"] += entry.prompt_estimate
+            t["stable_prefix_tokens"] += prefix
+        return prefix
+
+    def record_turn(self, session_id: str, usage: Optional[Usage], ttft_seconds: Optional[float]) -> None:
+        """Attach the provider-reported usage and the observed TTFT to the session's latest turn."""
+        if ttft_seconds is not None:
+            PROMPT_CACHE_TTFT_SECONDS.observe(ttft_seconds, cache_outcome(usage))
+        if usage is not None and usage.cached_tokens is not None:
+            PROMPT_TOKENS.inc("cached", amount=usage.cached_tokens)
+            PROMPT_TOKENS.inc("uncached", amount=max(0, usage.prompt_tokens - usage.cached_tokens))
+        elif usage is not None:
+            PROMPT_TOKENS.inc("unknown", amount=usage.prompt_tokens)
+        with self._lock:
+            entry = self._entry(session_id)
+            if ttft_seconds is not None:
+                entry.ttft_total += ttft_seconds
+                entry.ttft_turns += 1
+                entry.last_ttft = ttft_seconds
+            if usage is None:
+                return
+            entry.reported_turns += 1
+            entry.prompt_tokens += usage.prompt_tokens
+            entry.completion_tokens += usage.completion_tokens
+            entry.cached_tokens += usage.cached_tokens or 0
+            entry.last_hit_ratio = usage.hit_ratio
+            t = self._totals
+            t["reported_turns"] += 1
+            t["prompt_tokens"] += usage.prompt_tokens
+            t["cached_tokens"] += usage.cached_tokens or 0
+
+    def session_stats(self, session_id: str) -> Optional[Dict[str, object]]:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            return {
+                "turns": entry.turns,
+                "reported_turns": entry.reported_turns,
+                "prompt_tokens": entry.prompt_tokens,
+                "cached_tokens": entry.cached_tokens,
+                "completion_tokens": entry.completion_tokens,
+                "hit_ratio": round(entry.cached_tokens / entry.prompt_tokens, 4) if entry.prompt_tokens else None,
+                "last_hit_ratio": round(entry.last_hit_ratio, 4) if entry.last_hit_ratio is not None else None,
+                "last_prompt_tokens_estimate": entry.prompt_estimate,
+                "last_stable_prefix_tokens": entry.prefix_tokens,
+                "avg_stable_prefix_tokens": round(entry.prefix_total / entry.turns, 1) if entry.turns else 0,
+                "avg_ttft_ms": round(entry.ttft_total * 1000.0 / entry.ttft_turns, 1) if entry.ttft_turns else None,
+                "last_ttft_ms": round(entry.last_ttft * 1000.0, 1) if entry.last_ttft is not None else None,
+            }
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            out: Dict[str, float] = dict(self._totals)
+            out["sessions"] = len(self._sessions)
+        estimated = out["estimated_prompt_tokens"]
+        out["stable_prefix_ratio"] = round(out["stable_prefix_tokens"] / estimated, 4) if estimated else 0.0
+        reported = out["prompt_tokens"]
+        out["hit_ratio"] = round(out["cached_tokens"] / reported, 4) if reported else 0.0
+        return out
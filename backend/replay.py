@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class ReplayLease:
+    """One connection delivering a stream; `release()` (idempotent) when it stops delivering."""
+
+    __slots__ = ("_stream", "released")
+
+    def __init__(self, stream: "ReplayStream"):
+        self._stream = stream
+        self.released = False
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self._stream._detach()
+
+
+class ReplayStream:
+    """Sequence-numbered delta frames of one streamed assistant reply.
+
+    生成方每发出一帧就 `append`（序号从 1 开始），结束（含取消）后 `finish`；断线重连的客户端用
+    `read(last_seq)` 取回错过的部分，再 `subscribe` 等后续的帧。只要还有连接持有 lease，
+    生成就继续；最后一个 lease 释放后再过 `grace_seconds` 仍没有人重连，按 disconnect 取消这一轮。
+    """
+
+    def __init__(
+        self,
+        buffer: "ReplayBuffer",
+        message_id: str,
+        session_id: str,
+        cancel: Callable[[str], bool],
+        grace_seconds: float,
+    ):
+        self.message_id = message_id
+        self.session_id = session_id
+        self._buffer: Optional[ReplayBuffer] = buffer
+        self._cancel = cancel
+        self._grace = grace_seconds
+        self._lock = threading.Lock()
+        self._chunks: List[str] = []
+        self.bytes = 0
+        # 已计入 ReplayBuffer 总量的字节数（只在 buffer 的锁里读写）
+        self._accounted = 0
+        self.done = False
+        self.truncated = False
+        self.finished_at: Optional[float] = None
+        self._subscribers: List[Callable[[], None]] = []
+        self._leases = 0
+        self._timer: Optional[threading.Timer] = None
+
+    # ---- 生成方 ----
+
+    def append(self, content: str) -> int:
+        """Record one delta frame; returns its seq."""
+        size = len(content.encode("utf-8"))
+        with self._lock:
+            self._chunks.append(content)
+            self.bytes += size
+            seq = len(self._chunks)
+            subscribers = list(self._subscribers)
+        buffer = self._buffer
+        if buffer is not None:
+            buffer._grow(self, size)
+        for notify in subscribers:
+            notify()
+        return seq
+
+    def finish(self, truncated: bool) -> None:
+        """The reply is final (and persisted); wakes every subscriber for the last time."""
+        with self._lock:
+            self.done = True
+            self.truncated = truncated
+            self.finished_at = time.monotonic()
+            subscribers, self._subscribers = self._subscribers, []
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        for notify in subscribers:
+            notify()
+        buffer = self._buffer
+        if buffer is not None:
+            buffer._finished()
+
+    # ---- 投递方 ----
+
+    def attach(self) -> ReplayLease:
+        with self._lock:
+            self._leases += 1
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        return ReplayLease(self)
+
+    def _detach(self) -> None:
+        with self._lock:
+            self._leases -= 1
+            if self._leases > 0 or self.done:
+                return
+            if self._grace <= 0:
+                timer = None
+            else:
+                timer = self._timer = threading.Timer(self._grace, self._abandon)
+                timer.daemon = True
+        if timer is None:
+            self._abandon()
+        else:
+            timer.start()
+
+    def _abandon(self) -> None:
+        with self._lock:
+            if self._leases > 0 or self.done:
+                return
+            self._timer = None
+        if self._cancel("disconnect") and self._buffer is not None:
+            self._buffer._count("abandoned")
+
+    def cancel(self, reason: str) -> bool:
+        """Cancel the underlying turn (a resumed client pressed stop / sent a new message)."""
+        return self._cancel(reason)
+
+    def read(self, after_seq: int) -> Tuple[str, int, bool]:
+        """(text of the frames after `after_seq`, seq of the last frame, done)."""
+        with self._lock:
+            seq = len(self._chunks)
+            start = min(max(0, int(after_seq)), seq)
+            text = "".join(self._chunks[start:]) if start < seq else ""
+            return text, seq, self.done
+
+    def text(self) -> str:
+        with self._lock:
+            return "".join(self._chunks)
+
+    def subscribe(self, notify: Callable[[], None]) -> Callable[[], None]:
+        """Call `notify` (from the producer's thread) on every new frame and on finish."""
+        with self._lock:
+            if not self.done:
+                self._subscribers.append(notify)
+                return lambda: self._unsubscribe(notify)
+        notify()
+        return lambda: None
+
+    def _unsubscribe(self, notify: Callable[[], None]) -> None:
+        with self._lock:
+            try:
+                self._subscribers.remove(notify)
+            except ValueError:
+                pass
+
+
+class ReplayBuffer:
+    """Bounded in-memory store of recent streamed replies, keyed by message_id.
+
+    淘汰：结束超过 `ttl_seconds` 的流直接丢弃；总字节数或流数超限时按创建顺序丢最旧的，
+    先丢已结束的，仍超限才丢进行中的（被丢弃的流生成照常继续，只是不能再续传）。
+    只在本进程内有效：多进程部署时重连落到别的 worker 会得到 resume_unavailable。
+    """
+
+    def __init__(self, *, max_bytes: int, ttl_seconds: float, max_streams: int = 10000, grace_seconds: float = 15.0):
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_seconds = max(0.0, float(ttl_seconds))
+        self.max_streams = max(1, int(max_streams))
+        self.grace_seconds = max(0.0, float(grace_seconds))
+        self._lock = threading.Lock()
+        self._streams: "OrderedDict[str, ReplayStream]" = OrderedDict()
+        self._bytes = 0
+        self._counts = {"started": 0, "resumed": 0, "resume_misses": 0, "evicted": 0, "abandoned": 0}
+
+    def start(self, session_id: str, cancel: Callable[[str], bool]) -> ReplayStream:
+        stream = ReplayStream(self, uuid.uuid4().hex, session_id, cancel, self.grace_seconds)
+        with self._lock:
+            self._streams[stream.message_id] = stream
+            self._counts["started"] += 1
+            self._evict(time.monotonic())
+        return stream
+
+    def get(self, message_id: str) -> Optional[ReplayStream]:
+        """The stream to resume, or None if unknown / evicted (counted as resumed / resume_misses)."""
+        with self._lock:
+            self._evict(time.monotonic())
+            stream = self._streams.get(message_id) if message_id else None
+            self._counts["resumed" if stream is not None else "resume_misses"] += 1
+            return stream
+
+    def discard(self, stream: ReplayStream) -> None:
+        """Forget a stream that never produced a reply (e.g. the scheduler refused the turn)."""
+        with self._lock:
+            if self._streams.get(stream.message_id) is stream:
+                self._drop(stream.message_id)
+
+    def cancel_session(self, session_id: str, reason: str) -> int:
+        """Cancel unfinished streams of a session (a new message arrived on another connection)."""
+        with self._lock:
+            running = [s for s in self._streams.values() if s.session_id == session_id and not s.done]
+        return sum(1 for s in running if s.cancel(reason))
+
+    def _grow(self, stream: ReplayStream, size: int) -> None:
+        with self._lock:
+            if self._streams.get(stream.message_id) is not stream:
+                return
+            stream._accounted += size
+            self._bytes += size
+            if self._bytes > self.max_bytes:
+                self._evict(time.monotonic())
+
+    def _finished(self) -> None:
+        with self._lock:
+            self._evict(time.monotonic())
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._counts[key] += 1
+
+    def _drop(self, message_id: str) -> None:
+        # 调用方持锁
+        stream = self._streams.pop(message_id)
+        stream._buffer = None
+        self._bytes -= stream._accounted
+
+    def _evict(self, now: float) -> None:
+        # 调用方持锁
+        expired = [
+            mid
+            for mid, s in self._streams.items()
+            if s.finished_at is not None and now - s.finished_at >= self.ttl_seconds
+        ]
+        for mid in expired:
+            self._drop(mid)
+            self._counts["evicted"] += 1
+        if self._bytes <= self.max_bytes and len(self._streams) <= self.max_streams:
+            return
+        for finished_only in (True, False):
+            for mid in [mid for mid, s in self._streams.items() if s.done or not finished_only]:
+                if self._bytes <= self.max_bytes and len(self._streams) <= self.max_streams:
+                    return
+                self._drop(mid)
+                self._counts["evicted"] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            out: Dict[str, float] = dict(self._counts)
+            out.update(
+                streams=len(self._streams),
+                active=sum(1 for s in self._streams.values() if not s.done),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+            )
+        return out
@@ -0,0 +1,321 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from backend.ai_client import BaseAIClient, Message, RequestOptions, aclose_stream
+
+
+# 回放缓存回复时每个分片的字符数；WS 侧的 DeltaCoalescer 会再把它们合并成帧
+_REPLAY_CHUNK_CHARS = 24
+
+_WS_RE = re.compile(r"\s+")
+
+
+def cache_key(messages: List[Message], *, model: str, temperature: float) -> str:
+    """Hash of the normalized message list + sampling params."""
+    normalized = [
+        [str(m.get("role", "")), _WS_RE.sub(" ", str(m.get("content", "") or "")).strip()] for m in messages
+    ]
+    raw = json.dumps([model, round(float(temperature), 4), normalized], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _MemoryTier:
+    def __init__(self, *, max_entries: int, max_bytes: int):
+        self._max_entries = max(1, int(max_entries))
+        self._max_bytes = max(0, int(max_bytes))
+        self._items: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str, now: float) -> Optional[str]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, reply = item
+            if expires_at <= now:
+                del self._items[key]
+                self._bytes -= len(reply)
+                return None
+            self._items.move_to_end(key)
+            return reply
+
+    def put(self, key: str, reply: str, expires_at: float) -> None:
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._items[key] = (expires_at, reply)
+            self._bytes += len(reply)
+            while self._items and (
+                len(self._items) > self._max_entries or (self._max_bytes and self._bytes > self._max_bytes)
+            ):
+                _k, (_exp, evicted) = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class _SQLiteTier:
+    """Shared, restart-surviving tier; one connection per thread like SQLiteStore."""
+
+    def __init__(self, db_path: str, *, max_entries: int):
+        self._db_path = db_path
+        self._max_entries = max(1, int(max_entries))
+        self._local = threading.local()
+        self._puts = 0
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS reply_cache (
+                key TEXT PRIMARY KEY,
+                reply TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_hit REAL NOT NULL
+            );
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_reply_cache_last_hit ON reply_cache(last_hit);")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str, now: float) -> Optional[Tuple[str, float]]:
+        row = self._connect().execute(
+            "SELECT reply, expires_at FROM reply_cache WHERE key=? AND expires_at>?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        # last_hit 只用于淘汰排序，不值得为它拿写锁阻塞读路径：失败就算了
+        try:
+            self._connect().execute("UPDATE reply_cache SET last_hit=? WHERE key=?", (now, key))
+        except sqlite3.OperationalError:
+            pass
+        return row[0], row[1]
+
+    def put(self, key: str, reply: str, expires_at: float, now: float) -> None:
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO reply_cache (key, reply, expires_at, last_hit) VALUES (?, ?, ?, ?)",
+            (key, reply, expires_at, now),
+        )
+        self._puts += 1
+        if self._puts % 64 == 0:
+            conn.execute("DELETE FROM reply_cache WHERE expires_at<=?", (now,))
+            conn.execute(
+                "DELETE FROM reply_cache WHERE key IN ("
+                " SELECT key FROM reply_cache ORDER BY last_hit DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries,),
+            )
+
+
+class ReplyCache:
+    """Two-tier (memory LRU + optional SQLite) cache of complete assistant replies."""
+
+    def __init__(
+        self,
+        *,
+        ttl_seconds: float = 3600.0,
+        max_entries: int = 1024,
+        max_bytes: int = 16 * 1024 * 1024,
+        sqlite_path: str = "",
+        sqlite_max_entries: int = 100000,
+    ):
+        self.ttl_seconds = max(0.0, float(ttl_seconds))
+        self._memory = _MemoryTier(max_entries=max_entries, max_bytes=max_bytes)
+        self._sqlite = _SQLiteTier(sqlite_path, max_entries=sqlite_max_entries) if sqlite_path else None
+        self._lock = threading.Lock()
+        self._counts = {"memory_hits": 0, "sqlite_hits": 0, "misses": 0, "bypassed": 0, "stores": 0}
+
+    @property
+    def has_sqlite_tier(self) -> bool:
+        return self._sqlite is not None
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        reply = self._memory.get(key, now)
+        if reply is not None:
+            self._count("memory_hits")
+            return reply
+        if self._sqlite is not None:
+            try:
+                found = self._sqlite.get(key, now)
+            except sqlite3.Error:
+                found = None
+            if found is not None:
+                reply, expires_at = found
+                self._memory.put(key, reply, expires_at)
+                self._count("sqlite_hits")
+                return reply
+        self._count("misses")
+        return None
+
+    def put(self, key: str, reply: str) -> None:
+        if not reply or self.ttl_seconds <= 0:
+            return
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        self._memory.put(key, reply, expires_at)
+        if self._sqlite is not None:
+            try:
+                self._sqlite.put(key, reply, expires_at, now)
+            except sqlite3.Error:
+                pass
+        self._count("stores")
+
+    def note_bypass(self) -> None:
+        self._count("bypassed")
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            counts = dict(self._counts)
+        hits = counts["memory_hits"] + counts["sqlite_hits"]
+        lookups = hits + counts["misses"]
+        counts["hit_ratio"] = hits / lookups if lookups else 0.0
+        counts["memory_entries"] = len(self._memory)
+        counts["memory_evictions"] = self._memory.evictions
+        return counts
+
+
+def _replay(reply: str) -> Iterator[str]:
+    for i in range(0, len(reply), _REPLAY_CHUNK_CHARS):
+        yield reply[i : i + _REPLAY_CHUNK_CHARS]
+
+
+class CachingAIClient(BaseAIClient):
+    """Wrap a provider with `ReplyCache`; cached replies are replayed as a chunked stream.
+
+    只缓存完整成功的回复：上游报错、流在 [DONE] 之前断掉（provider 抛 stream_incomplete）
+    或被中途关闭时不写缓存；空回复由 `ReplyCache.put` 丢弃。
+    """
+
+    def __init__(self, inner: BaseAIClient, cache: ReplyCache):
+        self.inner = inner
+        self.cache = cache
+
+    def _key(self, messages: List[Message]) -> str:
+        return cache_key(
+            messages,
+            model=str(getattr(self.inner, "model", "")),
+            temperature=float(getattr(self.inner, "temperature", 0.0) or 0.0),
+        )
+
+    def _bypassed(self, options: Optional[RequestOptions]) -> bool:
+        if options is not None and options.bypass_cache:
+            self.cache.note_bypass()
+            return True
+        return False
+
+    def generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        if self._bypassed(options):
+            return self.inner.generate(messages, options)
+        key = self._key(messages)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        reply = self.inner.generate(messages, options)
+        self.cache.put(key, reply)
+        return reply
+
+    def stream_generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> Iterable[str]:
+        if self._bypassed(options):
+            yield from self.inner.stream_generate(messages, options)
+            return
+        key = self._key(messages)
+        cached = self.cache.get(key)
+        if cached is not None:
+            yield from _replay(cached)
+            return
+        parts: List[str] = []
+        for chunk in self.inner.stream_generate(messages, options):
+            parts.append(chunk)
+            yield chunk
+        self.cache.put(key, "".join(parts))
+
+    async def _aget(self, key: str) -> Optional[str]:
+        if self.cache.has_sqlite_tier:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.cache.get, key)
+        return self.cache.get(key)
+
+    async def _aput(self, key: str, reply: str) -> None:
+        if self.cache.has_sqlite_tier:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.cache.put, key, reply)
+        else:
+            self.cache.put(key, reply)
+
+    async def agenerate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        if self._bypassed(options):
+            return await self.inner.agenerate(messages, options)
+        key = self._key(messages)
+        cached = await self._aget(key)
+        if cached is not None:
+            return cached
+        reply = await self.inner.agenerate(messages, options)
+        await self._aput(key, reply)
+        return reply
+
+    async def astream_generate(
+        self, messages: List[Message], options: Optional[RequestOptions] = None
+    ) -> AsyncIterator[str]:
+        if self._bypassed(options):
+            stream = self.inner.astream_generate(messages, options)
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                await aclose_stream(stream)
+            return
+        key = self._key(messages)
+        cached = await self._aget(key)
+        if cached is not None:
+            for chunk in _replay(cached):
+                yield chunk
+            return
+        parts: List[str] = []
+        stream = self.inner.astream_generate(messages, options)
+        try:
+            async for chunk in stream:
+                parts.append(chunk)
+                yield chunk
+        finally:
+            await aclose_stream(stream)
+        await self._aput(key, "".join(parts))
+
+    def summarize(self, previous: str, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        # 摘要不走回复缓存
+        return self.inner.summarize(previous, messages, options)
+
+    def warm_up(self) -> None:
+        self.inner.warm_up()
+
+    async def awarm_up(self) -> None:
+        await self.inner.awarm_up()
+
+    def pool_stats(self) -> Dict[str, int]:
+        return self.inner.pool_stats()
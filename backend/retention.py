@@ -0,0 +1,321 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+from backend.sse import json_dumps, json_loads
+from backend.storage_sqlite import ArchivedSession, SQLiteStore
+
+
+logger = logging.getLogger(__name__)
+
+_CODEC = "zlib+json"
+
+
+def utc_cutoff(ttl_days: float, now: Optional[float] = None) -> str:
+    """`sessions.updated_at` value (SQLite datetime('now') format, UTC) older than `ttl_days`."""
+    now = time.time() if now is None else now
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - float(ttl_days) * 86400.0))
+
+
+class ArchiveStore:
+    """Cold storage for expired sessions: one zlib-compressed JSON blob per session in its own SQLite file.
+
+    放在独立文件里：热库（chat.db）真正变小，备份冷热分开。只在归档时写、在 /api/session 翻到头时读，
+    所以文件在第一次归档前不会被创建。
+    """
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        self._local = threading.local()
+        self._ready = False
+        self._init_lock = threading.Lock()
+
+    @property
+    def db_path(self) -> str:
+        return self._db_path
+
+    def _connect(self, create: bool = False) -> Optional[sqlite3.Connection]:
+        if not self._ready:
+            if not create and not Path(self._db_path).exists():
+                return None
+            with self._init_lock:
+                if not self._ready:
+                    Path(self._db_path).parent.mkdir(parents=True, exist_ok=True)
+                    conn = sqlite3.connect(self._db_path, timeout=5.0, isolation_level=None)
+                    conn.execute("PRAGMA journal_mode=WAL;")
+                    conn.execute(
+                        """
+                        CREATE TABLE IF NOT EXISTS archived_sessions (
+                            session_id TEXT PRIMARY KEY,
+                            system_prompt TEXT,
+                            summary TEXT,
+                            updated_at TEXT,
+                            message_count INTEGER NOT NULL,
+                            last_id INTEGER NOT NULL,
+                            codec TEXT NOT NULL,
+                            blob BLOB NOT NULL,
+                            archived_at TEXT DEFAULT (datetime('now'))
+                        );
+                        """
+                    )
+                    conn.close()
+                    self._ready = True
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _decode(row: sqlite3.Row) -> List[Dict[str, object]]:
+        if row["codec"] != _CODEC:
+            raise ValueError(f"unknown_archive_codec:{row['codec']}")
+        return json_loads(zlib.decompress(row["blob"]))
+
+    def put_many(self, sessions: List[ArchivedSession]) -> None:
+        """Write (or extend) archive rows; a session archived before keeps its older messages."""
+        conn = self._connect(create=True)
+        assert conn is not None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for a in sessions:
+                messages = a.messages
+                old = conn.execute("SELECT * FROM archived_sessions WHERE session_id=?", (a.session_id,)).fetchone()
+                if old is not None:
+                    # 会话归档后又被续聊、再次过期：按 id 合并（重复归档同一批时也是幂等的）
+                    merged = {int(m["id"]): m for m in self._decode(old)}  # type: ignore[arg-type]
+                    merged.update((int(m["id"]), m) for m in messages)  # type: ignore[arg-type]
+                    messages = [merged[k] for k in sorted(merged)]
+                blob = zlib.compress(json_dumps(messages), 6)
+                conn.execute(
+                    "INSERT OR REPLACE INTO archived_sessions "
+                    "(session_id, system_prompt, summary, updated_at, message_count, last_id, codec, blob) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        a.session_id,
+                        a.system_prompt if a.system_prompt is not None else (old["system_prompt"] if old else None),
+                        a.summary if a.summary is not None else (old["summary"] if old else None),
+                        a.updated_at,
+                        len(messages),
+                        int(messages[-1]["id"]) if messages else 0,  # type: ignore[arg-type]
+                        _CODEC,
+                        blob,
+                    ),
+                )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, session_id: str) -> Optional[ArchivedSession]:
+        conn = self._connect()
+        if conn is None or not session_id:
+            return None
+        row = conn.execute("SELECT * FROM archived_sessions WHERE session_id=?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        return ArchivedSession(
+            session_id=session_id,
+            system_prompt=row["system_prompt"],
+            summary=row["summary"],
+            updated_at=row["updated_at"],
+            messages=self._decode(row),
+        )
+
+    def get_messages_page(self, session_id: str, *, limit: int, before: Optional[int] = None) -> Dict[str, object]:
+        """Same shape as `SQLiteStore.get_messages_page`, served from the archived blob."""
+        archived = self.get(session_id)
+        messages = archived.messages if archived is not None else []
+        if before is not None:
+            messages = [m for m in messages if int(m["id"]) < before]  # type: ignore[arg-type]
+        limit = max(1, int(limit))
+        page = messages[-limit:]
+        has_more = len(messages) > len(page)
+        return {"messages": page, "has_more": has_more, "next_before": page[0]["id"] if has_more else None}
+
+    def stats(self) -> Dict[str, int]:
+        conn = self._connect()
+        if conn is None:
+            return {"sessions": 0, "messages": 0, "blob_bytes": 0}
+        row = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(message_count), 0), COALESCE(SUM(LENGTH(blob)), 0) FROM archived_sessions"
+        ).fetchone()
+        return {"sessions": int(row[0]), "messages": int(row[1]), "blob_bytes": int(row[2])}
+
+
+def merge_archived_page(
+    page: Dict[str, object],
+    archive: Optional[ArchiveStore],
+    session_id: str,
+    *,
+    limit: int,
+    before: Optional[int],
+) -> Dict[str, object]:
+    """Continue a hot-table history page into the archive once the hot rows run out."""
+    if archive is None or page["has_more"]:
+        return page
+    messages: List[Dict[str, object]] = page["messages"]  # type: ignore[assignment]
+    cursor = int(messages[0]["id"]) if messages else before  # type: ignore[arg-type]
+    older = archive.get_messages_page(session_id, limit=max(1, limit - len(messages)), before=cursor)
+    if len(messages) >= limit:
+        # 热表这一页已经满了：只需要告诉前端冷存储里还有更早的
+        if older["messages"]:
+            page["has_more"] = True
+            page["next_before"] = cursor
+        return page
+    page["messages"] = older["messages"] + messages  # type: ignore[operator]
+    page["has_more"] = older["has_more"]
+    page["next_before"] = older["next_before"]
+    return page
+
+
+def iter_with_archive(
+    store: SQLiteStore, archive: Optional[ArchiveStore], session_id: str
+) -> Iterator[Dict[str, object]]:
+    """All messages of a session in id order: archived ones first, then the hot table."""
+    last_id = 0
+    archived = archive.get(session_id) if archive is not None else None
+    if archived is not None:
+        for m in archived.messages:
+            last_id = int(m["id"])  # type: ignore[arg-type]
+            yield m
+    yield from store.iter_session_messages(session_id, after=last_id)
+
+
+class RetentionManager:
+    """Archive sessions idle for longer than `ttl_days`, then give freed pages back with paced incremental vacuum.
+
+    每批在写事务之外读取、写冷存储，热库上只持有一个短的删除事务（见 `SQLiteStore.archive_expired_sessions`），
+    批与批之间 sleep pause_ms，让在线写入有机会拿到写锁；incremental_vacuum 同样按 vacuum_pages 一步步执行。
+    """
+
+    def __init__(
+        self,
+        store: SQLiteStore,
+        archive: Optional[ArchiveStore],
+        *,
+        ttl_days: float = 180.0,
+        batch_sessions: int = 50,
+        batch_messages: int = 5000,
+        pause_ms: int = 100,
+        vacuum_pages: int = 512,
+        on_archived: Optional[Callable[[str], None]] = None,
+    ):
+        self._store = store
+        self._archive = archive
+        self.ttl_days = float(ttl_days)
+        self._batch_sessions = max(1, int(batch_sessions))
+        self._batch_messages = max(1, int(batch_messages))
+        self._pause = max(0, int(pause_ms)) / 1000.0
+        self._vacuum_pages = max(1, int(vacuum_pages))
+        # 归档后回调（让上下文缓存丢掉这些会话）
+        self._on_archived = on_archived
+        self._lock = threading.Lock()
+        self._totals = {"runs": 0, "archived_sessions": 0, "archived_messages": 0, "vacuumed_pages": 0, "failures": 0}
+
+    def expired_count(self, now: Optional[float] = None) -> int:
+        return self._store.count_expired_sessions(utc_cutoff(self.ttl_days, now))
+
+    def archive_expired(self, *, now: Optional[float] = None, max_batches: Optional[int] = None) -> Dict[str, int]:
+        if self._archive is None:
+            raise RuntimeError("archive_not_configured")
+        cutoff = utc_cutoff(self.ttl_days, now)
+        # write-behind 队列里的写入先落库，避免删掉会话后它们又把会话“复活”成半截
+        self._store.flush()
+        sessions = messages = batches = 0
+        while max_batches is None or batches < max_batches:
+            if batches:
+                time.sleep(self._pause)
+            batch = self._store.archive_expired_sessions(
+                cutoff,
+                max_sessions=self._batch_sessions,
+                max_messages=self._batch_messages,
+                sink=self._archive.put_many,
+            )
+            if not batch:
+                break
+            batches += 1
+            sessions += sum(1 for a in batch if a.complete)
+            messages += sum(len(a.messages) for a in batch)
+            if self._on_archived is not None:
+                for a in batch:
+                    self._on_archived(a.session_id)
+        with self._lock:
+            self._totals["archived_sessions"] += sessions
+            self._totals["archived_messages"] += messages
+        return {"sessions": sessions, "messages": messages, "batches": batches}
+
+    def vacuum(self, *, max_pages: Optional[int] = None) -> Dict[str, int]:
+        space = self._store.space_stats()
+        if space["auto_vacuum"] != 2:  # 2 = INCREMENTAL
+            return {"pages": 0, "steps": 0, "freelist_count": space["freelist_count"], "incremental": 0}
+        freed = steps = 0
+        while max_pages is None or freed < max_pages:
+            step = self._vacuum_pages if max_pages is None else min(self._vacuum_pages, max_pages - freed)
+            n = self._store.incremental_vacuum(step)
+            if n <= 0:
+                break
+            freed += n
+            steps += 1
+            time.sleep(self._pause)
+        with self._lock:
+            self._totals["vacuumed_pages"] += freed
+        return {
+            "pages": freed,
+            "steps": steps,
+            "freelist_count": self._store.space_stats()["freelist_count"],
+            "incremental": 1,
+        }
+
+    def run(self, *, now: Optional[float] = None) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            self._totals["runs"] += 1
+        archived = self.archive_expired(now=now)
+        return {"archive": archived, "vacuum": self.vacuum()}
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            out: Dict[str, float] = dict(self._totals)
+        out["ttl_days"] = self.ttl_days
+        return out
+
+    def note_failure(self) -> None:
+        with self._lock:
+            self._totals["failures"] += 1
+
+
+class RetentionJob:
+    """Run `RetentionManager.run` every `interval_seconds` on a daemon thread."""
+
+    def __init__(self, manager: RetentionManager, interval_seconds: float):
+        self._manager = manager
+        self._interval = max(1.0, float(interval_seconds))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+
+    def start(self) -> "RetentionJob":
+        self._thread.start()
+        return self
+
+    def _loop(self) -> None:
+        # 启动后先等一个周期：不和启动时的预热、迁移抢资源
+        while not self._stop.wait(self._interval):
+            try:
+                result = self._manager.run()
+                if result["archive"]["sessions"] or result["vacuum"]["pages"]:
+                    logger.info("retention: %s", result)
+            except Exception:
+                self._manager.note_failure()
+                logger.exception("retention run failed")
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=5.0)
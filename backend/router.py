@@ -0,0 +1,513 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import math
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncIterator, Deque, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from backend.ai_client import (
+    AIClientError,
+    BaseAIClient,
+    CancelToken,
+    GenerationCancelled,
+    Message,
+    RequestOptions,
+    aclose_stream,
+    cancel_token,
+)
+from backend.metrics import ROUTER_ATTEMPTS, ROUTER_HEDGES
+
+
+@dataclass
+class EndpointSpec:
+    """One upstream entry of `AI_FALLBACK_ENDPOINTS`: `base_url[|model[|API_KEY_ENV]]`."""
+
+    base_url: str
+    model: str = ""
+    api_key_env: str = ""
+
+
+def parse_endpoints(raw: str) -> List[EndpointSpec]:
+    specs: List[EndpointSpec] = []
+    for item in (raw or "").split(","):
+        parts = [p.strip() for p in item.split("|")]
+        if not parts[0]:
+            continue
+        parts += [""] * (3 - len(parts))
+        specs.append(EndpointSpec(base_url=parts[0], model=parts[1], api_key_env=parts[2]))
+    return specs
+
+
+@dataclass
+class RouterPolicy:
+    # 首个分片超过“该端点近期 TTFT 的第 hedge_percentile 百分位”仍未到达时，向下一个端点再发一份
+    hedge_enabled: bool = True
+    hedge_percentile: float = 95.0
+    hedge_min_seconds: float = 0.3
+    hedge_max_seconds: float = 5.0
+    # 样本不足 hedge_min_samples 时用固定延迟
+    hedge_default_seconds: float = 2.0
+    hedge_min_samples: int = 20
+    ttft_window: int = 200
+    # 连续 circuit_failures 次 AIClientError 后熔断 circuit_open_seconds 秒，之后放一个试探请求（half-open）
+    circuit_failures: int = 5
+    circuit_open_seconds: float = 30.0
+
+
+_CLOSED, _OPEN, _HALF_OPEN = "closed", "open", "half_open"
+
+
+class Endpoint:
+    """An upstream client plus its latency window, error counters and circuit breaker."""
+
+    def __init__(self, name: str, client: BaseAIClient, policy: RouterPolicy):
+        self.name = name
+        self.client = client
+        self._policy = policy
+        self._lock = threading.Lock()
+        self._ttft: Deque[float] = deque(maxlen=max(1, policy.ttft_window))
+        self._state = _CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._counts = {"requests": 0, "errors": 0, "closed": 0, "circuit_opens": 0}
+        self._ewma_ttft = 0.0
+
+    def try_reserve(self, now: float) -> bool:
+        """Whether a request may go here now; in half-open state only one trial request at a time."""
+        with self._lock:
+            if self._state == _OPEN and now - self._opened_at >= self._policy.circuit_open_seconds:
+                self._state = _HALF_OPEN
+                self._trial = False
+            if self._state == _OPEN or (self._state == _HALF_OPEN and self._trial):
+                return False
+            if self._state == _HALF_OPEN:
+                self._trial = True
+            self._counts["requests"] += 1
+            return True
+
+    def record_ttft(self, seconds: float) -> None:
+        with self._lock:
+            self._ttft.append(seconds)
+            self._ewma_ttft = seconds if not self._ewma_ttft else 0.9 * self._ewma_ttft + 0.1 * seconds
+
+    def success(self) -> None:
+        ROUTER_ATTEMPTS.inc(self.name, "ok")
+        with self._lock:
+            self._failures = 0
+            self._state = _CLOSED
+            self._trial = False
+
+    def failure(self) -> None:
+        ROUTER_ATTEMPTS.inc(self.name, "error")
+        with self._lock:
+            self._counts["errors"] += 1
+            self._failures += 1
+            if self._state == _HALF_OPEN or self._failures >= self._policy.circuit_failures:
+                if self._state != _OPEN:
+                    self._counts["circuit_opens"] += 1
+                self._state = _OPEN
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+    def abandoned(self) -> None:
+        """The attempt was closed before a verdict (hedge lost / caller cancelled)."""
+        ROUTER_ATTEMPTS.inc(self.name, "closed")
+        with self._lock:
+            self._counts["closed"] += 1
+            if self._state == _HALF_OPEN:
+                self._trial = False
+
+    def hedge_delay(self) -> float:
+        policy = self._policy
+        with self._lock:
+            samples = sorted(self._ttft)
+        if len(samples) < policy.hedge_min_samples:
+            delay = policy.hedge_default_seconds
+        else:
+            rank = min(len(samples) - 1, max(0, int(math.ceil(policy.hedge_percentile / 100.0 * len(samples))) - 1))
+            delay = samples[rank]
+        return min(policy.hedge_max_seconds, max(policy.hedge_min_seconds, delay))
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            out: Dict[str, float] = dict(self._counts)
+            out.update(
+                circuit_open=1 if self._state == _OPEN else 0,
+                half_open=1 if self._state == _HALF_OPEN else 0,
+                consecutive_failures=self._failures,
+                ewma_ttft_seconds=round(self._ewma_ttft, 4),
+                ttft_samples=len(self._ttft),
+            )
+        out["hedge_delay_seconds"] = round(self.hedge_delay(), 4)
+        return out
+
+
+def endpoint_name(base_url: str, model: str) -> str:
+    host = urlsplit(base_url).netloc or base_url
+    return f"{host}/{model}" if model else host
+
+
+_END = object()
+
+
+class _Attempt:
+    """One upstream stream started by the router; its own token closes just this stream."""
+
+    def __init__(self, endpoint: Endpoint, options: Optional[RequestOptions]):
+        self.endpoint = endpoint
+        self.token = CancelToken()
+        self.options = dataclasses.replace(options or RequestOptions(), cancel=self.token)
+        self.started = time.monotonic()
+        self.finished = False
+        self.task: Optional["asyncio.Task[None]"] = None
+
+    def close(self, reason: str) -> None:
+        if not self.finished:
+            self.finished = True
+            self.token.cancel(reason)
+            if self.task is not None:
+                self.task.cancel()
+            self.endpoint.abandoned()
+
+
+class RouterClient(BaseAIClient):
+    """Route over several OpenAI-compatible endpoints with failover, hedging and circuit breaking.
+
+    端点按配置顺序优先（主端点在前），熔断中的端点被跳过：
+    - 流式：首个分片在 `hedge_delay()` 内没到，就向下一个端点再发一份，谁先吐字用谁，另一条立即关闭；
+      还没吐字就失败的，直接换下一个端点（不等对冲延迟）；
+    - 非流式：按顺序失败转移（整段回复没有 TTFT 可比，不做对冲）。
+    已经开始输出之后的失败照常抛给调用方：两条流的内容不能拼接。
+    """
+
+    def __init__(self, endpoints: List[Endpoint], policy: Optional[RouterPolicy] = None):
+        if not endpoints:
+            raise ValueError("RouterClient needs at least one endpoint")
+        self.endpoints = endpoints
+        self.policy = policy or RouterPolicy()
+        self._lock = threading.Lock()
+        self._counts = {"hedged": 0, "hedge_won": 0, "failovers": 0, "no_endpoint": 0}
+
+    # 回复缓存 / single-flight 按这两个属性算 key：以主端点为准
+    @property
+    def model(self) -> str:
+        return str(getattr(self.endpoints[0].client, "model", ""))
+
+    @property
+    def temperature(self) -> float:
+        return float(getattr(self.endpoints[0].client, "temperature", 0.0) or 0.0)
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._counts[key] += 1
+
+    def _next(self, tried: List[Endpoint]) -> Optional[Endpoint]:
+        now = time.monotonic()
+        for ep in self.endpoints:
+            if ep not in tried and ep.try_reserve(now):
+                tried.append(ep)
+                return ep
+        return None
+
+    def _unavailable(self, last_error: Optional[BaseException]) -> AIClientError:
+        # 每个端点都试过了：抛最后一个端点的错误（ChatService 据此给兜底回复）；全部熔断时没有错误可抛
+        if isinstance(last_error, AIClientError):
+            return last_error
+        if last_error is not None:
+            return AIClientError(type(last_error).__name__)
+        self._count("no_endpoint")
+        return AIClientError("no_endpoint_available")
+
+    # ---- 非流式：顺序失败转移 ----
+
+    def generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        tried: List[Endpoint] = []
+        last_error: Optional[BaseException] = None
+        while True:
+            ep = self._next(tried)
+            if ep is None:
+                raise self._unavailable(last_error)
+            if last_error is not None:
+                self._count("failovers")
+            try:
+                reply = ep.client.generate(messages, options)
+            except GenerationCancelled:
+                ep.abandoned()
+                raise
+            except AIClientError as e:
+                ep.failure()
+                last_error = e
+                continue
+            ep.success()
+            return reply
+
+    async def agenerate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        tried: List[Endpoint] = []
+        last_error: Optional[BaseException] = None
+        while True:
+            ep = self._next(tried)
+            if ep is None:
+                raise self._unavailable(last_error)
+            if last_error is not None:
+                self._count("failovers")
+            try:
+                reply = await ep.client.agenerate(messages, options)
+            except (GenerationCancelled, asyncio.CancelledError):
+                ep.abandoned()
+                raise
+            except AIClientError as e:
+                ep.failure()
+                last_error = e
+                continue
+            ep.success()
+            return reply
+
+    # ---- 流式：对冲 + 失败转移 ----
+
+    def _first_won(self, winner: _Attempt, attempts: List[_Attempt], hedged: bool) -> None:
+        winner.endpoint.record_ttft(time.monotonic() - winner.started)
+        for a in attempts:
+            if a is not winner:
+                a.close("hedge_lost")
+        if hedged:
+            hedge_won = winner is not attempts[0]
+            ROUTER_HEDGES.inc("hedge_won" if hedge_won else "primary_won")
+            if hedge_won:
+                self._count("hedge_won")
+
+    def _failed(self, attempt: _Attempt, error: BaseException, caller: Optional[CancelToken]) -> None:
+        """Record a stream that ended with `error`; re-raises the caller's cancellation."""
+        if not attempt.finished:
+            attempt.finished = True
+            if isinstance(error, GenerationCancelled) or (caller is not None and caller.cancelled):
+                attempt.endpoint.abandoned()
+            else:
+                attempt.endpoint.failure()
+        if caller is not None:
+            caller.raise_if_cancelled()
+
+    def stream_generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> Iterable[str]:
+        caller = cancel_token(options)
+        events: "queue.Queue[Tuple[_Attempt, object]]" = queue.Queue()
+        attempts: List[_Attempt] = []
+        tried: List[Endpoint] = []
+
+        def pump(a: _Attempt) -> None:
+            # 队列不设上限：输家在 token 取消后的下一个分片处退出，积压很少
+            it = iter(a.endpoint.client.stream_generate(messages, a.options))
+            try:
+                for chunk in it:
+                    events.put((a, chunk))
+                events.put((a, _END))
+            except BaseException as e:  # noqa: BLE001 - 交给路由线程处理
+                events.put((a, e))
+            finally:
+                close = getattr(it, "close", None)
+                if callable(close):
+                    close()
+
+        def launch() -> bool:
+            ep = self._next(tried)
+            if ep is None:
+                return False
+            a = _Attempt(ep, options)
+            attempts.append(a)
+            threading.Thread(target=pump, args=(a,), name="router-attempt", daemon=True).start()
+            return True
+
+        def close_all(reason: str) -> None:
+            for a in attempts:
+                a.close(reason)
+
+        unregister = caller.add_callback(lambda: close_all("cancelled")) if caller is not None else None
+        winner: Optional[_Attempt] = None
+        last_error: Optional[BaseException] = None
+        try:
+            if not launch():
+                raise self._unavailable(None)
+            hedge_at = time.monotonic() + attempts[0].endpoint.hedge_delay()
+            hedged = False
+            first: object = _END
+            while winner is None:
+                if caller is not None:
+                    caller.raise_if_cancelled()
+                live = [a for a in attempts if not a.finished]
+                if not live:
+                    # 还没吐字就失败了：立即换下一个端点
+                    if not launch():
+                        raise self._unavailable(last_error)
+                    self._count("failovers")
+                    continue
+                timeout: Optional[float] = None
+                if self.policy.hedge_enabled and len(attempts) == 1:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                try:
+                    a, item = events.get(timeout=timeout)
+                except queue.Empty:
+                    hedged = launch()
+                    if hedged:
+                        self._count("hedged")
+                    else:
+                        hedge_at = math.inf
+                    continue
+                if isinstance(item, BaseException):
+                    self._failed(a, item, caller)
+                    last_error = item
+                    continue
+                if a.finished:
+                    continue
+                winner, first = a, item
+            self._first_won(winner, attempts, hedged)
+            if first is _END:
+                winner.finished = True
+                winner.endpoint.success()
+                return
+            yield first  # type: ignore[misc]
+            while True:
+                a, item = events.get()
+                if a is not winner:
+                    continue
+                if item is _END:
+                    winner.finished = True
+                    winner.endpoint.success()
+                    return
+                if isinstance(item, BaseException):
+                    self._failed(winner, item, caller)
+                    raise item
+                yield item  # type: ignore[misc]
+        finally:
+            if unregister is not None:
+                unregister()
+            # 调用方提前关闭（或出错）：还在跑的上游一并关掉
+            close_all("closed")
+
+    async def astream_generate(
+        self, messages: List[Message], options: Optional[RequestOptions] = None
+    ) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        caller = cancel_token(options)
+        events: "asyncio.Queue[Tuple[_Attempt, object]]" = asyncio.Queue()
+        attempts: List[_Attempt] = []
+        tried: List[Endpoint] = []
+
+        async def pump(a: _Attempt) -> None:
+            stream = a.endpoint.client.astream_generate(messages, a.options)
+            try:
+                async for chunk in stream:
+                    events.put_nowait((a, chunk))
+                events.put_nowait((a, _END))
+            except asyncio.CancelledError:
+                events.put_nowait((a, GenerationCancelled("hedge_lost")))
+            except Exception as e:  # noqa: BLE001 - 交给路由协程处理
+                events.put_nowait((a, e))
+            finally:
+                await aclose_stream(stream)
+
+        def launch() -> bool:
+            ep = self._next(tried)
+            if ep is None:
+                return False
+            a = _Attempt(ep, options)
+            attempts.append(a)
+            a.task = loop.create_task(pump(a))
+            return True
+
+        def close_all(reason: str) -> None:
+            for a in attempts:
+                a.close(reason)
+
+        # 取消可能来自别的线程：close_all 会 task.cancel()，必须回到事件循环里执行
+        unregister = (
+            caller.add_callback(lambda: loop.call_soon_threadsafe(close_all, "cancelled"))
+            if caller is not None
+            else None
+        )
+        winner: Optional[_Attempt] = None
+        last_error: Optional[BaseException] = None
+        try:
+            if not launch():
+                raise self._unavailable(None)
+            hedge_at = time.monotonic() + attempts[0].endpoint.hedge_delay()
+            hedged = False
+            first: object = _END
+            while winner is None:
+                if caller is not None:
+                    caller.raise_if_cancelled()
+                live = [a for a in attempts if not a.finished]
+                if not live:
+                    if not launch():
+                        raise self._unavailable(last_error)
+                    self._count("failovers")
+                    continue
+                timeout: Optional[float] = None
+                if self.policy.hedge_enabled and len(attempts) == 1:
+                    timeout = max(0.0, hedge_at - time.monotonic())
+                try:
+                    a, item = await asyncio.wait_for(events.get(), timeout)
+                except asyncio.TimeoutError:
+                    hedged = launch()
+                    if hedged:
+                        self._count("hedged")
+                    else:
+                        hedge_at = math.inf
+                    continue
+                if isinstance(item, BaseException):
+                    self._failed(a, item, caller)
+                    last_error = item
+                    continue
+                if a.finished:
+                    continue
+                winner, first = a, item
+            self._first_won(winner, attempts, hedged)
+            if first is _END:
+                winner.finished = True
+                winner.endpoint.success()
+                return
+            yield first  # type: ignore[misc]
+            while True:
+                a, item = await events.get()
+                if a is not winner:
+                    continue
+                if item is _END:
+                    winner.finished = True
+                    winner.endpoint.success()
+                    return
+                if isinstance(item, BaseException):
+                    self._failed(winner, item, caller)
+                    raise item
+                yield item  # type: ignore[misc]
+        finally:
+            if unregister is not None:
+                unregister()
+            close_all("closed")
+
+    # ---- 其它 ----
+
+    def warm_up(self) -> None:
+        for ep in self.endpoints:
+            ep.client.warm_up()
+
+    async def awarm_up(self) -> None:
+        for ep in self.endpoints:
+            await ep.client.awarm_up()
+
+    def pool_stats(self) -> Dict[str, int]:
+        total: Dict[str, int] = {}
+        for ep in self.endpoints:
+            for key, value in ep.client.pool_stats().items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._counts)
+
+    def endpoint_stats(self) -> Dict[str, Dict[str, float]]:
+        return {ep.name: ep.stats() for ep in self.endpoints}
@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Optional
+
+from backend.ai_client import CancelToken
+from backend.metrics import SCHEDULER_REJECTED, SCHEDULER_WAIT_SECONDS
+
+
+class SchedulerRejected(RuntimeError):
+    """The scheduler refused to start a turn; the client should retry after `retry_after` seconds."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        # 整数秒，直接用作 HTTP Retry-After
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, at most `burst` banked."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until one token is available (0 = available now); does not consume."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1.0
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Buckets:
+    """Per-key token buckets; buckets that have refilled completely are dropped (they carry no state)."""
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int = 100000):
+        self.rate = max(0.0, float(per_minute)) / 60.0
+        self.burst = max(1.0, float(burst))
+        self._max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def wait_time(self, key: str, now: float) -> float:
+        if not self.enabled or not key:
+            return 0.0
+        bucket = self._buckets.get(key)
+        return bucket.wait_time(now) if bucket is not None else 0.0
+
+    def take(self, key: str, now: float) -> None:
+        if not self.enabled or not key:
+            return
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+        else:
+            self._buckets.move_to_end(key)
+        bucket.take()
+        self._prune(now)
+
+    def _prune(self, now: float) -> None:
+        # 从最久未用的一端清理：已回满的桶与“从未用过”等价；超过上限时直接丢最旧的（最多让它多放行一次突发）
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self._max_keys and not bucket.full(now):
+                break
+            del self._buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class _Waiter:
+    __slots__ = ("session_id", "granted", "notify", "enqueued_at")
+
+    def __init__(self, session_id: str, notify: Callable[[], None], now: float):
+        self.session_id = session_id
+        self.granted = False
+        self.notify = notify
+        self.enqueued_at = now
+
+
+class GenerationSlot:
+    """Permission to run one upstream generation; `release()` (or leaving the `with`) frees it."""
+
+    def __init__(self, scheduler: "GenerationScheduler"):
+        self._scheduler = scheduler
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._scheduler._release(time.monotonic() - self._started)
+
+    def __enter__(self) -> "GenerationSlot":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.release()
+
+
+class GenerationScheduler:
+    """Admission control in front of upstream generations.
+
+    - 全局并发上限 `max_concurrent`：占满后新请求进入等待队列；
+    - 每会话 / 每客户端令牌桶：超速的请求直接拒绝（带 retry_after），不占队列；
+    - 等待队列有界（`max_queue`），按会话轮转出队：一个会话连发多条只占一个轮次，不会饿死其它会话；
+      队列满或等待超过 `max_wait_seconds` 时拒绝，而不是让请求一直挂到上游超时。
+
+    同步调用方用 `acquire`（阻塞当前线程），asyncio 调用方用 `aacquire`；两者共享同一把锁和同一个队列。
+    """
+
+    def __init__(
+        self,
+        *,
+        max_concurrent: int,
+        max_queue: int,
+        max_wait_seconds: float,
+        session_per_minute: float = 0.0,
+        session_burst: int = 1,
+        client_per_minute: float = 0.0,
+        client_burst: int = 1,
+    ):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_queue = max(0, int(max_queue))
+        self.max_wait_seconds = max(0.0, float(max_wait_seconds))
+        self._session_buckets = _Buckets(session_per_minute, session_burst)
+        self._client_buckets = _Buckets(client_per_minute, client_burst)
+        self._lock = threading.Lock()
+        self._active = 0
+        # session_id -> 该会话排队中的请求；OrderedDict 的顺序就是轮转顺序
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._queued = 0
+        # 一次生成平均占用多久（指数滑动平均），用来估算 retry_after
+        self._avg_hold = 0.0
+        self._counts = {"admitted": 0, "waited": 0, "rejected": 0, "max_queued": 0}
+
+    # ---- 准入 ----
+
+    def _admit(self, session_id: str, client_id: str, notify: Callable[[], None]) -> Optional[_Waiter]:
+        """Charge the rate limits and take a slot or a queue place; None = slot granted right away."""
+        now = time.monotonic()
+        with self._lock:
+            for reason, buckets, key in (
+                ("session_rate_limited", self._session_buckets, session_id),
+                ("client_rate_limited", self._client_buckets, client_id),
+            ):
+                wait = buckets.wait_time(key, now)
+                if wait > 0:
+                    self._reject(reason)
+                    raise SchedulerRejected(reason, wait)
+            if self._queued == 0 and self._active < self.max_concurrent:
+                self._charge(session_id, client_id, now)
+                self._active += 1
+                return None
+            if self._queued >= self.max_queue:
+                self._reject("queue_full")
+                raise SchedulerRejected("queue_full", self._estimate_wait(self._queued))
+            self._charge(session_id, client_id, now)
+            waiter = _Waiter(session_id, notify, now)
+            queue = self._queues.get(session_id)
+            if queue is None:
+                queue = self._queues[session_id] = deque()
+            queue.append(waiter)
+            self._queued += 1
+            self._counts["waited"] += 1
+            self._counts["max_queued"] = max(self._counts["max_queued"], self._queued)
+            return waiter
+
+    def _charge(self, session_id: str, client_id: str, now: float) -> None:
+        # 调用方持锁；只有真正被接受（拿到名额或排上队）的请求才扣令牌
+        self._session_buckets.take(session_id, now)
+        self._client_buckets.take(client_id, now)
+        self._counts["admitted"] += 1
+
+    def _reject(self, reason: str) -> None:
+        # 调用方持锁
+        self._counts["rejected"] += 1
+        SCHEDULER_REJECTED.inc(reason)
+
+    def _estimate_wait(self, ahead: int) -> float:
+        # 调用方持锁；还没有样本时按 1 秒估
+        hold = self._avg_hold or 1.0
+        return hold * (ahead + 1) / self.max_concurrent
+
+    def _dispatch(self) -> None:
+        """Hand free slots to queued waiters, one session per turn (caller holds the lock)."""
+        while self._queued and self._active < self.max_concurrent:
+            session_id, queue = self._queues.popitem(last=False)
+            waiter = queue.popleft()
+            if queue:
+                # 该会话还有排队的请求：排到轮转的末尾
+                self._queues[session_id] = queue
+            self._queued -= 1
+            self._active += 1
+            waiter.granted = True
+            waiter.notify()
+
+    def _withdraw(self, waiter: _Waiter) -> bool:
+        """Leave the queue (timeout / cancel); returns True if a slot was granted meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            queue = self._queues.get(waiter.session_id)
+            if queue is not None:
+                try:
+                    queue.remove(waiter)
+                    self._queued -= 1
+                except ValueError:
+                    pass
+                if not queue:
+                    del self._queues[waiter.session_id]
+            return False
+
+    def _release(self, held_seconds: Optional[float] = None) -> None:
+        with self._lock:
+            self._active -= 1
+            if held_seconds is not None:
+                self._avg_hold = held_seconds if not self._avg_hold else 0.8 * self._avg_hold + 0.2 * held_seconds
+            self._dispatch()
+
+    def _finish_wait(self, waiter: _Waiter, cancel: Optional[CancelToken]) -> GenerationSlot:
+        """After waking up: take the granted slot, or raise for a cancel / timeout."""
+        SCHEDULER_WAIT_SECONDS.observe(time.monotonic() - waiter.enqueued_at)
+        granted = self._withdraw(waiter)
+        if cancel is not None and cancel.cancelled:
+            # 排队期间被取消：刚分到的名额直接还回去
+            if granted:
+                self._release()
+            cancel.raise_if_cancelled()
+        if granted:
+            return GenerationSlot(self)
+        with self._lock:
+            self._reject("queue_timeout")
+            retry_after = self._estimate_wait(self._queued)
+        raise SchedulerRejected("queue_timeout", retry_after)
+
+    def acquire(self, session_id: str, client_id: str = "", cancel: Optional[CancelToken] = None) -> GenerationSlot:
+        """Block until a slot is free; raises `SchedulerRejected` or `GenerationCancelled`."""
+        event = threading.Event()
+        waiter = self._admit(session_id, client_id, event.set)
+        if waiter is None:
+            SCHEDULER_WAIT_SECONDS.observe(0.0)
+            return GenerationSlot(self)
+        unregister = cancel.add_callback(event.set) if cancel is not None else None
+        try:
+            event.wait(self.max_wait_seconds)
+        finally:
+            if unregister is not None:
+                unregister()
+        return self._finish_wait(waiter, cancel)
+
+    async def aacquire(
+        self, session_id: str, client_id: str = "", cancel: Optional[CancelToken] = None
+    ) -> GenerationSlot:
+        """Async `acquire`: waits on a future instead of blocking a thread."""
+        loop = asyncio.get_running_loop()
+        fut: "asyncio.Future[None]" = loop.create_future()
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(_resolve, fut)
+
+        waiter = self._admit(session_id, client_id, wake)
+        if waiter is None:
+            SCHEDULER_WAIT_SECONDS.observe(0.0)
+            return GenerationSlot(self)
+        unregister = cancel.add_callback(wake) if cancel is not None else None
+        try:
+            await asyncio.wait_for(fut, self.max_wait_seconds)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            # 任务被取消（连接断开 / ActiveTurn.cancel）：退出队列，已经拿到的名额要还回去
+            if self._withdraw(waiter):
+                self._release()
+            raise
+        finally:
+            if unregister is not None:
+                unregister()
+        return self._finish_wait(waiter, cancel)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            out: Dict[str, float] = dict(self._counts)
+            out.update(
+                active=self._active,
+                queued=self._queued,
+                queued_sessions=len(self._queues),
+                max_concurrent=self.max_concurrent,
+                max_queue=self.max_queue,
+                avg_hold_seconds=round(self._avg_hold, 3),
+                session_buckets=len(self._session_buckets),
+                client_buckets=len(self._client_buckets),
+            )
+        return out
+
+
+def _resolve(fut: "asyncio.Future[None]") -> None:
+    if not fut.done():
+        fut.set_result(None)
+
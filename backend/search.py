@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+import html
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Optional
+
+from backend.metrics import SQLITE_OP_SECONDS, timed
+
+if TYPE_CHECKING:  # pragma: no cover
+    from backend.storage_sqlite import SQLiteStore
+
+
+logger = logging.getLogger(__name__)
+
+# trigram 分词器按 3 个字符切分，对中文这种没有空格分词的文本也能做子串检索；更短的词无法走索引
+MIN_TERM_CHARS = 3
+
+_MARK_OPEN = "\x02"
+_MARK_CLOSE = "\x03"
+_SNIPPET_TOKENS = 24
+
+# 外部内容（content='messages'）的 FTS5 表：索引本身不再存一份正文
+#
+# 老库第一次建索引时，已有的消息由回填命令按 id 分批补进来。fts_state 记录：
+#   start_id         建索引那一刻的 MAX(messages.id)，之后插入的行由触发器实时索引
+#   backfilled_until 回填已经覆盖到的 id
+# (backfilled_until, start_id] 区间里的行还没进索引：对它们执行 FTS5 的 'delete' 会损坏索引，
+# 所以删除/更新触发器用 WHEN 跳过这段，回填时会直接读到当前内容。
+_SQL_STATE_TABLE = """
+CREATE TABLE IF NOT EXISTS fts_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    tokenizer TEXT NOT NULL,
+    start_id INTEGER NOT NULL,
+    backfilled_until INTEGER NOT NULL
+);
+"""
+_INDEXED = (
+    "(old.id > (SELECT start_id FROM fts_state WHERE id=1) "
+    "OR old.id <= (SELECT backfilled_until FROM fts_state WHERE id=1))"
+)
+_SQL_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content, session_id) VALUES (new.id, new.content, new.session_id);
+    END;
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages WHEN {_INDEXED} BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content, session_id)
+        VALUES ('delete', old.id, old.content, old.session_id);
+    END;
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages WHEN {_INDEXED} BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content, session_id)
+        VALUES ('delete', old.id, old.content, old.session_id);
+        INSERT INTO messages_fts (rowid, content, session_id) VALUES (new.id, new.content, new.session_id);
+    END;
+    """,
+)
+_SQL_DROP = (
+    "DROP TRIGGER IF EXISTS messages_fts_ai",
+    "DROP TRIGGER IF EXISTS messages_fts_ad",
+    "DROP TRIGGER IF EXISTS messages_fts_au",
+    "DROP TABLE IF EXISTS messages_fts",
+    "DELETE FROM fts_state",
+)
+
+_SQL_SEARCH = (
+    "SELECT m.id, m.session_id, m.role, m.created_at, "
+    f"snippet(messages_fts, 0, char(2), char(3), '…', {_SNIPPET_TOKENS}) AS snip, "
+    "bm25(messages_fts) AS score "
+    "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+    "WHERE messages_fts MATCH ?{scope} ORDER BY score LIMIT ? OFFSET ?"
+)
+# 短于 3 个字符的词用不上 trigram 索引：只在单个会话内按 idx_messages_session 扫描
+_SQL_SHORT_IN_SESSION = (
+    "SELECT id, session_id, role, created_at, content FROM messages "
+    "WHERE session_id=? AND content LIKE ? ESCAPE '\\' ORDER BY id DESC LIMIT ? OFFSET ?"
+)
+
+
+class SearchError(ValueError):
+    pass
+
+
+def schema_state(conn: sqlite3.Connection, tokenizer: str) -> Optional[bool]:
+    """Read-only check: whether search is available if the index already matches `tokenizer`, None if `ensure_schema` must run."""
+    try:
+        row = conn.execute("SELECT tokenizer FROM fts_state WHERE id=1").fetchone()
+    except sqlite3.OperationalError:
+        # 还没有 fts_state 表（全文索引之前的老库）
+        return None
+    if row is None:
+        return None if tokenizer else False
+    return True if row[0] == tokenizer else None
+
+
+def ensure_schema(conn: sqlite3.Connection, tokenizer: str) -> bool:
+    """Create (or re-create after a tokenizer change) the FTS table and triggers; False if unsupported.
+
+    调用方负责事务。tokenizer 为空表示关闭搜索：已有的索引和触发器会被删掉，写入不再多一份开销。
+    SQLite 没编译 FTS5 或不认识该分词器时只记日志，搜索功能关闭。
+    """
+    conn.execute(_SQL_STATE_TABLE)
+    row = conn.execute("SELECT tokenizer FROM fts_state WHERE id=1").fetchone()
+    if row is not None and row[0] == tokenizer:
+        return True
+    if row is not None:
+        if tokenizer:
+            logger.warning("search tokenizer changed (%s -> %s): index dropped, run backfill", row[0], tokenizer)
+        for sql in _SQL_DROP:
+            conn.execute(sql)
+    if not tokenizer:
+        return False
+    try:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            "content, session_id UNINDEXED, content='messages', content_rowid='id', "
+            f"tokenize='{tokenizer.replace(chr(39), '')}')"
+        )
+    except sqlite3.OperationalError as e:
+        logger.warning("full-text search disabled: %s", e)
+        return False
+    start_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+    conn.execute(
+        "INSERT INTO fts_state (id, tokenizer, start_id, backfilled_until) VALUES (1, ?, ?, 0)",
+        (tokenizer, start_id),
+    )
+    for sql in _SQL_TRIGGERS:
+        conn.execute(sql)
+    return True
+
+
+def _match_expression(query: str) -> Optional[str]:
+    """Quote every whitespace-separated term as an FTS5 phrase (implicit AND); None if no term is long enough."""
+    terms = [t for t in query.split() if len(t) >= MIN_TERM_CHARS]
+    if not terms:
+        return None
+    return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+def _render_snippet(raw: str) -> str:
+    # snippet() 不做 HTML 转义：先用控制字符标出命中，转义后再换成 <mark>
+    return html.escape(raw).replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+
+
+def _like_snippet(content: str, needle: str, width: int = _SNIPPET_TOKENS) -> str:
+    i = content.lower().find(needle.lower())
+    if i < 0:
+        return html.escape(content[: width * 2])
+    start = max(0, i - width)
+    end = min(len(content), i + len(needle) + width)
+    return (
+        ("…" if start > 0 else "")
+        + html.escape(content[start:i])
+        + "<mark>"
+        + html.escape(content[i : i + len(needle)])
+        + "</mark>"
+        + html.escape(content[i + len(needle) : end])
+        + ("…" if end < len(content) else "")
+    )
+
+
+@dataclass
+class BackfillProgress:
+    indexed_until: int
+    target: int
+
+    @property
+    def complete(self) -> bool:
+        return self.indexed_until >= self.target
+
+
+class MessageSearch:
+    """Full-text search over `messages` through the `messages_fts` index kept by `ensure_schema`."""
+
+    def __init__(self, store: "SQLiteStore"):
+        self._store = store
+
+    @property
+    def available(self) -> bool:
+        return self._store.fts_available
+
+    def progress(self) -> BackfillProgress:
+        row = self._store._connect().execute(
+            "SELECT start_id, backfilled_until FROM fts_state WHERE id=1"
+        ).fetchone()
+        if row is None:
+            return BackfillProgress(indexed_until=0, target=0)
+        return BackfillProgress(indexed_until=min(row[1], row[0]), target=row[0])
+
+    @timed(SQLITE_OP_SECONDS, "search")
+    def search(
+        self, query: str, *, session_id: Optional[str] = None, limit: int = 20, offset: int = 0
+    ) -> Dict[str, object]:
+        """Ranked (bm25) hits with HTML-safe snippets; `next_offset` is None on the last page."""
+        if not self.available:
+            raise SearchError("search_unavailable")
+        query = (query or "").strip()
+        if not query:
+            raise SearchError("missing_query")
+        limit = max(1, int(limit))
+        offset = max(0, int(offset))
+        conn = self._store._connect()
+
+        expr = _match_expression(query)
+        if expr is not None:
+            try:
+                if session_id:
+                    rows = conn.execute(
+                        _SQL_SEARCH.format(scope=" AND m.session_id=?"), (expr, session_id, limit + 1, offset)
+                    ).fetchall()
+                else:
+                    rows = conn.execute(_SQL_SEARCH.format(scope=""), (expr, limit + 1, offset)).fetchall()
+            except sqlite3.OperationalError as e:
+                # 每个词都已按短语加引号，正常不会有语法错误；这里兜住分词器拒绝的输入
+                raise SearchError("invalid_query") from e
+            results = [
+                {
+                    "id": r["id"],
+                    "session_id": r["session_id"],
+                    "role": r["role"],
+                    "created_at": r["created_at"],
+                    "snippet": _render_snippet(r["snip"]),
+                    "score": round(-float(r["score"]), 4),
+                }
+                for r in rows[:limit]
+            ]
+        elif session_id:
+            needle = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            rows = conn.execute(_SQL_SHORT_IN_SESSION, (session_id, f"%{needle}%", limit + 1, offset)).fetchall()
+            results = [
+                {
+                    "id": r["id"],
+                    "session_id": r["session_id"],
+                    "role": r["role"],
+                    "created_at": r["created_at"],
+                    "snippet": _like_snippet(r["content"], query),
+                    "score": 0.0,
+                }
+                for r in rows[:limit]
+            ]
+        else:
+            raise SearchError("query_too_short")
+
+        return {
+            "results": results,
+            "next_offset": offset + limit if len(rows) > limit else None,
+            "index_complete": self.progress().complete,
+        }
+
+    @timed(SQLITE_OP_SECONDS, "fts_backfill")
+    def backfill_step(self, batch_size: int) -> int:
+        """Index the next id range of pre-existing messages in one short write transaction; returns rows indexed."""
+        with self._store.transaction() as conn:
+            row = conn.execute("SELECT start_id, backfilled_until FROM fts_state WHERE id=1").fetchone()
+            if row is None or row[1] >= row[0]:
+                return 0
+            upper = min(row[0], row[1] + max(1, int(batch_size)))
+            cur = conn.execute(
+                "INSERT INTO messages_fts (rowid, content, session_id) "
+                "SELECT id, content, session_id FROM messages WHERE id>? AND id<=?",
+                (row[1], upper),
+            )
+            conn.execute("UPDATE fts_state SET backfilled_until=? WHERE id=1", (upper,))
+            return max(0, cur.rowcount)
+
+    def backfill(
+        self, *, batch_size: int = 2000, pause_ms: int = 50, max_batches: Optional[int] = None
+    ) -> Dict[str, int]:
+        """Backfill until done, sleeping `pause_ms` between batches so live writers get the lock."""
+        if not self.available:
+            raise SearchError("search_unavailable")
+        batches = rows = 0
+        while (max_batches is None or batches < max_batches) and not self.progress().complete:
+            if batches:
+                time.sleep(max(0, int(pause_ms)) / 1000.0)
+            rows += self.backfill_step(batch_size)
+            batches += 1
+        p = self.progress()
+        return {"batches": batches, "rows": rows, "indexed_until": p.indexed_until, "target": p.target}
+
+    def rebuild(self) -> None:
+        """Re-index everything from `messages` (FTS5 'rebuild'; one long transaction, offline use)."""
+        with self._store.transaction() as conn:
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            conn.execute("UPDATE fts_state SET backfilled_until=start_id WHERE id=1")
@@ -0,0 +1,310 @@
+"""Multi-process launcher: several HTTP worker processes and several asyncio WS processes.
+
+    python -m backend.serve                                   # HTTP_WORKERS / WS_WORKERS（0 = CPU 核数）
+    python -m backend.serve --http-workers 4 --ws-workers 4 --threads 16
+    python -m backend.serve --http-server gunicorn            # HTTP 交给 gunicorn（需 pip install gunicorn）
+
+同一角色的进程都用 SO_REUSEPORT 绑定同一个端口（PORT / WS_PORT），由内核把新连接分给它们，
+所以 /api/config 返回的 WS 端口是固定的。父进程只做一次性初始化和看护：worker 退出后自动拉起，
+SIGTERM / Ctrl-C 时通知所有 worker 落盘退出。没有 SO_REUSEPORT 的平台（Windows）退化为各一个进程。
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from backend.config import Settings, load_env  # noqa: E402
+
+
+logger = logging.getLogger("aichat.serve")
+
+ROLES = ("http", "ws")
+# worker 启动后这么快就退出算一次“快速失败”；连续太多次说明配置有问题（比如端口被别的程序占着），不再重启
+_FAST_EXIT_SECONDS = 5.0
+_MAX_FAST_EXITS = 5
+
+
+def reuse_port_supported() -> bool:
+    return hasattr(socket, "SO_REUSEPORT") and not sys.platform.startswith("win")
+
+
+def _listen_socket(host: str, port: int, reuse_port: bool, backlog: int = 1024) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def _raise_exit(_signum, _frame) -> None:  # type: ignore[no-untyped-def]
+    raise SystemExit(0)
+
+
+# ---- worker 进程 ----
+
+
+def _run_http_worker(settings: Settings, threads: int, reuse_port: bool, access_log: bool) -> None:
+    from werkzeug.serving import BaseWSGIServer
+
+    from backend.app import create_app
+    from backend.services import build_services
+
+    class PooledWSGIServer(BaseWSGIServer):
+        """Werkzeug server that handles connections on a fixed-size thread pool."""
+
+        multithread = True
+
+        def __init__(self, *a, **kw):  # type: ignore[no-untyped-def]
+            super().__init__(*a, **kw)
+            self._pool = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="http")
+
+        def process_request(self, request, client_address):  # type: ignore[no-untyped-def]
+            self._pool.submit(self._process, request, client_address)
+
+        def _process(self, request, client_address):  # type: ignore[no-untyped-def]
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+        def server_close(self) -> None:
+            super().server_close()
+            pool = getattr(self, "_pool", None)
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+    if not access_log:
+        # werkzeug 默认每个请求打一行日志，多进程高并发时这本身就是瓶颈
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    services = build_services(settings)
+    app = create_app(services=services)
+    sock = _listen_socket(settings.host, settings.port, reuse_port)
+    server = PooledWSGIServer(settings.host, settings.port, app, fd=sock.fileno())
+    signal.signal(signal.SIGTERM, _raise_exit)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        sock.close()
+        services.close()
+
+
+def _run_ws_worker(settings: Settings, reuse_port: bool) -> None:
+    from backend.services import build_services
+    from backend.ws_async_server import run_ws_worker
+
+    services = build_services(settings)
+    try:
+        run_ws_worker(services.chat_service, settings, reuse_port=reuse_port, replay=services.replay)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        services.close()
+
+
+# ---- 父进程：派生与看护 ----
+
+
+class Supervisor:
+    """Spawn one subprocess per (role, index) and restart it when it exits."""
+
+    def __init__(self, commands: Dict[Tuple[str, int], List[str]], envs: Dict[Tuple[str, int], Dict[str, str]]):
+        self._commands = commands
+        self._envs = envs
+        self._procs: Dict[Tuple[str, int], subprocess.Popen] = {}
+        self._started: Dict[Tuple[str, int], float] = {}
+        self._fast_exits = 0
+        self._stopping = False
+
+    def _spawn(self, key: Tuple[str, int]) -> None:
+        self._procs[key] = subprocess.Popen(self._commands[key], env=self._envs[key], cwd=str(PROJECT_ROOT))
+        self._started[key] = time.monotonic()
+
+    def stop(self, *_args) -> None:  # type: ignore[no-untyped-def]
+        self._stopping = True
+
+    def run(self) -> int:
+        for key in self._commands:
+            self._spawn(key)
+        code = 0
+        try:
+            while not self._stopping:
+                time.sleep(0.5)
+                for key, proc in list(self._procs.items()):
+                    rc = proc.poll()
+                    if rc is None or self._stopping:
+                        continue
+                    if time.monotonic() - self._started[key] < _FAST_EXIT_SECONDS:
+                        self._fast_exits += 1
+                        if self._fast_exits >= _MAX_FAST_EXITS:
+                            logger.error("%s worker %d keeps exiting (code %s), giving up", key[0], key[1], rc)
+                            self._stopping = True
+                            code = 1
+                            break
+                    logger.warning("%s worker %d exited with code %s, restarting", key[0], key[1], rc)
+                    self._spawn(key)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._shutdown()
+        return code
+
+    def _shutdown(self, timeout: float = 10.0) -> None:
+        for proc in self._procs.values():
+            if proc.poll() is None:
+                proc.terminate()
+        deadline = time.monotonic() + timeout
+        for proc in self._procs.values():
+            try:
+                proc.wait(timeout=max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def _worker_command(role: str, index: int, args: argparse.Namespace, threads: int, reuse_port: bool) -> List[str]:
+    cmd = [sys.executable, "-m", "backend.serve", "--role", role, "--index", str(index), "--threads", str(threads)]
+    if not reuse_port:
+        cmd.append("--no-reuse-port")
+    if args.access_log:
+        cmd.append("--access-log")
+    return cmd
+
+
+def _gunicorn_command(settings: Settings, workers: int, threads: int, access_log: bool) -> List[str]:
+    cmd = [
+        sys.executable, "-m", "gunicorn",
+        "--workers", str(workers),
+        "--worker-class", "gthread",
+        "--threads", str(threads),
+        "--reuse-port",
+        "--bind", f"{settings.host}:{settings.port}",
+        "--graceful-timeout", "10",
+    ]
+    if access_log:
+        cmd += ["--access-logfile", "-"]
+    return cmd + ["backend.app:create_app()"]
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m backend.serve",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--http-workers", type=int, default=None, help="override HTTP_WORKERS (0 = CPU count)")
+    parser.add_argument("--ws-workers", type=int, default=None, help="override WS_WORKERS (0 = CPU count)")
+    parser.add_argument("--threads", type=int, default=None, help="override HTTP_THREADS (per HTTP worker)")
+    parser.add_argument("--http-server", choices=("auto", "werkzeug", "gunicorn"), default="auto")
+    parser.add_argument(
+        "--keep-context-cache",
+        action="store_true",
+        help="keep CONTEXT_CACHE_ENABLED from the environment (only safe if a session always hits the same worker)",
+    )
+    parser.add_argument("--access-log", action="store_true")
+    # 以下由父进程传给 worker
+    parser.add_argument("--role", choices=ROLES, help=argparse.SUPPRESS)
+    parser.add_argument("--index", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--no-reuse-port", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s[%(process)d] %(levelname)s %(message)s")
+    load_env()
+    settings = Settings()
+    threads = max(1, args.threads if args.threads is not None else settings.http_threads)
+
+    if args.role == "http":
+        _run_http_worker(settings, threads, not args.no_reuse_port, args.access_log)
+        return 0
+    if args.role == "ws":
+        _run_ws_worker(settings, not args.no_reuse_port)
+        return 0
+
+    cpus = os.cpu_count() or 1
+    http_workers = args.http_workers if args.http_workers is not None else settings.http_workers
+    ws_workers = args.ws_workers if args.ws_workers is not None else settings.ws_workers
+    http_workers = max(1, http_workers or cpus)
+    ws_workers = max(1, ws_workers or cpus)
+    reuse_port = reuse_port_supported()
+    if not reuse_port and (http_workers > 1 or ws_workers > 1):
+        logger.warning("SO_REUSEPORT is not available on this platform: running one HTTP and one WS worker")
+        http_workers = ws_workers = 1
+
+    http_server = args.http_server
+    if http_server == "auto":
+        try:
+            import gunicorn  # noqa: F401
+        except ModuleNotFoundError:
+            http_server = "werkzeug"
+        else:
+            http_server = "gunicorn" if reuse_port else "werkzeug"
+
+    # 一次性初始化（建表、迁移、FTS 触发器）在父进程里做完，worker 同时启动时不会抢写锁
+    from backend.services import open_store
+
+    open_store(settings).close()
+
+    base_env = dict(os.environ)
+    if not args.keep_context_cache:
+        # 上下文缓存在每个进程各有一份：HTTP 与 WS 至少是两个进程，同一会话的下一轮落到别的 worker 时，
+        # 这里缓存的窗口就过期了
+        base_env["CONTEXT_CACHE_ENABLED"] = "false"
+
+    if ws_workers > 1:
+        # 回放缓冲在每个进程各有一份，重连多半落到别的 worker：宽限期只会白白消耗上游
+        base_env["WS_RESUME_GRACE_SECONDS"] = "0"
+
+    def env_for(role: str, index: int) -> Dict[str, str]:
+        env = dict(base_env)
+        env["AICHAT_WORKER_ROLE"] = role
+        env["AICHAT_WORKER_INDEX"] = str(index)
+        # 保留期等后台任务只在 ws worker 0 里跑，避免多个进程同时归档 / vacuum
+        env["AICHAT_BACKGROUND_JOBS"] = "1" if (role, index) == ("ws", 0) else "0"
+        return env
+
+    commands: Dict[Tuple[str, int], List[str]] = {}
+    envs: Dict[Tuple[str, int], Dict[str, str]] = {}
+    if http_server == "gunicorn":
+        commands[("http", 0)] = _gunicorn_command(settings, http_workers, threads, args.access_log)
+        envs[("http", 0)] = env_for("http", 0)
+    else:
+        for i in range(http_workers):
+            commands[("http", i)] = _worker_command("http", i, args, threads, reuse_port)
+            envs[("http", i)] = env_for("http", i)
+    for i in range(ws_workers):
+        commands[("ws", i)] = _worker_command("ws", i, args, threads, reuse_port)
+        envs[("ws", i)] = env_for("ws", i)
+
+    logger.info(
+        "serving http://%s:%d (%d x %s, %d threads) and ws://%s:%d/ws (%d x asyncio)",
+        settings.host, settings.port, http_workers, http_server, threads,
+        settings.host, settings.ws_port, ws_workers,
+    )
+    supervisor = Supervisor(commands, envs)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    return supervisor.run()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
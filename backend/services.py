@@ -0,0 +1,339 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from backend.ai_client import BaseAIClient, PlaceholderClient, build_client
+from backend.chat_service import ChatService
+from backend.compaction import ConversationCompactor
+from backend.config import Settings, _get_bool, _get_int, load_env
+from backend.context_cache import SessionContextCache
+from backend.http_pool import PoolConfig
+from backend.metered_client import MeteredAIClient
+from backend.metrics import gauge_lines
+from backend.prompt_cache import PromptCacheTracker
+from backend.replay import ReplayBuffer
+from backend.reply_cache import CachingAIClient, ReplyCache
+from backend.retention import ArchiveStore, RetentionJob, RetentionManager
+from backend.router import Endpoint, RouterClient, RouterPolicy, endpoint_name, parse_endpoints
+from backend.scheduler import GenerationScheduler
+from backend.search import MessageSearch
+from backend.single_flight import SingleFlightClient
+from backend.storage_sqlite import SQLiteStore, SQLiteTuning
+from backend.streaming import STREAM_STATS, PumpPool
+from backend.write_behind import DURABILITY_LEVELS, WriteBehindStore
+
+
+def open_store(settings: Settings) -> SQLiteStore:
+    tuning = SQLiteTuning(
+        synchronous=settings.sqlite_synchronous,
+        cache_size_kb=settings.sqlite_cache_size_kb,
+        mmap_size=settings.sqlite_mmap_size,
+        busy_timeout_ms=settings.sqlite_busy_timeout_ms,
+        auto_vacuum=settings.sqlite_auto_vacuum,
+    )
+    if settings.db_write_mode in DURABILITY_LEVELS:
+        return WriteBehindStore(
+            settings.db_path,
+            tuning=tuning,
+            fts_tokenizer=settings.search_tokenizer,
+            durability=settings.db_write_mode,
+            batch_size=settings.db_write_batch_size,
+            flush_interval_ms=settings.db_write_flush_ms,
+        )
+    return SQLiteStore(settings.db_path, tuning=tuning, fts_tokenizer=settings.search_tokenizer)
+
+
+def _pool_config(settings: Settings) -> PoolConfig:
+    return PoolConfig(
+        pool_connections=settings.ai_pool_connections,
+        pool_maxsize=settings.ai_pool_maxsize,
+        pool_block=settings.ai_pool_block,
+        idle_seconds=settings.ai_pool_idle_seconds,
+        warmup_connections=settings.ai_pool_warmup,
+    )
+
+
+def build_provider(settings: Settings, model: str) -> BaseAIClient:
+    client = build_client(
+        settings.ai_provider,
+        base_url=settings.ai_base_url,
+        api_key=settings.deepseek_api_key,
+        model=model,
+        temperature=settings.ai_temperature,
+        timeout_seconds=settings.ai_timeout_seconds,
+        pool_config=_pool_config(settings),
+        stream_usage=settings.ai_stream_usage,
+    )
+    specs = parse_endpoints(settings.ai_fallback_endpoints)
+    if not specs or isinstance(client, PlaceholderClient):
+        return client
+
+    policy = RouterPolicy(
+        hedge_enabled=settings.router_hedge_enabled,
+        hedge_percentile=settings.router_hedge_percentile,
+        hedge_min_seconds=settings.router_hedge_min_ms / 1000.0,
+        hedge_max_seconds=settings.router_hedge_max_ms / 1000.0,
+        hedge_default_seconds=settings.router_hedge_default_ms / 1000.0,
+        circuit_failures=settings.router_circuit_failures,
+        circuit_open_seconds=settings.router_circuit_open_seconds,
+    )
+    endpoints = [Endpoint(endpoint_name(settings.ai_base_url, model), client, policy)]
+    for spec in specs:
+        # 每个端点各自一个连接池
+        backup = build_client(
+            settings.ai_provider,
+            base_url=spec.base_url,
+            api_key=(os.getenv(spec.api_key_env, "").strip() if spec.api_key_env else "") or settings.deepseek_api_key,
+            model=spec.model or model,
+            temperature=settings.ai_temperature,
+            timeout_seconds=settings.ai_timeout_seconds,
+            pool_config=_pool_config(settings),
+            stream_usage=settings.ai_stream_usage,
+        )
+        endpoints.append(Endpoint(endpoint_name(spec.base_url, spec.model or model), backup, policy))
+    return RouterClient(endpoints, policy)
+
+
+class Services:
+    """Everything one serving process holds: store, client chain, caches and background jobs.
+
+    `backend.app.create_app` 与 `backend.serve` 的 WS worker 各自调用 `build_services`：
+    每个进程一份，import 时不创建任何东西。构造只做必须同步完成的部分（打开库、按需迁移），
+    连接预热等由 `start_warm_up` 放到后台，完成前 `/api/ready` 返回 503。
+    """
+
+    def __init__(self, settings: Settings, *, background: Optional[bool] = None):
+        started = time.perf_counter()
+        self.settings = settings
+        self._ready = threading.Event()
+        self._warm_up_thread: Optional[threading.Thread] = None
+        self._warm_up_lock = threading.Lock()
+        # 由 backend/serve.py 通过环境变量告诉 worker 自己是谁；单进程运行时是 single/0
+        self.worker_info = {
+            "role": os.getenv("AICHAT_WORKER_ROLE", "single"),
+            "index": _get_int("AICHAT_WORKER_INDEX", 0),
+            "pid": os.getpid(),
+        }
+        if background is None:
+            background = _get_bool("AICHAT_BACKGROUND_JOBS", True)
+        self.store = open_store(settings)
+        self.message_search = MessageSearch(self.store)
+
+        # 指标包在 provider 外面：只统计真正打到上游的调用（多端点时是路由后的结果，单个端点的情况见 aichat_router_*）
+        provider = build_provider(settings, settings.ai_model)
+        self.router = provider if isinstance(provider, RouterClient) else None
+        ai_client: BaseAIClient = MeteredAIClient(provider)
+        # 摘要直接调用 provider（不经过 single-flight / 回复缓存）
+        self.summary_client = (
+            MeteredAIClient(build_provider(settings, settings.summary_model))
+            if settings.summary_model and settings.summary_model != settings.ai_model
+            else ai_client
+        )
+
+        # 包装顺序：回复缓存在最外层（命中时不进 flight），未命中的相同请求再由 single-flight 合并
+        self.single_flight = (
+            SingleFlightClient(ai_client, PumpPool(settings.single_flight_max_threads))
+            if settings.single_flight_enabled
+            else None
+        )
+        if self.single_flight is not None:
+            ai_client = self.single_flight
+
+        self.reply_cache = (
+            ReplyCache(
+                ttl_seconds=settings.reply_cache_ttl_seconds,
+                max_entries=settings.reply_cache_max_entries,
+                max_bytes=settings.reply_cache_max_bytes,
+                sqlite_path=settings.reply_cache_db_path,
+                sqlite_max_entries=settings.reply_cache_sqlite_max_entries,
+            )
+            if settings.reply_cache_enabled
+            else None
+        )
+        if self.reply_cache is not None:
+            ai_client = CachingAIClient(ai_client, self.reply_cache)
+        self.ai_client = ai_client
+
+        self.context_cache = (
+            SessionContextCache(
+                max_sessions=settings.context_cache_max_sessions,
+                max_bytes=settings.context_cache_max_bytes,
+            )
+            if settings.context_cache_enabled
+            else None
+        )
+        invalidate = self.context_cache.invalidate if self.context_cache is not None else None
+
+        self.compactor = (
+            ConversationCompactor(
+                self.store,
+                self.summary_client,
+                trigger_messages=settings.summary_trigger_messages or settings.max_history_messages,
+                keep_recent=settings.summary_keep_recent,
+                batch_messages=settings.summary_batch_messages,
+                # 摘要前移后，缓存里的窗口（含没有 id 的增量消息）需要按新的摘要边界重新从库里读
+                on_compacted=invalidate,
+            )
+            if settings.summary_enabled
+            else None
+        )
+
+        self.archive = ArchiveStore(settings.archive_db_path) if settings.archive_db_path else None
+        self.retention = (
+            RetentionManager(
+                self.store,
+                self.archive,
+                ttl_days=settings.retention_ttl_days,
+                batch_sessions=settings.retention_batch_sessions,
+                batch_messages=settings.retention_batch_messages,
+                pause_ms=settings.retention_pause_ms,
+                vacuum_pages=settings.vacuum_pages_per_step,
+                on_archived=invalidate,
+            )
+            if self.archive is not None
+            else None
+        )
+        # 多进程部署时只有一个进程带 background=True（见 backend/serve.py），避免多个进程同时归档
+        self.retention_job: Optional[RetentionJob] = None
+        if background and self.retention is not None and settings.retention_enabled:
+            self.retention_job = RetentionJob(self.retention, settings.retention_interval_minutes * 60.0).start()
+
+        self.scheduler = (
+            GenerationScheduler(
+                max_concurrent=settings.scheduler_max_concurrent,
+                max_queue=settings.scheduler_max_queue,
+                max_wait_seconds=settings.scheduler_max_wait_seconds,
+                session_per_minute=settings.scheduler_session_per_minute,
+                session_burst=settings.scheduler_session_burst,
+                client_per_minute=settings.scheduler_client_per_minute,
+                client_burst=settings.scheduler_client_burst,
+            )
+            if settings.scheduler_enabled
+            else None
+        )
+
+        # 流式回复的回放缓冲（断线续传）；两个 WS 通道共用，续传可以落在另一个通道上
+        self.replay = (
+            ReplayBuffer(
+                max_bytes=settings.replay_buffer_max_bytes,
+                ttl_seconds=settings.replay_buffer_ttl_seconds,
+                max_streams=settings.replay_buffer_max_streams,
+                grace_seconds=settings.ws_resume_grace_seconds,
+            )
+            if settings.ws_resume_enabled
+            else None
+        )
+
+        # 同步通道读上游分片的有界线程池（Flask /ws、/api/chat/stream）
+        self.stream_pumps = PumpPool(settings.stream_pump_threads)
+
+        self.prompt_cache = PromptCacheTracker(max_sessions=settings.prompt_cache_stats_sessions)
+
+        self.chat_service = ChatService(
+            ai_client=self.ai_client,
+            store=self.store,
+            default_system_prompt=settings.system_prompt,
+            max_history_messages=settings.max_history_messages,
+            context_token_budget=settings.context_token_budget,
+            history_scan_limit=settings.context_history_scan,
+            context_cache=self.context_cache,
+            compactor=self.compactor,
+            scheduler=self.scheduler,
+            context_block_messages=settings.context_block_messages,
+            prompt_cache=self.prompt_cache,
+        )
+        self._started = started
+        # 启动耗时（毫秒），由 /api/ready 返回；scripts/bench_startup.py 读的就是它
+        self.startup: Dict[str, object] = {"services_ms": round((time.perf_counter() - started) * 1000.0, 1)}
+
+    def warm_up(self) -> None:
+        """Prepare the upstream client (session, pooled connections) ahead of the first turn, then mark ready."""
+        t0 = time.perf_counter()
+        try:
+            self.ai_client.warm_up()
+        except Exception as e:
+            # 预热失败不影响服务：首个请求按正常路径建连并报错
+            self.startup["warm_up_error"] = repr(e)
+        finally:
+            now = time.perf_counter()
+            self.startup["warm_up_ms"] = round((now - t0) * 1000.0, 1)
+            self.startup["ready_ms"] = round((now - self._started) * 1000.0, 1)
+            self._ready.set()
+
+    def start_warm_up(self) -> None:
+        """Run `warm_up` once in a background thread: the worker starts serving right away, unready."""
+        with self._warm_up_lock:
+            if self._warm_up_thread is not None:
+                return
+            self._warm_up_thread = threading.Thread(target=self.warm_up, name="warm-up", daemon=True)
+        self._warm_up_thread.start()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def readiness(self) -> Dict[str, object]:
+        out: Dict[str, object] = {"ready": self.ready, "worker": self.worker_info}
+        out.update(self.startup)
+        return out
+
+    def _worker_gauges(self) -> Dict[str, float]:
+        return {"pid": self.worker_info["pid"], "index": self.worker_info["index"], "ready": int(self.ready)}
+
+    def collect_stats(self) -> List[str]:
+        """Component gauges for `/api/metrics` (rendered per scrape by the app that owns these services)."""
+        # 指标按进程统计：多进程部署时每次抓取只看到处理这次请求的 worker
+        lines = gauge_lines("aichat_worker", "Worker serving this scrape.", self._worker_gauges(), "stat")
+        lines += gauge_lines(
+            "aichat_upstream_pool", "Upstream connection pool counters.", self.ai_client.pool_stats(), "stat"
+        )
+        lines += gauge_lines("aichat_streaming", "assistant_delta framing counters.", STREAM_STATS.snapshot(), "stat")
+        lines += gauge_lines("aichat_stream_pumps", "Upstream reader threads for sync streams.", self.stream_pumps.stats(), "stat")
+        lines += gauge_lines("aichat_context", "Context window totals.", self.chat_service.context_stats(), "stat")
+        lines += gauge_lines(
+            "aichat_prompt_cache", "Prompt prefix stability and provider cache hits.", self.prompt_cache.stats(), "stat"
+        )
+        if self.context_cache is not None:
+            lines += gauge_lines("aichat_context_cache", "Session context cache.", self.context_cache.stats(), "stat")
+        if self.reply_cache is not None:
+            lines += gauge_lines("aichat_reply_cache", "Reply cache.", self.reply_cache.stats(), "stat")
+        if self.router is not None:
+            lines += gauge_lines("aichat_router", "Endpoint router totals.", self.router.stats(), "stat")
+            per_endpoint = {
+                f"{name}:{key}": value
+                for name, values in self.router.endpoint_stats().items()
+                for key, value in values.items()
+            }
+            lines += gauge_lines("aichat_router_endpoint", "Per-endpoint state (endpoint:stat).", per_endpoint, "stat")
+        if self.scheduler is not None:
+            lines += gauge_lines("aichat_scheduler", "Generation scheduler.", self.scheduler.stats(), "stat")
+        if self.replay is not None:
+            lines += gauge_lines("aichat_replay", "WS resume replay buffer.", self.replay.stats(), "stat")
+        if self.single_flight is not None:
+            lines += gauge_lines("aichat_single_flight", "Single-flight coalescing.", self.single_flight.stats(), "stat")
+        if self.compactor is not None:
+            lines += gauge_lines("aichat_summary", "Rolling summary compaction.", self.compactor.stats(), "stat")
+        if self.retention is not None:
+            lines += gauge_lines("aichat_retention", "Retention / archival totals.", self.retention.stats(), "stat")
+        return lines
+
+    def close(self) -> None:
+        """Stop background threads and flush pending writes (worker shutdown)."""
+        if self.retention_job is not None:
+            self.retention_job.stop()
+        if self.compactor is not None:
+            self.compactor.close(timeout=5.0)
+        self.stream_pumps.shutdown()
+        if self.single_flight is not None:
+            self.single_flight.close()
+        self.store.close()
+
+
+def build_services(settings: Optional[Settings] = None, *, background: Optional[bool] = None) -> Services:
+    if settings is None:
+        load_env()
+        settings = Settings()
+    return Services(settings, background=background)
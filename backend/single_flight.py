@@ -0,0 +1,425 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import threading
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from backend.ai_client import (
+    AIClientError,
+    BaseAIClient,
+    CancelToken,
+    Message,
+    RequestOptions,
+    Usage,
+    aclose_stream,
+    cancel_token,
+)
+from backend.reply_cache import cache_key
+from backend.streaming import PumpPool
+
+
+class _Flight:
+    """One upstream call shared by every concurrent subscriber with the same key.
+
+    分片追加到 `chunks`，订阅者各自记下读到的位置：晚加入的先拿到已流出的前缀，再跟上实时分片。
+    同步订阅者用 Condition 等待，asyncio 订阅者注册一个 waker（call_soon_threadsafe 唤醒自己的事件循环），
+    所以 Flask 线程与 asyncio WS server 可以挂在同一个 flight 上。
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._cond = threading.Condition(threading.Lock())
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.abandoned = False
+        # 上游报告的 usage：每个订阅者读完后各自收到一份（`RequestOptions.on_usage`）
+        self.usage: Optional[Usage] = None
+        self._wakers: Set[Callable[[], None]] = set()
+        # 由驱动方设置：最后一个订阅者离开时调用，尽快关掉上游
+        self.cancel: Optional[Callable[[], None]] = None
+
+    def _wake(self, wakers: List[Callable[[], None]]) -> None:
+        for wake in wakers:
+            try:
+                wake()
+            except RuntimeError:
+                # 订阅者的事件循环已关闭
+                pass
+
+    def publish(self, chunk: str) -> None:
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+            wakers = list(self._wakers)
+        self._wake(wakers)
+
+    def record_usage(self, usage: Usage) -> None:
+        with self._cond:
+            self.usage = usage
+
+    def deliver_usage(self, options: Optional[RequestOptions]) -> None:
+        on_usage = options.on_usage if options is not None else None
+        with self._cond:
+            usage = self.usage
+        if on_usage is not None and usage is not None:
+            on_usage(usage)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self._cond:
+            if self.done:
+                return
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+            wakers = list(self._wakers)
+        self._wake(wakers)
+
+    def join(self) -> bool:
+        with self._cond:
+            if self.abandoned:
+                return False
+            self.subscribers += 1
+            return True
+
+    def leave(self) -> None:
+        with self._cond:
+            self.subscribers -= 1
+            if self.subscribers > 0 or self.done:
+                return
+            self.abandoned = True
+            cancel = self.cancel
+        if cancel is not None:
+            cancel()
+
+    def _read(self, pos: int):  # type: ignore[no-untyped-def]
+        # 调用方持锁
+        return self.chunks[pos:], self.done, self.error
+
+    def _interrupt(self) -> None:
+        # 某个订阅者取消了：叫醒等待中的同步订阅者，让它们各自检查自己的 token
+        with self._cond:
+            self._cond.notify_all()
+
+    def iter_sync(self, cancel: Optional[CancelToken] = None) -> Iterator[str]:
+        # 订阅者取消只让自己离开；上游要等所有订阅者都离开（leave -> cancel）才会被关掉
+        unregister = cancel.add_callback(self._interrupt) if cancel is not None else None
+        try:
+            pos = 0
+            while True:
+                with self._cond:
+                    while pos >= len(self.chunks) and not self.done and not (cancel is not None and cancel.cancelled):
+                        self._cond.wait()
+                    batch, done, error = self._read(pos)
+                if cancel is not None:
+                    cancel.raise_if_cancelled()
+                pos += len(batch)
+                for chunk in batch:
+                    yield chunk
+                if done and pos >= len(self.chunks):
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            if unregister is not None:
+                unregister()
+
+    async def iter_async(self, cancel: Optional[CancelToken] = None) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(event.set)
+
+        with self._cond:
+            self._wakers.add(wake)
+        unregister = cancel.add_callback(wake) if cancel is not None else None
+        try:
+            pos = 0
+            while True:
+                event.clear()
+                if cancel is not None:
+                    cancel.raise_if_cancelled()
+                with self._cond:
+                    batch, done, error = self._read(pos)
+                pos += len(batch)
+                for chunk in batch:
+                    yield chunk
+                if done and pos >= len(self.chunks):
+                    if error is not None:
+                        raise error
+                    return
+                if not batch:
+                    await event.wait()
+        finally:
+            if unregister is not None:
+                unregister()
+            with self._cond:
+                self._wakers.discard(wake)
+
+
+class SingleFlightClient(BaseAIClient):
+    """Coalesce identical in-flight requests onto one upstream call.
+
+    key 与回复缓存相同（归一化消息列表 + 模型 + 温度）。流式与非流式分开合并；
+    `options.bypass_cache` 的请求要的是一次“全新”的回复，不加入别人的 flight。
+    同步流的上游由 `drivers` 里的有界线程驱动；名额用完时发起者在自己的线程上边读边分发。
+    """
+
+    def __init__(self, inner: BaseAIClient, drivers: Optional[PumpPool] = None):
+        self.inner = inner
+        self._drivers = drivers if drivers is not None else PumpPool(32)
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+        self._counts = {"upstream_calls": 0, "coalesced": 0, "max_subscribers": 0, "inline_driven": 0}
+
+    # 回复缓存等外层包装按这两个属性算 key
+    @property
+    def model(self) -> str:
+        return str(getattr(self.inner, "model", ""))
+
+    @property
+    def temperature(self) -> float:
+        return float(getattr(self.inner, "temperature", 0.0) or 0.0)
+
+    def _key(self, kind: str, messages: List[Message]) -> str:
+        return kind + ":" + cache_key(messages, model=self.model, temperature=self.temperature)
+
+    def _acquire(self, key: str) -> Tuple[_Flight, bool]:
+        """Return (flight, is_leader); the caller is already subscribed to it."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.join():
+                self._counts["coalesced"] += 1
+                self._counts["max_subscribers"] = max(self._counts["max_subscribers"], flight.subscribers)
+                return flight, False
+            flight = _Flight(key)
+            flight.join()
+            self._flights[key] = flight
+            self._counts["upstream_calls"] += 1
+            return flight, True
+
+    def _retire(self, flight: _Flight) -> None:
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def _complete(self, flight: _Flight, error: Optional[BaseException] = None) -> None:
+        # 先摘掉再 finish：finish 之后新来的请求会发起新的上游调用，而不是挂到已结束的 flight 上
+        self._retire(flight)
+        if isinstance(error, asyncio.CancelledError):
+            # 发起者被取消不等于其它订阅者被取消：对它们表现为一次上游失败
+            error = AIClientError("cancelled")
+        flight.finish(error)
+
+    @staticmethod
+    def _fresh(options: Optional[RequestOptions]) -> bool:
+        return options is not None and options.bypass_cache
+
+    @staticmethod
+    def _upstream_options(
+        flight: _Flight, options: Optional[RequestOptions], token: Optional[CancelToken] = None
+    ) -> RequestOptions:
+        # 上游调用属于整个 flight：usage 先记在 flight 上再分给每个订阅者；流式时发起者的取消 token
+        # 也不能传下去，换成 flight 自己的（所有人离开时触发）
+        upstream = dataclasses.replace(options or RequestOptions(), on_usage=flight.record_usage)
+        if token is not None:
+            upstream.cancel = token
+        return upstream
+
+    # ---- 同步 ----
+
+    def generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        if self._fresh(options):
+            return self.inner.generate(messages, options)
+        flight, leader = self._acquire(self._key("generate", messages))
+        try:
+            if leader:
+                try:
+                    reply = self.inner.generate(messages, self._upstream_options(flight, options))
+                except BaseException as e:
+                    self._complete(flight, e)
+                    raise
+                flight.publish(reply)
+                self._complete(flight)
+            else:
+                reply = "".join(flight.iter_sync())
+            flight.deliver_usage(options)
+            return reply
+        finally:
+            flight.leave()
+
+    def _drive_sync(self, flight: _Flight, messages: List[Message], options: Optional[RequestOptions]) -> None:
+        it = iter(self.inner.stream_generate(messages, options))
+        try:
+            for chunk in it:
+                if flight.abandoned:
+                    break
+                flight.publish(chunk)
+        except BaseException as e:  # noqa: BLE001 - 转交给所有订阅者
+            self._complete(flight, e)
+            return
+        finally:
+            close = getattr(it, "close", None)
+            if callable(close):
+                close()
+        self._complete(flight)
+
+    def stream_generate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> Iterable[str]:
+        if self._fresh(options):
+            yield from self.inner.stream_generate(messages, options)
+            return
+        flight, leader = self._acquire(self._key("stream", messages))
+        cancel = cancel_token(options)
+        try:
+            if leader:
+                # 上游由独立线程驱动：发起者断开时其它订阅者不受影响；所有人都离开后立即关掉上游连接
+                token = CancelToken()
+                flight.cancel = lambda: token.cancel("abandoned")
+                upstream = self._upstream_options(flight, options, token)
+                if not self._drivers.try_submit(lambda: self._drive_sync(flight, list(messages), upstream)):
+                    with self._lock:
+                        self._counts["inline_driven"] += 1
+                    yield from self._drive_inline(flight, messages, upstream, cancel)
+                    flight.deliver_usage(options)
+                    return
+            yield from flight.iter_sync(cancel)
+            flight.deliver_usage(options)
+        finally:
+            flight.leave()
+
+    def _drive_inline(
+        self,
+        flight: _Flight,
+        messages: List[Message],
+        upstream: RequestOptions,
+        cancel: Optional[CancelToken],
+    ) -> Iterator[str]:
+        """Drive the upstream on the leader's own thread, publishing each chunk as it is yielded.
+
+        驱动线程池满时的退路：上游随发起者走，发起者取消或提前离开时 flight 以错误结束，
+        已挂上来的订阅者各自收到 AIClientError（客户端可重试），不会永远等下去。
+        """
+        token = upstream.cancel
+        unregister = (
+            cancel.add_callback(lambda: token.cancel(cancel.reason))  # type: ignore[union-attr]
+            if cancel is not None and token is not None
+            else None
+        )
+        it = iter(self.inner.stream_generate(messages, upstream))
+        try:
+            for chunk in it:
+                flight.publish(chunk)
+                yield chunk
+            self._complete(flight)
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            # 发起者自己取消不等于其它订阅者取消：对它们表现为一次上游失败
+            left = cancel is not None and cancel.cancelled
+            self._complete(flight, AIClientError("single_flight_leader_left") if left else e)
+            raise
+        finally:
+            if unregister is not None:
+                unregister()
+            close = getattr(it, "close", None)
+            if callable(close):
+                close()
+            if not flight.done:
+                # 发起者提前离开（生成器被关闭）
+                self._complete(flight, AIClientError("single_flight_leader_left"))
+
+    # ---- asyncio ----
+
+    async def agenerate(self, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        if self._fresh(options):
+            return await self.inner.agenerate(messages, options)
+        flight, leader = self._acquire(self._key("generate", messages))
+        try:
+            if leader:
+                try:
+                    reply = await self.inner.agenerate(messages, self._upstream_options(flight, options))
+                except BaseException as e:
+                    self._complete(flight, e)
+                    raise
+                flight.publish(reply)
+                self._complete(flight)
+            else:
+                reply = "".join([chunk async for chunk in flight.iter_async()])
+            flight.deliver_usage(options)
+            return reply
+        finally:
+            flight.leave()
+
+    async def _drive_async(self, flight: _Flight, messages: List[Message], options: Optional[RequestOptions]) -> None:
+        stream = self.inner.astream_generate(messages, options)
+        try:
+            async for chunk in stream:
+                flight.publish(chunk)
+        except (asyncio.CancelledError, Exception) as e:  # noqa: BLE001 - 转交给所有订阅者
+            self._complete(flight, e)
+            return
+        finally:
+            await aclose_stream(stream)
+        self._complete(flight)
+
+    async def astream_generate(
+        self, messages: List[Message], options: Optional[RequestOptions] = None
+    ) -> AsyncIterator[str]:
+        if self._fresh(options):
+            stream = self.inner.astream_generate(messages, options)
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                await aclose_stream(stream)
+            return
+        flight, leader = self._acquire(self._key("stream", messages))
+        cancel = cancel_token(options)
+        try:
+            if leader:
+                loop = asyncio.get_running_loop()
+                token = CancelToken()
+                task = loop.create_task(
+                    self._drive_async(flight, list(messages), self._upstream_options(flight, options, token))
+                )
+
+                def abandon() -> None:
+                    token.cancel("abandoned")
+                    loop.call_soon_threadsafe(task.cancel)
+
+                flight.cancel = abandon
+            async for chunk in flight.iter_async(cancel):
+                yield chunk
+            flight.deliver_usage(options)
+        finally:
+            flight.leave()
+
+    # ---- 其它 ----
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counts = dict(self._counts)
+            counts["in_flight"] = len(self._flights)
+        drivers = self._drivers.stats()
+        counts["driver_threads"] = int(drivers["max_threads"])
+        counts["active_drivers"] = int(drivers["active"])
+        return counts
+
+    def summarize(self, previous: str, messages: List[Message], options: Optional[RequestOptions] = None) -> str:
+        # 摘要请求各不相同，合并不到；直接交给内层
+        return self.inner.summarize(previous, messages, options)
+
+    def warm_up(self) -> None:
+        self.inner.warm_up()
+
+    def close(self) -> None:
+        self._drivers.shutdown()
+
+    async def awarm_up(self) -> None:
+        await self.inner.awarm_up()
+
+    def pool_stats(self) -> Dict[str, int]:
+        return self.inner.pool_stats()
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import json
+from typing import Any, Callable, List, Optional, Tuple
+
+try:
+    import orjson
+except ModuleNotFoundError:  # pragma: no cover
+    orjson = None
+
+
+# 可选的 orjson 后端（直接解析 bytes）；没装时退回标准库
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+    json_loads: Callable[[bytes], Any] = orjson.loads
+
+    def json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+else:
+    JSON_BACKEND = "json"
+    _decoder = json.JSONDecoder()
+
+    def json_loads(raw: bytes) -> Any:
+        # 绕开 json.loads 的纯 Python 外壳（bytes 编码探测 + 首尾空白正则），直接进 C 扫描器
+        text = raw.decode("utf-8") if isinstance(raw, (bytes, bytearray)) else raw
+        text = text.strip()
+        obj, end = _decoder.raw_decode(text)
+        if end != len(text):
+            raise ValueError("extra_data")
+        return obj
+
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+_DONE = b"[DONE]"
+
+
+class SSEDecoder:
+    """Incremental Server-Sent Events decoder over raw bytes.
+
+    `feed` 接收任意切分的字节块，返回其中已完整的事件的 data（多行 data 用 \\n 连接）。
+    只按 \\n / \\r 切行：它们不会出现在多字节 UTF-8 序列内部，所以被切断的汉字会原样留在缓冲里等下一块，
+    data 以 bytes 交给 JSON 解析，全程不需要逐行 decode。注释行（以 : 开头）与 event/id/retry 字段被忽略。
+    """
+
+    __slots__ = ("_buf", "_data", "_skip_lf")
+
+    def __init__(self) -> None:
+        self._buf = b""
+        self._data: List[bytes] = []
+        # 上一块恰好以 \r 结尾：若下一块以 \n 开头，那是同一个 CRLF，不能当成空行
+        self._skip_lf = False
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        if self._skip_lf:
+            self._skip_lf = False
+            if chunk[:1] == b"\n":
+                chunk = chunk[1:]
+        buf = self._buf + chunk if self._buf else chunk
+        cut = max(buf.rfind(b"\n"), buf.rfind(b"\r"))
+        if cut < 0:
+            self._buf = buf
+            return []
+        self._buf = buf[cut + 1 :]
+        if buf[cut] == 13 and not self._buf:  # b"\r"
+            self._skip_lf = True
+
+        region = buf[: cut + 1]
+        if b"\r" in region:
+            region = region.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        lines = region.split(b"\n")
+        lines.pop()  # region 以换行结尾，最后一段总是空串
+
+        events: List[bytes] = []
+        data = self._data
+        for line in lines:
+            if not line:
+                if data:
+                    events.append(data[0] if len(data) == 1 else b"\n".join(data))
+                    data = self._data = []
+                continue
+            if line.startswith(b"data:"):
+                value = line[5:]
+                data.append(value[1:] if value[:1] == b" " else value)
+            elif line == b"data":
+                data.append(b"")
+            # 注释（: 开头）与其它字段（event / id / retry）对 chat completions 流没有意义
+        return events
+
+    def flush(self) -> List[bytes]:
+        """End of stream: dispatch a trailing event that was not followed by a blank line."""
+        events: List[bytes] = []
+        if self._buf:
+            events.extend(self.feed(b"\n"))
+        if self._data:
+            events.append(b"\n".join(self._data))
+            self._data = []
+        return events
+
+
+def _delta_content(payload: bytes) -> Optional[str]:
+    # 心跳 / 只有 role 或 usage 的事件里没有 content：不值得解析 JSON
+    if b'"content"' not in payload:
+        return None
+    try:
+        data = json_loads(payload)
+    except ValueError:
+        return None
+    return _content_of(data)
+
+
+def _content_of(data: Any) -> Optional[str]:
+    try:
+        content = data["choices"][0]["delta"].get("content")
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None
+    return content if content else None
+
+
+def _usage_event(payload: bytes) -> bool:
+    # stream_options.include_usage 时每个事件都带 "usage":null，只有最后一个（choices 为空）是对象
+    i = payload.find(b'"usage"')
+    if i < 0:
+        return False
+    rest = payload[i + 7 :].lstrip(b" :")
+    return rest[:1] == b"{"
+
+
+class ChatStreamDecoder:
+    """Bytes of an OpenAI-compatible `stream=true` response -> delta contents.
+
+    `feed` 返回 (本块里的 content 列表, 是否已收到 [DONE])；[DONE] 之后的数据被忽略。
+    上游返回的 usage 对象（请求里带 `stream_options.include_usage`）保存在 `usage`。
+    """
+
+    __slots__ = ("_sse", "done", "usage")
+
+    def __init__(self) -> None:
+        self._sse = SSEDecoder()
+        self.done = False
+        self.usage: Optional[dict] = None
+
+    def _contents(self, payloads: List[bytes]) -> List[str]:
+        out: List[str] = []
+        for payload in payloads:
+            if payload == _DONE:
+                self.done = True
+                break
+            if _usage_event(payload):
+                try:
+                    data = json_loads(payload)
+                except ValueError:
+                    continue
+                if isinstance(data, dict) and isinstance(data.get("usage"), dict):
+                    self.usage = data["usage"]
+                content = _content_of(data)
+            else:
+                content = _delta_content(payload)
+            if content is not None:
+                out.append(content)
+        return out
+
+    def feed(self, chunk: bytes) -> Tuple[List[str], bool]:
+        if self.done:
+            return [], True
+        return self._contents(self._sse.feed(chunk)), self.done
+
+    def flush(self) -> Tuple[List[str], bool]:
+        if self.done:
+            return [], True
+        return self._contents(self._sse.flush()), self.done
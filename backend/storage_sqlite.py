@@ -1,21 +1,182 @@
 from __future__ import annotations
 
-import os
 import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterator, List, Optional
+
+from backend import search
+from backend.metrics import SQLITE_OP_SECONDS, timed
+from backend.tokens import message_tokens
 
 
 @dataclass
 class StoredMessage:
     role: str
     content: str
+    # 写入时估算一次并落库，之后挑选上下文窗口只做加法，不再重复计数
+    token_count: int = 0
+    # messages.id；还没落库（write-behind 叠加 / 缓存里增量追加）的消息为 0
+    id: int = 0
+    # 会话内的序号（第几条消息，从 1 开始）；只有 get_recent_messages(with_seq=True) 及其缓存 / 叠加会填，未知为 0
+    seq: int = 0
+
+
+@dataclass
+class StoredSummary:
+    """Rolling summary of a session's messages with id <= covered_until."""
+
+    content: str
+    covered_until: int
+    token_count: int = 0
+
+
+@dataclass
+class SQLiteTuning:
+    # WAL 下 synchronous=NORMAL 只在 checkpoint 时 fsync，断电最多丢最后几个事务，不会损坏库
+    synchronous: str = "NORMAL"
+    cache_size_kb: int = 16384
+    mmap_size: int = 64 * 1024 * 1024
+    busy_timeout_ms: int = 5000
+    cached_statements: int = 256
+    # 只对新建的库生效；老库要切换需要一次完整 VACUUM（python -m backend.manage vacuum --enable）
+    auto_vacuum: str = "INCREMENTAL"
+
+
+@dataclass
+class ArchivedSession:
+    """Everything retention moves out of the hot tables for one session."""
+
+    session_id: str
+    system_prompt: Optional[str]
+    summary: Optional[str]
+    updated_at: str
+    # [{"id", "role", "content", "created_at"}, ...]，按 id 升序
+    messages: List[Dict[str, object]]
+    # False：超长会话这一批只搬走了最早的一段，会话行和其余消息还在热表里
+    complete: bool = True
+
+
+# 常用语句保持为模块级常量：同一条长连接上 sqlite3 会按 SQL 文本复用已编译的 statement
+# 表结构版本，记在 PRAGMA user_version 里：改表结构时加一，并在 `_migrate` 里补上对应的步骤
+SCHEMA_VERSION = 1
+
+_SQL_TOUCH_SESSION = (
+    "INSERT INTO sessions (id) VALUES (?) "
+    "ON CONFLICT(id) DO UPDATE SET updated_at=datetime('now')"
+)
+_SQL_UPSERT_PROMPT = (
+    "INSERT INTO sessions (id, system_prompt) VALUES (?, ?) "
+    "ON CONFLICT(id) DO UPDATE SET system_prompt=excluded.system_prompt, updated_at=datetime('now')"
+)
+_SQL_INSERT_MESSAGE = (
+    "INSERT INTO messages (session_id, role, content, token_count, truncated) VALUES (?, ?, ?, ?, ?)"
+)
+_SQL_GET_PROMPT = "SELECT system_prompt FROM sessions WHERE id=?"
+# total 是不相关子查询，SQLite 只算一次（走 idx_messages_session 覆盖索引），用来给结果编会话内序号
+_SQL_RECENT_MESSAGES = (
+    "SELECT id, role, content, token_count FROM messages WHERE session_id=? ORDER BY id DESC LIMIT ?"
+)
+# 带会话内序号的版本多一次整段 COUNT（O(会话长度)），只在分块对齐需要 seq 时使用
+_SQL_RECENT_MESSAGES_WITH_TOTAL = (
+    "SELECT id, role, content, token_count, (SELECT COUNT(*) FROM messages WHERE session_id=?1) AS total "
+    "FROM messages WHERE session_id=?1 ORDER BY id DESC LIMIT ?2"
+)
+_SQL_GET_SUMMARY = "SELECT content, covered_until, token_count FROM summaries WHERE session_id=?"
+# 比较并交换：只有库里的 covered_until 仍是调用方读到的值时才覆盖（并发压缩时后到者放弃）
+_SQL_SAVE_SUMMARY = (
+    "INSERT INTO summaries (session_id, content, covered_until, token_count) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(session_id) DO UPDATE SET content=excluded.content, covered_until=excluded.covered_until, "
+    "token_count=excluded.token_count, updated_at=datetime('now') WHERE summaries.covered_until=?"
+)
+_SQL_EXPIRED_SESSIONS = (
+    "SELECT id, system_prompt, updated_at FROM sessions WHERE updated_at<? ORDER BY updated_at LIMIT ?"
+)
+_SQL_COUNT_EXPIRED = "SELECT COUNT(*) FROM sessions WHERE updated_at<?"
+_SQL_STILL_EXPIRED = "SELECT 1 FROM sessions WHERE id=? AND updated_at<?"
+_SQL_ARCHIVE_MESSAGES = (
+    "SELECT id, role, content, created_at, truncated FROM messages WHERE session_id=? ORDER BY id LIMIT ?"
+)
+_SQL_DELETE_ARCHIVED_MESSAGES = "DELETE FROM messages WHERE session_id=? AND id<=?"
+_SQL_COUNT_AFTER = "SELECT COUNT(*) FROM messages WHERE session_id=? AND id>?"
+_SQL_MESSAGES_AFTER = (
+    "SELECT id, role, content, token_count FROM messages WHERE session_id=? AND id>? ORDER BY id LIMIT ?"
+)
+# 分页 / 导出都是 idx_messages_session(session_id, id) 上的一次范围扫描（keyset，不用 OFFSET）
+_SQL_PAGE_LATEST = (
+    "SELECT id, role, content, created_at, truncated FROM messages WHERE session_id=? ORDER BY id DESC LIMIT ?"
+)
+_SQL_PAGE_BEFORE = (
+    "SELECT id, role, content, created_at, truncated FROM messages "
+    "WHERE session_id=? AND id<? ORDER BY id DESC LIMIT ?"
+)
+_SQL_EXPORT_MESSAGES = (
+    "SELECT id, role, content, created_at, truncated FROM messages WHERE session_id=? AND id>? ORDER BY id"
+)
+
+
+def _message_dict(r: sqlite3.Row) -> Dict[str, object]:
+    # 分页 / 导出 / 归档共用的消息形状；truncated 表示回复在生成途中被取消，只保存了已生成的部分
+    return {
+        "id": r["id"],
+        "role": r["role"],
+        "content": r["content"],
+        "created_at": r["created_at"],
+        "truncated": bool(r["truncated"]),
+    }
+
+
+def _stored_message(r: sqlite3.Row) -> StoredMessage:
+    return StoredMessage(
+        role=r["role"],
+        content=r["content"],
+        token_count=r["token_count"] if r["token_count"] is not None else message_tokens(r["content"]),
+        id=r["id"],
+    )
+
+
+def _close_quietly(conn: sqlite3.Connection) -> None:
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+class _ThreadConnection:
+    """One thread's connection and transaction depth, kept only in that thread's `threading.local`.
+
+    线程退出时 threading.local 里的这一份随之释放，finalizer 关闭连接（连同 WAL/shm 的 fd）；
+    store 只持有弱引用，`close()` 时用来关掉仍然活着的线程的连接。
+    """
+
+    __slots__ = ("conn", "depth", "__weakref__")
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.depth = 0
+        weakref.finalize(self, _close_quietly, conn)
 
 
 class SQLiteStore:
-    def __init__(self, db_path: str):
+    """SQLite persistence with one long-lived connection per live thread.
+
+    读操作直接在本线程连接上执行；写操作走 `transaction()`，同一线程内可嵌套，
+    最外层一次 BEGIN IMMEDIATE / COMMIT，保证“一个逻辑操作 = 一个事务”。
+    线程退出时它的连接随之关闭：开发服务器每个请求一个线程，不会因此累积连接。
+    """
+
+    def __init__(self, db_path: str, *, tuning: Optional[SQLiteTuning] = None, fts_tokenizer: str = ""):
         self._db_path = db_path
+        self._tuning = tuning or SQLiteTuning()
+        # 非空时维护 messages_fts 全文索引（见 backend/search.py）
+        self._fts_tokenizer = (fts_tokenizer or "").strip()
+        self.fts_available = False
+        self._local = threading.local()
+        self._threads: "weakref.WeakSet[_ThreadConnection]" = weakref.WeakSet()
+        self._threads_lock = threading.Lock()
         self._ensure_parent_dir()
         self._init_db()
 
@@ -27,92 +188,406 @@ class SQLiteStore:
         p = Path(self._db_path)
         p.parent.mkdir(parents=True, exist_ok=True)
 
-    def _connect(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self._db_path)
+    def _open(self) -> sqlite3.Connection:
+        t = self._tuning
+        conn = sqlite3.connect(
+            self._db_path,
+            timeout=max(0, t.busy_timeout_ms) / 1000.0,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=max(0, int(t.cached_statements)),
+        )
         conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout={int(t.busy_timeout_ms)};")
+        sync_mode = (t.synchronous or "").strip().upper()
+        if sync_mode not in {"OFF", "NORMAL", "FULL", "EXTRA"}:
+            sync_mode = "NORMAL"
+        conn.execute(f"PRAGMA synchronous={sync_mode};")
+        conn.execute(f"PRAGMA cache_size=-{abs(int(t.cache_size_kb))};")
+        conn.execute(f"PRAGMA mmap_size={max(0, int(t.mmap_size))};")
+        conn.execute("PRAGMA temp_store=MEMORY;")
         return conn
 
+    def _thread_connection(self) -> _ThreadConnection:
+        local = getattr(self._local, "conn", None)
+        if local is None:
+            local = _ThreadConnection(self._open())
+            self._local.conn = local
+            with self._threads_lock:
+                self._threads.add(local)
+        return local
+
+    def _connect(self) -> sqlite3.Connection:
+        return self._thread_connection().conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """One write transaction on this thread's connection; nested calls join the outer one."""
+        local = self._thread_connection()
+        conn = local.conn
+        depth = local.depth
+        if depth == 0:
+            # IMMEDIATE：一开始就拿写锁，避免读后升级写锁时的 SQLITE_BUSY 死锁
+            with SQLITE_OP_SECONDS.time("begin"):
+                conn.execute("BEGIN IMMEDIATE")
+        local.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            local.depth = depth
+            if depth == 0:
+                conn.execute("ROLLBACK")
+            raise
+        local.depth = depth
+        if depth == 0:
+            with SQLITE_OP_SECONDS.time("commit"):
+                conn.execute("COMMIT")
+
+    def atomic(self):
+        """Group several store calls into one logical write (one transaction here)."""
+        return self.transaction()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until queued writes are durable; plain stores write through, so always True."""
+        return True
+
+    def close(self) -> None:
+        with self._threads_lock:
+            live, self._threads = list(self._threads), weakref.WeakSet()
+        for local in live:
+            _close_quietly(local.conn)
+        self._local = threading.local()
+
     def _init_db(self) -> None:
-        with self._connect() as conn:
-            conn.execute("PRAGMA journal_mode=WAL;")
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS sessions (
-                    id TEXT PRIMARY KEY,
-                    system_prompt TEXT,
-                    created_at TEXT DEFAULT (datetime('now')),
-                    updated_at TEXT DEFAULT (datetime('now'))
-                );
-                """
-            )
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    created_at TEXT DEFAULT (datetime('now')),
-                    FOREIGN KEY(session_id) REFERENCES sessions(id)
-                );
-                """
-            )
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);")
+        """Bring the schema up to `SCHEMA_VERSION` once per database file, not once per process.
+
+        库已是当前版本时（父进程或先启动的 worker 已经迁移过）只读两个值就返回，不拿写锁；
+        否则在写事务里再确认一次版本后迁移，多个进程同时启动也只有第一个真正执行 DDL。
+        """
+        conn = self._connect()
+        if self._schema_version(conn) >= SCHEMA_VERSION:
+            fts = search.schema_state(conn, self._fts_tokenizer)
+            if fts is not None:
+                self.fts_available = fts
+                return
+        mode = (self._tuning.auto_vacuum or "").strip().upper()
+        if mode in {"NONE", "FULL", "INCREMENTAL"}:
+            # 必须在建表之前设置；库里已有表时这条只是记下期望值，不改变现有文件
+            conn.execute(f"PRAGMA auto_vacuum={mode};")
+        conn.execute("PRAGMA journal_mode=WAL;")
+        with self.transaction():
+            # 拿到写锁后再读一次：同时启动的其它进程可能刚迁移完
+            if self._schema_version(conn) < SCHEMA_VERSION:
+                self._migrate(conn)
+                conn.execute(f"PRAGMA user_version={SCHEMA_VERSION};")
+        # 全文索引单独一个事务：SQLite 不支持 FTS5 / 该分词器时只关闭搜索，不影响建表
+        with self.transaction():
+            self.fts_available = search.ensure_schema(conn, self._fts_tokenizer)
+
+    @staticmethod
+    def _schema_version(conn: sqlite3.Connection) -> int:
+        return int(conn.execute("PRAGMA user_version").fetchone()[0])
 
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        # 调用方持写事务；每一步都可重复执行（老库 user_version 为 0，表可能已经部分存在）
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                system_prompt TEXT,
+                created_at TEXT DEFAULT (datetime('now')),
+                updated_at TEXT DEFAULT (datetime('now'))
+            );
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TEXT DEFAULT (datetime('now')),
+                FOREIGN KEY(session_id) REFERENCES sessions(id)
+            );
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);")
+        # 保留期清理按 updated_at 找过期会话
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at);")
+        # 旧库迁移：历史行的 token_count 为 NULL，读取时现场估算
+        self._ensure_column(conn, "messages", "token_count", "INTEGER")
+        # 被取消的回复：只保存了已生成的部分
+        self._ensure_column(conn, "messages", "truncated", "INTEGER NOT NULL DEFAULT 0")
+        # 滚动摘要：id <= covered_until 的消息已折叠进 content，构建 prompt 时用它代替这些消息
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS summaries (
+                session_id TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                covered_until INTEGER NOT NULL,
+                token_count INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT DEFAULT (datetime('now')),
+                FOREIGN KEY(session_id) REFERENCES sessions(id)
+            );
+            """
+        )
+
+    @staticmethod
+    def _ensure_column(conn: sqlite3.Connection, table: str, column: str, decl: str) -> None:
+        cols = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+        if column not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+    @timed(SQLITE_OP_SECONDS, "get_or_create_session")
     def get_or_create_session(self, session_id: str) -> str:
         if not session_id:
             raise ValueError("session_id_required")
 
-        with self._connect() as conn:
-            conn.execute(
-                "INSERT OR IGNORE INTO sessions (id, system_prompt) VALUES (?, ?)",
-                (session_id, None),
-            )
-            conn.execute("UPDATE sessions SET updated_at=datetime('now') WHERE id=?", (session_id,))
+        with self.transaction() as conn:
+            conn.execute(_SQL_TOUCH_SESSION, (session_id,))
         return session_id
 
+    @timed(SQLITE_OP_SECONDS, "set_system_prompt")
     def set_system_prompt(self, session_id: str, system_prompt: str) -> None:
-        self.get_or_create_session(session_id)
-        with self._connect() as conn:
-            conn.execute(
-                "UPDATE sessions SET system_prompt=?, updated_at=datetime('now') WHERE id=?",
-                (system_prompt, session_id),
-            )
+        if not session_id:
+            raise ValueError("session_id_required")
+        with self.transaction() as conn:
+            conn.execute(_SQL_UPSERT_PROMPT, (session_id, system_prompt))
 
+    @timed(SQLITE_OP_SECONDS, "get_system_prompt")
     def get_system_prompt(self, session_id: str) -> Optional[str]:
         if not session_id:
             return None
-        with self._connect() as conn:
-            row = conn.execute("SELECT system_prompt FROM sessions WHERE id=?", (session_id,)).fetchone()
-            if row is None:
-                return None
-            return row["system_prompt"]
-
-    def append_message(self, session_id: str, role: str, content: str) -> None:
-        self.get_or_create_session(session_id)
-        with self._connect() as conn:
-            conn.execute(
-                "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)",
-                (session_id, role, content),
-            )
-            conn.execute("UPDATE sessions SET updated_at=datetime('now') WHERE id=?", (session_id,))
+        row = self._connect().execute(_SQL_GET_PROMPT, (session_id,)).fetchone()
+        if row is None:
+            return None
+        return row["system_prompt"]
+
+    @timed(SQLITE_OP_SECONDS, "append_message")
+    def append_message(
+        self,
+        session_id: str,
+        role: str,
+        content: str,
+        token_count: Optional[int] = None,
+        *,
+        truncated: bool = False,
+    ) -> None:
+        """Insert a message and create/touch its session in a single transaction."""
+        if not session_id:
+            raise ValueError("session_id_required")
+        if token_count is None:
+            token_count = message_tokens(content)
+        with self.transaction() as conn:
+            conn.execute(_SQL_TOUCH_SESSION, (session_id,))
+            conn.execute(_SQL_INSERT_MESSAGE, (session_id, role, content, token_count, int(truncated)))
 
-    def get_recent_messages(self, session_id: str, limit: int) -> List[StoredMessage]:
+    @timed(SQLITE_OP_SECONDS, "get_recent_messages")
+    def get_recent_messages(self, session_id: str, limit: int, *, with_seq: bool = False) -> List[StoredMessage]:
+        """The last `limit` messages in id order; `with_seq` also fills `seq` (costs a COUNT over the session)."""
         if not session_id:
             return []
         limit = max(0, int(limit))
         if limit == 0:
             return []
 
-        with self._connect() as conn:
-            rows = conn.execute(
-                "SELECT role, content FROM messages WHERE session_id=? ORDER BY id DESC LIMIT ?",
-                (session_id, limit),
-            ).fetchall()
+        if not with_seq:
+            rows = self._connect().execute(_SQL_RECENT_MESSAGES, (session_id, limit)).fetchall()
+            return [_stored_message(r) for r in reversed(rows)]
+
+        rows = self._connect().execute(_SQL_RECENT_MESSAGES_WITH_TOTAL, (session_id, limit)).fetchall()
+        out = []
+        for seq, r in zip(range(rows[0]["total"] if rows else 0, 0, -1), rows):
+            m = _stored_message(r)
+            m.seq = seq
+            out.append(m)
+        out.reverse()
+        return out
+
+    @timed(SQLITE_OP_SECONDS, "get_summary")
+    def get_summary(self, session_id: str) -> Optional[StoredSummary]:
+        if not session_id:
+            return None
+        row = self._connect().execute(_SQL_GET_SUMMARY, (session_id,)).fetchone()
+        if row is None:
+            return None
+        return StoredSummary(content=row["content"], covered_until=row["covered_until"], token_count=row["token_count"])
+
+    @timed(SQLITE_OP_SECONDS, "save_summary")
+    def save_summary(self, session_id: str, summary: StoredSummary, *, expected_covered_until: int) -> bool:
+        """Store `summary` unless another writer moved the session's summary past `expected_covered_until`.
+
+        摘要只由后台压缩写入、频率很低，所以 write-behind 模式下也直接写库，不进写队列。
+        """
+        if not session_id:
+            raise ValueError("session_id_required")
+        with self.transaction() as conn:
+            cur = conn.execute(
+                _SQL_SAVE_SUMMARY,
+                (
+                    session_id,
+                    summary.content,
+                    int(summary.covered_until),
+                    int(summary.token_count),
+                    int(expected_covered_until),
+                ),
+            )
+            return cur.rowcount > 0
+
+    @timed(SQLITE_OP_SECONDS, "count_messages_after")
+    def count_messages_after(self, session_id: str, after_id: int) -> int:
+        row = self._connect().execute(_SQL_COUNT_AFTER, (session_id, int(after_id))).fetchone()
+        return int(row[0]) if row is not None else 0
+
+    @timed(SQLITE_OP_SECONDS, "get_messages_after")
+    def get_messages_after(self, session_id: str, after_id: int, limit: int) -> List[StoredMessage]:
+        """The `limit` oldest committed messages with id > `after_id`, oldest first."""
+        limit = max(0, int(limit))
+        if not session_id or limit == 0:
+            return []
+        rows = self._connect().execute(_SQL_MESSAGES_AFTER, (session_id, int(after_id), limit)).fetchall()
+        return [_stored_message(r) for r in rows]
+
+    @timed(SQLITE_OP_SECONDS, "get_messages_page")
+    def get_messages_page(self, session_id: str, *, limit: int, before: Optional[int] = None) -> Dict[str, object]:
+        """One page of history, oldest first, ending just before message id `before` (latest page if None).
+
+        `next_before` 是下一页（更早）的游标；没有更早的消息时为 None。
+        """
+        limit = max(1, int(limit))
+        # 排队中的写入还没有 id：先等它们提交，分页才能看到刚发的消息
+        self.flush()
+        conn = self._connect()
+        if before is None:
+            rows = conn.execute(_SQL_PAGE_LATEST, (session_id, limit + 1)).fetchall()
+        else:
+            rows = conn.execute(_SQL_PAGE_BEFORE, (session_id, int(before), limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return {
+            "messages": [_message_dict(r) for r in rows],
+            "has_more": has_more,
+            "next_before": rows[0]["id"] if has_more and rows else None,
+        }
+
+    def iter_session_messages(
+        self, session_id: str, *, after: int = 0, batch_size: int = 256
+    ) -> Iterator[Dict[str, object]]:
+        """Yield every message of a session in id order straight from a cursor (constant memory).
+
+        用一条独立的连接：导出可能持续很久，不占用本线程的长连接，也不会卷进它上面的事务；
+        整个导出读的是同一个 WAL 快照。
+        """
+        self.flush()
+        conn = self._open()
+        try:
+            cur = conn.execute(_SQL_EXPORT_MESSAGES, (session_id, int(after)))
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for r in rows:
+                    yield _message_dict(r)
+        finally:
+            conn.close()
+
+    # ---- 保留期 / 空间回收（由 backend/retention.py 调用）----
+
+    def count_expired_sessions(self, older_than: str) -> int:
+        row = self._connect().execute(_SQL_COUNT_EXPIRED, (older_than,)).fetchone()
+        return int(row[0]) if row is not None else 0
+
+    @timed(SQLITE_OP_SECONDS, "archive_batch")
+    def archive_expired_sessions(
+        self,
+        older_than: str,
+        *,
+        max_sessions: int,
+        max_messages: int,
+        sink: Callable[[List[ArchivedSession]], None],
+    ) -> List[ArchivedSession]:
+        """Move one batch of sessions not updated since `older_than` (UTC "YYYY-MM-DD HH:MM:SS") out of the hot tables.
+
+        读会话、读消息、交给 `sink` 写冷存储都在写事务之外；最后只用一个短写事务删除，
+        并再次确认会话仍然过期（期间被续聊的会话原样留在热表，冷存储里那份下次归档时按 id 合并）。
+        一批最多读 max_messages 条消息：超长会话每批只搬走最早的 max_messages 条
+        （`complete=False`），会话行留到消息搬完的那一批再删。sink 抛异常则热表不动。
+        """
+        max_sessions = max(1, int(max_sessions))
+        max_messages = max(1, int(max_messages))
+        conn = self._connect()
+        batch: List[ArchivedSession] = []
+        n_messages = 0
+        for row in conn.execute(_SQL_EXPIRED_SESSIONS, (older_than, max_sessions)).fetchall():
+            budget = max_messages - n_messages
+            if budget <= 0:
+                break
+            session_id = row["id"]
+            # 多读一条用来判断会话是否还有剩余消息
+            rows = conn.execute(_SQL_ARCHIVE_MESSAGES, (session_id, budget + 1)).fetchall()
+            complete = len(rows) <= budget
+            if not complete and batch:
+                # 装不下的会话留给下一批，由它单独开头
+                break
+            summary = conn.execute(_SQL_GET_SUMMARY, (session_id,)).fetchone()
+            batch.append(
+                ArchivedSession(
+                    session_id=session_id,
+                    system_prompt=row["system_prompt"],
+                    summary=summary["content"] if summary is not None else None,
+                    updated_at=row["updated_at"],
+                    messages=[_message_dict(r) for r in rows[:budget]],
+                    complete=complete,
+                )
+            )
+            n_messages += min(len(rows), budget)
+        if not batch:
+            return []
+        sink(batch)
+
+        archived: List[ArchivedSession] = []
+        with self.transaction() as conn:
+            for a in batch:
+                if conn.execute(_SQL_STILL_EXPIRED, (a.session_id, older_than)).fetchone() is None:
+                    continue
+                last_id = int(a.messages[-1]["id"]) if a.messages else 0  # type: ignore[arg-type]
+                conn.execute(_SQL_DELETE_ARCHIVED_MESSAGES, (a.session_id, last_id))
+                if a.complete:
+                    conn.execute("DELETE FROM summaries WHERE session_id=?", (a.session_id,))
+                    conn.execute("DELETE FROM sessions WHERE id=?", (a.session_id,))
+                archived.append(a)
+        return archived
+
+    def space_stats(self) -> Dict[str, int]:
+        conn = self._connect()
+        stats = {
+            name: int(conn.execute(f"PRAGMA {name}").fetchone()[0])
+            for name in ("page_size", "page_count", "freelist_count", "auto_vacuum")
+        }
+        stats["file_bytes"] = stats["page_size"] * stats["page_count"]
+        stats["free_bytes"] = stats["page_size"] * stats["freelist_count"]
+        return stats
+
+    @timed(SQLITE_OP_SECONDS, "incremental_vacuum")
+    def incremental_vacuum(self, pages: int) -> int:
+        """Return up to `pages` free pages to the OS (auto_vacuum=INCREMENTAL only); returns pages freed."""
+        conn = self._connect()
+        before = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+        # 这条 pragma 每 step 释放一页且不返回列，execute() 只会 step 一次；executescript 会一直 step 到结束。
+        # 每次调用是一个独立的短写事务
+        conn.executescript(f"PRAGMA incremental_vacuum({max(1, int(pages))});")
+        after = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+        return before - after
 
-        rows = list(reversed(rows))
-        return [StoredMessage(role=r["role"], content=r["content"]) for r in rows]
+    def enable_incremental_vacuum(self) -> None:
+        """Switch an existing database to auto_vacuum=INCREMENTAL (a full VACUUM: exclusive lock, offline use)."""
+        conn = self._connect()
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        conn.execute("VACUUM;")
 
+    @timed(SQLITE_OP_SECONDS, "export_session")
     def export_session(self, session_id: str, limit: int) -> Dict[str, object]:
         prompt = self.get_system_prompt(session_id)
         msgs = self.get_recent_messages(session_id, limit)
@@ -0,0 +1,390 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional
+
+from backend.ai_client import CancelToken
+
+
+class StreamStats:
+    """Process-wide counters for delta framing (frames/sec, bytes/sec, coalescing ratio)."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._streams = 0
+        self._chunks_in = 0
+        self._frames_out = 0
+        self._bytes_out = 0
+        self._seconds = 0.0
+
+    def record(self, *, chunks_in: int, frames_out: int, bytes_out: int, seconds: float) -> None:
+        with self._lock:
+            self._streams += 1
+            self._chunks_in += chunks_in
+            self._frames_out += frames_out
+            self._bytes_out += bytes_out
+            self._seconds += seconds
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            secs = self._seconds
+            return {
+                "streams": self._streams,
+                "chunks_in": self._chunks_in,
+                "frames_out": self._frames_out,
+                "bytes_out": self._bytes_out,
+                "frames_per_sec": self._frames_out / secs if secs else 0.0,
+                "bytes_per_sec": self._bytes_out / secs if secs else 0.0,
+                "chunks_per_frame": self._chunks_in / self._frames_out if self._frames_out else 0.0,
+            }
+
+
+STREAM_STATS = StreamStats()
+
+
+class DeltaCoalescer:
+    """Merge small provider chunks into fewer assistant_delta frames.
+
+    首个分片立即发出（TTFT 不变）；之后在时间窗（window_ms）或字节阈值（max_bytes）到达时合并发出。
+    全文用 list + join 累积，避免 `full += chunk` 的二次方拷贝。
+    """
+
+    def __init__(
+        self,
+        *,
+        window_ms: float = 20.0,
+        max_bytes: int = 2048,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.window = max(0.0, float(window_ms)) / 1000.0
+        self.max_bytes = max(1, int(max_bytes))
+        self._clock = clock
+        self._parts: List[str] = []
+        self._pending: List[str] = []
+        self._pending_bytes = 0
+        self._pending_since: Optional[float] = None
+        self._started = clock()
+        self.chunks_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+
+    def push(self, chunk: str) -> Optional[str]:
+        """Add a chunk; return a frame payload if one is due now."""
+        if not chunk:
+            return None
+        self.chunks_in += 1
+        self._parts.append(chunk)
+        self._pending.append(chunk)
+        self._pending_bytes += len(chunk.encode("utf-8"))
+        now = self._clock()
+        if self._pending_since is None:
+            self._pending_since = now
+        if (
+            self.frames_out == 0
+            or self._pending_bytes >= self.max_bytes
+            or now - self._pending_since >= self.window
+        ):
+            return self.flush()
+        return None
+
+    def due_in(self) -> Optional[float]:
+        """Seconds until pending text must be flushed, or None if nothing is pending."""
+        if self._pending_since is None:
+            return None
+        return max(0.0, self._pending_since + self.window - self._clock())
+
+    def flush(self) -> Optional[str]:
+        if not self._pending:
+            return None
+        frame = "".join(self._pending) if len(self._pending) > 1 else self._pending[0]
+        self._pending = []
+        self.frames_out += 1
+        self.bytes_out += self._pending_bytes
+        self._pending_bytes = 0
+        self._pending_since = None
+        return frame
+
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def finish(self, stats: Optional[StreamStats] = STREAM_STATS) -> None:
+        if stats is not None:
+            stats.record(
+                chunks_in=self.chunks_in,
+                frames_out=self.frames_out,
+                bytes_out=self.bytes_out,
+                seconds=self._clock() - self._started,
+            )
+
+
+class PumpPool:
+    """Bounded threads that keep reading upstream for `iter_coalesced` while the caller waits on the flush timer.
+
+    线程数有上限，不随并发流数增长；名额用完时 `iter_coalesced` 在调用方线程上直接读
+    （照样合并，只是上游停顿时积压的尾巴要等下一个分片才发出）。
+    """
+
+    def __init__(self, max_threads: int) -> None:
+        self.max_threads = max(0, int(max_threads))
+        self._slots = threading.BoundedSemaphore(self.max_threads) if self.max_threads else None
+        self._executor = (
+            ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="delta-pump")
+            if self.max_threads
+            else None
+        )
+        self._lock = threading.Lock()
+        self._active = 0
+        self._pumped = 0
+        self._inline = 0
+
+    def try_submit(self, fn: Callable[[], None]) -> bool:
+        """Run `fn` on a pump thread if one is free; False means the caller should read inline."""
+        if self._slots is None or not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._inline += 1
+            return False
+
+        def run() -> None:
+            try:
+                fn()
+            finally:
+                with self._lock:
+                    self._active -= 1
+                self._slots.release()  # type: ignore[union-attr]
+
+        with self._lock:
+            self._active += 1
+            self._pumped += 1
+        try:
+            self._executor.submit(run)  # type: ignore[union-attr]
+        except RuntimeError:  # 已 shutdown
+            with self._lock:
+                self._active -= 1
+                self._pumped -= 1
+                self._inline += 1
+            self._slots.release()
+            return False
+        return True
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "max_threads": float(self.max_threads),
+                "active": float(self._active),
+                "pumped": float(self._pumped),
+                "inline": float(self._inline),
+            }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+_END = object()
+
+
+def _pump(it: Iterator[str], q: "queue.Queue[object]", stop: threading.Event) -> None:
+    try:
+        for chunk in it:
+            if stop.is_set():
+                break
+            q.put(chunk)
+        q.put(_END)
+    except BaseException as e:  # noqa: BLE001 - 交给消费线程重新抛出
+        q.put(e)
+    finally:
+        close = getattr(it, "close", None)
+        if stop.is_set() and callable(close):
+            close()
+
+
+def iter_coalesced(
+    chunks: Iterable[str], coalescer: DeltaCoalescer, pumps: Optional[PumpPool] = None
+) -> Iterator[str]:
+    """Sync variant: frames from `chunks`, flushing on the time window even if upstream stalls.
+
+    第一个分片在调用方线程上取：ChatService 的生成器在吐出第一个字之前完成准入、读上下文、
+    落用户消息，这些 SQLite 操作因此都留在请求线程上。之后的分片交给 `pumps` 里的线程读，
+    本线程带超时地等待，上游在一个 burst 之后停顿时积压的尾巴也按时间窗发出；
+    没有 `pumps` 或名额用完时直接在本线程读。消费方提前关闭本生成器时，读线程会在下一个分片后退出。
+    """
+    it = iter(chunks)
+    handed_off = False
+    try:
+        first = next(it, _END)
+        if first is _END:
+            return
+        frame = coalescer.push(first)  # type: ignore[arg-type]
+        if frame:
+            yield frame
+
+        q: "queue.Queue[object]" = queue.Queue(maxsize=256)
+        stop = threading.Event()
+        handed_off = pumps is not None and pumps.try_submit(lambda: _pump(it, q, stop))
+        if not handed_off:
+            for chunk in it:
+                frame = coalescer.push(chunk)
+                if frame:
+                    yield frame
+        else:
+            try:
+                while True:
+                    due = coalescer.due_in()
+                    try:
+                        item = q.get(timeout=due) if due is not None else q.get()
+                    except queue.Empty:
+                        frame = coalescer.flush()
+                        if frame:
+                            yield frame
+                        continue
+                    if item is _END:
+                        break
+                    if isinstance(item, BaseException):
+                        raise item
+                    frame = coalescer.push(item)  # type: ignore[arg-type]
+                    if frame:
+                        yield frame
+            finally:
+                stop.set()
+                # 让阻塞在满队列上的读线程能继续走到 stop 检查
+                while not q.empty():
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+        frame = coalescer.flush()
+        if frame:
+            yield frame
+    finally:
+        # 交给读线程后由它负责关闭上游生成器
+        close = getattr(it, "close", None)
+        if not handed_off and callable(close):
+            close()
+
+
+async def acoalesce(chunks: AsyncIterator[str], coalescer: DeltaCoalescer) -> AsyncIterator[str]:
+    """Async variant of `iter_coalesced`: a pending tail is flushed when its window expires."""
+    it = chunks.__aiter__()
+    nxt: Optional["asyncio.Future[str]"] = None
+    try:
+        while True:
+            if nxt is None:
+                nxt = asyncio.ensure_future(it.__anext__())
+            due = coalescer.due_in()
+            if due is not None and not nxt.done():
+                done, _pending = await asyncio.wait({nxt}, timeout=due)
+                if not done:
+                    frame = coalescer.flush()
+                    if frame:
+                        yield frame
+                    continue
+            try:
+                chunk = await nxt
+            except StopAsyncIteration:
+                nxt = None
+                break
+            nxt = None
+            frame = coalescer.push(chunk)
+            if frame:
+                yield frame
+        frame = coalescer.flush()
+        if frame:
+            yield frame
+    finally:
+        if nxt is not None and not nxt.done():
+            nxt.cancel()
+            try:
+                await nxt
+            except BaseException:
+                pass
+        elif nxt is not None and not nxt.cancelled():
+            # 被取消的同时上游刚好结束：取回结果，免得报 "Task exception was never retrieved"
+            nxt.exception()
+        aclose = getattr(it, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def delta_frame_encoder(session_id: str, message_id: str = "") -> Callable[..., str]:
+    """Return (content, seq) -> assistant_delta JSON; the constant head is encoded once per stream.
+
+    带 message_id 时每帧附上 `seq`（本条回复内从 1 开始），断线重连后用 `resume` 从这里接着收。
+    """
+    head = '{"type":"assistant_delta","session_id":' + json.dumps(session_id, ensure_ascii=False)
+    if message_id:
+        head += ',"message_id":' + json.dumps(message_id)
+    head += ',"content":'
+
+    def encode(content: str, seq: int = 0) -> str:
+        body = head + json.dumps(content, ensure_ascii=False)
+        return body + (',"seq":%d}' % seq if seq else "}")
+
+    return encode
+
+
+def assistant_start_frame(session_id: str, message_id: str) -> str:
+    """`assistant_start` JSON: sent before the first delta so a client can resume even before any text."""
+    return json.dumps({"type": "assistant_start", "session_id": session_id, "message_id": message_id})
+
+
+def assistant_message_frame(
+    session_id: str, content: str, *, truncated: bool = False, message_id: str = ""
+) -> str:
+    """Final `assistant_message` JSON; `truncated` is only present when the reply was cancelled."""
+    frame: Dict[str, object] = {"type": "assistant_message", "content": content, "session_id": session_id}
+    if message_id:
+        frame["message_id"] = message_id
+    if truncated:
+        frame["truncated"] = True
+    return json.dumps(frame, ensure_ascii=False)
+
+
+def error_frame(
+    session_id: str, message: str, *, retry_after: Optional[int] = None, message_id: Optional[str] = None
+) -> str:
+    """`error` JSON; `retry_after` (seconds) is set when the scheduler refused the turn."""
+    frame: Dict[str, object] = {"type": "error", "message": message, "session_id": session_id}
+    if retry_after is not None:
+        frame["retry_after"] = retry_after
+    if message_id is not None:
+        frame["message_id"] = message_id
+    return json.dumps(frame, ensure_ascii=False)
+
+
+class ActiveTurn:
+    """The streamed reply currently running on one WS connection, cancellable from another thread / task.
+
+    只在流式阶段可取消：`finish()` 之后（正在落库 / 发最终消息）再来的 cancel 被忽略，
+    这样“取消”与“正常结束”不会同时发生，truncated 就等于 `token.cancelled`。
+    """
+
+    def __init__(self, on_cancel: Optional[Callable[[], None]] = None):
+        self.token = CancelToken()
+        # 取消时额外要做的事（asyncio 侧：task.cancel() 打断正在 await 的上游读）
+        self._on_cancel = on_cancel
+        self._lock = threading.Lock()
+        self._streaming = True
+
+    def cancel(self, reason: str) -> bool:
+        with self._lock:
+            if not self._streaming or not self.token.cancel(reason):
+                return False
+        if self._on_cancel is not None:
+            self._on_cancel()
+        return True
+
+    @property
+    def streaming(self) -> bool:
+        return self._streaming
+
+    def finish(self) -> bool:
+        """Leave the streaming phase; returns whether the turn was cancelled."""
+        with self._lock:
+            self._streaming = False
+        return self.token.cancelled
+
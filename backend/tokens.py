@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import functools
+import math
+
+
+# 每条消息的角色/分隔符开销（OpenAI 兼容 chat 格式大致为 3~4 token）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Deepseek 官方给出的经验换算：1 个英文字符 ≈ 0.3 token，1 个中文字符 ≈ 0.6 token
+_ASCII_RATIO = 0.3
+_WIDE_RATIO = 0.6
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast local token estimate for `text` (no tokenizer, O(n) in C via `encode`)."""
+    if not text:
+        return 0
+    n_chars = len(text)
+    n_bytes = len(text.encode("utf-8", errors="ignore"))
+    # 非 ASCII 字符在 UTF-8 里多占 1~3 个字节；CJK 基本都是 3 字节，按多出的 2 字节折算字符数
+    wide = min(n_chars, (n_bytes - n_chars) // 2)
+    ascii_chars = n_chars - wide
+    return max(1, math.ceil(ascii_chars * _ASCII_RATIO + wide * _WIDE_RATIO))
+
+
+def message_tokens(content: str) -> int:
+    return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+@functools.lru_cache(maxsize=256)
+def prompt_tokens(system_prompt: str) -> int:
+    """Like `message_tokens`, memoized: system prompts repeat across turns and sessions."""
+    return message_tokens(system_prompt)
@@ -0,0 +1,413 @@
+from __future__ import annotations
+
+import atexit
+import dataclasses
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from backend.storage_sqlite import (
+    _SQL_INSERT_MESSAGE,
+    _SQL_TOUCH_SESSION,
+    _SQL_UPSERT_PROMPT,
+    SQLiteStore,
+    SQLiteTuning,
+    StoredMessage,
+)
+from backend.metrics import SQLITE_OP_SECONDS, timed
+from backend.tokens import message_tokens
+
+
+logger = logging.getLogger(__name__)
+
+# 持久化级别：
+#   group —— 调用方入队后等待所在批次提交（多个会话共享一次 fsync，返回即已落盘）
+#   async —— 入队即返回，后台按批次/时间窗提交；进程崩溃可能丢最后一个时间窗的数据
+DURABILITY_LEVELS = ("group", "async")
+
+
+class _Op:
+    __slots__ = ("sql", "params", "on_commit")
+
+    def __init__(self, sql: str, params: Tuple[object, ...], on_commit=None):  # type: ignore[no-untyped-def]
+        self.sql = sql
+        self.params = params
+        self.on_commit = on_commit
+
+
+class _Unit:
+    """Ops that must land in the same transaction; `done` is set once they are committed."""
+
+    __slots__ = ("ops", "done", "error", "settled")
+
+    def __init__(self, ops: List[_Op], wait: bool):
+        self.ops = ops
+        self.done: Optional[threading.Event] = threading.Event() if wait else None
+        self.error: Optional[BaseException] = None
+        # 已提交或已判定失败（写线程异常退出时据此找出还没有结果的单元）
+        self.settled = False
+
+
+_STOP = object()
+
+
+# 进程退出时 flush 仍在运行的 store；只注册一次 atexit，弱引用不会让已关闭的 store 一直活着
+_LIVE_STORES: "weakref.WeakSet[WriteBehindStore]" = weakref.WeakSet()
+_atexit_lock = threading.Lock()
+_atexit_registered = False
+
+
+def _close_live_stores() -> None:
+    for store in list(_LIVE_STORES):
+        store.close()
+
+
+def _track(store: "WriteBehindStore") -> None:
+    global _atexit_registered
+    with _atexit_lock:
+        _LIVE_STORES.add(store)
+        if not _atexit_registered:
+            atexit.register(_close_live_stores)
+            _atexit_registered = True
+
+
+def _busy(error: BaseException) -> bool:
+    # 其它进程持有写锁超过 busy_timeout：与批次内容无关，整批重试
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    text = str(error).lower()
+    return "locked" in text or "busy" in text
+
+
+def _rollback_quietly(conn: sqlite3.Connection) -> None:
+    if not conn.in_transaction:
+        return
+    try:
+        conn.execute("ROLLBACK")
+    except sqlite3.Error:
+        logger.exception("write-behind rollback failed")
+
+
+class WriteBehindStore(SQLiteStore):
+    """SQLiteStore whose writes are queued and group-committed by one background writer.
+
+    读操作会叠加尚未提交的写入（read-your-writes），所以 `_build_messages` 一定能看到刚发的用户消息。
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        *,
+        tuning: Optional[SQLiteTuning] = None,
+        fts_tokenizer: str = "",
+        durability: str = "group",
+        batch_size: int = 256,
+        flush_interval_ms: int = 10,
+    ):
+        durability = (durability or "group").strip().lower()
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"unknown_durability:{durability}")
+        super().__init__(db_path, tuning=tuning, fts_tokenizer=fts_tokenizer)
+        self._durability = durability
+        self._batch_size = max(1, int(batch_size))
+        self._flush_interval = max(0, int(flush_interval_ms)) / 1000.0
+
+        self._queue: "queue.Queue[object]" = queue.Queue()
+        self._local_unit = threading.local()
+        # 未提交写入的叠加视图；提交与移除在同一把锁内完成，读者不会看到重复或缺失
+        self._overlay_lock = threading.Lock()
+        self._pending_messages: Dict[str, Deque[StoredMessage]] = {}
+        self._pending_prompts: Dict[str, Tuple[int, Optional[str]]] = {}
+        self._prompt_seq = 0
+        # 入队与关闭互斥：关闭后（或写线程异常退出后）不会再有单元排到 _STOP 之后没人处理
+        self._state_lock = threading.Lock()
+        self._closed = False
+        self._dead: Optional[BaseException] = None
+
+        self._writer = threading.Thread(target=self._writer_loop, name="sqlite-write-behind", daemon=True)
+        self._writer.start()
+        _track(self)
+
+    @property
+    def durability(self) -> str:
+        return self._durability
+
+    # ---- 写入：入队 ----
+
+    def _submit(self, ops: List[_Op]) -> None:
+        collecting = getattr(self._local_unit, "ops", None)
+        if collecting is not None:
+            collecting.extend(ops)
+            return
+        self._enqueue(_Unit(ops, wait=self._durability == "group"))
+
+    def _enqueue(self, unit: _Unit) -> None:
+        with self._state_lock:
+            if self._closed:
+                raise RuntimeError("store_closed")
+            if self._dead is not None:
+                raise RuntimeError("store_writer_dead") from self._dead
+            self._queue.put(unit)
+        if unit.done is not None:
+            unit.done.wait()
+            if unit.error is not None:
+                raise unit.error
+
+    @contextmanager
+    def atomic(self) -> Iterator[None]:
+        """Collect this thread's writes and enqueue them as one unit (same batch, same transaction)."""
+        if getattr(self._local_unit, "ops", None) is not None:
+            yield
+            return
+        self._local_unit.ops = []
+        try:
+            yield
+            ops = self._local_unit.ops
+        finally:
+            self._local_unit.ops = None
+        if ops:
+            self._enqueue(_Unit(ops, wait=self._durability == "group"))
+
+    @timed(SQLITE_OP_SECONDS, "get_or_create_session")
+    def get_or_create_session(self, session_id: str) -> str:
+        if not session_id:
+            raise ValueError("session_id_required")
+        self._submit([_Op(_SQL_TOUCH_SESSION, (session_id,))])
+        return session_id
+
+    @timed(SQLITE_OP_SECONDS, "set_system_prompt")
+    def set_system_prompt(self, session_id: str, system_prompt: str) -> None:
+        if not session_id:
+            raise ValueError("session_id_required")
+        with self._overlay_lock:
+            self._prompt_seq += 1
+            seq = self._prompt_seq
+            self._pending_prompts[session_id] = (seq, system_prompt)
+
+        def committed() -> None:
+            current = self._pending_prompts.get(session_id)
+            if current is not None and current[0] == seq:
+                del self._pending_prompts[session_id]
+
+        self._submit([_Op(_SQL_UPSERT_PROMPT, (session_id, system_prompt), committed)])
+
+    @timed(SQLITE_OP_SECONDS, "append_message")
+    def append_message(
+        self,
+        session_id: str,
+        role: str,
+        content: str,
+        token_count: Optional[int] = None,
+        *,
+        truncated: bool = False,
+    ) -> None:
+        if not session_id:
+            raise ValueError("session_id_required")
+        if token_count is None:
+            token_count = message_tokens(content)
+        msg = StoredMessage(role=role, content=content, token_count=token_count)
+        with self._overlay_lock:
+            self._pending_messages.setdefault(session_id, deque()).append(msg)
+
+        def committed() -> None:
+            pending = self._pending_messages.get(session_id)
+            if pending:
+                # 单写线程按 FIFO 提交，所以最早的待提交消息就是这一条
+                pending.popleft()
+                if not pending:
+                    del self._pending_messages[session_id]
+
+        self._submit(
+            [
+                _Op(_SQL_TOUCH_SESSION, (session_id,)),
+                _Op(_SQL_INSERT_MESSAGE, (session_id, role, content, token_count, int(truncated)), committed),
+            ]
+        )
+
+    # ---- 读取：DB + 未提交叠加 ----
+
+    def get_system_prompt(self, session_id: str) -> Optional[str]:
+        if not session_id:
+            return None
+        with self._overlay_lock:
+            pending = self._pending_prompts.get(session_id)
+            if pending is not None:
+                return pending[1]
+            return super().get_system_prompt(session_id)
+
+    def get_recent_messages(self, session_id: str, limit: int, *, with_seq: bool = False) -> List[StoredMessage]:
+        if not session_id:
+            return []
+        limit = max(0, int(limit))
+        if limit == 0:
+            return []
+        with self._overlay_lock:
+            pending = list(self._pending_messages.get(session_id) or ())
+            if not with_seq:
+                committed = super().get_recent_messages(session_id, limit - len(pending))
+                return (committed + pending)[-limit:]
+            # 至少读一条已提交的消息：待提交消息的会话内序号接着它往下编
+            committed = super().get_recent_messages(session_id, max(1, limit - len(pending)), with_seq=True)
+        base = committed[-1].seq if committed else 0
+        pending = [dataclasses.replace(m, seq=base + i) for i, m in enumerate(pending, 1)]
+        return (committed + pending)[-limit:]
+
+    # ---- 后台写线程 ----
+
+    def _collect_batch(self, first: object) -> Tuple[List[_Unit], bool]:
+        units: List[_Unit] = []
+        stop = False
+        item: object = first
+        # group 模式不额外等待：写线程忙于上一次提交期间排进来的写入自然凑成一批；
+        # async 模式则在时间窗内尽量攒批，减少提交次数
+        linger = self._flush_interval if self._durability == "async" else 0.0
+        deadline = time.monotonic() + linger
+        n_ops = 0
+        while True:
+            if item is _STOP:
+                stop = True
+                break
+            unit = item  # type: ignore[assignment]
+            units.append(unit)  # type: ignore[arg-type]
+            n_ops += len(unit.ops)  # type: ignore[attr-defined]
+            if n_ops >= self._batch_size:
+                break
+            try:
+                remaining = deadline - time.monotonic()
+                item = self._queue.get_nowait() if remaining <= 0 else self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+        return units, stop
+
+    @timed(SQLITE_OP_SECONDS, "write_batch")
+    def _commit(self, units: List[_Unit]) -> None:
+        error = self._try_commit(units)
+        if error is None:
+            self._done(units)
+            return
+        if len(units) > 1 and not _busy(error):
+            # 一个坏单元不能拖垮同批里其它会话的写入：逐个单元重试，只让出错的那个失败
+            for unit in units:
+                unit_error = self._try_commit([unit])
+                if unit_error is None:
+                    self._done([unit])
+                else:
+                    self._fail([unit], unit_error)
+            return
+        self._fail(units, error)
+
+    def _try_commit(self, units: List[_Unit]) -> Optional[BaseException]:
+        """Commit `units` in one transaction; returns the error instead of raising (after rolling back)."""
+        conn = self._connect()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for unit in units:
+                    for op in unit.ops:
+                        conn.execute(op.sql, op.params)
+                with self._overlay_lock:
+                    conn.execute("COMMIT")
+                    self._run_on_commit(units)
+                return None
+            except Exception as e:  # noqa: BLE001 - 写线程不能因为一个批次退出
+                # COMMIT 失败（如 SQLITE_BUSY）时事务仍开着，不回滚的话之后每次 BEGIN 都会失败
+                _rollback_quietly(conn)
+                if _busy(e) and attempt < 3:
+                    time.sleep(0.05 * attempt)
+                    continue
+                return e
+
+    @staticmethod
+    def _run_on_commit(units: List[_Unit]) -> None:
+        # 调用方持 _overlay_lock；已经提交，回调出错也不能让批次被当成失败重试（会重复写入）
+        for unit in units:
+            for op in unit.ops:
+                if op.on_commit is not None:
+                    try:
+                        op.on_commit()
+                    except Exception:  # noqa: BLE001
+                        logger.exception("write-behind on_commit callback failed")
+
+    @staticmethod
+    def _done(units: List[_Unit]) -> None:
+        for unit in units:
+            unit.settled = True
+            if unit.done is not None:
+                unit.done.set()
+
+    def _fail(self, units: List[_Unit], error: BaseException) -> None:
+        # group 模式下调用方会收到这个异常；async 模式没有调用方可通知，只能记日志
+        logger.error("write-behind: %d units failed and were dropped: %r", len(units), error)
+        with self._overlay_lock:
+            self._run_on_commit(units)
+        for unit in units:
+            unit.settled = True
+            unit.error = error
+            if unit.done is not None:
+                unit.done.set()
+
+    def _drain(self, error: BaseException) -> None:
+        """Fail every unit still queued (writer gone); callers waiting on them are released."""
+        units: List[_Unit] = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                units.append(item)  # type: ignore[arg-type]
+        if units:
+            self._fail(units, error)
+
+    def _writer_loop(self) -> None:
+        units: List[_Unit] = []
+        try:
+            while True:
+                units, stop = self._collect_batch(self._queue.get())
+                if units:
+                    self._commit(units)
+                if stop:
+                    return
+        except BaseException as e:
+            logger.exception("write-behind writer died")
+            with self._state_lock:
+                self._dead = e
+            error = RuntimeError("store_writer_dead")
+            pending = [unit for unit in units if not unit.settled]
+            if pending:
+                self._fail(pending, error)
+            self._drain(error)
+
+    # ---- flush / 关闭 ----
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything queued so far has been committed."""
+        barrier = _Unit([], wait=True)
+        with self._state_lock:
+            if self._closed or self._dead is not None:
+                return True
+            self._queue.put(barrier)
+        assert barrier.done is not None
+        return barrier.done.wait(timeout)
+
+    def close(self) -> None:
+        with self._state_lock:
+            closing = not self._closed
+            self._closed = True
+            if closing and self._dead is None:
+                self._queue.put(_STOP)
+        if closing:
+            if self._writer is not threading.current_thread():
+                self._writer.join()
+            # 写线程已经退出：万一还有没处理的单元，让等待它们的调用方拿到错误而不是永远挂着
+            self._drain(RuntimeError("store_closed"))
+            _LIVE_STORES.discard(self)
+        super().close()
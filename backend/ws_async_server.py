@@ -2,83 +2,324 @@ from __future__ import annotations
 
 import asyncio
 import json
+import signal
 import threading
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Coroutine, Dict, List, Optional, Set, Tuple
 
 import websockets
 
+from backend.async_bridge import set_default_queue_size
 from backend.chat_service import ChatService
 from backend.config import Settings
+from backend.metrics import GENERATIONS_IN_FLIGHT, WS_CONNECTIONS
+from backend.replay import ReplayBuffer, ReplayLease, ReplayStream
+from backend.scheduler import SchedulerRejected
+from backend.streaming import (
+    ActiveTurn,
+    DeltaCoalescer,
+    acoalesce,
+    assistant_message_frame,
+    assistant_start_frame,
+    delta_frame_encoder,
+    error_frame,
+)
 
 
-def _run_server(chat_service: ChatService, settings: Settings, state: Dict[str, object], ready: threading.Event) -> None:
+def _threadsafe(loop: asyncio.AbstractEventLoop, fn) -> None:  # type: ignore[no-untyped-def]
+    # 回调可能来自别的线程（Flask WS 连接取消 / 续传缓冲通知）；事件循环已关闭时忽略
+    try:
+        loop.call_soon_threadsafe(fn)
+    except RuntimeError:
+        pass
+
+
+def _new_turn(loop: asyncio.AbstractEventLoop) -> Tuple[ActiveTurn, Callable[[Coroutine], asyncio.Task]]:
+    """An ActiveTurn whose cancel interrupts the task started with the returned `launch`."""
+    tasks: List[asyncio.Task] = []
+
+    def interrupt() -> None:
+        # 在事件循环里执行；已进入落库阶段的回复不再打断
+        if turn.streaming and tasks:
+            tasks[0].cancel()
+
+    # 可能在别的线程里被取消（续传的客户端、宽限期计时器）
+    turn = ActiveTurn(on_cancel=lambda: _threadsafe(loop, interrupt))
+
+    def launch(coro: Coroutine) -> asyncio.Task:
+        tasks.append(loop.create_task(coro))
+        return tasks[0]
+
+    return turn, launch
+
+
+def _run_server(
+    chat_service: ChatService,
+    settings: Settings,
+    state: Dict[str, object],
+    ready: threading.Event,
+    *,
+    reuse_port: bool = False,
+    fixed_port: bool = False,
+    replay: Optional[ReplayBuffer] = None,
+) -> None:
+    # requests / sqlite3 都是阻塞调用，绝不能直接在事件循环里跑，否则一个慢流会卡住所有连接；
+    # 该线程池设为事件循环的默认 executor，ChatService 的 a* 方法与非原生异步的 client 都会用它
+    executor = ThreadPoolExecutor(
+        max_workers=max(1, int(settings.ws_executor_workers)),
+        thread_name_prefix="ws-blocking",
+    )
+    # 连接已断开、但回复还在续传缓冲里继续生成的 task：持有引用直到它结束
+    detached: Set[asyncio.Task] = set()
+
     async def handler(ws):
+        with WS_CONNECTIONS.track("asyncio"):
+            await serve(ws)
+
+    async def serve(ws):
         session_id = chat_service.new_session_id()
+        # 调度器按客户端限速的 key：对端 IP
+        client_id = str(ws.remote_address[0]) if ws.remote_address else ""
         await ws.send(json.dumps({"type": "session", "session_id": session_id}, ensure_ascii=False))
+        # 正在流式生成的回复（或续传的转发）在独立 task 里跑，这里继续读消息：cancel / 新消息 / 断开都能立刻打断它
+        active: Optional[ActiveTurn] = None
+        resumed: Optional[ReplayStream] = None
+        lease: Optional[ReplayLease] = None
+        running: Optional[asyncio.Task] = None
+        loop = asyncio.get_running_loop()
 
-        async for raw in ws:
-            try:
-                data = json.loads(raw)
-            except Exception:
-                await ws.send(
-                    json.dumps({"type": "error", "message": "invalid_json", "session_id": session_id}, ensure_ascii=False)
-                )
-                continue
+        async def stop_running(reason: str) -> None:
+            # 打断并等它把截断的部分落库：下一条用户消息必须排在它后面
+            if running is not None and not running.done():
+                if active is not None:
+                    active.cancel(reason)
+                elif resumed is not None:
+                    resumed.cancel(reason)
+                await asyncio.gather(running, return_exceptions=True)
 
-            if data.get("type") != "user_message":
-                await ws.send(
-                    json.dumps({"type": "error", "message": "unknown_type", "session_id": session_id}, ensure_ascii=False)
-                )
-                continue
+        try:
+            async for raw in ws:
+                try:
+                    data = json.loads(raw)
+                except Exception:
+                    await ws.send(error_frame(session_id, "invalid_json"))
+                    continue
 
-            content = str(data.get("content", ""))
-            provided = data.get("session_id")
-            if isinstance(provided, str) and provided.strip():
-                session_id = provided.strip()
-
-            system_prompt = data.get("system_prompt")
-            if system_prompt is not None:
-                system_prompt = str(system_prompt)
-
-            stream = bool(data.get("stream", True))
-            if not stream:
-                result = chat_service.handle_user_message(session_id=session_id, content=content, system_prompt=system_prompt)
-                session_id = result.session_id
-                await ws.send(
-                    json.dumps(
-                        {"type": "assistant_message", "content": result.reply, "session_id": session_id},
-                        ensure_ascii=False,
-                    )
-                )
-                continue
+                msg_type = data.get("type")
+                if msg_type == "cancel":
+                    # 没有进行中的回复时忽略（用户点停止与回复结束可能同时发生）
+                    if active is not None:
+                        active.cancel("cancel")
+                    elif resumed is not None and running is not None and not running.done():
+                        resumed.cancel("cancel")
+                    continue
+                if msg_type == "resume":
+                    await stop_running("superseded")
+                    message_id = str(data.get("message_id") or "")
+                    target = replay.get(message_id) if replay is not None else None
+                    if target is None:
+                        await ws.send(error_frame(session_id, "resume_unavailable", message_id=message_id))
+                        continue
+                    try:
+                        last_seq = int(data.get("last_seq") or 0)
+                    except (TypeError, ValueError):
+                        last_seq = 0
+                    session_id = target.session_id
+                    active, resumed, lease = None, target, target.attach()
+                    running = loop.create_task(forward_replay(ws, target, lease, last_seq))
+                    continue
+                if msg_type != "user_message":
+                    await ws.send(error_frame(session_id, "unknown_type"))
+                    continue
 
-            full = ""
-            for chunk in chat_service.stream_user_message(session_id=session_id, content=content, system_prompt=system_prompt):
-                full += chunk
-                await ws.send(
-                    json.dumps(
-                        {"type": "assistant_delta", "content": chunk, "session_id": session_id},
-                        ensure_ascii=False,
+                # 上一条还在生成时又来了新消息：上一条就此截断
+                await stop_running("superseded")
+                active, resumed, lease = None, None, None
+
+                content = str(data.get("content", ""))
+                provided = data.get("session_id")
+                if isinstance(provided, str) and provided.strip():
+                    session_id = provided.strip()
+                if replay is not None:
+                    # 同一会话在断开的连接上还没生成完的回复（没有来续传）同样就此截断
+                    replay.cancel_session(session_id, "superseded")
+
+                system_prompt = data.get("system_prompt")
+                if system_prompt is not None:
+                    system_prompt = str(system_prompt)
+
+                stream = bool(data.get("stream", True))
+                no_cache = bool(data.get("no_cache", False))
+                if not stream:
+                    try:
+                        with GENERATIONS_IN_FLIGHT.track("asyncio_ws"):
+                            result = await chat_service.ahandle_user_message(
+                                session_id=session_id,
+                                content=content,
+                                system_prompt=system_prompt,
+                                bypass_cache=no_cache,
+                                client_id=client_id,
+                            )
+                    except SchedulerRejected as e:
+                        await ws.send(error_frame(session_id, e.reason, retry_after=e.retry_after))
+                        continue
+                    session_id = result.session_id
+                    await ws.send(assistant_message_frame(session_id, result.reply))
+                    continue
+
+                active, launch = _new_turn(loop)
+                replay_stream = replay.start(session_id, active.cancel) if replay is not None else None
+                lease = replay_stream.attach() if replay_stream is not None else None
+                running = launch(
+                    stream_reply(
+                        ws, active, replay_stream, lease, session_id, content, system_prompt, no_cache, client_id
                     )
                 )
+        finally:
+            if running is not None and not running.done():
+                if resumed is not None:
+                    # 续传的转发：停止转发即可，生成归原来的连接管
+                    running.cancel()
+                    await asyncio.gather(running, return_exceptions=True)
+                elif lease is not None:
+                    # 回复继续写进续传缓冲：宽限期内客户端重连可以接着收，没人接手再取消
+                    lease.release()
+                    detached.add(running)
+                    running.add_done_callback(detached.discard)
+                else:
+                    # 连接断开：立即关闭上游，已生成的部分按截断落库
+                    await stop_running("disconnect")
 
-            # stream_user_message 不负责落 assistant，最终在这里落库
-            chat_service.append_assistant_message(session_id, full)
-            await ws.send(
-                json.dumps(
-                    {"type": "assistant_message", "content": full, "session_id": session_id},
-                    ensure_ascii=False,
-                )
-            )
+    async def stream_reply(
+        ws,
+        turn: ActiveTurn,
+        stream: Optional[ReplayStream],
+        lease: Optional[ReplayLease],
+        session_id: str,
+        content: str,
+        system_prompt: Optional[str],
+        no_cache: bool,
+        client_id: str,
+    ) -> None:
+        coalescer = DeltaCoalescer(window_ms=settings.ws_delta_window_ms, max_bytes=settings.ws_delta_max_bytes)
+        message_id = stream.message_id if stream is not None else ""
+        encode = delta_frame_encoder(session_id, message_id)
+        frames = acoalesce(
+            chat_service.astream_user_message(
+                session_id=session_id,
+                content=content,
+                system_prompt=system_prompt,
+                bypass_cache=no_cache,
+                cancel=turn.token,
+                client_id=client_id,
+            ),
+            coalescer,
+        )
+        # 连接断开后（有续传缓冲时）继续生成，只是不再发送
+        sending = True
+        GENERATIONS_IN_FLIGHT.inc("asyncio_ws")
+        try:
+            if stream is not None:
+                await ws.send(assistant_start_frame(session_id, message_id))
+            async for frame in frames:
+                seq = stream.append(frame) if stream is not None else 0
+                if not sending:
+                    continue
+                try:
+                    await ws.send(encode(frame, seq))
+                except websockets.ConnectionClosed:
+                    if lease is None:
+                        raise
+                    sending = False
+                    lease.release()
+        except SchedulerRejected as e:
+            # 还没落用户消息、也没有任何输出：只回一个带 retry_after 的错误帧
+            turn.finish()
+            if stream is not None and replay is not None:
+                replay.discard(stream)
+                stream.finish(False)
+            if lease is not None:
+                lease.release()
+            try:
+                await ws.send(error_frame(session_id, e.reason, retry_after=e.retry_after))
+            except websockets.ConnectionClosed:
+                pass
+            return
+        except asyncio.CancelledError:
+            # 由 turn.cancel() 发起的 task.cancel()：吞掉，继续落库；其它来源（事件循环关闭）照常传播
+            if not turn.token.cancelled:
+                raise
+        except websockets.ConnectionClosed:
+            turn.cancel("disconnect")
+        finally:
+            # 先离开可取消阶段，之后到达的 cancel 不会再打断关闭上游 / 落库
+            truncated = turn.finish()
+            # 立即关闭上游流，释放连接与线程池名额
+            await frames.aclose()
+            coalescer.finish()
+            GENERATIONS_IN_FLIGHT.dec("asyncio_ws")
+        full = coalescer.text()
+
+        # stream_user_message 不负责落 assistant，最终在这里落库（被取消的标记为截断）
+        await chat_service.afinish_streamed_reply(session_id, full, turn.token)
+        if stream is not None:
+            # 落库之后才结束续传流：续传方收到最终消息时它已经在历史里了
+            stream.finish(truncated)
+            if lease is not None:
+                lease.release()
+        if not sending:
+            return
+        try:
+            await ws.send(assistant_message_frame(session_id, full, truncated=truncated, message_id=message_id))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def forward_replay(ws, stream: ReplayStream, lease: ReplayLease, last_seq: int) -> None:
+        """Send what a reconnecting client missed after `last_seq`, then the live tail and the final message."""
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        unsubscribe = stream.subscribe(lambda: _threadsafe(loop, wake.set))
+        encode = delta_frame_encoder(stream.session_id, stream.message_id)
+        cursor = last_seq
+        try:
+            while True:
+                wake.clear()
+                # 错过的多帧合并成一帧补发，seq 取其中最后一帧的序号
+                text, seq, done = stream.read(cursor)
+                if text:
+                    await ws.send(encode(text, seq))
+                    cursor = seq
+                if done:
+                    await ws.send(
+                        assistant_message_frame(
+                            stream.session_id, stream.text(), truncated=stream.truncated, message_id=stream.message_id
+                        )
+                    )
+                    return
+                await wake.wait()
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            unsubscribe()
+            lease.release()
 
     async def main() -> None:
+        asyncio.get_running_loop().set_default_executor(executor)
+        set_default_queue_size(settings.ws_stream_queue_size)
         last_error: Optional[BaseException] = None
         bound_port: Optional[int] = None
 
-        # 从 WS_PORT 开始，自动尝试下一个空闲端口，避免 Windows 上端口占用导致启动失败
-        for port in range(int(settings.ws_port), int(settings.ws_port) + 20):
+        # 从 WS_PORT 开始，自动尝试下一个空闲端口，避免 Windows 上端口占用导致启动失败；
+        # 独立的 WS 进程（backend/serve.py）不能换端口：HTTP 进程的 /api/config 只知道 WS_PORT，
+        # reuse_port 时各进程绑同一个端口，由内核在它们之间分配连接
+        ports = [int(settings.ws_port)] if fixed_port else range(int(settings.ws_port), int(settings.ws_port) + 20)
+        server = None
+        for port in ports:
             try:
-                await websockets.serve(handler, settings.host, port)
+                if reuse_port:
+                    server = await websockets.serve(handler, settings.host, port, reuse_port=True)
+                else:
+                    server = await websockets.serve(handler, settings.host, port)
                 bound_port = port
                 settings.ws_port = port
                 break
@@ -93,15 +334,57 @@ def _run_server(chat_service: ChatService, settings: Settings, state: Dict[str,
 
         state["port"] = bound_port
         ready.set()
-        await asyncio.Future()
+        try:
+            await chat_service.ai_client.awarm_up()
+        except Exception:
+            pass
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+
+        def _stop() -> None:
+            if not stop.done():
+                stop.set_result(None)
+
+        if fixed_port:
+            # worker 进程：SIGTERM/SIGINT 时停止接新连接并返回，由调用方 flush 存储后退出
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    loop.add_signal_handler(sig, _stop)
+                except (NotImplementedError, RuntimeError):  # pragma: no cover - Windows
+                    pass
+        await stop
+        server.close()
+        await server.wait_closed()
 
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown(wait=False)
+
+
+def run_ws_worker(
+    chat_service: ChatService,
+    settings: Settings,
+    *,
+    reuse_port: bool = True,
+    replay: Optional[ReplayBuffer] = None,
+) -> None:
+    """Serve WS on exactly `settings.ws_port` in the calling thread (blocks until SIGTERM / SIGINT)."""
+    state: Dict[str, object] = {"port": None, "error": None}
+    ready = threading.Event()
+    _run_server(chat_service, settings, state, ready, reuse_port=reuse_port, fixed_port=True, replay=replay)
+    if state["error"] is not None:
+        raise OSError(f"ws_bind_failed:{state['error']}")
 
 
-def start_ws_server_in_thread(chat_service: ChatService, settings: Settings) -> None:
+def start_ws_server_in_thread(
+    chat_service: ChatService, settings: Settings, *, replay: Optional[ReplayBuffer] = None
+) -> None:
     state: Dict[str, object] = {"port": None, "error": None}
     ready = threading.Event()
-    t = threading.Thread(target=_run_server, args=(chat_service, settings, state, ready), daemon=True)
+    t = threading.Thread(
+        target=_run_server, args=(chat_service, settings, state, ready), kwargs={"replay": replay}, daemon=True
+    )
     t.start()
 
     # 等待 WS server 绑定端口，确保 /api/config 返回的是实际可用端口
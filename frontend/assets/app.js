@@ -12,9 +12,7 @@ function nowTime() {
   return d.toLocaleTimeString([], { hour: "2-digit", minute: "2-digit" });
 }
 
-function appendMessage({ role, content }) {
-  const container = document.getElementById("messages");
-
+function buildMessage({ role, content, time, truncated }) {
   const wrapper = document.createElement("div");
   wrapper.className = `msg ${role}`;
 
@@ -24,15 +22,22 @@ function appendMessage({ role, content }) {
 
   const meta = document.createElement("div");
   meta.className = "meta";
-  meta.textContent = `${role === "user" ? "你" : "AI"} · ${nowTime()}`;
+  meta.textContent = `${role === "user" ? "你" : "AI"} · ${time || nowTime()}`;
+  if (truncated) meta.textContent += "（已中断）";
 
   wrapper.appendChild(bubble);
   wrapper.appendChild(meta);
+  return { wrapper, bubble, meta };
+}
+
+function appendMessage({ role, content, time, truncated }) {
+  const container = document.getElementById("messages");
+  const { wrapper, bubble, meta } = buildMessage({ role, content, time, truncated });
   container.appendChild(wrapper);
 
   container.scrollTop = container.scrollHeight;
 
-  return { wrapper, bubble };
+  return { wrapper, bubble, meta };
 }
 
 async function sendViaHttp(message, sessionId, systemPrompt) {
@@ -41,12 +46,101 @@ async function sendViaHttp(message, sessionId, systemPrompt) {
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify({ message, session_id: sessionId, system_prompt: systemPrompt || "" }),
   });
-  if (!res.ok) throw new Error(`HTTP ${res.status}`);
+  // 429：调度器拒绝了这一轮（没有落库），带 retry_after 交给调用方提示
+  if (!res.ok && res.status !== 429) throw new Error(`HTTP ${res.status}`);
   return await res.json();
 }
 
-async function loadSession(sessionId) {
-  const res = await fetch(`/api/session?session_id=${encodeURIComponent(sessionId)}`);
+// WS 不可用时的流式回退：POST /api/chat/stream 返回 SSE，每个 data 事件就是一帧 WS 同款 JSON。
+// 用 fetch 读响应体（EventSource 只能 GET）；中止 signal 即断开连接，服务端按截断保存已生成的部分。
+// 返回是否收到了任何帧：一帧都没有（老版本服务端 / 代理不支持）时调用方再退回 /api/chat。
+async function streamViaHttp(message, sessionId, systemPrompt, onFrame, signal) {
+  const res = await fetch("/api/chat/stream", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ message, session_id: sessionId, system_prompt: systemPrompt || "" }),
+    signal,
+  });
+  if (!res.ok || !res.body) return false;
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffered = "";
+  let received = false;
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffered += decoder.decode(value, { stream: true });
+    let end;
+    while ((end = buffered.indexOf("\n\n")) >= 0) {
+      const event = buffered.slice(0, end);
+      buffered = buffered.slice(end + 2);
+      const payload = event
+        .split("\n")
+        .filter((line) => line.startsWith("data:"))
+        .map((line) => line.slice(5).trimStart())
+        .join("\n");
+      if (!payload) continue;
+      let data = null;
+      try {
+        data = JSON.parse(payload);
+      } catch {
+        continue;
+      }
+      received = true;
+      if (isReplyFrame(data)) onFrame(data);
+    }
+  }
+  return received;
+}
+
+// 服务端调度器拒绝（队列满 / 超速）时的 error 帧 / 429 响应
+function isBusy(data) {
+  return Boolean(data && data.retry_after);
+}
+
+// 交给回复处理函数的帧：回复本身、调度器拒绝、续传失败
+function isReplyFrame(data) {
+  if (!data) return false;
+  if (data.type === "assistant_start" || data.type === "assistant_delta" || data.type === "assistant_message") return true;
+  return isBusy(data) || (data.type === "error" && data.message === "resume_unavailable");
+}
+
+function busyText(data) {
+  return `服务繁忙，请 ${Number(data.retry_after) || 1} 秒后重试。`;
+}
+
+// 更早的历史按页插到顶部，并保持当前可见位置不跳动
+function prependMessages(msgs) {
+  const container = document.getElementById("messages");
+  const before = container.scrollHeight;
+  const frag = document.createDocumentFragment();
+  for (const m of msgs) {
+    if (!m || !m.role) continue;
+    frag.appendChild(buildMessage(historyItem(m)).wrapper);
+  }
+  container.insertBefore(frag, container.firstChild);
+  container.scrollTop += container.scrollHeight - before;
+}
+
+function historyItem(m) {
+  // created_at 是 SQLite 的 UTC 时间（"YYYY-MM-DD HH:MM:SS"）
+  let time = "";
+  if (m.created_at) {
+    const d = new Date(String(m.created_at).replace(" ", "T") + "Z");
+    if (!Number.isNaN(d.getTime())) time = d.toLocaleTimeString([], { hour: "2-digit", minute: "2-digit" });
+  }
+  return {
+    role: m.role === "assistant" ? "assistant" : "user",
+    content: String(m.content ?? ""),
+    time,
+    truncated: Boolean(m.truncated),
+  };
+}
+
+async function loadSession(sessionId, before) {
+  let url = `/api/session?session_id=${encodeURIComponent(sessionId)}`;
+  if (before) url += `&before=${encodeURIComponent(before)}`;
+  const res = await fetch(url);
   if (!res.ok) return null;
   return await res.json();
 }
@@ -61,7 +155,7 @@ function connectWebSocket(onAssistantMessage) {
   ws.addEventListener("message", (evt) => {
     try {
       const data = JSON.parse(evt.data);
-      if (data.type === "assistant_delta" || data.type === "assistant_message") {
+      if (isReplyFrame(data)) {
         onAssistantMessage(data);
       }
       if (data.type === "session" && data.session_id) {
@@ -82,16 +176,18 @@ async function connectWebSocketFromConfig(onAssistantMessage) {
     const cfg = await res.json();
     const wsPort = Number(cfg.ws_port);
     const wsPath = String(cfg.ws_path || "/ws");
-    if (!wsPort) return connectWebSocket(onAssistantMessage);
+    // 部署时配置了 WS_PUBLIC_URL（反向代理后的固定地址）就直接用它
+    const wsUrl = cfg.ws_url ? String(cfg.ws_url) : "";
+    if (!wsUrl && !wsPort) return connectWebSocket(onAssistantMessage);
 
     const scheme = location.protocol === "https:" ? "wss" : "ws";
-    const url = `${scheme}://${location.hostname}:${wsPort}${wsPath}`;
+    const url = wsUrl || `${scheme}://${location.hostname}:${wsPort}${wsPath}`;
     const ws = new WebSocket(url);
 
     ws.addEventListener("message", (evt) => {
       try {
         const data = JSON.parse(evt.data);
-        if (data.type === "assistant_delta" || data.type === "assistant_message") {
+        if (isReplyFrame(data)) {
           onAssistantMessage(data);
         }
         if (data.type === "session" && data.session_id) {
@@ -112,7 +208,7 @@ async function connectWebSocketFromConfig(onAssistantMessage) {
   ws.addEventListener("message", (evt) => {
     try {
       const data = JSON.parse(evt.data);
-      if (data.type === "assistant_delta" || data.type === "assistant_message") {
+      if (isReplyFrame(data)) {
         onAssistantMessage(data);
       }
       if (data.type === "session" && data.session_id) {
@@ -130,6 +226,7 @@ async function connectWebSocketFromConfig(onAssistantMessage) {
   const form = document.getElementById("composer");
   const input = document.getElementById("input");
   const systemPromptEl = document.getElementById("systemPrompt");
+  const stopBtn = document.getElementById("stop");
 
   let sessionId = getOrCreateSessionId();
   let ws = null;
@@ -142,7 +239,9 @@ async function connectWebSocketFromConfig(onAssistantMessage) {
     });
   }
 
-  // Load persisted history/prompt (best-effort)
+  // Load persisted history/prompt (best-effort)；之后滚到顶部时再按游标加载更早的一页
+  let historyCursor = null;
+  let historyLoading = false;
   loadSession(sessionId)
     .then((data) => {
       if (!data) return;
@@ -153,42 +252,138 @@ async function connectWebSocketFromConfig(onAssistantMessage) {
       const msgs = Array.isArray(data.messages) ? data.messages : [];
       for (const m of msgs) {
         if (!m || !m.role) continue;
-        appendMessage({ role: m.role === "assistant" ? "assistant" : "user", content: String(m.content ?? "") });
+        appendMessage(historyItem(m));
       }
+      historyCursor = data.next_before || null;
     })
     .catch(() => {
       // ignore
     });
 
+  const messagesEl = document.getElementById("messages");
+  messagesEl.addEventListener("scroll", async () => {
+    if (messagesEl.scrollTop > 40 || !historyCursor || historyLoading) return;
+    historyLoading = true;
+    try {
+      const data = await loadSession(sessionId, historyCursor);
+      if (data) {
+        prependMessages(Array.isArray(data.messages) ? data.messages : []);
+        historyCursor = data.next_before || null;
+      }
+    } catch {
+      // ignore
+    } finally {
+      historyLoading = false;
+    }
+  });
+
   let streamingAssistant = null;
   let streamingText = "";
+  // 正在接收的回复：断线重连后发 resume，从 lastSeq 之后接着收（服务端不重新生成）
+  let replyId = null;
+  let replySeq = 0;
+  // HTTP 流式回退进行中时的中止控制器（“停止”即断开这次请求）
+  let httpAbort = null;
+
+  // 流式回复期间显示“停止”：服务端会立即断开上游，已生成的部分按截断保存
+  function setStreaming(on) {
+    if (stopBtn) stopBtn.hidden = !on;
+  }
+  if (stopBtn) {
+    stopBtn.addEventListener("click", () => {
+      if (ws && ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify({ type: "cancel" }));
+      if (httpAbort) httpAbort.abort();
+    });
+  }
 
-  try {
-    ws = await connectWebSocketFromConfig((data) => {
-      if (data.session_id) sessionId = data.session_id;
+  function finishReply(content, truncated) {
+    setStreaming(false);
+    replyId = null;
+    replySeq = 0;
+    if (streamingAssistant) {
+      streamingAssistant.bubble.textContent = content;
+      if (truncated) streamingAssistant.meta.textContent += "（已中断）";
+      streamingAssistant = null;
+      streamingText = "";
+    } else {
+      appendMessage({ role: "assistant", content, truncated });
+    }
+  }
 
-      if (data.type === "assistant_delta") {
-        if (!streamingAssistant) {
-          streamingText = "";
-          streamingAssistant = appendMessage({ role: "assistant", content: "" });
-        }
-        streamingText += String(data.content ?? "");
-        streamingAssistant.bubble.textContent = streamingText;
-        return;
-      }
+  function onReplyFrame(data) {
+    if (data.session_id) sessionId = data.session_id;
+
+    if (data.type === "error" && data.message === "resume_unavailable") {
+      // 续传缓冲里已经没有这条回复（服务重启 / 已过期 / 连到了别的进程）：以已保存的历史为准
+      replyId = null;
+      loadSession(sessionId)
+        .then((page) => {
+          const msgs = page && Array.isArray(page.messages) ? page.messages : [];
+          const last = msgs[msgs.length - 1];
+          if (last && last.role === "assistant") {
+            const item = historyItem(last);
+            finishReply(item.content, item.truncated);
+          } else {
+            finishReply(streamingText, true);
+          }
+        })
+        .catch(() => finishReply(streamingText, true));
+      return;
+    }
+
+    if (data.type === "error") {
+      setStreaming(false);
+      replyId = null;
+      appendMessage({ role: "assistant", content: busyText(data) });
+      return;
+    }
+
+    if (data.type === "assistant_start") {
+      replyId = data.message_id || null;
+      replySeq = 0;
+      setStreaming(true);
+      return;
+    }
 
-      // final
-      if (streamingAssistant) {
-        streamingAssistant.bubble.textContent = String(data.content ?? streamingText ?? "");
-        streamingAssistant = null;
+    if (data.type === "assistant_delta") {
+      if (!streamingAssistant) {
         streamingText = "";
-      } else {
-        appendMessage({ role: "assistant", content: String(data.content ?? "") });
+        streamingAssistant = appendMessage({ role: "assistant", content: "" });
+        setStreaming(true);
       }
+      if (data.seq) replySeq = data.seq;
+      streamingText += String(data.content ?? "");
+      streamingAssistant.bubble.textContent = streamingText;
+      return;
+    }
+
+    // final
+    finishReply(String(data.content ?? streamingText ?? ""), Boolean(data.truncated));
+  }
+
+  // 断线后按 1s、2s、4s… （最多 10s）重连；重连成功时如果有回复没收完就续传
+  let reconnectDelay = 1000;
+  async function connect() {
+    try {
+      ws = await connectWebSocketFromConfig(onReplyFrame);
+    } catch {
+      ws = null;
+    }
+    if (!ws) {
+      scheduleReconnect();
+      return;
+    }
+    ws.addEventListener("open", () => {
+      reconnectDelay = 1000;
+      if (replyId) ws.send(JSON.stringify({ type: "resume", message_id: replyId, last_seq: replySeq }));
     });
-  } catch {
-    ws = null;
+    ws.addEventListener("close", scheduleReconnect);
+  }
+  function scheduleReconnect() {
+    setTimeout(connect, reconnectDelay);
+    reconnectDelay = Math.min(reconnectDelay * 2, 10000);
   }
+  await connect();
 
   form.addEventListener("submit", async (e) => {
     e.preventDefault();
@@ -214,10 +409,27 @@ async function connectWebSocketFromConfig(onAssistantMessage) {
       return;
     }
 
+    // WS 不通（代理不放行等）：先走 SSE 流式接口，首字不必等整条回复生成完
+    httpAbort = new AbortController();
+    let streamed = false;
+    try {
+      streamed = await streamViaHttp(text, sessionId, systemPrompt, onReplyFrame, httpAbort.signal);
+    } catch {
+      streamed = httpAbort.signal.aborted || Boolean(streamingAssistant);
+    } finally {
+      httpAbort = null;
+    }
+    if (streamed) {
+      // 用户停止或连接中断时没有最终帧：按已收到的部分收尾
+      if (streamingAssistant) finishReply(streamingText, true);
+      setStreaming(false);
+      return;
+    }
+
     try {
       const data = await sendViaHttp(text, sessionId, systemPrompt);
       if (data.session_id) sessionId = data.session_id;
-      appendMessage({ role: "assistant", content: String(data.reply ?? "") });
+      appendMessage({ role: "assistant", content: isBusy(data) ? busyText(data) : String(data.reply ?? "") });
     } catch {
       appendMessage({ role: "assistant", content: "发送失败，请稍后重试。" });
     }
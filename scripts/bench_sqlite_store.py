@@ -0,0 +1,130 @@
+"""Micro-benchmark: SQLiteStore vs. the old connect-per-call store.
+
+    python scripts/bench_sqlite_store.py --turns 2000
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from backend.storage_sqlite import SQLiteStore  # noqa: E402
+
+
+class LegacyStore:
+    """The original implementation: a fresh sqlite3 connection for every call."""
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, system_prompt TEXT, "
+                "created_at TEXT DEFAULT (datetime('now')), updated_at TEXT DEFAULT (datetime('now')))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, "
+                "role TEXT NOT NULL, content TEXT NOT NULL, created_at TEXT DEFAULT (datetime('now')))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);")
+
+    def _connect(self):
+        conn = sqlite3.connect(self._db_path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def get_or_create_session(self, session_id):
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO sessions (id, system_prompt) VALUES (?, ?)", (session_id, None))
+            conn.execute("UPDATE sessions SET updated_at=datetime('now') WHERE id=?", (session_id,))
+
+    def get_system_prompt(self, session_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT system_prompt FROM sessions WHERE id=?", (session_id,)).fetchone()
+            return None if row is None else row["system_prompt"]
+
+    def append_message(self, session_id, role, content):
+        self.get_or_create_session(session_id)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)", (session_id, role, content)
+            )
+            conn.execute("UPDATE sessions SET updated_at=datetime('now') WHERE id=?", (session_id,))
+
+    def get_recent_messages(self, session_id, limit):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT role, content FROM messages WHERE session_id=? ORDER BY id DESC LIMIT ?", (session_id, limit)
+            ).fetchall()
+        return list(reversed(rows))
+
+
+def _bench(store, turns: int, sessions: int, history: int) -> dict:
+    content = "你好，介绍一下你自己" * 4
+    results = {}
+
+    t0 = time.perf_counter()
+    for i in range(turns):
+        store.append_message(f"s{i % sessions}", "user", content)
+    results["append_message_ops"] = turns / (time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    for i in range(turns):
+        store.get_recent_messages(f"s{i % sessions}", history)
+    results["get_recent_messages_ops"] = turns / (time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    for i in range(turns):
+        store.get_system_prompt(f"s{i % sessions}")
+    results["get_system_prompt_ops"] = turns / (time.perf_counter() - t0)
+
+    # 一个完整 chat turn 的存储开销：落用户消息 + 读 prompt + 读历史 + 落 assistant
+    t0 = time.perf_counter()
+    for i in range(turns):
+        sid = f"t{i % sessions}"
+        store.append_message(sid, "user", content)
+        store.get_system_prompt(sid)
+        store.get_recent_messages(sid, history)
+        store.append_message(sid, "assistant", content)
+    results["chat_turns_per_sec"] = turns / (time.perf_counter() - t0)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=2000)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--history", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="print machine-readable JSON only")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before = _bench(LegacyStore(os.path.join(tmp, "legacy.db")), args.turns, args.sessions, args.history)
+        store = SQLiteStore(os.path.join(tmp, "pooled.db"))
+        after = _bench(store, args.turns, args.sessions, args.history)
+        store.close()
+
+    report = {
+        "before": before,
+        "after": after,
+        "speedup": {k: after[k] / before[k] for k in before},
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{'operation':<26}{'before ops/s':>14}{'after ops/s':>14}{'speedup':>10}")
+    for k in before:
+        print(f"{k:<26}{before[k]:>14.0f}{after[k]:>14.0f}{report['speedup'][k]:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Micro-benchmark: incremental byte-level SSE decoder vs. the old iter_lines + per-line parser.
+
+    python scripts/bench_sse_parse.py --events 20000 --chunk 512
+"""
+
+import argparse
+import io
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import requests
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from backend.sse import JSON_BACKEND, ChatStreamDecoder  # noqa: E402
+
+_PIECES = ["你好", "，", "我是", "模型", "。", " Hello", " world", "!", "这是", "一段", "测试", "\n"]
+
+
+def legacy_parse_line(line: str) -> Tuple[bool, Optional[str]]:
+    """The original `_parse_sse_line` from backend/ai_client.py."""
+    line = line.strip()
+    if not line.startswith("data:"):
+        return False, None
+
+    data_part = line[len("data:") :].strip()
+    if data_part == "[DONE]":
+        return True, None
+
+    try:
+        data = json.loads(data_part)
+    except ValueError:
+        return False, None
+
+    try:
+        choice0 = data.get("choices", [{}])[0]
+        delta = choice0.get("delta", {}) or {}
+        content = delta.get("content")
+        if content:
+            return False, str(content)
+    except Exception:
+        pass
+    return False, None
+
+
+def build_stream(n_events: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    out = []
+    for i in range(n_events):
+        event = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "deepseek-chat",
+            "choices": [{"index": 0, "delta": {"content": rng.choice(_PIECES)}, "finish_reason": None}],
+        }
+        out.append(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n")
+        if i % 200 == 0:
+            out.append(b": keep-alive\n\n")
+    out.append(b"data: [DONE]\n\n")
+    return b"".join(out)
+
+
+def _response(raw: bytes) -> requests.Response:
+    resp = requests.Response()
+    resp.raw = io.BytesIO(raw)
+    resp.status_code = 200
+    # 旧实现依赖响应编码；给它正确的 utf-8，只比较解析开销
+    resp.encoding = "utf-8"
+    return resp
+
+
+def run_legacy(raw: bytes, chunk: int) -> List[str]:
+    out: List[str] = []
+    for line in _response(raw).iter_lines(chunk_size=chunk, decode_unicode=True):
+        if not line:
+            continue
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="ignore")
+        done, content = legacy_parse_line(line)
+        if done:
+            break
+        if content:
+            out.append(content)
+    return out
+
+
+def run_decoder(raw: bytes, chunk: int) -> List[str]:
+    out: List[str] = []
+    decoder = ChatStreamDecoder()
+    for data in _response(raw).iter_content(chunk_size=chunk):
+        contents, done = decoder.feed(data)
+        out.extend(contents)
+        if done:
+            break
+    return out
+
+
+def bench(fn, raw: bytes, chunk: int, repeat: int) -> Tuple[float, List[str]]:  # type: ignore[no-untyped-def]
+    best = float("inf")
+    result: List[str] = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(raw, chunk)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def main(argv: Optional[Iterable[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--chunk", type=int, default=512, help="bytes per network read")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args(argv)
+
+    raw = build_stream(args.events, args.seed)
+    legacy_s, legacy_out = bench(run_legacy, raw, args.chunk, args.repeat)
+    new_s, new_out = bench(run_decoder, raw, args.chunk, args.repeat)
+    if legacy_out != new_out:
+        raise SystemExit("decoders disagree")
+
+    results = {
+        "events": args.events,
+        "bytes": len(raw),
+        "chunk": args.chunk,
+        "json_backend": JSON_BACKEND,
+        "legacy_events_per_sec": round(args.events / legacy_s),
+        "decoder_events_per_sec": round(args.events / new_s),
+        "legacy_mb_per_sec": round(len(raw) / legacy_s / 1e6, 2),
+        "decoder_mb_per_sec": round(len(raw) / new_s / 1e6, 2),
+        "speedup": round(legacy_s / new_s, 2),
+    }
+    if args.json:
+        print(json.dumps(results))
+        return
+    print(f"{args.events} events, {len(raw)} bytes, {args.chunk}-byte reads, json backend: {JSON_BACKEND}")
+    print(f"{'parser':<10} {'events/s':>12} {'MB/s':>8}")
+    print(f"{'legacy':<10} {results['legacy_events_per_sec']:>12} {results['legacy_mb_per_sec']:>8}")
+    print(f"{'decoder':<10} {results['decoder_events_per_sec']:>12} {results['decoder_mb_per_sec']:>8}")
+    print(f"speedup: {results['speedup']}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Cold-start benchmark: import, create_app and time-to-ready of fresh worker processes.
+
+    python scripts/bench_startup.py --runs 5 --workers 4
+
+每次都起一个新的 Python 进程（和 backend.serve 拉起 worker 一样），分三种情况：
+- fresh_db：空库，第一次启动要执行迁移；
+- migrated_db：库已是当前版本，worker 只读一下 user_version 就跳过 DDL；
+- concurrent：`--workers` 个进程同时对一个空库冷启动（只有一个真正迁移，其余等它的写锁后跳过）。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+# 在子进程里执行：计时 import / create_app / 预热，再打一个 /api/ready
+_CHILD = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import backend.app as app_module
+t1 = time.perf_counter()
+deferred = [m for m in ("requests", "urllib3", "flask_sock", "simple_websocket", "websockets") if m not in sys.modules]
+app = app_module.create_app()
+t2 = time.perf_counter()
+services = app.extensions["aichat"]
+while not services.ready and time.perf_counter() - t2 < 30:
+    time.sleep(0.001)
+t3 = time.perf_counter()
+status = app.test_client().get("/api/ready").status_code
+services.close()
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000.0,
+    "create_app_ms": (t2 - t1) * 1000.0,
+    "services_ms": services.startup["services_ms"],
+    "ready_ms": (t3 - t0) * 1000.0,
+    "ready_status": status,
+    "deferred_imports": deferred,
+}))
+"""
+
+_METRICS = ("import_ms", "create_app_ms", "services_ms", "ready_ms", "process_ms")
+
+
+def _env(db_dir: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update(
+        PYTHONPATH=str(PROJECT_ROOT),
+        DB_PATH=os.path.join(db_dir, "chat.db"),
+        ARCHIVE_DB_PATH=os.path.join(db_dir, "archive.db"),
+        REPLY_CACHE_DB_PATH="",
+        AICHAT_BACKGROUND_JOBS="0",
+    )
+    return env
+
+
+def _start_once(env: Dict[str, str]) -> dict:
+    t0 = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", _CHILD], env=env, cwd=str(PROJECT_ROOT), capture_output=True, text=True, check=True
+    )
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result["process_ms"] = (time.perf_counter() - t0) * 1000.0
+    return result
+
+
+def _median(samples: List[dict]) -> dict:
+    report = {k: round(statistics.median(s[k] for s in samples), 1) for k in _METRICS}
+    report["ready_status"] = sorted({s["ready_status"] for s in samples})
+    report["deferred_imports"] = samples[-1]["deferred_imports"]
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4, help="processes started together in the concurrent case")
+    parser.add_argument("--json", action="store_true", help="print machine-readable JSON only")
+    args = parser.parse_args()
+
+    results: Dict[str, List[dict]] = {"fresh_db": [], "migrated_db": [], "concurrent": []}
+    for _ in range(max(1, args.runs)):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = _env(tmp)
+            results["fresh_db"].append(_start_once(env))
+            results["migrated_db"].append(_start_once(env))
+        with tempfile.TemporaryDirectory() as tmp:
+            env = _env(tmp)
+            with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+                results["concurrent"] += list(pool.map(lambda _i: _start_once(env), range(max(1, args.workers))))
+
+    report = {name: _median(samples) for name, samples in results.items()}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{'case':<14}" + "".join(f"{k:>15}" for k in _METRICS))
+    for name, row in report.items():
+        print(f"{name:<14}" + "".join(f"{row[k]:>15.1f}" for k in _METRICS))
+    print("deferred until first use:", ", ".join(report["fresh_db"]["deferred_imports"]) or "-")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,487 @@
+"""Load generator for /api/chat, the Flask-sock /ws and the asyncio WS server.
+
+    # 1) 自带环境：启动 mock 上游 + 后端，压三条通道，结果写成 JSON
+    python scripts/load_test.py --launch --target all --sessions 50 --turns 3 --out bench.json
+
+    # 2) 压已在运行的后端（RSS 需要 --server-pid）
+    python scripts/load_test.py --base-url http://127.0.0.1:5000 --target ws-async --sessions 100
+
+    # 3) 与上一次结果对比，超出容差时退出码为 1（便于在发版前卡回归）
+    python scripts/load_test.py --launch --baseline bench.json --tolerance 0.2
+
+    # 4) 多进程部署的扩展性：同样的负载分别压 1 个和 4 个 worker
+    python scripts/load_test.py --launch --workers 1 --sessions 200 --out w1.json
+    python scripts/load_test.py --launch --workers 4 --sessions 200 --out w4.json
+
+TTFT = 发出消息到第一帧 assistant_delta（HTTP 没有流式，等于总耗时）；gap = 相邻两帧 delta 的间隔。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+import websockets
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+TARGETS = ("http", "ws", "ws-async")
+
+
+# ---- 统计 ----
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def summarize_ms(seconds: List[float]) -> Dict[str, Optional[float]]:
+    ms = [s * 1000.0 for s in seconds]
+
+    def r(v: Optional[float]) -> Optional[float]:
+        return None if v is None else round(v, 2)
+
+    return {
+        "count": len(ms),
+        "mean": r(sum(ms) / len(ms)) if ms else None,
+        "p50": r(percentile(ms, 50)),
+        "p95": r(percentile(ms, 95)),
+        "p99": r(percentile(ms, 99)),
+        "max": r(max(ms)) if ms else None,
+    }
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.ttft: List[float] = []
+        self.gaps: List[float] = []
+        self.total: List[float] = []
+        self.ok = 0
+        self.errors: Dict[str, int] = {}
+
+    def message(self, ttft: float, gaps: List[float], total: float) -> None:
+        with self._lock:
+            self.ok += 1
+            self.ttft.append(ttft)
+            self.gaps.extend(gaps)
+            self.total.append(total)
+
+    def error(self, kind: str) -> None:
+        with self._lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class RSSSampler:
+    """Sample a process' resident set size (Linux /proc, or psutil when installed)."""
+
+    def __init__(self, pid: Optional[int], interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[int] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def read_kb(self) -> Optional[int]:
+        if not self.pid:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/status", "r", encoding="ascii", errors="ignore") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        try:
+            import psutil  # type: ignore
+        except ModuleNotFoundError:
+            return None
+        try:
+            return int(psutil.Process(self.pid).memory_info().rss // 1024)
+        except Exception:
+            return None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            kb = self.read_kb()
+            if kb is not None:
+                self.samples.append(kb)
+
+    def start(self) -> None:
+        kb = self.read_kb()
+        if kb is None:
+            return
+        self.samples.append(kb)
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Dict[str, Optional[int]]:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            kb = self.read_kb()
+            if kb is not None:
+                self.samples.append(kb)
+        if not self.samples:
+            return {"start_kb": None, "peak_kb": None, "end_kb": None}
+        return {"start_kb": self.samples[0], "peak_kb": max(self.samples), "end_kb": self.samples[-1]}
+
+
+# ---- 各通道的客户端 ----
+
+
+def _message_text(args: argparse.Namespace, session: int, turn: int) -> str:
+    if args.same_message:
+        return args.message
+    # 默认每条消息唯一，避免回复缓存 / single-flight 让结果虚高
+    return f"{args.message} #{session}-{turn}"
+
+
+def run_http(args: argparse.Namespace, base_url: str, rec: Recorder) -> None:
+    def session_worker(i: int) -> None:
+        http = requests.Session()
+        session_id = ""
+        for turn in range(args.turns):
+            t0 = time.perf_counter()
+            try:
+                resp = http.post(
+                    base_url + "/api/chat",
+                    json={"message": _message_text(args, i, turn), "session_id": session_id, "no_cache": args.no_cache},
+                    timeout=args.timeout,
+                )
+                if resp.status_code == 429:
+                    # 调度器拒绝（队列满 / 超速）：按原因计数，WS 侧对应 ws_error:<原因>
+                    rec.error("http_429:" + str(resp.json().get("error")))
+                    continue
+                resp.raise_for_status()
+                data = resp.json()
+            except requests.RequestException as e:
+                rec.error(type(e).__name__)
+                continue
+            elapsed = time.perf_counter() - t0
+            session_id = data.get("session_id") or session_id
+            if str(data.get("reply", "")).startswith("（AI 服务暂不可用"):
+                rec.error("fallback_reply")
+                continue
+            rec.message(elapsed, [], elapsed)
+
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        list(pool.map(session_worker, range(args.sessions)))
+
+
+async def _ws_session(args: argparse.Namespace, url: str, i: int, rec: Recorder) -> None:
+    try:
+        async with websockets.connect(url, max_size=None) as ws:
+            hello = json.loads(await asyncio.wait_for(ws.recv(), args.timeout))
+            session_id = hello.get("session_id", "")
+            for turn in range(args.turns):
+                payload = {
+                    "type": "user_message",
+                    "content": _message_text(args, i, turn),
+                    "session_id": session_id,
+                    "stream": True,
+                    "no_cache": args.no_cache,
+                }
+                t0 = time.perf_counter()
+                await ws.send(json.dumps(payload, ensure_ascii=False))
+                first: Optional[float] = None
+                last = t0
+                gaps: List[float] = []
+                while True:
+                    data = json.loads(await asyncio.wait_for(ws.recv(), args.timeout))
+                    now = time.perf_counter()
+                    kind = data.get("type")
+                    if kind == "assistant_delta":
+                        if first is None:
+                            first = now - t0
+                        else:
+                            gaps.append(now - last)
+                        last = now
+                    elif kind == "assistant_message":
+                        content = str(data.get("content", ""))
+                        if content.startswith("（AI 服务暂不可用"):
+                            rec.error("fallback_reply")
+                        else:
+                            rec.message(first if first is not None else now - t0, gaps, now - t0)
+                        break
+                    elif kind == "error":
+                        rec.error("ws_error:" + str(data.get("message")))
+                        break
+    except asyncio.TimeoutError:
+        rec.error("timeout")
+    except (OSError, websockets.exceptions.WebSocketException) as e:
+        rec.error(type(e).__name__)
+
+
+async def _run_ws(args: argparse.Namespace, url: str, rec: Recorder) -> None:
+    await asyncio.gather(*(_ws_session(args, url, i, rec) for i in range(args.sessions)))
+
+
+def ws_urls(base_url: str, timeout: float) -> Dict[str, str]:
+    parts = urlsplit(base_url)
+    scheme = "wss" if parts.scheme == "https" else "ws"
+    cfg = requests.get(base_url + "/api/config", timeout=timeout).json()
+    return {
+        "ws": f"{scheme}://{parts.netloc}/ws",
+        "ws-async": cfg.get("ws_url") or f"{scheme}://{parts.hostname}:{cfg['ws_port']}{cfg.get('ws_path', '/ws')}",
+    }
+
+
+# ---- 启动 mock 上游 + 后端 ----
+
+
+def _free_port() -> int:
+    import socket
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_http(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(url, timeout=1.0)
+            return
+        except requests.RequestException:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"not_ready:{url}")
+            time.sleep(0.1)
+
+
+def launch(args: argparse.Namespace) -> Tuple[str, int, List[subprocess.Popen]]:
+    mock_port = _free_port()
+    http_port = _free_port()
+    ws_port = _free_port()
+    procs: List[subprocess.Popen] = []
+    mock = subprocess.Popen(
+        [
+            sys.executable,
+            str(PROJECT_ROOT / "scripts" / "mock_openai_server.py"),
+            "--port", str(mock_port),
+            "--ttft-ms", str(args.mock_ttft_ms),
+            "--tokens-per-sec", str(args.mock_tokens_per_sec),
+            "--tokens", str(args.mock_tokens),
+            "--error-rate", str(args.mock_error_rate),
+            "--stall-rate", str(args.mock_stall_rate),
+            "--stall-ms", str(args.mock_stall_ms),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    procs.append(mock)
+    _wait_http(f"http://127.0.0.1:{mock_port}/stats", 10.0)
+
+    env = dict(os.environ)
+    env.update(
+        {
+            "HOST": "127.0.0.1",
+            "PORT": str(http_port),
+            "WS_PORT": str(ws_port),
+            "AI_PROVIDER": "deepseek",
+            "AI_BASE_URL": f"http://127.0.0.1:{mock_port}",
+            "DEEPSEEK_API_KEY": "load-test",
+            "DB_PATH": os.path.join(tempfile.mkdtemp(prefix="aichat-load-"), "chat.db"),
+        }
+    )
+    if args.workers > 0:
+        # 多进程部署（backend/serve.py）：HTTP 与 WS 各 N 个进程；RSS 只采样看护进程
+        cmd = [
+            sys.executable, "-m", "backend.serve",
+            "--http-workers", str(args.workers),
+            "--ws-workers", str(args.workers),
+        ]
+    else:
+        cmd = [sys.executable, str(PROJECT_ROOT / "backend" / "app.py")]
+    server = subprocess.Popen(
+        cmd,
+        cwd=str(PROJECT_ROOT),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    procs.append(server)
+    base_url = f"http://127.0.0.1:{http_port}"
+    _wait_http(base_url + "/api/health", 20.0)
+    return base_url, server.pid, procs
+
+
+# ---- 回归对比 ----
+
+# (路径, 越大越好?)
+_COMPARE_KEYS = [
+    (("ttft_ms", "p95"), False),
+    (("total_ms", "p95"), False),
+    (("gap_ms", "p99"), False),
+    (("messages_per_sec",), True),
+]
+
+
+def compare(current: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    problems: List[str] = []
+    for target, result in current.items():
+        base = baseline.get(target)
+        if not base:
+            continue
+        for path, higher_is_better in _COMPARE_KEYS:
+            now, before = result, base
+            for key in path:
+                now = now.get(key) if isinstance(now, dict) else None
+                before = before.get(key) if isinstance(before, dict) else None
+            if not isinstance(now, (int, float)) or not isinstance(before, (int, float)) or before == 0:
+                continue
+            change = (now - before) / before
+            worse = -change if higher_is_better else change
+            if worse > tolerance:
+                problems.append(f"{target} {'.'.join(path)}: {before} -> {now} ({change:+.0%})")
+    return problems
+
+
+def _git_rev() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT, capture_output=True, text=True, timeout=5
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run_target(args: argparse.Namespace, target: str, base_url: str, server_pid: Optional[int]) -> Dict[str, object]:
+    rec = Recorder()
+    rss = RSSSampler(server_pid)
+    rss.start()
+    t0 = time.perf_counter()
+    if target == "http":
+        run_http(args, base_url, rec)
+    else:
+        asyncio.run(_run_ws(args, ws_urls(base_url, args.timeout)[target], rec))
+    duration = time.perf_counter() - t0
+    return {
+        "sessions": args.sessions,
+        "turns": args.turns,
+        "messages": rec.ok,
+        "errors": rec.errors,
+        "duration_s": round(duration, 3),
+        "messages_per_sec": round(rec.ok / duration, 2) if duration else 0.0,
+        "ttft_ms": summarize_ms(rec.ttft),
+        "gap_ms": summarize_ms(rec.gaps),
+        "total_ms": summarize_ms(rec.total),
+        "rss": rss.stop(),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=TARGETS + ("all",), default="all")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--server-pid", type=int, default=0, help="backend pid for RSS sampling")
+    parser.add_argument("--sessions", type=int, default=20, help="concurrent sessions per target")
+    parser.add_argument("--turns", type=int, default=3, help="messages per session")
+    parser.add_argument("--message", default="你好，介绍一下你自己")
+    parser.add_argument("--same-message", action="store_true", help="send the identical message from every session")
+    parser.add_argument("--no-cache", action="store_true", help="set no_cache on every request")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--out", default="", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", default="", help="previous JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--launch", action="store_true", help="start the mock upstream and the backend")
+    parser.add_argument(
+        "--workers", type=int, default=0, help="with --launch: run backend.serve with N HTTP + N WS processes"
+    )
+    parser.add_argument("--mock-ttft-ms", type=float, default=200.0)
+    parser.add_argument("--mock-tokens-per-sec", type=float, default=50.0)
+    parser.add_argument("--mock-tokens", type=int, default=80)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mock-stall-rate", type=float, default=0.0)
+    parser.add_argument("--mock-stall-ms", type=float, default=2000.0)
+    args = parser.parse_args()
+    args.sessions = max(1, args.sessions)
+
+    procs: List[subprocess.Popen] = []
+    base_url = args.base_url.rstrip("/")
+    server_pid: Optional[int] = args.server_pid or None
+    if args.launch:
+        base_url, server_pid, procs = launch(args)
+
+    try:
+        targets = TARGETS if args.target == "all" else (args.target,)
+        results = {t: run_target(args, t, base_url, server_pid) for t in targets}
+        try:
+            health = requests.get(base_url + "/api/health", timeout=args.timeout).json()
+        except (requests.RequestException, ValueError):
+            health = None
+    finally:
+        for p in reversed(procs):
+            p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_rev": _git_rev(),
+            "python": platform.python_version(),
+            "launched": bool(args.launch),
+            "workers": args.workers if args.launch else None,
+            "mock": (
+                {
+                    "ttft_ms": args.mock_ttft_ms,
+                    "tokens_per_sec": args.mock_tokens_per_sec,
+                    "tokens": args.mock_tokens,
+                    "error_rate": args.mock_error_rate,
+                    "stall_rate": args.mock_stall_rate,
+                }
+                if args.launch
+                else None
+            ),
+        },
+        "results": results,
+        "server_health": health,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+    for target, r in results.items():
+        print(
+            f"{target:9s} msgs={r['messages']:5d} err={sum(r['errors'].values()):4d} "
+            f"msg/s={r['messages_per_sec']:8.2f} ttft_p95={r['ttft_ms']['p95']} total_p95={r['total_ms']['p95']} "
+            f"gap_p99={r['gap_ms']['p99']} rss_peak_kb={r['rss']['peak_kb']}",
+            file=sys.stderr,
+        )
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8")).get("results", {})
+        problems = compare(results, baseline, args.tolerance)
+        for line in problems:
+            print("REGRESSION " + line, file=sys.stderr)
+        if problems:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""Local stand-in for an OpenAI-compatible `/chat/completions` endpoint (what DeepseekClient talks to).
+
+    python scripts/mock_openai_server.py --port 18080 --ttft-ms 300 --tokens-per-sec 40 --tokens 120
+
+Then point the backend at it:  AI_PROVIDER=deepseek AI_BASE_URL=http://127.0.0.1:18080 DEEPSEEK_API_KEY=x
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 回复由这些片段循环拼成：中英混排，接近真实流的分片长度与 UTF-8 字节分布
+_PIECES = ["你好", "，", "我是", "一个", "本地", "模拟", "的", "模型", "。", " Hello", " world", "!", " 这", "是", "压测", "回复", "\n"]
+
+
+class MockConfig:
+    def __init__(self, args: argparse.Namespace):
+        self.ttft = max(0.0, args.ttft_ms) / 1000.0
+        self.gap = 1.0 / args.tokens_per_sec if args.tokens_per_sec > 0 else 0.0
+        self.tokens = max(1, args.tokens)
+        self.error_rate = min(1.0, max(0.0, args.error_rate))
+        self.error_status = args.error_status
+        self.stall_rate = min(1.0, max(0.0, args.stall_rate))
+        self.stall = max(0.0, args.stall_ms) / 1000.0
+        self.rng = random.Random(args.seed)
+        self.prefill = max(0.0, args.uncached_ms_per_1k) / 1000.0
+        self._lock = threading.Lock()
+        self.counts = {"requests": 0, "streams": 0, "errors": 0, "stalls": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        # 模拟上游的前缀缓存：见过的“消息前缀”的哈希
+        self._prefixes: set = set()
+
+    def prompt_usage(self, messages: list) -> tuple:
+        """(prompt_tokens, cached_tokens): cached = the longest message-aligned prefix seen before."""
+        digest = hashlib.sha1()
+        total = cached = 0
+        hit = True
+        keys = []
+        for msg in messages if isinstance(messages, list) else []:
+            text = json.dumps(msg, ensure_ascii=False, sort_keys=True)
+            digest.update(text.encode("utf-8"))
+            key = digest.hexdigest()
+            tokens = len(text.encode("utf-8")) // 3 + 4
+            total += tokens
+            with self._lock:
+                hit = hit and key in self._prefixes
+            if hit:
+                cached = total
+            keys.append(key)
+        with self._lock:
+            if len(self._prefixes) > 100000:
+                self._prefixes.clear()
+            self._prefixes.update(keys)
+            self.counts["prompt_tokens"] += total
+            self.counts["cached_tokens"] += cached
+        return total, cached
+
+    def roll(self, p: float) -> bool:
+        with self._lock:
+            return self.rng.random() < p
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] += 1
+
+
+def _reply_pieces(n: int):  # type: ignore[no-untyped-def]
+    return [_PIECES[i % len(_PIECES)] for i in range(n)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: MockConfig
+
+    def log_message(self, *_args) -> None:  # noqa: D401 - 安静模式
+        pass
+
+    def _send_json(self, status: int, obj: dict) -> None:
+        out = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/stats":
+            with self.config._lock:
+                self._send_json(200, dict(self.config.counts))
+            return
+        self._send_json(404, {"error": "not_found"})
+
+    def do_POST(self) -> None:
+        cfg = self.config
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid_json"}})
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not_found"}})
+            return
+
+        cfg.count("requests")
+        if cfg.roll(cfg.error_rate):
+            cfg.count("errors")
+            time.sleep(cfg.ttft)
+            self._send_json(cfg.error_status, {"error": {"message": "mock_injected_error"}})
+            return
+
+        pieces = _reply_pieces(cfg.tokens)
+        prompt_tokens, cached_tokens = cfg.prompt_usage(body.get("messages"))
+        # DeepSeek 风格的 usage（带前缀缓存命中数）；未命中的部分按 --uncached-ms-per-1k 增加首 token 延迟
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(pieces),
+            "total_tokens": prompt_tokens + len(pieces),
+            "prompt_cache_hit_tokens": cached_tokens,
+            "prompt_cache_miss_tokens": prompt_tokens - cached_tokens,
+        }
+        ttft = cfg.ttft + cfg.prefill * (prompt_tokens - cached_tokens) / 1000.0
+        if not body.get("stream"):
+            time.sleep(ttft + cfg.gap * len(pieces))
+            reply = {"choices": [{"message": {"role": "assistant", "content": "".join(pieces)}}], "usage": usage}
+            self._send_json(200, reply)
+            return
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        cfg.count("streams")
+        stall_at = cfg.rng.randrange(len(pieces)) if cfg.roll(cfg.stall_rate) else -1
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            time.sleep(ttft)
+            for i, piece in enumerate(pieces):
+                if i == stall_at:
+                    cfg.count("stalls")
+                    time.sleep(cfg.stall)
+                elif i and cfg.gap:
+                    time.sleep(cfg.gap)
+                event = {"choices": [{"index": 0, "delta": {"content": piece}}]}
+                self._write_chunk(("data: " + json.dumps(event, ensure_ascii=False) + "\n\n").encode("utf-8"))
+            if include_usage:
+                self._write_chunk(("data: " + json.dumps({"choices": [], "usage": usage}) + "\n\n").encode("utf-8"))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中途断开（取消 / 压测结束），不算错误
+            self.close_connection = True
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--ttft-ms", type=float, default=200.0, help="delay before the first chunk")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="0 = send as fast as possible")
+    parser.add_argument("--tokens", type=int, default=80, help="chunks per reply")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="fraction of streams that pause once mid-reply")
+    parser.add_argument("--stall-ms", type=float, default=2000.0)
+    parser.add_argument(
+        "--uncached-ms-per-1k", type=float, default=0.0, help="extra first-chunk delay per 1000 uncached prompt tokens"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    Handler.config = MockConfig(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"mock /chat/completions on http://{args.host}:{server.server_port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import dataclasses
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from backend.config import Settings  # noqa: E402
+
+
+@pytest.fixture
+def settings(tmp_path):
+    """Settings isolated from the developer's .env: temp databases, placeholder provider, no background jobs."""
+    return dataclasses.replace(
+        Settings(),
+        ai_provider="placeholder",
+        db_path=str(tmp_path / "chat.db"),
+        archive_db_path=str(tmp_path / "archive.db"),
+        reply_cache_enabled=False,
+        reply_cache_db_path="",
+        summary_enabled=False,
+        retention_enabled=False,
+    )
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import ssl
+
+import pytest
+
+from backend import aio_http
+from backend.ai_client import DeepseekClient
+
+
+def _sse(*contents):
+    body = b""
+    for c in contents:
+        body += b"data: " + json.dumps({"choices": [{"delta": {"content": c}}]}).encode() + b"\n\n"
+    return body + b"data: [DONE]\n\n"
+
+
+class _Server:
+    """Tiny keep-alive HTTP/1.1 server: /len, /chunked, /bad and /chat/completions (SSE)."""
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = []
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = lines[0].split(" ", 2)
+                headers = dict(line.split(": ", 1) for line in lines[1:] if line)
+                body = await reader.readexactly(int(headers.get("Content-Length", "0")))
+                self.requests.append((method, path, body))
+                if path == "/bad":
+                    writer.write(b"garbage\r\n\r\n")
+                elif path == "/chunked":
+                    writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nhe\r\n3\r\nllo\r\n0\r\n\r\n")
+                elif path == "/chat/completions":
+                    payload = _sse("你", "好")
+                    writer.write(
+                        b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nContent-Length: %d\r\n\r\n"
+                        % len(payload)
+                        + payload
+                    )
+                else:
+                    writer.write(b"HTTP/1.1 200 OK\r\nX-Test: yes\r\nContent-Length: 5\r\n\r\nhello")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def _run(test):
+    async def main():
+        server = _Server()
+        srv = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+        port = srv.sockets[0].getsockname()[1]
+        try:
+            await test(server, f"http://127.0.0.1:{port}")
+        finally:
+            srv.close()
+            await srv.wait_closed()
+
+    asyncio.run(asyncio.wait_for(main(), 10))
+
+
+def test_content_length_and_chunked_bodies():
+    async def test(server, base):
+        resp = await aio_http.request("GET", base + "/len")
+        assert resp.status == 200 and resp.headers["x-test"] == "yes"
+        assert await resp.read() == b"hello"
+        await resp.aclose()
+
+        resp = await aio_http.request("POST", base + "/chunked", body=b"{}")
+        assert b"".join([c async for c in resp.iter_chunks()]) == b"hello"
+        await resp.aclose()
+        assert server.requests[1] == ("POST", "/chunked", b"{}")
+
+    _run(test)
+
+
+def test_malformed_status_line_raises():
+    async def test(server, base):
+        with pytest.raises(aio_http.AsyncHTTPError):
+            await aio_http.request("GET", base + "/bad")
+
+    _run(test)
+
+
+def test_deepseek_client_streams_over_asyncio():
+    async def test(server, base):
+        client = DeepseekClient(base_url=base, api_key="k", model="m")
+        chunks = [c async for c in client.astream_generate([{"role": "user", "content": "hi"}])]
+        assert chunks == ["你", "好"]
+        _method, path, body = server.requests[-1]
+        assert path == "/chat/completions" and json.loads(body)["stream"] is True
+
+    _run(test)
+
+
+def test_https_requests_share_one_ssl_context(monkeypatch):
+    created = []
+    real = ssl.create_default_context
+
+    def counting():
+        created.append(1)
+        return real()
+
+    used = []
+
+    async def fake_open(host, port, ssl_context, connect_timeout):
+        used.append(ssl_context)
+        raise OSError("no network in tests")
+
+    monkeypatch.setattr(ssl, "create_default_context", counting)
+    monkeypatch.setattr(aio_http, "_open", fake_open)
+    aio_http.default_ssl_context.cache_clear()
+    try:
+
+        async def main():
+            for _ in range(3):
+                with pytest.raises(OSError):
+                    await aio_http.request("GET", "https://example.invalid/x")
+
+        asyncio.run(main())
+    finally:
+        aio_http.default_ssl_context.cache_clear()
+
+    assert len(created) == 1
+    assert len(used) == 3 and used[0] is used[1] is used[2]
+
+
+def test_pool_reuses_connections():
+    async def test(server, base):
+        pool = aio_http.AsyncConnectionPool(maxsize_per_host=2)
+        for _ in range(3):
+            resp = await aio_http.request("GET", base + "/len", pool=pool)
+            assert await resp.read() == b"hello"
+            await resp.aclose()
+        stats = pool.stats.snapshot()
+        assert (stats["new_connections"], stats["reused_connections"]) == (1, 2)
+        assert server.connections == 1
+        pool.close()
+
+    _run(test)
+
+
+def test_pool_ssl_context_is_used_for_requests_and_warm_up(monkeypatch):
+    used = []
+
+    async def fake_open(host, port, ssl_context, connect_timeout):
+        used.append(ssl_context)
+        raise OSError("no network in tests")
+
+    monkeypatch.setattr(aio_http, "_open", fake_open)
+    ctx = ssl.create_default_context()
+
+    async def main():
+        pool = aio_http.AsyncConnectionPool(ssl_context=ctx)
+        assert await pool.warm_up("https://example.invalid/", 2) == 0
+        with pytest.raises(OSError):
+            await aio_http.request("GET", "https://example.invalid/x", pool=pool)
+
+    asyncio.run(main())
+    assert used == [ctx, ctx]
@@ -0,0 +1,104 @@
+import dataclasses
+import json
+import sqlite3
+
+import pytest
+
+from backend.app import create_app
+
+
+@pytest.fixture
+def make_client(settings):
+    apps = []
+
+    def make(**overrides):
+        app = create_app(dataclasses.replace(settings, **overrides))
+        apps.append(app)
+        return app.test_client()
+
+    yield make
+    for app in apps:
+        app.extensions["aichat"].close()
+
+
+def _events(body):
+    out = []
+    for block in body.split("\n\n"):
+        if block:
+            assert block.startswith("data: ")
+            out.append(json.loads(block[len("data: ") :]))
+    return out
+
+
+def _stored(client, session_id):
+    services = client.application.extensions["aichat"]
+    services.store.flush()
+    conn = sqlite3.connect(services.settings.db_path)
+    try:
+        return conn.execute(
+            "SELECT role, content, truncated FROM messages WHERE session_id = ? ORDER BY id", (session_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def test_streams_deltas_and_persists_the_reply(make_client):
+    client = make_client()
+    resp = client.post("/api/chat/stream", json={"message": "hello", "session_id": "sse-1"})
+
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/event-stream"
+    assert resp.headers["Cache-Control"] == "no-cache"
+    assert resp.headers["X-Accel-Buffering"] == "no"
+
+    events = _events(resp.get_data(as_text=True))
+    assert events[0] == {"type": "assistant_start", "session_id": "sse-1", "message_id": ""}
+    deltas = events[1:-1]
+    assert deltas and all(e["type"] == "assistant_delta" and e["session_id"] == "sse-1" for e in deltas)
+    final = events[-1]
+    assert final["type"] == "assistant_message" and "truncated" not in final
+    assert "".join(e["content"] for e in deltas) == final["content"]
+    assert "hello" in final["content"]
+
+    assert _stored(client, "sse-1") == [("user", "hello", 0), ("assistant", final["content"], 0)]
+
+
+def test_new_session_id_is_assigned_when_missing(make_client):
+    client = make_client()
+    events = _events(client.post("/api/chat/stream", json={"message": "hi"}).get_data(as_text=True))
+    session_id = events[0]["session_id"]
+    assert session_id
+    assert {e["session_id"] for e in events} == {session_id}
+
+
+def test_rate_limited_turn_gets_error_event_and_is_not_stored(make_client):
+    client = make_client(scheduler_enabled=True, scheduler_session_per_minute=60.0, scheduler_session_burst=1)
+    first = _events(client.post("/api/chat/stream", json={"message": "one", "session_id": "rl"}).get_data(as_text=True))
+    assert first[-1]["type"] == "assistant_message"
+
+    resp = client.post("/api/chat/stream", json={"message": "two", "session_id": "rl"})
+    assert resp.status_code == 200
+    events = _events(resp.get_data(as_text=True))
+    assert [e["type"] for e in events] == ["assistant_start", "error"]
+    assert events[-1]["message"] == "session_rate_limited"
+    assert events[-1]["retry_after"] >= 1
+    assert [row[:2] for row in _stored(client, "rl")] == [("user", "one"), ("assistant", first[-1]["content"])]
+
+
+def test_disconnect_cancels_and_stores_truncated_reply(make_client):
+    client = make_client()
+    resp = client.post("/api/chat/stream", json={"message": "hello", "session_id": "gone"}, buffered=False)
+    chunks = iter(resp.response)
+    seen = []
+    while not any('"assistant_delta"' in c for c in seen):
+        chunk = next(chunks)
+        seen.append(chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk)
+    # 客户端断开：WSGI 服务器关闭响应迭代器
+    resp.close()
+
+    rows = _stored(client, "gone")
+    assert rows[0] == ("user", "hello", 0)
+    role, content, truncated = rows[1]
+    assert role == "assistant" and truncated == 1
+    streamed = "".join(e["content"] for e in _events("".join(seen)) if e["type"] == "assistant_delta")
+    assert content == streamed
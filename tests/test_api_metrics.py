@@ -0,0 +1,13 @@
+from backend.app import create_app
+
+
+def test_repeated_create_app_keeps_one_family_per_metric(settings):
+    apps = [create_app(settings) for _ in range(3)]
+    try:
+        body = apps[-1].test_client().get("/api/metrics").get_data(as_text=True)
+        type_lines = [line for line in body.splitlines() if line.startswith("# TYPE ")]
+        assert len(type_lines) == len(set(type_lines))
+        assert "# TYPE aichat_worker gauge" in type_lines
+    finally:
+        for app in apps:
+            app.extensions["aichat"].close()
@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+from backend.app import create_app
+from backend.services import build_services
+
+
+@pytest.fixture
+def services(settings):
+    svc = build_services(settings)
+    yield svc
+    svc.close()
+
+
+def _wait_ready(services):
+    services._warm_up_thread.join(5)
+
+
+def test_ready_turns_200_once_warm_up_finishes(services, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(services.ai_client, "warm_up", lambda: release.wait(5))
+    client = create_app(services=services).test_client()
+
+    resp = client.get("/api/ready")
+    assert resp.status_code == 503 and resp.get_json()["ready"] is False
+    # 存活探针不受预热影响
+    assert client.get("/api/health").status_code == 200
+
+    release.set()
+    _wait_ready(services)
+    data = client.get("/api/ready").get_json()
+    assert data["ready"] is True
+    assert {"services_ms", "warm_up_ms", "ready_ms"} <= set(data)
+    assert data["worker"]["pid"] == services.worker_info["pid"]
+
+
+def test_failed_warm_up_still_becomes_ready(services, monkeypatch):
+    def broken():
+        raise OSError("upstream unreachable")
+
+    monkeypatch.setattr(services.ai_client, "warm_up", broken)
+    client = create_app(services=services).test_client()
+    _wait_ready(services)
+    data = client.get("/api/ready").get_json()
+    assert data["ready"] is True and "upstream unreachable" in data["warm_up_error"]
+
+
+def test_warm_up_runs_once_per_services(services, monkeypatch):
+    calls = []
+    monkeypatch.setattr(services.ai_client, "warm_up", lambda: calls.append(1))
+    create_app(services=services)
+    create_app(services=services)
+    _wait_ready(services)
+    assert calls == [1]
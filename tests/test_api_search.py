@@ -0,0 +1,30 @@
+import dataclasses
+
+from backend.app import create_app
+
+
+def test_api_search_requires_a_session_unless_global_is_allowed(settings):
+    app = create_app(dataclasses.replace(settings, search_tokenizer="trigram"))
+    try:
+        app.extensions["aichat"].store.append_message("s", "user", "hello world")
+        client = app.test_client()
+        assert client.get("/api/search?q=hello").get_json() == {"error": "missing_session_id"}
+        data = client.get("/api/search?q=hello&session_id=s").get_json()
+        assert data["scope"] == "session" and len(data["results"]) == 1
+    finally:
+        app.extensions["aichat"].close()
+
+    app = create_app(dataclasses.replace(settings, search_tokenizer="trigram", search_allow_global=True))
+    try:
+        assert app.test_client().get("/api/search?q=hello").get_json()["scope"] == "global"
+    finally:
+        app.extensions["aichat"].close()
+
+
+def test_api_search_reports_unavailable_when_disabled(settings):
+    app = create_app(settings)
+    try:
+        resp = app.test_client().get("/api/search?q=hello&session_id=s")
+        assert resp.status_code == 503 and resp.get_json()["error"] == "search_unavailable"
+    finally:
+        app.extensions["aichat"].close()
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from backend.app import create_app
+
+
+@pytest.fixture
+def app(settings):
+    app = create_app(settings)
+    yield app
+    app.extensions["aichat"].close()
+
+
+def _seed(app, n):
+    store = app.extensions["aichat"].store
+    for i in range(n):
+        store.append_message("s", "user", f"m{i}")
+
+
+def test_session_pages_by_cursor(app):
+    _seed(app, 5)
+    client = app.test_client()
+    page = client.get("/api/session?session_id=s&limit=3").get_json()
+    assert [m["content"] for m in page["messages"]] == ["m2", "m3", "m4"]
+    assert page["session_id"] == "s" and page["system_prompt"]
+    older = client.get(f"/api/session?session_id=s&limit=3&before={page['next_before']}").get_json()
+    assert [m["content"] for m in older["messages"]] == ["m0", "m1"] and older["has_more"] is False
+
+
+def test_session_rejects_bad_cursor_and_missing_session(app):
+    client = app.test_client()
+    assert client.get("/api/session?session_id=s&before=abc").get_json() == {"error": "invalid_cursor"}
+    assert client.get("/api/session").get_json() == {"error": "missing_session_id"}
+
+
+def test_export_streams_ndjson(app):
+    _seed(app, 3)
+    app.extensions["aichat"].store.set_system_prompt("s", "be brief")
+    resp = app.test_client().get("/api/session/export?session_id=s")
+    assert resp.mimetype == "application/x-ndjson"
+    assert 'filename="session-s.ndjson"' in resp.headers["Content-Disposition"]
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert lines[0] == {"type": "session", "session_id": "s", "system_prompt": "be brief"}
+    assert [(line["type"], line["content"]) for line in lines[1:]] == [("message", f"m{i}") for i in range(3)]
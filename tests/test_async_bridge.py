@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from backend.async_bridge import iterate_in_executor
+
+
+def _collect(make_iterable, **kw):
+    async def main():
+        return [item async for item in iterate_in_executor(make_iterable, **kw)]
+
+    return asyncio.run(main())
+
+
+def test_items_arrive_in_order():
+    assert _collect(lambda: iter(range(100)), maxsize=4) == list(range(100))
+
+
+@pytest.mark.parametrize("fail_on_create", [False, True])
+def test_producer_errors_reach_the_consumer(fail_on_create):
+    def make():
+        if fail_on_create:
+            raise ValueError("bad request")
+        yield 1
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError, match="bad request"):
+        _collect(make)
+
+
+def test_slow_producer_does_not_block_the_loop():
+    def slow():
+        for i in range(3):
+            time.sleep(0.05)
+            yield i
+
+    async def main():
+        ticks = 0
+        done = asyncio.ensure_future(asyncio.gather(*[_drain(slow()) for _ in range(4)]))
+        while not done.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        return ticks, done.result()
+
+    async def _drain(it):
+        return [i async for i in iterate_in_executor(lambda: it)]
+
+    ticks, results = asyncio.run(main())
+    assert results == [[0, 1, 2]] * 4
+    assert ticks >= 5
+
+
+def test_consumer_leaving_early_stops_and_closes_the_producer():
+    produced = []
+    closed = threading.Event()
+
+    def endless():
+        try:
+            i = 0
+            while True:
+                produced.append(i)
+                yield i
+                i += 1
+        finally:
+            closed.set()
+
+    async def main():
+        stream = iterate_in_executor(endless, maxsize=2)
+        async for item in stream:
+            if item == 3:
+                break
+        await stream.aclose()
+
+    asyncio.run(main())
+    assert closed.wait(5)
+    # 有界队列：生产者最多领先消费者 maxsize 个左右
+    assert len(produced) < 10
@@ -0,0 +1,103 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from backend.ai_client import CancelToken, DeepseekClient, GenerationCancelled, PlaceholderClient, RequestOptions
+from backend.chat_service import ChatService
+from backend.storage_sqlite import SQLiteStore
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+def test_token_runs_callbacks_once():
+    token = CancelToken()
+    calls = []
+    token.add_callback(lambda: calls.append("a"))
+    unregister = token.add_callback(lambda: calls.append("b"))
+    unregister()
+    assert token.cancel("stop") and not token.cancel("again")
+    assert calls == ["a"] and token.reason == "stop"
+    # 已取消时注册的回调立即执行
+    token.add_callback(lambda: calls.append("late"))
+    assert calls == ["a", "late"]
+    with pytest.raises(GenerationCancelled):
+        token.raise_if_cancelled()
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SQLiteStore(str(tmp_path / "chat.db"))
+    yield s
+    s.close()
+
+
+def _history(store):
+    return store.get_messages_page("s", limit=10)["messages"]
+
+
+def test_cancelled_stream_stops_and_is_stored_truncated(store):
+    svc = ChatService(ai_client=PlaceholderClient(), store=store, default_system_prompt="")
+    token = CancelToken()
+    got = []
+    for chunk in svc.stream_user_message(session_id="s", content="hello", cancel=token):
+        got.append(chunk)
+        if len(got) == 3:
+            token.cancel("user_stop")
+    # 取消后没有兜底回复，流直接结束
+    assert len(got) == 3
+    assert svc.finish_streamed_reply("s", "".join(got), token) is True
+    last = _history(store)[-1]
+    assert last["role"] == "assistant" and last["content"] == "".join(got) and last["truncated"] is True
+
+
+def test_cancel_before_any_output_stores_nothing(store):
+    svc = ChatService(ai_client=PlaceholderClient(), store=store, default_system_prompt="")
+    token = CancelToken()
+    token.cancel("user_stop")
+    assert list(svc.stream_user_message(session_id="s", content="hello", cancel=token)) == []
+    assert svc.finish_streamed_reply("s", "", token) is True
+    assert [m["role"] for m in _history(store)] == ["user"]
+
+
+class _StallingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        event = b'data: {"choices":[{"delta":{"content":"first"}}]}\n\n'
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+        self.wfile.flush()
+        # 上游卡住：只有关闭连接才能让客户端的读返回
+        self.server.release.wait(10)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_cancel_aborts_a_blocked_upstream_read():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _StallingHandler)
+    srv.release = threading.Event()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    try:
+        client = DeepseekClient(
+            base_url="http://127.0.0.1:%d" % srv.server_address[1], api_key="k", model="m", timeout_seconds=30
+        )
+        token = CancelToken()
+        got = []
+        started = time.monotonic()
+        with pytest.raises(GenerationCancelled):
+            for chunk in client.stream_generate(MESSAGES, RequestOptions(cancel=token)):
+                got.append(chunk)
+                threading.Timer(0.1, token.cancel, args=("user_stop",)).start()
+        assert got == ["first"]
+        assert time.monotonic() - started < 5
+    finally:
+        srv.release.set()
+        srv.shutdown()
+        srv.server_close()
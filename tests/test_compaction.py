@@ -0,0 +1,88 @@
+import pytest
+
+from backend.ai_client import AIClientError, PlaceholderClient
+from backend.chat_service import ChatService
+from backend.compaction import ConversationCompactor
+from backend.context_cache import SessionContextCache
+from backend.storage_sqlite import SQLiteStore, StoredSummary
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SQLiteStore(str(tmp_path / "chat.db"))
+    yield s
+    s.close()
+
+
+def _fill(store, n, session_id="s"):
+    for i in range(n):
+        store.append_message(session_id, "user" if i % 2 == 0 else "assistant", f"m{i}")
+
+
+def _compactor(store, summarizer=None, **kw):
+    kw.setdefault("trigger_messages", 6)
+    kw.setdefault("keep_recent", 2)
+    return ConversationCompactor(store, summarizer or PlaceholderClient(), start=False, **kw)
+
+
+class _FailingSummarizer(PlaceholderClient):
+    def summarize(self, previous, messages, options=None):
+        raise AIClientError("upstream_down")
+
+
+def test_nothing_happens_below_the_trigger(store):
+    _fill(store, 6)
+    assert not _compactor(store).compact("s")
+    assert store.get_summary("s") is None
+
+
+def test_old_messages_fold_into_the_summary(store):
+    _fill(store, 9)
+    compactor = _compactor(store)
+    assert compactor.compact("s")
+    summary = store.get_summary("s")
+    assert summary.content.splitlines() == [f"{'用户' if i % 2 == 0 else 'AI'}：m{i}" for i in range(7)]
+    assert store.count_messages_after("s", summary.covered_until) == 2
+    assert compactor.stats()["folded_messages"] == 7
+
+
+def test_batches_extend_the_previous_summary(store):
+    _fill(store, 9)
+    compactor = _compactor(store, batch_messages=3)
+    assert compactor.compact("s")
+    stats = compactor.stats()
+    assert stats["compactions"] == 3 and stats["folded_messages"] == 7
+    assert len(store.get_summary("s").content.splitlines()) == 7
+
+
+def test_stale_summary_write_is_rejected(store):
+    _fill(store, 3)
+    first = StoredSummary(content="a", covered_until=1)
+    assert store.save_summary("s", first, expected_covered_until=0)
+    assert not store.save_summary("s", StoredSummary(content="b", covered_until=2), expected_covered_until=0)
+    assert store.get_summary("s").content == "a"
+
+
+def test_failed_summarizer_keeps_the_old_summary(store):
+    _fill(store, 9)
+    compactor = ConversationCompactor(store, _FailingSummarizer(), trigger_messages=6, keep_recent=2)
+    try:
+        compactor.notify("s")
+    finally:
+        compactor.close(timeout=5)
+    assert store.get_summary("s") is None
+    assert compactor.stats()["failures"] == 1
+
+
+def test_prompt_uses_the_summary_instead_of_folded_messages(store):
+    cache = SessionContextCache()
+    compactor = _compactor(store, on_compacted=cache.invalidate)
+    svc = ChatService(
+        ai_client=PlaceholderClient(), store=store, default_system_prompt="sys", context_cache=cache, compactor=compactor
+    )
+    _fill(store, 9)
+    svc._build_messages("s")  # 先把窗口读进缓存
+    compactor.compact("s")
+    messages = svc._build_messages("s")
+    assert [m["role"] for m in messages] == ["system", "system", "assistant", "user"]
+    assert "m0" in messages[1]["content"] and [m["content"] for m in messages[2:]] == ["m7", "m8"]
@@ -0,0 +1,95 @@
+import pytest
+
+from backend.ai_client import PlaceholderClient
+from backend.chat_service import ChatService
+from backend.context_cache import SessionContextCache
+from backend.storage_sqlite import SQLiteStore, StoredMessage
+
+
+def _window(*contents):
+    return [StoredMessage(role="user", content=c) for c in contents]
+
+
+def _fill(cache, session_id, window, capacity=4, prompt=None):
+    token = cache.begin_fill(session_id)
+    cache.end_fill(session_id, token, window=window, capacity=capacity, prompt=prompt, prompt_loaded=True)
+
+
+def _contents(window):
+    return [m.content for m in window]
+
+
+def test_append_slides_a_warm_window():
+    cache = SessionContextCache()
+    assert cache.get_window("s", 3) is None
+    _fill(cache, "s", _window("a", "b"), capacity=3)
+    cache.append("s", "assistant", "c")
+    cache.append("s", "user", "d")
+    assert _contents(cache.get_window("s", 3)) == ["b", "c", "d"]
+    assert _contents(cache.get_window("s", 2)) == ["c", "d"]
+    # 比缓存容量更大的窗口只能回库读
+    assert cache.get_window("s", 4) is None
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+
+
+def test_append_to_a_cold_session_is_ignored():
+    cache = SessionContextCache()
+    cache.append("s", "user", "a")
+    assert cache.get_window("s", 1) is None and cache.stats()["sessions"] == 0
+
+
+def test_fill_loses_the_race_against_a_concurrent_append():
+    cache = SessionContextCache()
+    token = cache.begin_fill("s")
+    cache.append("s", "user", "written while reading")
+    cache.end_fill("s", token, window=_window("stale"), capacity=4)
+    assert cache.get_window("s", 1) is None
+
+
+def test_prompt_is_cached_including_none():
+    cache = SessionContextCache()
+    assert cache.get_prompt("s") == (False, None)
+    _fill(cache, "s", [], prompt=None)
+    assert cache.get_prompt("s") == (True, None)
+    cache.set_prompt("s", "be brief")
+    assert cache.get_prompt("s") == (True, "be brief")
+    cache.invalidate("s")
+    assert cache.get_prompt("s") == (False, None)
+
+
+def test_lru_eviction_by_sessions_and_bytes():
+    cache = SessionContextCache(max_sessions=2)
+    for sid in ("a", "b"):
+        _fill(cache, sid, _window(sid))
+    cache.get_window("a", 1)
+    _fill(cache, "c", _window("c"))
+    assert cache.get_window("b", 1) is None and cache.get_window("a", 1) is not None
+    assert cache.stats()["evictions"] == 1
+
+    small = SessionContextCache(max_bytes=2000)
+    _fill(small, "a", _window("x" * 500))
+    _fill(small, "b", _window("y" * 500))
+    assert small.stats()["sessions"] == 1 and small.get_window("b", 1) is not None
+    assert small.stats()["bytes"] <= 2000
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SQLiteStore(str(tmp_path / "chat.db"))
+    yield s
+    s.close()
+
+
+def test_warm_session_builds_its_prompt_without_reading_sqlite(store, monkeypatch):
+    cache = SessionContextCache()
+    svc = ChatService(ai_client=PlaceholderClient(), store=store, default_system_prompt="sys", context_cache=cache)
+    svc.handle_user_message(session_id="s", content="one")
+
+    def no_reads(*args, **kwargs):
+        raise AssertionError("context should come from the cache")
+
+    monkeypatch.setattr(store, "get_recent_messages", no_reads)
+    monkeypatch.setattr(store, "get_system_prompt", no_reads)
+    svc.handle_user_message(session_id="s", content="two")
+    history = [m["content"] for m in svc._build_messages("s") if m["role"] != "system"]
+    assert history[0] == "one" and history[2] == "two" and len(history) == 4
@@ -0,0 +1,86 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from backend.ai_client import DeepseekClient
+from backend.http_pool import PoolConfig, PooledHTTP
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        self.server.connections.add(self.client_address)
+        body = json.dumps({"choices": [{"message": {"content": "pong"}}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    srv.connections = set()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def _url(srv):
+    return "http://127.0.0.1:%d/chat/completions" % srv.server_address[1]
+
+
+def test_requests_reuse_one_keep_alive_connection(server):
+    http = PooledHTTP(PoolConfig())
+    try:
+        for _ in range(3):
+            resp = http.post(_url(server), data=b"{}", timeout=5)
+            assert resp.json()["choices"][0]["message"]["content"] == "pong"
+        stats = http.stats.snapshot()
+        assert stats["requests"] == 3
+        assert (stats["new_connections"], stats["reused_connections"]) == (1, 2)
+        assert len(server.connections) == 1
+    finally:
+        http.close()
+
+
+def test_idle_connections_expire(server):
+    http = PooledHTTP(PoolConfig(idle_seconds=0.01))
+    try:
+        http.post(_url(server), data=b"{}", timeout=5).content
+        time.sleep(0.05)
+        http.post(_url(server), data=b"{}", timeout=5).content
+        stats = http.stats.snapshot()
+        assert stats["expired_connections"] == 1
+        assert len(server.connections) == 2
+    finally:
+        http.close()
+
+
+def test_warm_up_opens_connections_without_counting_requests(server):
+    http = PooledHTTP(PoolConfig(pool_maxsize=4))
+    try:
+        assert http.warm_up(_url(server), 2) == 2
+        assert http.stats.snapshot()["requests"] == 0
+        http.post(_url(server), data=b"{}", timeout=5).content
+        assert http.stats.snapshot()["reused_connections"] == 1
+    finally:
+        http.close()
+
+
+def test_deepseek_client_uses_the_pool(server):
+    base = "http://127.0.0.1:%d" % server.server_address[1]
+    client = DeepseekClient(base_url=base, api_key="k", model="m")
+    messages = [{"role": "user", "content": "ping"}]
+    assert [client.generate(messages) for _ in range(2)] == ["pong", "pong"]
+    assert client.pool_stats()["reused_connections"] == 1
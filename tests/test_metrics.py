@@ -0,0 +1,65 @@
+import pytest
+
+from backend.metrics import Counter, Gauge, Histogram, Registry, gauge_lines, timed
+
+
+def test_counter_and_gauge_exposition():
+    reg = Registry()
+    c = reg.register(Counter("t_total", "Things.", ["kind"]))
+    g = reg.register(Gauge("t_open", "Open things."))
+    c.inc("a")
+    c.inc("a", amount=2)
+    c.inc('b"x')
+    with g.track():
+        assert g.value() == 1
+    lines = reg.render().splitlines()
+    assert "# TYPE t_total counter" in lines
+    assert 't_total{kind="a"} 3' in lines
+    assert 't_total{kind="b\\"x"} 1' in lines
+    assert "t_open 0" in lines
+
+
+def test_wrong_label_count_is_rejected():
+    c = Counter("t_total", "Things.", ["kind"])
+    with pytest.raises(ValueError):
+        c.inc()
+
+
+def test_histogram_buckets_are_cumulative():
+    h = Histogram("t_seconds", "Latency.", buckets=(0.1, 1.0))
+    for v in (0.05, 0.5, 0.5, 5.0):
+        h.observe(v)
+    lines = h.render()
+    assert 't_seconds_bucket{le="0.1"} 1' in lines
+    assert 't_seconds_bucket{le="1"} 3' in lines
+    assert 't_seconds_bucket{le="+Inf"} 4' in lines
+    assert "t_seconds_count 4" in lines and h.count() == 4
+
+
+def test_timed_observes_even_when_the_call_raises():
+    h = Histogram("t_seconds", "Latency.", ["op"])
+
+    @timed(h, "boom")
+    def boom():
+        raise RuntimeError("x")
+
+    with pytest.raises(RuntimeError):
+        boom()
+    assert h.count("boom") == 1
+
+
+def test_per_scrape_collectors_are_not_kept():
+    reg = Registry()
+    first = reg.render([lambda: gauge_lines("t_stat", "Stats.", {"a": 1, "flag": True}, "stat")])
+    assert 't_stat{stat="a"} 1' in first and "flag" not in first
+    assert "t_stat" not in reg.render()
+
+
+def test_failing_collector_does_not_break_the_scrape():
+    reg = Registry()
+    reg.register(Counter("t_total", "Things.")).inc()
+
+    def broken():
+        raise RuntimeError("collector")
+
+    assert "t_total 1" in reg.render([broken])
@@ -0,0 +1,102 @@
+import pytest
+
+from backend.ai_client import PlaceholderClient, Usage
+from backend.chat_service import ChatService
+from backend.context_cache import SessionContextCache
+from backend.prompt_cache import PromptCacheTracker, cache_outcome
+from backend.storage_sqlite import SQLiteStore
+from backend.write_behind import WriteBehindStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SQLiteStore(str(tmp_path / "chat.db"))
+    yield s
+    s.close()
+
+
+def _service(store, **kw):
+    kw.setdefault("max_history_messages", 20)
+    return ChatService(ai_client=PlaceholderClient(), store=store, default_system_prompt="sys", **kw)
+
+
+def _fill(store, n, start=1):
+    for i in range(start, start + n):
+        store.append_message("s", "user" if i % 2 else "assistant", f"m{i}")
+
+
+def _first_history(messages):
+    return next(m["content"] for m in messages if m["role"] != "system")
+
+
+def test_seq_is_only_computed_when_asked(store):
+    _fill(store, 5)
+    assert [m.seq for m in store.get_recent_messages("s", 3)] == [0, 0, 0]
+    assert [m.seq for m in store.get_recent_messages("s", 3, with_seq=True)] == [3, 4, 5]
+
+
+def test_write_behind_overlay_numbers_pending_messages_after_committed(tmp_path):
+    s = WriteBehindStore(str(tmp_path / "chat.db"), durability="async", flush_interval_ms=1000)
+    try:
+        s.append_message("s", "user", "one")
+        assert s.flush(timeout=5)
+        s.append_message("s", "assistant", "two")
+        assert [m.seq for m in s.get_recent_messages("s", 10, with_seq=True)] == [1, 2]
+        # 不要 seq 时叠加的消息也保持“未知”
+        assert [m.seq for m in s.get_recent_messages("s", 10)] == [0, 0]
+    finally:
+        s.close()
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_count_mode_window_moves_in_whole_blocks(store, cached):
+    svc = _service(store, context_block_messages=8, context_cache=SessionContextCache() if cached else None)
+    starts = {}
+    _fill(store, 20)
+    for n in range(21, 30):
+        if cached:
+            svc._append("s", "user" if n % 2 else "assistant", f"m{n}")
+        else:
+            _fill(store, 1, start=n)
+        starts[n] = _first_history(svc._build_messages("s"))
+    assert {starts[n] for n in range(21, 29)} == {"m9"}
+    assert starts[29] == "m17"
+
+
+def test_sliding_window_without_blocks(store):
+    svc = _service(store)
+    _fill(store, 25)
+    messages = svc._build_messages("s")
+    assert _first_history(messages) == "m6" and len(messages) == 21
+
+
+def test_block_aligned_prompts_extend_the_previous_prefix(store):
+    tracker = PromptCacheTracker()
+    svc = _service(store, context_block_messages=8, prompt_cache=tracker)
+    _fill(store, 21)
+    svc._build_messages("s")
+    before = tracker.session_stats("s")["last_prompt_tokens_estimate"]
+    _fill(store, 1, start=22)
+    svc._build_messages("s")
+    stats = tracker.session_stats("s")
+    # 窗口没有滑动：上一轮整个 prompt 都是这一轮的前缀
+    assert stats["last_stable_prefix_tokens"] == before
+    assert stats["turns"] == 2
+
+
+def test_tracker_records_provider_usage():
+    tracker = PromptCacheTracker(max_sessions=1)
+    tracker.record_turn("a", Usage(prompt_tokens=100, completion_tokens=5, cached_tokens=90), 0.2)
+    stats = tracker.session_stats("a")
+    assert stats["hit_ratio"] == 0.9 and stats["last_ttft_ms"] == 200.0
+    tracker.record_turn("b", None, None)
+    assert tracker.session_stats("a") is None
+    assert tracker.stats()["evictions"] == 1
+
+
+def test_cache_outcome_buckets():
+    assert cache_outcome(None) == "unknown"
+    assert cache_outcome(Usage(prompt_tokens=10, completion_tokens=1, cached_tokens=None)) == "unknown"
+    assert cache_outcome(Usage(prompt_tokens=10, completion_tokens=1, cached_tokens=9)) == "hit"
+    assert cache_outcome(Usage(prompt_tokens=10, completion_tokens=1, cached_tokens=3)) == "partial"
+    assert cache_outcome(Usage(prompt_tokens=10, completion_tokens=1, cached_tokens=0)) == "miss"
@@ -0,0 +1,137 @@
+import time
+
+from backend.replay import ReplayBuffer
+
+
+class _Turn:
+    """Stand-in for ActiveTurn.cancel: records reasons, True only the first time."""
+
+    def __init__(self):
+        self.reasons = []
+
+    def cancel(self, reason):
+        self.reasons.append(reason)
+        return len(self.reasons) == 1
+
+
+def _buffer(**kwargs):
+    params = dict(max_bytes=1 << 20, ttl_seconds=60.0, grace_seconds=0.0)
+    params.update(kwargs)
+    return ReplayBuffer(**params)
+
+
+def test_read_returns_frames_after_seq():
+    buf = _buffer()
+    stream = buf.start("s", _Turn().cancel)
+    assert [stream.append(x) for x in ("你", "好", "!")] == [1, 2, 3]
+
+    assert stream.read(0) == ("你好!", 3, False)
+    assert stream.read(2) == ("!", 3, False)
+    assert stream.read(3) == ("", 3, False)
+    # 客户端报的序号超出范围时按已有的帧截断
+    assert stream.read(99) == ("", 3, False)
+
+    stream.finish(truncated=False)
+    assert stream.read(1) == ("好!", 3, True)
+    assert buf.get(stream.message_id) is stream
+    assert buf.get("unknown") is None
+    stats = buf.stats()
+    assert (stats["resumed"], stats["resume_misses"], stats["bytes"]) == (1, 1, len("你好!".encode("utf-8")))
+
+
+def test_subscribers_are_woken_on_append_and_finish():
+    stream = _buffer().start("s", _Turn().cancel)
+    calls = []
+    unsubscribe = stream.subscribe(lambda: calls.append("a"))
+    stream.append("x")
+    stream.finish(truncated=True)
+    stream.append("ignored by finished subscribers")
+    assert calls == ["a", "a"]
+    unsubscribe()
+    assert stream.truncated
+
+    late = []
+    stream.subscribe(lambda: late.append(1))
+    assert late == [1]
+
+
+def test_last_lease_released_cancels_after_grace():
+    buf = _buffer(grace_seconds=0.0)
+    turn = _Turn()
+    stream = buf.start("s", turn.cancel)
+    first, second = stream.attach(), stream.attach()
+    first.release()
+    first.release()  # 幂等
+    assert turn.reasons == []
+    second.release()
+    assert turn.reasons == ["disconnect"]
+    assert buf.stats()["abandoned"] == 1
+
+
+def test_reattach_within_grace_keeps_generating():
+    buf = _buffer(grace_seconds=0.05)
+    turn = _Turn()
+    stream = buf.start("s", turn.cancel)
+    stream.attach().release()
+    lease = stream.attach()
+    time.sleep(0.1)
+    assert turn.reasons == []
+    lease.release()
+    time.sleep(0.1)
+    assert turn.reasons == ["disconnect"]
+
+
+def test_finished_stream_is_not_cancelled_on_detach():
+    turn = _Turn()
+    stream = _buffer().start("s", turn.cancel)
+    lease = stream.attach()
+    stream.finish(truncated=False)
+    lease.release()
+    assert turn.reasons == []
+
+
+def test_byte_limit_evicts_finished_streams_first():
+    buf = _buffer(max_bytes=10)
+    old_done = buf.start("s", _Turn().cancel)
+    old_done.append("12345")
+    old_done.finish(truncated=False)
+    running = buf.start("s", _Turn().cancel)
+    running.append("12345")
+    newer = buf.start("s", _Turn().cancel)
+    newer.append("123")
+
+    assert buf.get(old_done.message_id) is None
+    assert buf.get(running.message_id) is running
+    assert buf.stats()["bytes"] == 8
+    assert buf.stats()["evicted"] == 1
+    # 被淘汰的流照常生成，只是不再计入缓冲
+    old_done.append("more")
+    assert buf.stats()["bytes"] == 8
+
+
+def test_stream_limit_and_ttl():
+    buf = _buffer(max_streams=2, ttl_seconds=0.05)
+    a = buf.start("s", _Turn().cancel)
+    b = buf.start("s", _Turn().cancel)
+    c = buf.start("s", _Turn().cancel)
+    # 都没结束：超过流数上限时丢最旧的进行中的流
+    assert buf.get(a.message_id) is None
+    b.finish(truncated=False)
+    time.sleep(0.1)
+    assert buf.get(b.message_id) is None
+    assert buf.get(c.message_id) is c
+
+
+def test_cancel_session_and_discard():
+    buf = _buffer()
+    t1, t2, other = _Turn(), _Turn(), _Turn()
+    running = buf.start("s", t1.cancel)
+    finished = buf.start("s", t2.cancel)
+    finished.finish(truncated=False)
+    buf.start("x", other.cancel)
+
+    assert buf.cancel_session("s", "superseded") == 1
+    assert t1.reasons == ["superseded"] and t2.reasons == [] and other.reasons == []
+
+    buf.discard(running)
+    assert buf.get(running.message_id) is None
@@ -0,0 +1,196 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from backend.ai_client import AIClientError, BaseAIClient, DeepseekClient, RequestOptions
+from backend.reply_cache import CachingAIClient, ReplyCache, cache_key
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+class _ScriptedClient(BaseAIClient):
+    """Streams `chunks`, then raises `fail` if set."""
+
+    model = "m"
+    temperature = 0.0
+
+    def __init__(self, chunks=("你", "好")):
+        self.chunks = list(chunks)
+        self.fail = None
+        self.calls = 0
+
+    def generate(self, messages, options=None):
+        self.calls += 1
+        return "".join(self.chunks)
+
+    def stream_generate(self, messages, options=None):
+        self.calls += 1
+        yield from self.chunks
+        if self.fail is not None:
+            raise self.fail
+
+    async def astream_generate(self, messages, options=None):
+        self.calls += 1
+        for chunk in self.chunks:
+            yield chunk
+        if self.fail is not None:
+            raise self.fail
+
+
+def _client(inner, **kw):
+    return CachingAIClient(inner, ReplyCache(**kw))
+
+
+def test_complete_stream_is_cached_and_replayed():
+    inner = _ScriptedClient()
+    client = _client(inner)
+    assert "".join(client.stream_generate(MESSAGES)) == "你好"
+    assert "".join(client.stream_generate(MESSAGES)) == "你好"
+    assert client.generate(MESSAGES) == "你好"
+    assert inner.calls == 1
+    assert client.cache.stats()["memory_hits"] == 2
+
+
+def test_whitespace_differences_share_a_key():
+    a = cache_key([{"role": "user", "content": "hi  there\n"}], model="m", temperature=0.0)
+    b = cache_key([{"role": "user", "content": "hi there"}], model="m", temperature=0.0)
+    assert a == b
+    assert a != cache_key([{"role": "user", "content": "hi there"}], model="m", temperature=0.7)
+
+
+def test_failed_stream_is_not_cached():
+    inner = _ScriptedClient()
+    inner.fail = AIClientError("stream_incomplete")
+    client = _client(inner)
+    with pytest.raises(AIClientError):
+        list(client.stream_generate(MESSAGES))
+    inner.fail = None
+    assert "".join(client.stream_generate(MESSAGES)) == "你好"
+    assert inner.calls == 2
+
+
+def test_async_failed_stream_is_not_cached():
+    inner = _ScriptedClient()
+    inner.fail = AIClientError("stream_incomplete")
+    client = _client(inner)
+
+    async def main():
+        with pytest.raises(AIClientError):
+            [c async for c in client.astream_generate(MESSAGES)]
+
+    asyncio.run(main())
+    assert client.cache.stats()["stores"] == 0
+
+
+def test_closed_stream_and_empty_reply_are_not_cached():
+    inner = _ScriptedClient()
+    client = _client(inner)
+    stream = client.stream_generate(MESSAGES)
+    next(stream)
+    stream.close()
+    inner.chunks = []
+    assert list(client.stream_generate(MESSAGES)) == []
+    assert client.cache.stats()["stores"] == 0
+
+
+def test_bypass_skips_the_cache():
+    inner = _ScriptedClient()
+    client = _client(inner)
+    client.generate(MESSAGES)
+    assert client.generate(MESSAGES, RequestOptions(bypass_cache=True)) == "你好"
+    assert inner.calls == 2 and client.cache.stats()["bypassed"] == 1
+
+
+def test_sqlite_tier_is_shared_between_caches(tmp_path):
+    path = str(tmp_path / "replies.db")
+    first = _client(_ScriptedClient(), sqlite_path=path)
+    first.generate(MESSAGES)
+    second_inner = _ScriptedClient(["other"])
+    second = _client(second_inner, sqlite_path=path)
+    assert second.generate(MESSAGES) == "你好"
+    assert second_inner.calls == 0 and second.cache.stats()["sqlite_hits"] == 1
+
+
+def test_zero_ttl_disables_storing():
+    inner = _ScriptedClient()
+    client = _client(inner, ttl_seconds=0)
+    client.generate(MESSAGES)
+    client.generate(MESSAGES)
+    assert inner.calls == 2
+
+
+# ---- provider：没读到 [DONE] 的流要报错，而不是当作完整回复 ----
+
+_TRUNCATED_SSE = b'data: {"choices":[{"delta":{"content":"half"}}]}\n\n'
+
+
+class _TruncatingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Length", str(len(_TRUNCATED_SSE)))
+        self.end_headers()
+        self.wfile.write(_TRUNCATED_SSE)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def truncating_server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _TruncatingHandler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%d" % srv.server_address[1]
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_provider_stream_without_done_is_incomplete_and_not_cached(truncating_server):
+    client = _client(DeepseekClient(base_url=truncating_server, api_key="k", model="m"))
+    got = []
+    with pytest.raises(AIClientError, match="stream_incomplete"):
+        for chunk in client.stream_generate(MESSAGES):
+            got.append(chunk)
+    assert got == ["half"]
+    assert client.cache.stats()["stores"] == 0
+
+
+def test_async_provider_stream_without_done_is_incomplete(truncating_server):
+    provider = DeepseekClient(base_url=truncating_server, api_key="k", model="m")
+
+    async def main():
+        got = []
+        with pytest.raises(AIClientError, match="stream_incomplete"):
+            async for chunk in provider.astream_generate(MESSAGES):
+                got.append(chunk)
+        return got
+
+    assert asyncio.run(main()) == ["half"]
+
+
+def test_provider_stream_with_done_is_complete():
+    body = _TRUNCATED_SSE + b"data: [DONE]\n\n"
+
+    class Handler(_TruncatingHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", "0")))
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    try:
+        base = "http://127.0.0.1:%d" % srv.server_address[1]
+        client = _client(DeepseekClient(base_url=base, api_key="k", model="m"))
+        assert list(client.stream_generate(MESSAGES)) == ["half"]
+        assert client.cache.stats()["stores"] == 1
+    finally:
+        srv.shutdown()
+        srv.server_close()
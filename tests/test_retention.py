@@ -0,0 +1,129 @@
+import sqlite3
+
+import pytest
+
+from backend.retention import ArchiveStore, RetentionManager, iter_with_archive, merge_archived_page
+from backend.storage_sqlite import SQLiteStore
+
+_OLD = "2000-01-01 00:00:00"
+_CUTOFF = "2001-01-01 00:00:00"
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SQLiteStore(str(tmp_path / "chat.db"))
+    yield s
+    s.close()
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return ArchiveStore(str(tmp_path / "archive.db"))
+
+
+def _session(store, session_id, n, old=True):
+    for i in range(n):
+        store.append_message(session_id, "user" if i % 2 == 0 else "assistant", f"{session_id}-{i}")
+    if old:
+        with store.transaction() as conn:
+            conn.execute("UPDATE sessions SET updated_at=? WHERE id=?", (_OLD, session_id))
+
+
+def _hot(store, session_id):
+    return [m["content"] for m in store.iter_session_messages(session_id)]
+
+
+def _archive_once(store, archive, **kw):
+    kw.setdefault("max_sessions", 10)
+    kw.setdefault("max_messages", 100)
+    return store.archive_expired_sessions(_CUTOFF, sink=archive.put_many, **kw)
+
+
+def test_expired_sessions_move_to_archive_and_stay_readable(store, archive):
+    _session(store, "old", 4)
+    _session(store, "new", 2, old=False)
+    batch = _archive_once(store, archive)
+    assert [a.session_id for a in batch] == ["old"]
+    assert _hot(store, "old") == [] and _hot(store, "new") == ["new-0", "new-1"]
+    assert [m["content"] for m in iter_with_archive(store, archive, "old")] == [f"old-{i}" for i in range(4)]
+
+    page = store.get_messages_page("old", limit=3)
+    page = merge_archived_page(page, archive, "old", limit=3, before=None)
+    assert [m["content"] for m in page["messages"]] == ["old-1", "old-2", "old-3"]
+    assert page["has_more"] is True
+
+
+def test_long_session_is_moved_over_several_capped_batches(store, archive):
+    _session(store, "long", 7)
+    first = _archive_once(store, archive, max_messages=3)
+    assert len(first) == 1 and not first[0].complete
+    assert len(first[0].messages) == 3
+    assert _hot(store, "long") == ["long-3", "long-4", "long-5", "long-6"]
+    # 部分归档后热表 + 冷存储拼起来仍是完整历史
+    assert len(list(iter_with_archive(store, archive, "long"))) == 7
+
+    assert not _archive_once(store, archive, max_messages=3)[0].complete
+    assert _archive_once(store, archive, max_messages=3)[0].complete
+    assert _hot(store, "long") == []
+    assert archive.stats() == {"sessions": 1, "messages": 7, "blob_bytes": archive.stats()["blob_bytes"]}
+
+
+def test_manager_counts_sessions_once_they_are_fully_moved(store, archive):
+    _session(store, "long", 7)
+    _session(store, "short", 1)
+    archived = []
+    manager = RetentionManager(store, archive, ttl_days=1, batch_messages=3, pause_ms=0, on_archived=archived.append)
+    out = manager.archive_expired()
+    assert out == {"sessions": 2, "messages": 8, "batches": 3}
+    assert manager.expired_count() == 0
+    assert set(archived) == {"long", "short"}
+
+
+def test_batch_stops_before_a_session_that_does_not_fit(store, archive):
+    _session(store, "a", 2)
+    _session(store, "b", 5)
+    batch = _archive_once(store, archive, max_messages=4)
+    assert [(a.session_id, a.complete) for a in batch] == [("a", True)]
+    assert len(_hot(store, "b")) == 5
+
+
+def test_sink_runs_outside_the_write_transaction(store, archive, tmp_path):
+    _session(store, "old", 3)
+    seen = []
+
+    def sink(batch):
+        other = sqlite3.connect(str(tmp_path / "chat.db"), timeout=0, isolation_level=None)
+        try:
+            other.execute("BEGIN IMMEDIATE")  # 热库写锁此时必须是空闲的
+            other.execute("ROLLBACK")
+            seen.append(True)
+        finally:
+            other.close()
+        archive.put_many(batch)
+
+    assert store.archive_expired_sessions(_CUTOFF, max_sessions=10, max_messages=100, sink=sink)
+    assert seen == [True]
+
+
+def test_session_touched_during_archiving_stays_hot(store, archive):
+    _session(store, "old", 2)
+
+    def sink(batch):
+        archive.put_many(batch)
+        store.append_message("old", "user", "again")
+
+    assert store.archive_expired_sessions(_CUTOFF, max_sessions=10, max_messages=100, sink=sink) == []
+    assert _hot(store, "old") == ["old-0", "old-1", "again"]
+    # 冷存储里的副本与热表按 id 去重
+    assert [m["content"] for m in iter_with_archive(store, archive, "old")] == ["old-0", "old-1", "again"]
+
+
+def test_sink_failure_leaves_hot_tables_untouched(store):
+    _session(store, "old", 2)
+
+    def sink(batch):
+        raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        store.archive_expired_sessions(_CUTOFF, max_sessions=10, max_messages=100, sink=sink)
+    assert _hot(store, "old") == ["old-0", "old-1"]
@@ -0,0 +1,164 @@
+import asyncio
+import time
+
+import pytest
+
+from backend.ai_client import AIClientError, BaseAIClient
+from backend.router import Endpoint, RouterClient, RouterPolicy, parse_endpoints
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+class _Upstream(BaseAIClient):
+    """Streams `reply` after `delay` seconds, or raises `fail` before the first chunk."""
+
+    model = "m"
+    temperature = 0.0
+
+    def __init__(self, reply="ok", delay=0.0, fail=None):
+        self.reply = reply
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self.cancelled = []
+
+    def generate(self, messages, options=None):
+        self.calls += 1
+        if self.fail is not None:
+            raise self.fail
+        return self.reply
+
+    def stream_generate(self, messages, options=None):
+        self.calls += 1
+        token = options.cancel if options is not None else None
+        deadline = time.monotonic() + self.delay
+        while time.monotonic() < deadline:
+            if token is not None and token.cancelled:
+                self.cancelled.append(token.reason)
+                return
+            time.sleep(0.005)
+        if self.fail is not None:
+            raise self.fail
+        yield from self.reply
+
+    async def astream_generate(self, messages, options=None):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled.append("task")
+            raise
+        if self.fail is not None:
+            raise self.fail
+        for ch in self.reply:
+            yield ch
+
+
+def _router(*upstreams, **policy):
+    policy.setdefault("hedge_default_seconds", 0.05)
+    policy.setdefault("hedge_min_seconds", 0.0)
+    p = RouterPolicy(**policy)
+    return RouterClient([Endpoint(f"ep{i}", u, p) for i, u in enumerate(upstreams)], p)
+
+
+def test_parse_endpoints():
+    specs = parse_endpoints("https://a/v1|m1|KEY_A, https://b/v1 ,,")
+    assert [(s.base_url, s.model, s.api_key_env) for s in specs] == [("https://a/v1", "m1", "KEY_A"), ("https://b/v1", "", "")]
+
+
+def test_generate_fails_over_in_order():
+    primary, backup = _Upstream(fail=AIClientError("boom")), _Upstream(reply="backup")
+    router = _router(primary, backup)
+    assert router.generate(MESSAGES) == "backup"
+    assert router.stats()["failovers"] == 1
+    assert router.endpoint_stats()["ep0"]["errors"] == 1
+
+
+def test_stream_failure_before_first_chunk_switches_immediately():
+    router = _router(_Upstream(fail=AIClientError("boom")), _Upstream(reply="好的"), hedge_default_seconds=5)
+    started = time.monotonic()
+    assert "".join(router.stream_generate(MESSAGES)) == "好的"
+    assert time.monotonic() - started < 1
+    assert router.stats()["failovers"] == 1 and router.stats()["hedged"] == 0
+
+
+def test_slow_primary_is_hedged_and_the_loser_closed():
+    slow, fast = _Upstream(reply="slow", delay=2), _Upstream(reply="fast")
+    router = _router(slow, fast)
+    assert "".join(router.stream_generate(MESSAGES)) == "fast"
+    assert router.stats() == {"hedged": 1, "hedge_won": 1, "failovers": 0, "no_endpoint": 0}
+    deadline = time.monotonic() + 2
+    while not slow.cancelled and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert slow.cancelled == ["hedge_lost"]
+    assert router.endpoint_stats()["ep0"]["closed"] == 1
+
+
+def test_async_slow_primary_is_hedged():
+    slow, fast = _Upstream(reply="slow", delay=2), _Upstream(reply="fast")
+    router = _router(slow, fast)
+
+    async def main():
+        return "".join([c async for c in router.astream_generate(MESSAGES)])
+
+    assert asyncio.run(main()) == "fast"
+    assert router.stats()["hedge_won"] == 1 and slow.cancelled == ["task"]
+
+
+def test_no_hedge_when_disabled():
+    slow, fast = _Upstream(reply="slow", delay=0.2), _Upstream(reply="fast")
+    router = _router(slow, fast, hedge_enabled=False)
+    assert "".join(router.stream_generate(MESSAGES)) == "slow"
+    assert fast.calls == 0
+
+
+def test_circuit_opens_then_lets_one_trial_through():
+    flaky, backup = _Upstream(fail=AIClientError("boom")), _Upstream(reply="backup")
+    router = _router(flaky, backup, circuit_failures=2, circuit_open_seconds=0.1)
+    for _ in range(2):
+        router.generate(MESSAGES)
+    assert router.endpoint_stats()["ep0"]["circuit_open"] == 1
+
+    router.generate(MESSAGES)
+    assert flaky.calls == 2  # 熔断期间直接跳过
+
+    time.sleep(0.15)
+    flaky.fail = None
+    flaky.reply = "recovered"
+    assert router.generate(MESSAGES) == "recovered"
+    stats = router.endpoint_stats()["ep0"]
+    assert stats["circuit_open"] == 0 and stats["consecutive_failures"] == 0 and stats["circuit_opens"] == 1
+
+
+def test_half_open_failure_reopens_immediately():
+    flaky = _Upstream(fail=AIClientError("boom"))
+    policy = RouterPolicy(circuit_failures=3, circuit_open_seconds=0.05)
+    ep = Endpoint("ep", flaky, policy)
+    for _ in range(3):
+        assert ep.try_reserve(time.monotonic())
+        ep.failure()
+    assert not ep.try_reserve(time.monotonic())
+    time.sleep(0.06)
+    assert ep.try_reserve(time.monotonic())
+    # half-open 时只放一个试探请求
+    assert not ep.try_reserve(time.monotonic())
+    ep.failure()
+    assert ep.stats()["circuit_opens"] == 2 and not ep.try_reserve(time.monotonic())
+
+
+def test_all_endpoints_open_raises():
+    router = _router(_Upstream(fail=AIClientError("boom")), circuit_failures=1, circuit_open_seconds=60)
+    with pytest.raises(AIClientError, match="boom"):
+        router.generate(MESSAGES)
+    with pytest.raises(AIClientError, match="no_endpoint_available"):
+        list(router.stream_generate(MESSAGES))
+    assert router.stats()["no_endpoint"] == 1
+
+
+def test_hedge_delay_follows_the_ttft_percentile():
+    policy = RouterPolicy(hedge_min_samples=10, hedge_percentile=90, hedge_min_seconds=0.0, hedge_max_seconds=5)
+    ep = Endpoint("ep", _Upstream(), policy)
+    assert ep.hedge_delay() == policy.hedge_default_seconds
+    for i in range(1, 11):
+        ep.record_ttft(i / 10)
+    assert ep.hedge_delay() == pytest.approx(0.9)
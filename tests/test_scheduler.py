@@ -0,0 +1,170 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from backend.ai_client import CancelToken, GenerationCancelled
+from backend.scheduler import GenerationScheduler, SchedulerRejected
+
+
+def _scheduler(**kwargs):
+    params = dict(max_concurrent=1, max_queue=16, max_wait_seconds=5.0)
+    params.update(kwargs)
+    return GenerationScheduler(**params)
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+class _Waiter(threading.Thread):
+    """Acquires a slot for `session_id`, records the grant, then holds the slot until `done` is set."""
+
+    def __init__(self, scheduler, session_id, granted, cancel=None):
+        super().__init__(daemon=True)
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.granted = granted
+        self.cancel = cancel
+        self.done = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            slot = self.scheduler.acquire(self.session_id, cancel=self.cancel)
+        except Exception as e:  # noqa: BLE001
+            self.error = e
+            return
+        with slot:
+            self.granted.append(self)
+            self.done.wait(5)
+
+
+def test_slot_is_granted_immediately_when_free():
+    s = _scheduler(max_concurrent=2)
+    a = s.acquire("a")
+    b = s.acquire("b")
+    assert s.stats()["active"] == 2
+    a.release()
+    a.release()  # 幂等
+    b.release()
+    assert s.stats()["active"] == 0
+    assert s.stats()["waited"] == 0
+
+
+def test_queue_is_served_round_robin_across_sessions():
+    s = _scheduler()
+    held = s.acquire("busy")
+    granted = []
+    waiters = []
+    # a 先连排三条，b 后排一条：b 只需等 a 的第一条，不用等 a 全部结束
+    for session_id in ("a", "a", "a", "b"):
+        w = _Waiter(s, session_id, granted)
+        w.start()
+        waiters.append(w)
+        _wait_until(lambda n=len(waiters): s.stats()["queued"] == n)
+
+    held.release()
+    for i in range(len(waiters)):
+        _wait_until(lambda: len(granted) == i + 1)
+        granted[i].done.set()
+    for w in waiters:
+        w.join(5)
+
+    assert [w.session_id for w in granted] == ["a", "b", "a", "a"]
+    assert s.stats()["queued"] == 0 and s.stats()["active"] == 0
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    s = _scheduler(max_queue=1)
+    held = s.acquire("busy")
+    granted = []
+    w = _Waiter(s, "a", granted)
+    w.start()
+    _wait_until(lambda: s.stats()["queued"] == 1)
+
+    with pytest.raises(SchedulerRejected) as info:
+        s.acquire("b")
+    assert info.value.reason == "queue_full"
+    assert info.value.retry_after >= 1
+
+    held.release()
+    _wait_until(lambda: granted)
+    w.done.set()
+    w.join(5)
+
+
+def test_waiting_too_long_is_rejected():
+    s = _scheduler(max_wait_seconds=0.05)
+    held = s.acquire("busy")
+    with pytest.raises(SchedulerRejected) as info:
+        s.acquire("a")
+    assert info.value.reason == "queue_timeout"
+    assert s.stats()["queued"] == 0
+    held.release()
+
+
+def test_cancel_while_queued_leaves_the_queue():
+    s = _scheduler()
+    held = s.acquire("busy")
+    token = CancelToken()
+    w = _Waiter(s, "a", [], cancel=token)
+    w.start()
+    _wait_until(lambda: s.stats()["queued"] == 1)
+    token.cancel("stop")
+    w.join(5)
+
+    assert isinstance(w.error, GenerationCancelled)
+    assert s.stats()["queued"] == 0
+    held.release()
+    assert s.stats()["active"] == 0
+
+
+def test_session_rate_limit_allows_burst_then_rejects():
+    s = _scheduler(max_concurrent=8, session_per_minute=60, session_burst=2)
+    for _ in range(2):
+        s.acquire("a").release()
+    with pytest.raises(SchedulerRejected) as info:
+        s.acquire("a")
+    assert info.value.reason == "session_rate_limited"
+    assert info.value.retry_after == 1
+    # 其它会话有自己的桶
+    s.acquire("b").release()
+    assert s.stats()["rejected"] == 1
+
+
+def test_client_rate_limit_spans_sessions():
+    s = _scheduler(max_concurrent=8, client_per_minute=60, client_burst=2)
+    s.acquire("a", "1.2.3.4").release()
+    s.acquire("b", "1.2.3.4").release()
+    with pytest.raises(SchedulerRejected) as info:
+        s.acquire("c", "1.2.3.4")
+    assert info.value.reason == "client_rate_limited"
+    s.acquire("c", "5.6.7.8").release()
+
+
+def test_rates_are_unlimited_by_default():
+    s = _scheduler(max_concurrent=8)
+    for _ in range(50):
+        s.acquire("a", "1.2.3.4").release()
+    assert s.stats()["rejected"] == 0
+
+
+def test_async_waiter_shares_the_queue_with_threads():
+    s = _scheduler()
+    held = s.acquire("busy")
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, held.release)
+        slot = await s.aacquire("a")
+        assert s.stats()["active"] == 1
+        slot.release()
+
+    asyncio.run(main())
+    assert s.stats()["waited"] == 1
+    assert s.stats()["active"] == 0
@@ -0,0 +1,96 @@
+import pytest
+
+from backend.search import MessageSearch, SearchError
+from backend.storage_sqlite import SQLiteStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SQLiteStore(str(tmp_path / "chat.db"), fts_tokenizer="trigram")
+    yield s
+    s.close()
+
+
+def _hits(search, query, **kw):
+    ids = [r["id"] for r in search.search(query, **kw)["results"]]
+    conn = search._store._connect()
+    return sorted(conn.execute("SELECT content FROM messages WHERE id=?", (i,)).fetchone()[0] for i in ids)
+
+
+def test_trigram_index_finds_chinese_substrings(store):
+    store.append_message("s1", "user", "明天北京天气怎么样")
+    store.append_message("s1", "assistant", "上海多云")
+    store.append_message("s2", "user", "北京天气<晴>")
+    search = MessageSearch(store)
+    assert search.available
+    assert _hits(search, "北京天气") == sorted(["明天北京天气怎么样", "北京天气<晴>"])
+    assert _hits(search, "北京天气", session_id="s2") == ["北京天气<晴>"]
+    snippet = search.search("北京天气", session_id="s2")["results"][0]["snippet"]
+    # 正文先转义再加高亮标记
+    assert snippet == "<mark>北京天气</mark>&lt;晴&gt;"
+
+
+def test_short_terms_only_search_inside_a_session(store):
+    store.append_message("s1", "user", "好的")
+    search = MessageSearch(store)
+    assert search.search("好", session_id="s1")["results"][0]["snippet"] == "<mark>好</mark>的"
+    with pytest.raises(SearchError, match="query_too_short"):
+        search.search("好")
+    with pytest.raises(SearchError, match="missing_query"):
+        search.search("  ")
+
+
+def test_pages_by_offset(store):
+    for i in range(5):
+        store.append_message("s", "user", f"needle {i}")
+    search = MessageSearch(store)
+    first = search.search("needle", limit=3)
+    assert len(first["results"]) == 3 and first["next_offset"] == 3
+    assert search.search("needle", limit=3, offset=3)["next_offset"] is None
+
+
+def test_search_is_off_without_a_tokenizer(tmp_path):
+    store = SQLiteStore(str(tmp_path / "chat.db"))
+    try:
+        store.append_message("s", "user", "hello world")
+        search = MessageSearch(store)
+        assert not search.available
+        with pytest.raises(SearchError, match="search_unavailable"):
+            search.search("hello")
+    finally:
+        store.close()
+
+
+def test_enabling_on_an_existing_database_needs_backfill(tmp_path):
+    path = str(tmp_path / "chat.db")
+    plain = SQLiteStore(path)
+    for i in range(5):
+        plain.append_message("s", "user", f"old message {i}")
+    plain.close()
+
+    store = SQLiteStore(path, fts_tokenizer="trigram")
+    try:
+        store.append_message("s", "user", "new message")
+        search = MessageSearch(store)
+        assert not search.progress().complete
+        # 新写入的消息由触发器实时索引，老消息要等回填
+        assert _hits(search, "message") == ["new message"]
+
+        out = search.backfill(batch_size=2, pause_ms=0)
+        assert out["batches"] == 3 and out["rows"] == 5
+        assert search.progress().complete
+        assert _hits(search, "message", limit=10) == sorted(["new message"] + [f"old message {i}" for i in range(5)])
+    finally:
+        store.close()
+
+
+def test_clearing_the_tokenizer_drops_the_index(tmp_path):
+    path = str(tmp_path / "chat.db")
+    SQLiteStore(path, fts_tokenizer="trigram").close()
+    store = SQLiteStore(path)
+    try:
+        store.append_message("s", "user", "hello world")
+        tables = {r[0] for r in store._connect().execute("SELECT name FROM sqlite_master")}
+        assert "messages_fts" not in tables and "messages_fts_ai" not in tables
+    finally:
+        store.close()
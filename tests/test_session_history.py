@@ -0,0 +1,63 @@
+import pytest
+
+from backend.storage_sqlite import SQLiteStore
+from backend.write_behind import WriteBehindStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SQLiteStore(str(tmp_path / "chat.db"))
+    yield s
+    s.close()
+
+
+def _seed(store, n, session_id="s"):
+    for i in range(n):
+        store.append_message(session_id, "user" if i % 2 == 0 else "assistant", f"m{i}")
+
+
+def _contents(page):
+    return [m["content"] for m in page["messages"]]
+
+
+def test_pages_walk_back_from_the_latest(store):
+    _seed(store, 7)
+    _seed(store, 2, session_id="other")
+    page = store.get_messages_page("s", limit=3)
+    assert _contents(page) == ["m4", "m5", "m6"] and page["has_more"] is True
+
+    seen = _contents(page)
+    while page["has_more"]:
+        page = store.get_messages_page("s", limit=3, before=page["next_before"])
+        seen = _contents(page) + seen
+    assert seen == [f"m{i}" for i in range(7)]
+    assert page["next_before"] is None and _contents(page) == ["m0"]
+
+
+def test_next_before_is_the_oldest_id_on_the_page(store):
+    _seed(store, 3)
+    page = store.get_messages_page("s", limit=2)
+    assert page["next_before"] == page["messages"][0]["id"]
+    assert [m["role"] for m in page["messages"]] == ["assistant", "user"]
+
+
+def test_empty_session_has_one_empty_page(store):
+    assert store.get_messages_page("nobody", limit=5) == {"messages": [], "has_more": False, "next_before": None}
+
+
+def test_export_iterates_in_id_order_across_batches(store):
+    _seed(store, 5)
+    assert [m["content"] for m in store.iter_session_messages("s", batch_size=2)] == [f"m{i}" for i in range(5)]
+    first = next(iter(store.iter_session_messages("s")))["id"]
+    assert [m["content"] for m in store.iter_session_messages("s", after=first)] == [f"m{i}" for i in range(1, 5)]
+
+
+def test_queued_writes_are_visible_to_paging_and_export(tmp_path):
+    s = WriteBehindStore(str(tmp_path / "chat.db"), durability="async", flush_interval_ms=1000)
+    try:
+        _seed(s, 3)
+        assert _contents(s.get_messages_page("s", limit=10)) == ["m0", "m1", "m2"]
+        s.append_message("s", "user", "late")
+        assert [m["content"] for m in s.iter_session_messages("s")][-1] == "late"
+    finally:
+        s.close()
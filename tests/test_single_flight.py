@@ -0,0 +1,256 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from backend.ai_client import (
+    AIClientError,
+    BaseAIClient,
+    CancelToken,
+    GenerationCancelled,
+    RequestOptions,
+    Usage,
+    cancel_token,
+)
+from backend.single_flight import SingleFlightClient
+from backend.streaming import PumpPool
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+USAGE = Usage(prompt_tokens=10, completion_tokens=2, cached_tokens=8)
+
+
+class _GatedClient(BaseAIClient):
+    """Streams "a", then blocks until `gate` is set (or its token is cancelled), then "b"."""
+
+    def __init__(self):
+        self.calls = 0
+        self.gate = threading.Event()
+        self.first_chunk = threading.Event()
+        self.tokens = []
+        self.fail = None
+
+    def generate(self, messages, options=None):
+        self.calls += 1
+        assert self.gate.wait(5)
+        if options is not None and options.on_usage is not None:
+            options.on_usage(USAGE)
+        return "reply"
+
+    def stream_generate(self, messages, options=None):
+        self.calls += 1
+        token = cancel_token(options)
+        self.tokens.append(token)
+        yield "a"
+        self.first_chunk.set()
+        while not self.gate.wait(0.01):
+            if token is not None and token.cancelled:
+                raise GenerationCancelled(token.reason)
+        if self.fail is not None:
+            raise self.fail
+        yield "b"
+        if options is not None and options.on_usage is not None:
+            options.on_usage(USAGE)
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+class _Subscriber(threading.Thread):
+    def __init__(self, client, options=None, messages=MESSAGES):
+        super().__init__(daemon=True)
+        self.client = client
+        self.options = options
+        self.messages = messages
+        self.result = None
+
+    def run(self):
+        try:
+            self.result = "".join(self.client.stream_generate(self.messages, self.options))
+        except Exception as e:  # noqa: BLE001
+            self.result = e
+
+
+@pytest.fixture
+def inner():
+    return _GatedClient()
+
+
+@pytest.fixture
+def client(inner):
+    return SingleFlightClient(inner)
+
+
+def test_late_joiner_gets_prefix_and_shares_upstream_call(inner, client):
+    first = _Subscriber(client)
+    first.start()
+    assert inner.first_chunk.wait(5)
+    second = _Subscriber(client)
+    second.start()
+    _wait_until(lambda: client.stats()["coalesced"] == 1)
+    inner.gate.set()
+    first.join(5)
+    second.join(5)
+
+    assert first.result == "ab"
+    assert second.result == "ab"
+    assert inner.calls == 1
+    assert client.stats()["in_flight"] == 0
+
+
+def test_cancelled_subscriber_leaves_without_stopping_others(inner, client):
+    first = _Subscriber(client)
+    first.start()
+    assert inner.first_chunk.wait(5)
+    token = CancelToken()
+    second = _Subscriber(client, RequestOptions(cancel=token))
+    second.start()
+    _wait_until(lambda: client.stats()["coalesced"] == 1)
+
+    token.cancel("stop")
+    second.join(5)
+    assert isinstance(second.result, GenerationCancelled)
+    assert not inner.tokens[0].cancelled
+
+    inner.gate.set()
+    first.join(5)
+    assert first.result == "ab"
+
+
+def test_last_subscriber_leaving_cancels_upstream(inner, client):
+    token = CancelToken()
+    only = _Subscriber(client, RequestOptions(cancel=token))
+    only.start()
+    assert inner.first_chunk.wait(5)
+    token.cancel("stop")
+    only.join(5)
+
+    assert isinstance(only.result, GenerationCancelled)
+    _wait_until(lambda: inner.tokens[0].cancelled)
+    assert inner.tokens[0].reason == "abandoned"
+    _wait_until(lambda: client.stats()["in_flight"] == 0)
+
+    # 被放弃的 flight 不再接纳新订阅者：同样的请求重新调用上游
+    inner.gate.set()
+    assert "".join(client.stream_generate(MESSAGES)) == "ab"
+    assert inner.calls == 2
+
+
+def test_upstream_error_reaches_every_subscriber(inner, client):
+    inner.fail = AIClientError("upstream_500")
+    first = _Subscriber(client)
+    first.start()
+    assert inner.first_chunk.wait(5)
+    second = _Subscriber(client)
+    second.start()
+    _wait_until(lambda: client.stats()["coalesced"] == 1)
+    inner.gate.set()
+    first.join(5)
+    second.join(5)
+
+    assert isinstance(first.result, AIClientError) and str(first.result) == "upstream_500"
+    assert second.result is first.result
+
+
+def test_bypass_cache_is_never_coalesced(inner, client):
+    subs = [_Subscriber(client, RequestOptions(bypass_cache=True)) for _ in range(2)]
+    for s in subs:
+        s.start()
+    _wait_until(lambda: inner.calls == 2)
+    inner.gate.set()
+    for s in subs:
+        s.join(5)
+    assert [s.result for s in subs] == ["ab", "ab"]
+    assert client.stats()["coalesced"] == 0
+
+
+def test_async_generate_joins_one_flight(inner, client):
+    async def main():
+        asyncio.get_running_loop().call_later(0.05, inner.gate.set)
+        return await asyncio.gather(client.agenerate(MESSAGES), client.agenerate(MESSAGES))
+
+    assert asyncio.run(main()) == ["reply", "reply"]
+    assert inner.calls == 1
+    assert client.stats()["coalesced"] == 1
+
+
+def test_every_subscriber_gets_the_upstream_usage(inner, client):
+    usages = [[], []]
+    first = _Subscriber(client, RequestOptions(on_usage=usages[0].append))
+    first.start()
+    assert inner.first_chunk.wait(5)
+    second = _Subscriber(client, RequestOptions(on_usage=usages[1].append))
+    second.start()
+    _wait_until(lambda: client.stats()["coalesced"] == 1)
+    inner.gate.set()
+    first.join(5)
+    second.join(5)
+    assert (first.result, second.result) == ("ab", "ab")
+    assert usages == [[USAGE], [USAGE]]
+
+
+def test_async_generate_followers_get_usage(inner, client):
+    usages = [[], []]
+
+    async def main():
+        asyncio.get_running_loop().call_later(0.05, inner.gate.set)
+        return await asyncio.gather(
+            *(client.agenerate(MESSAGES, RequestOptions(on_usage=u.append)) for u in usages)
+        )
+
+    assert asyncio.run(main()) == ["reply", "reply"]
+    assert usages == [[USAGE], [USAGE]]
+
+
+def test_saturated_drivers_drive_on_the_leader_thread(inner):
+    client = SingleFlightClient(inner, PumpPool(0))
+    first = _Subscriber(client)
+    first.start()
+    assert inner.first_chunk.wait(5)
+    second = _Subscriber(client)
+    second.start()
+    _wait_until(lambda: client.stats()["coalesced"] == 1)
+    inner.gate.set()
+    first.join(5)
+    second.join(5)
+    assert (first.result, second.result) == ("ab", "ab")
+    assert inner.calls == 1
+    stats = client.stats()
+    assert stats["inline_driven"] == 1 and stats["active_drivers"] == 0 and stats["in_flight"] == 0
+
+
+def test_inline_leader_leaving_fails_followers_instead_of_hanging(inner):
+    client = SingleFlightClient(inner, PumpPool(0))
+    token = CancelToken()
+    leader = _Subscriber(client, RequestOptions(cancel=token))
+    leader.start()
+    assert inner.first_chunk.wait(5)
+    follower = _Subscriber(client)
+    follower.start()
+    _wait_until(lambda: client.stats()["coalesced"] == 1)
+    token.cancel("stop")
+    leader.join(5)
+    follower.join(5)
+    assert isinstance(leader.result, GenerationCancelled)
+    assert isinstance(follower.result, AIClientError) and str(follower.result) == "single_flight_leader_left"
+    assert inner.tokens[0].cancelled
+
+
+def test_driver_threads_are_bounded(inner):
+    drivers = PumpPool(2)
+    client = SingleFlightClient(inner, drivers)
+    # 每个订阅者一份不同的上下文：四个独立的 flight
+    subs = [_Subscriber(client, messages=[{"role": "user", "content": str(i)}]) for i in range(4)]
+    for s in subs:
+        s.start()
+    _wait_until(lambda: inner.calls == 4)
+    assert drivers.stats()["active"] <= 2
+    inner.gate.set()
+    for s in subs:
+        s.join(5)
+    assert [s.result for s in subs] == ["ab"] * 4
+    assert client.stats()["inline_driven"] == 2
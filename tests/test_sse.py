@@ -0,0 +1,69 @@
+import json
+
+from backend.sse import ChatStreamDecoder, SSEDecoder
+
+
+def _event(content=None, **extra):
+    body = {"choices": [{"delta": {"content": content} if content is not None else {}}]}
+    body.update(extra)
+    return b"data: " + json.dumps(body, ensure_ascii=False).encode("utf-8") + b"\n\n"
+
+
+def _decode(chunks):
+    dec = ChatStreamDecoder()
+    out, done = [], False
+    for chunk in chunks:
+        contents, done = dec.feed(chunk)
+        out += contents
+    if not done:
+        contents, done = dec.flush()
+        out += contents
+    return out, done, dec
+
+
+def test_decodes_deltas_until_done():
+    raw = _event(None, role="assistant") + _event("你好") + _event("，世界") + b"data: [DONE]\n\n" + _event("late")
+    out, done, _ = _decode([raw])
+    assert out == ["你好", "，世界"]
+    assert done
+
+
+def test_split_at_every_byte_including_inside_utf8():
+    raw = b": keep-alive\n\n" + _event("汉字") + _event("ok") + b"data: [DONE]\n\n"
+    out, done, _ = _decode([raw[i : i + 1] for i in range(len(raw))])
+    assert out == ["汉字", "ok"]
+    assert done
+
+
+def test_crlf_split_between_chunks_is_one_line_break():
+    dec = SSEDecoder()
+    assert dec.feed(b'data: {"a":1}\r') == []
+    # 下一块开头的 \n 属于同一个 CRLF，不能当成空行提前派发
+    assert dec.feed(b"\ndata: more\r\n") == []
+    assert dec.feed(b"\r\n") == [b'{"a":1}\nmore']
+
+
+def test_ignores_comments_and_other_fields():
+    dec = SSEDecoder()
+    events = dec.feed(b": ping\nevent: message\nid: 7\nretry: 10\ndata: x\n\n")
+    assert events == [b"x"]
+
+
+def test_flush_dispatches_trailing_event_without_blank_line():
+    out, done, _ = _decode([_event("a"), b'data: {"choices":[{"delta":{"content":"b"}}]}'])
+    assert out == ["a", "b"]
+    assert not done
+
+
+def test_usage_event_is_captured():
+    usage = {"prompt_tokens": 12, "completion_tokens": 3, "prompt_cache_hit_tokens": 8}
+    raw = _event("hi", usage=None) + b"data: " + json.dumps({"choices": [], "usage": usage}).encode() + b"\n\n"
+    out, _, dec = _decode([raw, b"data: [DONE]\n\n"])
+    assert out == ["hi"]
+    assert dec.usage == usage
+
+
+def test_malformed_payload_is_skipped():
+    out, done, _ = _decode([b'data: {"content": nope\n\n', _event("ok"), b"data: [DONE]\n\n"])
+    assert out == ["ok"]
+    assert done
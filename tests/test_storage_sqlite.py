@@ -0,0 +1,93 @@
+import gc
+import sqlite3
+import threading
+
+import pytest
+
+from backend.storage_sqlite import SQLiteStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SQLiteStore(str(tmp_path / "chat.db"))
+    yield s
+    s.close()
+
+
+def _contents(store, session_id):
+    return [m.content for m in store.get_recent_messages(session_id, 100)]
+
+
+def test_transaction_commits_all_writes(store):
+    with store.transaction():
+        store.append_message("s", "user", "hi")
+        store.append_message("s", "assistant", "hello")
+    assert _contents(store, "s") == ["hi", "hello"]
+
+
+def test_transaction_rolls_back_on_error(store):
+    store.append_message("s", "user", "kept")
+    with pytest.raises(RuntimeError):
+        with store.transaction():
+            store.append_message("s", "user", "lost")
+            raise RuntimeError("boom")
+    assert _contents(store, "s") == ["kept"]
+    # 回滚后连接可以继续开新事务
+    store.append_message("s", "user", "after")
+    assert _contents(store, "s") == ["kept", "after"]
+
+
+def test_nested_transaction_joins_outer(store):
+    with pytest.raises(RuntimeError):
+        with store.transaction() as outer:
+            with store.transaction() as inner:
+                assert inner is outer
+                store.append_message("s", "user", "inner")
+            assert outer.in_transaction
+            raise RuntimeError("boom")
+    assert _contents(store, "s") == []
+
+
+def test_each_thread_gets_its_own_connection(store):
+    main = store._connect()
+    assert store._connect() is main
+    seen = []
+    t = threading.Thread(target=lambda: seen.append(store._connect()))
+    t.start()
+    t.join()
+    assert seen and seen[0] is not main
+
+
+def test_thread_exit_closes_its_connection(store):
+    conns = []
+
+    def work(i):
+        store.append_message(f"s{i}", "user", "hi")
+        conns.append(store._connect())
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    gc.collect()
+
+    assert len(conns) == 20
+    for conn in conns:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+    # 只剩主线程自己的连接（如果它用过）
+    assert len(store._threads) <= 1
+    assert _contents(store, "s7") == ["hi"]
+
+
+def test_close_closes_live_connections(tmp_path):
+    s = SQLiteStore(str(tmp_path / "chat.db"))
+    conn = s._connect()
+    s.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+    # close 之后同一线程再用会重新打开连接
+    s.append_message("s", "user", "again")
+    assert _contents(s, "s") == ["again"]
+    s.close()
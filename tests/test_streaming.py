@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+from backend.streaming import DeltaCoalescer, PumpPool, iter_coalesced
+
+
+def _chunks(threads, stall=0.0):
+    # 生成器里第一个分片之前的部分对应 ChatService 的准入 / 读上下文 / 落用户消息
+    threads.append(threading.current_thread())
+    yield "a"
+    threads.append(threading.current_thread())
+    yield "b"
+    yield "c"
+    if stall:
+        time.sleep(stall)
+    yield "d"
+
+
+def _coalescer():
+    return DeltaCoalescer(window_ms=20, max_bytes=2048)
+
+
+def test_setup_runs_on_caller_thread_and_rest_on_pump():
+    pool = PumpPool(2)
+    threads = []
+    frames = list(iter_coalesced(_chunks(threads, stall=0.2), _coalescer(), pool))
+    assert threads[0] is threading.current_thread()
+    assert threads[1] is not threading.current_thread()
+    # 上游停顿前积压的 "bc" 按时间窗发出，不等到 "d"
+    assert frames == ["a", "bc", "d"]
+    assert pool.stats()["pumped"] == 1
+    pool.shutdown()
+
+
+def test_saturated_pool_reads_inline():
+    pool = PumpPool(1)
+    release = threading.Event()
+    assert pool.try_submit(release.wait)
+    threads = []
+    frames = list(iter_coalesced(_chunks(threads), _coalescer(), pool))
+    assert threads == [threading.current_thread()] * 2
+    assert "".join(frames) == "abcd"
+    assert pool.stats()["inline"] == 1
+    release.set()
+    pool.shutdown()
+
+
+def test_closing_early_closes_upstream():
+    closed = threading.Event()
+
+    def endless():
+        try:
+            while True:
+                yield "x"
+                time.sleep(0.005)
+        finally:
+            closed.set()
+
+    pool = PumpPool(1)
+    frames = iter_coalesced(endless(), _coalescer(), pool)
+    next(frames)
+    next(frames)
+    frames.close()
+    assert closed.wait(5)
+    pool.shutdown()
+
+
+def test_upstream_error_is_raised_to_caller():
+    def failing():
+        yield "a"
+        raise ValueError("upstream")
+
+    pool = PumpPool(1)
+    frames = iter_coalesced(failing(), _coalescer(), pool)
+    assert next(frames) == "a"
+    with pytest.raises(ValueError, match="upstream"):
+        list(frames)
+    pool.shutdown()
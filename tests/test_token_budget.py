@@ -0,0 +1,76 @@
+import sqlite3
+
+import pytest
+
+from backend.ai_client import PlaceholderClient
+from backend.chat_service import ChatService
+from backend.storage_sqlite import SQLiteStore
+from backend.tokens import MESSAGE_OVERHEAD_TOKENS, estimate_tokens, message_tokens
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = SQLiteStore(str(tmp_path / "chat.db"))
+    yield s
+    s.close()
+
+
+def _history(messages):
+    return [m["content"] for m in messages if m["role"] != "system"]
+
+
+def test_estimate_weighs_cjk_heavier_than_ascii():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("a") == 1
+    assert estimate_tokens("a" * 10) == 3
+    assert estimate_tokens("中" * 10) == 6
+    assert message_tokens("a" * 10) == 3 + MESSAGE_OVERHEAD_TOKENS
+
+
+def test_token_count_is_stored_on_write(store):
+    store.append_message("s", "user", "中" * 10)
+    assert [m.token_count for m in store.get_recent_messages("s", 1)] == [message_tokens("中" * 10)]
+
+
+def test_budget_keeps_the_newest_messages_that_fit(store):
+    # 每条 10 个 ASCII 字符 = 3 + 4 token；system 同理
+    svc = ChatService(
+        ai_client=PlaceholderClient(),
+        store=store,
+        default_system_prompt="s" * 10,
+        max_history_messages=2,
+        context_token_budget=7 * 4,
+    )
+    for i in range(6):
+        store.append_message("s", "user", f"message {i}")
+    assert _history(svc._build_messages("s")) == ["message 3", "message 4", "message 5"]
+    stats = svc.context_stats()
+    assert stats["turns"] == 1 and stats["trimmed_turns"] == 1 and stats["max_tokens"] == 28
+
+
+def test_newest_message_is_kept_even_over_budget(store):
+    svc = ChatService(ai_client=PlaceholderClient(), store=store, default_system_prompt="", context_token_budget=5)
+    store.append_message("s", "user", "old")
+    store.append_message("s", "user", "x" * 200)
+    assert _history(svc._build_messages("s")) == ["x" * 200]
+
+
+def test_rows_from_before_the_migration_are_estimated_on_read(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE sessions (id TEXT PRIMARY KEY, system_prompt TEXT,
+            created_at TEXT DEFAULT (datetime('now')), updated_at TEXT DEFAULT (datetime('now')));
+        CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL,
+            role TEXT NOT NULL, content TEXT NOT NULL, created_at TEXT DEFAULT (datetime('now')));
+        INSERT INTO sessions (id) VALUES ('s');
+        INSERT INTO messages (session_id, role, content) VALUES ('s', 'user', 'legacy message');
+        """
+    )
+    conn.close()
+    store = SQLiteStore(path)
+    try:
+        assert [m.token_count for m in store.get_recent_messages("s", 1)] == [message_tokens("legacy message")]
+    finally:
+        store.close()
@@ -0,0 +1,181 @@
+import sqlite3
+import threading
+
+import pytest
+
+from backend import write_behind
+from backend.write_behind import WriteBehindStore, _Op
+
+
+class _FlakyCommit:
+    """Writer-thread connection whose next `fail` COMMITs raise SQLITE_BUSY."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.fail = 0
+
+    def execute(self, sql, *args):
+        if sql == "COMMIT" and self.fail:
+            self.fail -= 1
+            raise sqlite3.OperationalError("database is locked")
+        return self.conn.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class _FlakyStore(WriteBehindStore):
+    flaky = None
+
+    def _connect(self):
+        conn = super()._connect()
+        if threading.current_thread() is not getattr(self, "_writer", None):
+            return conn
+        if self.flaky is None:
+            self.flaky = _FlakyCommit(conn)
+        return self.flaky
+
+
+def _contents(store, session_id):
+    return [m.content for m in store.get_recent_messages(session_id, 100)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = _FlakyStore(str(tmp_path / "chat.db"))
+    yield s
+    s.close()
+
+
+def test_group_mode_is_durable_on_return(tmp_path, store):
+    store.append_message("s", "user", "hi")
+    store.set_system_prompt("s", "be brief")
+    # 另开一个 store 直接读库：group 模式下返回即已提交
+    other = WriteBehindStore(str(tmp_path / "chat.db"))
+    try:
+        assert _contents(other, "s") == ["hi"]
+        assert other.get_system_prompt("s") == "be brief"
+    finally:
+        other.close()
+
+
+def test_async_mode_reads_its_own_writes(tmp_path):
+    s = WriteBehindStore(str(tmp_path / "chat.db"), durability="async", flush_interval_ms=50)
+    try:
+        s.append_message("s", "user", "one")
+        s.append_message("s", "assistant", "two")
+        assert _contents(s, "s") == ["one", "two"]
+        assert [m.seq for m in s.get_recent_messages("s", 10, with_seq=True)] == [1, 2]
+        assert s.flush(timeout=5)
+        assert _contents(s, "s") == ["one", "two"]
+    finally:
+        s.close()
+
+
+def test_atomic_groups_writes_into_one_unit(store):
+    with store.atomic():
+        store.append_message("s", "user", "q")
+        store.append_message("s", "assistant", "a")
+    assert _contents(store, "s") == ["q", "a"]
+
+
+def test_busy_commit_is_rolled_back_and_retried(store):
+    store.append_message("s", "user", "one")
+    store.flaky.fail = 1
+    store.append_message("s", "user", "two")
+    assert not store.flaky.conn.in_transaction
+    assert _contents(store, "s") == ["one", "two"]
+
+
+def test_failed_batch_raises_and_later_writes_still_commit(store):
+    store.append_message("s", "user", "one")
+    store.flaky.fail = 10
+    with pytest.raises(sqlite3.OperationalError):
+        store.append_message("s", "user", "lost")
+    # 失败的批次已回滚：写线程的连接不会卡在打开的事务里
+    assert not store.flaky.conn.in_transaction
+    store.flaky.fail = 0
+    store.append_message("s", "user", "three")
+    assert _contents(store, "s") == ["one", "three"]
+
+
+def test_rejects_unknown_durability(tmp_path):
+    with pytest.raises(ValueError):
+        WriteBehindStore(str(tmp_path / "chat.db"), durability="eventually")
+
+
+_BAD_SQL = "INSERT INTO no_such_table VALUES (?)"
+
+
+def test_bad_unit_does_not_take_down_its_batch(tmp_path):
+    s = WriteBehindStore(str(tmp_path / "chat.db"), durability="async", flush_interval_ms=50)
+    try:
+        s.append_message("a", "user", "before")
+        s._submit([_Op(_BAD_SQL, (1,))])
+        s.append_message("b", "user", "after")
+        assert s.flush(timeout=5)
+        assert _contents(s, "a") == ["before"]
+        assert _contents(s, "b") == ["after"]
+    finally:
+        s.close()
+
+
+def test_bad_unit_fails_only_its_own_caller(store):
+    with pytest.raises(sqlite3.OperationalError):
+        store._submit([_Op(_BAD_SQL, (1,))])
+    store.append_message("s", "user", "fine")
+    assert _contents(store, "s") == ["fine"]
+
+
+def test_callback_error_does_not_kill_writer(store):
+    def boom():
+        raise ValueError("callback")
+
+    store._submit([_Op("INSERT INTO sessions (id) VALUES (?)", ("cb",), boom)])
+    store.append_message("s", "user", "still writing")
+    assert store._writer.is_alive()
+    assert _contents(store, "s") == ["still writing"]
+
+
+def test_submit_after_close_raises(tmp_path):
+    s = WriteBehindStore(str(tmp_path / "chat.db"))
+    s.close()
+    with pytest.raises(RuntimeError, match="store_closed"):
+        s.append_message("s", "user", "late")
+    assert s not in write_behind._LIVE_STORES
+
+
+def test_close_racing_writers_never_hangs(tmp_path):
+    s = WriteBehindStore(str(tmp_path / "chat.db"))
+    outcomes = []
+
+    def writer(i):
+        for n in range(50):
+            try:
+                s.append_message(f"s{i}", "user", str(n))
+            except RuntimeError as e:
+                outcomes.append(str(e))
+                return
+        outcomes.append("ok")
+
+    threads = [threading.Thread(target=writer, args=(i,), daemon=True) for i in range(8)]
+    for t in threads:
+        t.start()
+    s.close()
+    for t in threads:
+        t.join(5)
+        assert not t.is_alive()
+    assert set(outcomes) <= {"ok", "store_closed"} and len(outcomes) == 8
+
+
+def test_dead_writer_releases_waiters(store):
+    def die(units):
+        raise SystemExit()
+
+    store._commit = die
+    with pytest.raises(RuntimeError, match="store_writer_dead"):
+        store.append_message("s", "user", "lost")
+    store._writer.join(5)
+    with pytest.raises(RuntimeError, match="store_writer_dead"):
+        store.append_message("s", "user", "later")
+    assert store.flush(timeout=1)